@@ -0,0 +1,156 @@
+"""
+Integer semantics for the Mallard interpreter.
+
+Python ints never overflow, but Duck Machine registers hold
+32-bit two's complement values.  A program whose values grow
+past 2^31 prints different results in the interpreter and on
+the DM2019W.  The interpreter therefore delegates arithmetic to
+an Arithmetic object (expr.ARITH), which can be
+
+   BigInt()           Python's unbounded ints (the original
+                      interpreter behavior; dividing by zero
+                      raises ZeroDivisionError)
+   Int32()            DM2019W arithmetic:  results wrap around
+                      to 32 bits, and an overflow or a division
+                      by zero sets the V (overflow) flag, like
+                      CondFlag.V in the condition code.  Division
+                      by zero produces 0.
+   Int32(trap=True)   as Int32, but raises ArithmeticOverflow
+                      whenever the V flag would be set
+
+Comparisons follow the machine too:  the DM2019W compares by
+subtracting (SUB r0,left,right) and testing the condition code.
+A subtraction that overflows sets only V, so none of M, Z and P
+holds, and neither does any relation:  in Int32 mode such a
+comparison is false, whichever it is, as in the compiled code
+(which tests V with the conditions for false).
+"""
+
+from typing import Callable, Tuple
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+WORD_BITS = 32
+WORD_MIN = -(1 << (WORD_BITS - 1))
+WORD_MAX = (1 << (WORD_BITS - 1)) - 1
+
+
+class ArithmeticOverflow(Exception):
+    """Raised in trapping mode when an operation would
+    set the V flag.
+    """
+    pass
+
+
+def wrap(value: int) -> int:
+    """Two's complement value of the low 32 bits of value"""
+    return ((value - WORD_MIN) & ((1 << WORD_BITS) - 1)) + WORD_MIN
+
+
+class Unordered(object):
+    """The outcome of a comparison that overflows:  no relation
+    holds between it and anything.
+    """
+
+    def __eq__(self, other) -> bool:
+        return False
+
+    __ne__ = __lt__ = __le__ = __gt__ = __ge__ = __eq__
+    __hash__ = object.__hash__
+
+    def __repr__(self) -> str:
+        return "UNORDERED"
+
+
+UNORDERED = Unordered()
+
+
+class BigInt(object):
+    """Unbounded Python ints.  Every operation is exact, so
+    the V flag is never set.
+    """
+
+    name = "bigint"
+
+    def __init__(self):
+        # V flag of the most recent operation, and how
+        # many operations have set it
+        self.v = False
+        self.overflows = 0
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}()"
+
+    def fit(self, value: int) -> int:
+        """A value as it would be held in a register"""
+        return value
+
+    def binop(self, apply: Callable[[int, int], int], left: int, right: int) -> int:
+        return apply(left, right)
+
+    def unop(self, apply: Callable[[int], int], value: int) -> int:
+        return apply(value)
+
+    def relation(self, left: int, right: int) -> Tuple[int, int]:
+        """Operands for a relational operator.  Comparing
+        the returned pair gives the same answer as the machine
+        gives for left and right.
+        """
+        return left, right
+
+
+class Int32(BigInt):
+    """32-bit two's complement, as on the DM2019W"""
+
+    name = "int32"
+
+    def __init__(self, trap: bool = False):
+        super().__init__()
+        self.trap = trap
+
+    def __repr__(self) -> str:
+        return f"Int32(trap={self.trap})"
+
+    def _set_v(self, why: str):
+        self.v = True
+        self.overflows += 1
+        if self.trap:
+            raise ArithmeticOverflow(why)
+
+    def fit(self, value: int) -> int:
+        """Wrap value to 32 bits, setting V if it changed"""
+        if WORD_MIN <= value <= WORD_MAX:
+            self.v = False
+            return value
+        self._set_v(f"{value} does not fit in {WORD_BITS} bits")
+        return wrap(value)
+
+    def binop(self, apply: Callable[[int, int], int], left: int, right: int) -> int:
+        try:
+            result = apply(left, right)
+        except ZeroDivisionError:
+            self._set_v(f"Division by zero: {left} / {right}")
+            return 0
+        return self.fit(result)
+
+    def unop(self, apply: Callable[[int], int], value: int) -> int:
+        return self.fit(apply(value))
+
+    def relation(self, left: int, right: int) -> Tuple[int, int]:
+        difference = left - right
+        if WORD_MIN <= difference <= WORD_MAX:
+            self.v = False
+            return difference, 0
+        self._set_v(f"{left} - {right} does not fit in {WORD_BITS} bits")
+        return UNORDERED, 0
+
+
+# Names for the command line
+SEMANTICS = {
+    "bigint": BigInt,
+    "int32": Int32,
+    "int32-trap": lambda: Int32(trap=True)
+}
@@ -60,14 +60,16 @@ a DM2018S instruction.
 
 John Kavel 2.28.2020
 """
-from instr_format import CondFlag
+from instr_format import CondFlag, offset_field
 import argparse
 
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 from enum import Enum, auto
 
 import sys
 import re
+import copy
+from types import SimpleNamespace
 
 import logging
 logging.basicConfig()
@@ -77,10 +79,23 @@ log.setLevel(logging.INFO)
 # Configuration constants
 ERROR_LIMIT = 5    # Abandon assembly if we exceed this
 
+# The offset field holds a signed displacement
+OFFSET_BITS = offset_field.to_bit - offset_field.from_bit + 1
+OFFSET_MIN = -(1 << (OFFSET_BITS - 1))
+OFFSET_MAX = (1 << (OFFSET_BITS - 1)) - 1
+
+# Memory-mapped input and output; these absolute addresses
+# are never program locations
+IO_ADDRESSES = [510, 511]
+
 # Exceptions raised by this module
 class SyntaxError(Exception):
     pass
 
+class RangeError(Exception):
+    """A label is too far away to address"""
+    pass
+
 ###
 # The whole instruction line is encoded as a single
 # regex with capture names for the parts we might
@@ -277,7 +292,7 @@ def to_flag(m: str) -> CondFlag:
     like Z or NEVER or might be a combination
     like PZ.
     """
-    if m in [ flag.name for flag in CondFlag ]:
+    if m in CondFlag.__members__:
         return CondFlag[m]
     composite = CondFlag.NEVER
     for bitname in m:
@@ -307,6 +322,7 @@ def transform(lines: List[str]) -> List[str]:
     error_count = 0
     address = 0
     transformed = []
+    lines = relax_lines(lines)
     # a table with labels and corresponding address
     labels = resolve(lines)
     for lnum in range(len(lines)):
@@ -322,28 +338,29 @@ def transform(lines: List[str]) -> List[str]:
 
             elif fields["kind"] == AsmSrcKind.MEMOP:
                 # translate address in "labels" to relative PC address
+                # (or an absolute address, if that's the only reach)
                 ref = fields["labelref"]
-                pc_relative = labels[ref] - address
+                src1, src2, offset = address_fields(labels[ref], address)
                 # make appropriate changes to optional fields
                 fix_optional_fields(fields)
                 f = fields
                 # format string to be appended
                 full = (f"{f['label']}   {f['opcode']}{f['predicate']} " +
-                        f" {f['target']},r0,r15[{pc_relative}] #{ref} " +
+                        f" {f['target']},{src1},{src2}[{offset}] #{ref} " +
                         f" {f['comment']}")
                 transformed.append(full)
 
             elif fields["kind"] == AsmSrcKind.JUMP:
                 # same procedures as MEMOP
                 ref = fields["labelref"]
-                pc_relative = labels[ref] - address
+                src1, src2, offset = address_fields(labels[ref], address)
                 fix_optional_fields(fields)
                 f = fields
                 # similar to string format for MEMOP
                 # differences: target register always r15
                 # opcode always ADD
                 full = (f"{f['label']}   ADD{f['predicate']} " +
-                        f" r15,r0,r15[{pc_relative}] #{ref} " +
+                        f" r15,{src1},{src2}[{offset}] #{ref} " +
                         f" {f['comment']}")
                 transformed.append(full)
             else:
@@ -369,6 +386,21 @@ def transform(lines: List[str]) -> List[str]:
     return transformed
 
 
+def address_fields(target: int, address: int) -> Tuple[str, str, int]:
+    """Source registers and offset that reach address target
+    from the instruction at address.  PC-relative (r0,r15[d])
+    if the displacement fits in the offset field; otherwise
+    absolute (r0,r0[target]), which reaches the low addresses
+    from anywhere in the program.
+    """
+    pc_relative = target - address
+    if OFFSET_MIN <= pc_relative <= OFFSET_MAX:
+        return "r0", "r15", pc_relative
+    if 0 <= target <= OFFSET_MAX and target not in IO_ADDRESSES:
+        return "r0", "r0", target
+    raise RangeError(f"Address {target} is out of reach from address {address}")
+
+
 def fix_optional_fields(fields: Dict[str, str]):
     """Fill in values of optional fields label,
     predicate, and comment, adding the punctuation
@@ -422,6 +454,337 @@ def resolve(lines: List[str]) -> Dict[str, int]:
     return labels
 
 
+def resolve_records(records: list) -> Dict[str, int]:
+    """
+    Like resolve, for instruction records rather than text.
+    A record has the fields of the compiler's
+    codegen_context.Instr: label, opcode, predicate, target,
+    src1, src2, offset, ref, comment, and value (of DATA).
+    A record with no opcode is a label or comment only.
+    """
+    labels = {}
+    address = 0
+    for record in records:
+        if record.label is not None:
+            labels[record.label] = address
+        if record.opcode is not None:
+            address += 1
+    return labels
+
+
+def transform_records(records: list) -> list:
+    """
+    Like transform, for instruction records:  returns copies
+    of the records with every label reference replaced by a
+    PC-relative address, and JUMP replaced by ADD to r15.
+    No text is parsed.
+    """
+    error_count = 0
+    address = 0
+    transformed = []
+    records = relax_records(records)
+    labels = resolve_records(records)
+    for record in records:
+        resolved = copy.copy(record)
+        try:
+            if record.opcode is None:
+                pass
+            elif record.ref is not None:
+                src1, src2, offset = address_fields(labels[record.ref], address)
+                if record.opcode == "JUMP":
+                    resolved.opcode = "ADD"
+                    resolved.target = "r15"
+                resolved.src1, resolved.src2 = src1, src2
+                resolved.offset = offset
+                resolved.ref = None
+                resolved.comment = f"#{record.ref}  {record.comment or ''}".rstrip()
+            elif getattr(record, "text", None) is not None:
+                raise SyntaxError(f"Assembler syntax error in {record.text}")
+        except SyntaxError as e:
+            error_count += 1
+            print(e, file=sys.stderr)
+        except KeyError as e:
+            error_count += 1
+            print("Unknown word at address {}: {}".format(address, e), file=sys.stderr)
+        except RangeError as e:
+            error_count += 1
+            print(e, file=sys.stderr)
+        if error_count > ERROR_LIMIT:
+            print("Too many errors; abandoning", file=sys.stderr)
+            sys.exit(1)
+        transformed.append(resolved)
+        if record.opcode is not None:
+            address += 1
+    return transformed
+
+
+###
+# Branch relaxation
+#
+# A JUMP is normally a single ADD to r15 with a PC-relative (or,
+# to a low address, absolute) offset.  A jump farther than the
+# offset field reaches is replaced by a long jump that loads the
+# target address into r15 from a word right beside it:
+#
+#         LOAD    r15,far_jump_1     # was JUMP  there
+#  far_jump_1:  DATA  <address of there>
+#
+# A predicated jump may not be taken, and then nothing else may
+# run before the next instruction:  everything sets the condition
+# code, which that instruction may test again (JUMP/P a; JUMP/M b).
+# So its word goes in a pool out of the way, right after the
+# nearest word in reach that control can't fall past (a HALT or
+# an unconditional jump):
+#
+#         LOAD/P  r15,far_jump_2     # was JUMP/P  there
+#         ...
+#         HALT    r0,r0,r0
+#  far_jump_2:  DATA  <address of there>
+#
+# Each long jump or pooled word moves everything after it, which
+# can push other jumps, or pooled words, out of reach, so we
+# repeat until everything is in reach.  A jump with no pool in
+# reach is left for transform_records to report.  Short jumps
+# stay single instructions.
+#
+# No word may land on the input/output addresses:  a program
+# that would reach them jumps over them, from the last word
+# before them that can follow a jump (see skip_io).  The words
+# in between just fill the space.
+###
+
+RECORD_FIELDS = ["label", "opcode", "predicate", "target", "src1", "src2",
+                 "offset", "ref", "comment", "value", "text"]
+
+
+def new_record(template, **fields):
+    """A record of the same kind as template, with the given fields"""
+    record = copy.copy(template)
+    for name in RECORD_FIELDS:
+        setattr(record, name, None)
+    record.offset = 0
+    for name, value in fields.items():
+        setattr(record, name, value)
+    return record
+
+
+def in_reach(target: int, address: int) -> bool:
+    try:
+        address_fields(target, address)
+        return True
+    except RangeError:
+        return False
+
+
+# Where code resumes past the input/output addresses
+PAST_IO = "past_io"
+
+
+def skip_io(records: list) -> list:
+    """records with a JUMP over IO_ADDRESSES, if the program
+    would reach them.  The JUMP sets the condition code, so the
+    word after it can't be predicated; it goes in before the
+    last word that isn't.
+    """
+    words = [i for i, record in enumerate(records) if record.opcode is not None]
+    if len(words) <= min(IO_ADDRESSES):
+        return records
+    at = min(IO_ADDRESSES) - 1
+    while at > 0 and records[words[at]].predicate not in (None, "ALWAYS"):
+        at -= 1
+    # Labels of that word move with it
+    insert = words[at - 1] + 1 if at > 0 else 0
+    template = records[words[at]]
+    hole = [new_record(template, opcode="JUMP", ref=PAST_IO, comment="# over input/output")]
+    hole += [new_record(template, opcode="DATA", value=0) for _ in range(at + 1, max(IO_ADDRESSES) + 1)]
+    hole.append(new_record(template, label=PAST_IO))
+    return records[:insert] + hole + records[insert:]
+
+
+def unconditional(record) -> bool:
+    return record.predicate is None or record.predicate == "ALWAYS"
+
+
+def falls_through(record) -> bool:
+    """Whether control can go on from record to the next word"""
+    if not unconditional(record):
+        return True
+    return record.opcode != "HALT" and record.opcode != "JUMP" and record.target != "r15"
+
+
+def pool(records: list, load, data, fresh_label) -> Optional[list]:
+    """records with data, the address word of the predicated long
+    jump load, in the nearest pool in reach.  Failing that, a pool
+    is made before an unpredicated instruction (which doesn't test
+    the condition code the JUMP around the pool sets).  None if
+    the word can't be reached from anywhere.
+    """
+    laid_out = skip_io(records)
+    addresses = {}
+    address = 0
+    for record in laid_out:
+        if record.opcode is not None:
+            addresses[id(record)] = address
+            address += 1
+    at = addresses[id(load)]
+    best = None
+    previous = -1
+    for i, record in enumerate(records):
+        if record.opcode is None or id(record) not in addresses:
+            continue
+        word = addresses[id(record)] + 1
+        if not falls_through(record):
+            cost, where = 0, i + 1
+        elif unconditional(record) and record.opcode != "DATA":
+            cost, where = 1, previous + 1
+        else:
+            cost = None
+        previous = i
+        # A word before the load moves it down
+        if cost is None or not in_reach(word, at if word > at else at + 1 + cost):
+            continue
+        if best is None or (cost, abs(word - at)) < best[0]:
+            best = ((cost, abs(word - at)), where)
+    if best is None:
+        return None
+    (cost, _), where = best
+    if cost == 0:
+        return records[:where] + [data] + records[where:]
+    past = fresh_label()
+    island = [new_record(data, opcode="JUMP", ref=past, comment="# around far jump words"),
+              data, new_record(data, label=past)]
+    return records[:where] + island + records[where:]
+
+
+def relax_records(records: list) -> list:
+    """Replace jumps that can't reach their targets by long
+    jumps, and keep words off the input/output addresses (see
+    above).  Returns a new list if anything changed.
+    """
+    address_words = {}
+    pooled = {}
+    stuck = set()
+    count = 0
+    relaxed = False
+    while True:
+        laid_out = skip_io(records)
+        labels = resolve_records(laid_out)
+        address = 0
+        far = None
+        for record in laid_out:
+            if id(record) not in stuck and (
+                    (record.opcode == "JUMP" and record.ref in labels
+                     and not in_reach(labels[record.ref], address))
+                    or (id(record) in pooled and not in_reach(labels[record.ref], address))):
+                far = record
+                break
+            if record.opcode is not None:
+                address += 1
+        if far is None:
+            break
+
+        def fresh_label() -> str:
+            nonlocal count
+            count += 1
+            while f"far_jump_{count}" in labels:
+                count += 1
+            return f"far_jump_{count}"
+
+        if id(far) in pooled:
+            # Its word has drifted out of reach; pool it again
+            data = pooled[id(far)]
+            moved = pool([r for r in records if r is not data], far, data, fresh_label)
+            if moved is None:
+                stuck.add(id(far))
+            else:
+                records = moved
+            continue
+        jump = far
+        index = next(i for i, r in enumerate(records) if r is jump)
+
+        word = fresh_label()
+        load = new_record(jump, label=jump.label, opcode="LOAD", predicate=jump.predicate,
+                          target="r15", ref=word, comment=f"# far jump to {jump.ref}")
+        data = new_record(jump, label=word, opcode="DATA", value=0)
+        if unconditional(jump):
+            records = records[:index] + [load, data] + records[index + 1:]
+        else:
+            pooled_records = pool(records[:index] + [load] + records[index + 1:],
+                                  load, data, fresh_label)
+            if pooled_records is None:
+                log.debug(f"No pool in reach for the jump to {jump.ref} at address {address}")
+                stuck.add(id(jump))
+                continue
+            records = pooled_records
+            pooled[id(load)] = data
+        address_words[word] = jump.ref
+        log.debug(f"Relaxing jump to {jump.ref} at address {address}")
+        relaxed = True
+    if relaxed:
+        for record in laid_out:
+            if record.label in address_words:
+                record.value = labels[address_words[record.label]]
+    return laid_out
+
+
+def record_from_fields(fields: dict, line: str):
+    """A record (as in resolve_records) for a parsed line of text"""
+    kind = fields["kind"]
+    record = SimpleNamespace(**{name: None for name in RECORD_FIELDS})
+    record.offset = 0
+    record.text = line
+    record.label = fields["label"]
+    record.comment = fields["comment"]
+    if kind == AsmSrcKind.COMMENT:
+        return record
+    record.opcode = fields["opcode"]
+    if kind == AsmSrcKind.DATA:
+        record.value = fields["value"]
+        return record
+    record.predicate = fields["predicate"]
+    if kind == AsmSrcKind.FULL:
+        record.target, record.src1, record.src2 = fields["target"], fields["src1"], fields["src2"]
+        record.offset = int(fields["offset"] or 0)
+    else:
+        record.target = fields.get("target")
+        record.ref = fields["labelref"]
+    return record
+
+
+def render_record(record) -> str:
+    """Text of a record made by relax_records"""
+    if record.text is not None:
+        return record.text
+    label = f"{record.label}:" if record.label else ""
+    comment = f"  {record.comment}" if record.comment else ""
+    if record.opcode is None:
+        return f"{label}{comment}"
+    if record.opcode == "DATA":
+        return f"{label}  DATA {record.value}{comment}"
+    pred = f"/{record.predicate}" if record.predicate else ""
+    operands = f"{record.target},{record.ref}" if record.target else record.ref
+    return f"{label}   {record.opcode}{pred}  {operands}{comment}"
+
+
+def relax_lines(lines: List[str]) -> List[str]:
+    """relax_records for lines of text.  Lines are returned
+    unchanged unless some jump needed relaxing.
+    """
+    records = []
+    for line in lines:
+        line = line.rstrip()
+        try:
+            records.append(record_from_fields(parse_line(line), line))
+        except SyntaxError:
+            # Reported by transform; takes no space
+            records.append(SimpleNamespace(**{name: None for name in RECORD_FIELDS}))
+            records[-1].text = line
+    relaxed = relax_records(records)
+    if len(relaxed) == len(records):
+        return lines
+    return [render_record(record) for record in relaxed]
+
+
 def cli() -> object:
     """Get arguments from command line"""
     parser = argparse.ArgumentParser(description="Duck Machine Assembler (phase 1)")
@@ -63,6 +63,11 @@ log.setLevel(logging.INFO)
 # Configuration constants
 ERROR_LIMIT = 5    # Abandon assembly if we exceed this
 
+# What a DATA word and an offset field can hold (32 and 10 bits,
+# two's complement)
+WORD_MIN, WORD_MAX = -(1 << 31), (1 << 31) - 1
+OFFSET_MIN, OFFSET_MAX = -(1 << 9), (1 << 9) - 1
+
 # Exceptions raised by this module
 class SyntaxError(Exception):
     pass
@@ -218,13 +223,27 @@ def value_parse(int_literal: str) -> int:
         return int(int_literal, 10)
 
 
+def check_word(value: int) -> int:
+    """value, if it fits in a memory word"""
+    if not WORD_MIN <= value <= WORD_MAX:
+        raise SyntaxError(f"DATA value {value} does not fit in a word")
+    return value
+
+
+def check_offset(offset: int) -> int:
+    """offset, if it fits in the offset field"""
+    if not OFFSET_MIN <= offset <= OFFSET_MAX:
+        raise SyntaxError(f"Offset {offset} does not fit in the offset field")
+    return offset
+
+
 def to_flag(m: str) -> CondFlag:
     """Making a conditon code from a mnemonic
     that might be one of the existing codes
     like Z or NEVER or might be a combination
     like PZ.
     """
-    if m in [ flag.name for flag in CondFlag ]:
+    if m in CondFlag.__members__:
         return CondFlag[m]
     composite = CondFlag.NEVER
     for bitname in m:
@@ -242,7 +261,7 @@ def instruction_from_dict(d: dict) -> Instruction:
     target = NAMED_REGS[d["target"]]
     src1 = NAMED_REGS[d["src1"]]
     src2 = NAMED_REGS[d["src2"]]
-    offset = int(d["offset"])
+    offset = check_offset(int(d["offset"]))
     return Instruction(opcode, pred, target, src1, src2, offset)
 
 
@@ -273,7 +292,7 @@ def assemble(lines: List[str]) -> List[int]:
                 word = instr.encode()
                 instructions.append(word)
             elif fields["kind"] == AsmSrcKind.DATA:
-                word = value_parse(fields["value"])
+                word = check_word(value_parse(fields["value"]))
                 instructions.append(word)
             else:
                 log.debug("No instruction on line")
@@ -291,6 +310,50 @@ def assemble(lines: List[str]) -> List[int]:
             sys.exit(1)
     return instructions
 
+def instruction_from_record(record) -> Instruction:
+    """Like instruction_from_dict, for a fully resolved
+    instruction record (see assembler_phase1.transform_records).
+    """
+    if record.ref is not None:
+        raise SyntaxError(f"Unresolved label {record.ref}")
+    opcode = OpCode[record.opcode]
+    pred = to_flag(record.predicate or "ALWAYS")
+    target = NAMED_REGS[record.target]
+    src1 = NAMED_REGS[record.src1]
+    src2 = NAMED_REGS[record.src2]
+    return Instruction(opcode, pred, target, src1, src2, check_offset(record.offset))
+
+
+def assemble_records(records: list) -> List[int]:
+    """
+    Like assemble, for fully resolved instruction records
+    rather than text.  Records without an opcode (labels,
+    comments) are skipped.  Raises SyntaxError if any record
+    can't be encoded, rather than return words missing one.
+    """
+    error_count = 0
+    instructions = [ ]
+    for record in records:
+        try:
+            if record.opcode is None:
+                continue
+            if record.opcode == "DATA":
+                instructions.append(check_word(record.value))
+            else:
+                instructions.append(instruction_from_record(record).encode())
+        except SyntaxError as e:
+            error_count += 1
+            print("Syntax error at address {}: {}".format(len(instructions), e), file=sys.stderr)
+        except KeyError as e:
+            error_count += 1
+            print("Unknown word at address {}: {}".format(len(instructions), e), file=sys.stderr)
+        if error_count > ERROR_LIMIT:
+            print("Too many errors; abandoning", file=sys.stderr)
+            sys.exit(1)
+    if error_count:
+        raise SyntaxError(f"{error_count} records could not be assembled")
+    return instructions
+
 def cli() -> object:
     """Get arguments from command line"""
     parser = argparse.ArgumentParser(description="Duck Machine Assembler (pass 2)")
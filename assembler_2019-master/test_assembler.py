@@ -1,8 +1,14 @@
 """Unit tests for assembler phase 1"""
 
+import os
+import sys
 import unittest
+from types import SimpleNamespace
 from assembler_phase1 import *
 
+# The machine, to run what we assemble
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 #
 class TestResolve(unittest.TestCase):
 
@@ -167,5 +173,176 @@ class TestTransformation(unittest.TestCase):
             self.assertEqual(squish(transformed[i]), squish(expected[i]))
 
 
+class TestAddressing(unittest.TestCase):
+
+    def test_near_is_pc_relative(self):
+        self.assertEqual(address_fields(700, 600), ("r0", "r15", 100))
+        self.assertEqual(address_fields(100, 611), ("r0", "r15", -511))
+
+    def test_far_is_absolute(self):
+        self.assertEqual(address_fields(5, 900), ("r0", "r0", 5))
+
+    def test_out_of_reach(self):
+        with self.assertRaises(RangeError):
+            address_fields(1500, 900 - 600)
+        with self.assertRaises(RangeError):
+            address_fields(510, 1500)
+
+
+class TestRelaxation(unittest.TestCase):
+
+    def far_program(self, predicate: str = "") -> list:
+        return (["   ADD r1,r0,r0[600]", f"   JUMP{predicate}  far"] +
+                ["   SUB r1,r1,r0[1]"] * 600 +
+                ["far:  HALT r0,r0,r0"])
+
+    def test_short_jumps_unchanged(self):
+        lines = ["   JUMP/P  near", "   SUB r1,r1,r0[1]", "near:  HALT r0,r0,r0"]
+        self.assertEqual(relax_lines(lines), lines)
+
+    def test_unconditional(self):
+        relaxed = relax_lines(self.far_program())
+        # and 4 lines to skip 510 and 511
+        self.assertEqual(len(relaxed), 600 + 4 + 4)
+        self.assertEqual(squish(relaxed[1]), "LOAD r15,far_jump_1 # far jump to far")
+        self.assertEqual(squish(relaxed[2]), "far_jump_1: DATA 606")
+        self.assertEqual(resolve(relaxed)["far"], 606)
+
+    def test_predicated(self):
+        """The address word is out of the way, so nothing runs when
+        the jump isn't taken
+        """
+        relaxed = relax_lines(self.far_program("/Z"))
+        self.assertEqual([squish(line) for line in relaxed[:6]],
+                         ["JUMP far_jump_2 # around far jump words",
+                          "far_jump_1: DATA 607",
+                          "far_jump_2:",
+                          "ADD r1,r0,r0[600]",
+                          "LOAD/Z r15,far_jump_1 # far jump to far",
+                          "SUB r1,r1,r0[1]"])
+        transformed = transform(relaxed)
+        self.assertEqual(squish(transformed[4]).split("#")[0].strip(), "LOAD/Z r15,r0,r15[-2]")
+        self.assertEqual(resolve(relaxed)["far"], 607)
+
+    def test_pooled_after_halt(self):
+        """A HALT in reach makes room for the word for free"""
+        lines = (["   JUMP/P  far", "   HALT r0,r0,r0"] + ["   SUB r1,r1,r0[1]"] * 600 +
+                 ["far:  HALT r0,r0,r0"])
+        relaxed = relax_lines(lines)
+        self.assertEqual([squish(line) for line in relaxed[:3]],
+                         ["LOAD/P r15,far_jump_1 # far jump to far", "HALT r0,r0,r0",
+                          "far_jump_1: DATA 606"])
+
+    def test_skip_io(self):
+        """Nothing runs at 510 and 511, and a predicated word
+        stays right after the comparison it tests
+        """
+        lines = (["   ADD r1,r1,r0[1]"] * 508 +
+                 ["   SUB r0,r1,r0[1000]", "   ADD/Z r1,r0,r0[2]", "again:  STORE r1,r0,r0[511]"])
+        relaxed = relax_lines(lines)
+        self.assertEqual([squish(line) for line in relaxed[508:514]],
+                         ["JUMP past_io # over input/output", "DATA 0", "DATA 0", "DATA 0",
+                          "past_io:", "SUB r0,r1,r0[1000]"])
+        self.assertEqual(resolve(relaxed)["again"], 514)
+        self.assertEqual(relax_lines(lines[:510]), lines[:510])
+
+    def test_back_to_low_address_is_absolute(self):
+        lines = (["top: SUB r1,r1,r0[1]"] + ["   ADD r2,r2,r0[1]"] * 600 + ["   JUMP top"])
+        transformed = transform(lines)
+        self.assertEqual(len(transformed), len(lines) + 4)
+        self.assertEqual(squish(transformed[-1]), "ADD r15,r0,r0[0] #top")
+
+    def cascade(self, filler: int) -> list:
+        """Branches three ways on the sign of the input"""
+        return (["   LOAD r1,r0,r0[510]"] + ["   ADD r2,r2,r0[1]"] * 518 +
+                ["   SUB r0,r1,r0[0]", "   JUMP/P  first_target", "   JUMP/M  second_target",
+                 "   JUMP  zero_target"] +
+                ["   ADD r2,r2,r0[1]"] * filler +
+                ["first_target:  ADD r3,r3,r0[1]", "   ADD r3,r3,r0[2]",
+                 "second_target:  STORE r3,r0,r0[511]", "   HALT r0,r0,r0",
+                 "zero_target:  ADD r3,r0,r0[10]", "   JUMP first_target"])
+
+    def test_cascade(self):
+        """Relaxing one jump can push another out of reach"""
+        import machine
+        from assembler_phase2 import assemble
+        lines = self.cascade(508)
+        # JUMP/P just reaches first_target, until JUMP/M is relaxed
+        # (510 and 511 are skipped before either)
+        self.assertEqual(resolve(lines)["first_target"] - 520, OFFSET_MAX)
+        records = relax_records([record_from_fields(parse_line(line), line) for line in lines])
+        labels = resolve_records(records)
+        address = 0
+        for r in records:
+            if r.opcode == "JUMP" or (r.opcode == "LOAD" and r.target == "r15"):
+                self.assertTrue(in_reach(labels[r.ref], address))
+            if r.opcode is not None:
+                address += 1
+        self.assertEqual([r.predicate for r in records if r.opcode == "LOAD" and r.target == "r15"],
+                         ["P", "M", None])
+        # Each way goes where it did before relaxation
+        relaxed, short = assemble(transform(lines)), assemble(transform(self.cascade(3)))
+        for x in [5, 0, -5]:
+            self.assertEqual(machine.run(relaxed, [x]).outputs, machine.run(short, [x]).outputs)
+        self.assertEqual([machine.run(relaxed, [x]).outputs for x in [5, 0, -5]], [[3], [13], [0]])
+
+
+def record(opcode=None, target=None, src1=None, src2=None, offset=0,
+           ref=None, predicate=None, label=None, comment=None, value=None):
+    """A stand-in for the compiler's instruction records"""
+    return SimpleNamespace(opcode=opcode, target=target, src1=src1, src2=src2,
+                           offset=offset, ref=ref, predicate=predicate,
+                           label=label, comment=comment, value=value)
+
+
+class TestRecords(unittest.TestCase):
+
+    def test_transform_records(self):
+        """The same loop as test_jump_around, as records"""
+        records = [record("LOAD", "r1", ref="x", label="begin"),
+                   record("SUB", "r1", "r1", "r0", 1, label="loop"),
+                   record("JUMP", ref="endloop", predicate="Z"),
+                   record("STORE", "r1", "r0", "r0", 511, comment="# print it"),
+                   record("JUMP", ref="loop"),
+                   record(label="endloop"),
+                   record("HALT", "r0", "r0", "r0"),
+                   record("DATA", value=42, label="x")]
+        transformed = transform_records(records)
+        self.assertEqual(records[0].ref, "x")
+        load, jump = transformed[0], transformed[2]
+        self.assertEqual((load.src1, load.src2, load.offset, load.ref), ("r0", "r15", 6, None))
+        self.assertEqual((jump.opcode, jump.target, jump.offset), ("ADD", "r15", 3))
+        self.assertEqual(transformed[4].offset, -3)
+
+    def test_assemble_records(self):
+        from assembler_phase2 import assemble, assemble_records
+        lines = """
+                  LOAD  r1,x
+           loop:  SUB r1,r1,r0[1]
+                  JUMP/PM loop
+                  HALT  r0,r0,r0
+           x:     DATA 42
+           """.split("\n")
+        records = [record("LOAD", "r1", ref="x"),
+                   record("SUB", "r1", "r1", "r0", 1, label="loop"),
+                   record("JUMP", ref="loop", predicate="PM"),
+                   record("HALT", "r0", "r0", "r0"),
+                   record("DATA", value=42, label="x")]
+        self.assertEqual(assemble_records(transform_records(records)),
+                         assemble(transform(lines)))
+
+    def test_out_of_range(self):
+        """Values that don't fit are errors, not silently wrong words"""
+        import assembler_phase2
+        for bad in [record("DATA", value=1562500000000, label="x"),
+                    record("DATA", value=-(1 << 31) - 1, label="x"),
+                    record("ADD", "r1", "r0", "r0", 512)]:
+            with self.assertRaises(assembler_phase2.SyntaxError, msg=str(bad)):
+                assembler_phase2.assemble_records([record("HALT", "r0", "r0", "r0"), bad])
+        words = assembler_phase2.assemble_records([record("DATA", value=(1 << 31) - 1),
+                                                   record("ADD", "r1", "r0", "r0", -512)])
+        self.assertEqual(words[0], (1 << 31) - 1)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,159 @@
+"""
+Build a Mallard program all the way to Duck Machine object code,
+in one process.
+
+The classic route writes assembly code to a file, then runs
+assembler_phase1.py and assembler_phase2.py over text files,
+each re-parsing the text of the last.  Here the instruction
+records built by the code generator go straight through label
+resolution (assembler_phase1.transform_records) and encoding
+(assembler_phase2.assemble_records, Instruction.encode) to the
+object file, one word per line as assembler_phase2 writes it.
+
+    python3 build.py prog.mal               writes prog.obj
+    python3 build.py prog.mal --asm --dasm  also prog.asm, prog.dasm
+    python3 build.py prog.mal --timings     time each stage
+    python3 build.py -O --profile prog.prof prog.mal
+                                            optimize for a profile (see pgo.py)
+"""
+
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, "compiler_2019-master"))
+sys.path.append(os.path.join(HERE, "assembler_2019-master"))
+
+from llparse import parse
+import assembler_phase1
+import assembler_phase2
+import codegen_context
+import compile
+import peephole
+import pgo
+
+import argparse
+import time
+from contextlib import contextmanager
+from typing import List
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class Stages(object):
+    """Wall clock time spent in each stage of the build"""
+
+    def __init__(self):
+        self.seconds = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+
+    def report(self) -> List[str]:
+        lines = [f"{name:10} {1000 * secs:8.2f} ms" for name, secs in self.seconds.items()]
+        lines.append(f"{'total':10} {1000 * sum(self.seconds.values()):8.2f} ms")
+        return lines
+
+
+class Build(object):
+    """The products of building one program"""
+
+    def __init__(self):
+        self.context = None
+        self.optimizer = None
+        # Records with labels resolved, and object code words
+        self.resolved = []
+        self.words = []
+        self.stages = Stages()
+
+    def asm_lines(self) -> List[str]:
+        return self.context.get_lines()
+
+    def dasm_lines(self) -> List[str]:
+        return [record.render() for record in self.resolved]
+
+
+def build(sourcefile, optimize: bool = False, profile: "pgo.Profile" = None,
+          rules: List[peephole.Rule] = None) -> Build:
+    """Compile, assemble, and encode a Mallard program,
+    given as an open file, optimizing (with -O) for the
+    profile if there is one, with the peephole rules given
+    (by default peephole.RULES).
+    """
+    result = Build()
+    stages = result.stages
+    context = codegen_context.Context()
+    result.context = context
+    compile.header(context, getattr(sourcefile, "name", "<program>"))
+    with stages.stage("parse"):
+        exp = parse(sourcefile)
+        context.sites = pgo.annotate(exp, profile, context.pgo_stats)
+    with stages.stage("codegen"):
+        compile.generate(exp, context, optimize)
+    if optimize:
+        with stages.stage("peephole"):
+            context.instrs, result.optimizer = peephole.optimize(context.instrs, rules)
+    with stages.stage("resolve"):
+        result.resolved = assembler_phase1.transform_records(context.get_instrs())
+    with stages.stage("encode"):
+        result.words = assembler_phase2.assemble_records(result.resolved)
+    return result
+
+
+def write_lines(path: str, lines: List) -> None:
+    with open(path, "w") as f:
+        for line in lines:
+            print(line, file=f)
+
+
+def cli() -> object:
+    """Get arguments from command line"""
+    parser = argparse.ArgumentParser(description="Mallard to Duck Machine object code")
+    parser.add_argument("sourcefile", type=argparse.FileType('r'),
+                        help="Source program text")
+    parser.add_argument("objfile", nargs="?", default=None,
+                        help="Object code file (default: source name with .obj)")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="Keep variables in registers and apply peephole rules")
+    parser.add_argument("--profile", type=argparse.FileType('r'),
+                        help="Optimize for this profile of the program (see pgo.py)")
+    parser.add_argument("--rules", type=argparse.FileType('r'),
+                        help="With -O, also apply the peephole rules in this table (written by superopt.py)")
+    parser.add_argument("--asm", action="store_true",
+                        help="Also write the assembly code (.asm)")
+    parser.add_argument("--dasm", action="store_true",
+                        help="Also write the resolved assembly code (.dasm)")
+    parser.add_argument("--timings", action="store_true",
+                        help="Report the time taken by each stage")
+    return parser.parse_args()
+
+
+def main():
+    args = cli()
+    objfile = args.objfile or os.path.splitext(args.sourcefile.name)[0] + ".obj"
+    stem = os.path.splitext(objfile)[0]
+    profile = pgo.Profile.read(args.profile) if args.profile else None
+    rules = peephole.RULES + peephole.load_rules(args.rules) if args.rules else None
+    result = build(args.sourcefile, args.optimize, profile, rules)
+    with result.stages.stage("write"):
+        write_lines(objfile, result.words)
+        if args.asm:
+            write_lines(stem + ".asm", result.asm_lines())
+        if args.dasm:
+            write_lines(stem + ".dasm", result.dasm_lines())
+    if args.timings:
+        for line in result.stages.report():
+            print(f"#{line}", file=sys.stderr)
+    log.info(f"{len(result.words)} words written to {objfile}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,569 @@
+"""
+Basic blocks, control flow graphs, and dataflow analysis.
+
+A control flow graph (CFG) can be built from either form of a
+program:
+
+ * from the AST (from_ast), where each block holds statements
+   (Assign, Print, ...), and a block that ends at the condition
+   of an If or While has that Comparison as its branch;
+ * from generated code (from_instrs), where each block holds
+   Instr records.  A block ends at a jump (a JUMP to a label,
+   or any instruction that writes r15, as resolved code has
+   ADD r15,r0,r15[d] and relaxed code LOAD r15,far_jump) or a
+   HALT, and a new one starts at each label.  A predicated
+   jump or HALT also falls through to the next block; other
+   predicated instructions don't end a block at all.
+
+Either way, every graph has an entry block with no code and an
+exit block where the program halts.
+
+Dataflow problems are solved by the worklist algorithm over
+bit vectors (Python ints, one bit per variable or register).
+Dominators are found by the iterative algorithm of Cooper,
+Harvey, and Kennedy, and loops are the natural loops of back
+edges, nested by containment.
+
+Analyses are cached per program (see Analyses).  A pass that
+changes the program must invalidate them:  Context counts its
+changes (Context.changed), so Context.analyses() notices new
+code by itself.  The passes that rewrite ASTs (sccp, scev,
+unroll, ranges, partial) build new nodes rather than change
+old ones, so the analyses of the old tree stay right; a pass
+that changed a tree in place would have to call invalidate().
+The analyses of an AST are kept on its root, and go with it.
+"""
+
+import expr
+from codegen_context import Instr
+
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Union
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+# Registers that never hold a value worth tracking
+FIXED_REGISTERS = {"r0", "r15"}
+
+
+class Block(object):
+    """A basic block:  code that runs straight through"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.code = []
+        # Successors and predecessors, in the order the edges
+        # were added (for a branch block, true before false)
+        self.succs = []
+        self.preds = []
+        # The Comparison ending a block of an AST CFG, if any
+        self.branch = None
+
+    def __repr__(self) -> str:
+        return f"Block({self.name})"
+
+
+class CFG(object):
+    """Blocks in layout order, with edges between them"""
+
+    def __init__(self):
+        self.entry = Block("entry")
+        self.exit = Block("exit")
+        self.blocks = [self.entry]
+
+    def new_block(self, name: str) -> Block:
+        block = Block(name)
+        self.blocks.append(block)
+        return block
+
+    def add_edge(self, source: Block, dest: Block):
+        if dest not in source.succs:
+            source.succs.append(dest)
+            dest.preds.append(source)
+
+    def finish(self) -> "CFG":
+        self.blocks.append(self.exit)
+        return self
+
+    def block(self, name: str) -> Block:
+        for block in self.blocks:
+            if block.name == name:
+                return block
+        raise KeyError(name)
+
+    def postorder(self) -> List[Block]:
+        """Blocks reachable from the entry, each after its successors
+        (except along back edges)
+        """
+        order, seen = [], {self.entry}
+        stack = [(self.entry, iter(self.entry.succs))]
+        while stack:
+            block, succs = stack[-1]
+            for succ in succs:
+                if succ not in seen:
+                    seen.add(succ)
+                    stack.append((succ, iter(succ.succs)))
+                    break
+            else:
+                stack.pop()
+                order.append(block)
+        return order
+
+    def reverse_postorder(self) -> List[Block]:
+        return list(reversed(self.postorder()))
+
+    def __str__(self) -> str:
+        return "\n".join(f"{b.name} -> {', '.join(s.name for s in b.succs)}"
+                         for b in self.blocks)
+
+
+# Building CFGs from code
+
+def writes_pc(instr: Instr) -> bool:
+    return instr.is_jump() or (instr.is_instruction() and instr.target == "r15"
+                               and instr.opcode != "STORE")
+
+
+def from_instrs(instrs: List[Instr]) -> CFG:
+    """The CFG of generated (or resolved) code"""
+    graph = CFG()
+    # Words by address, addresses of labels, and the first
+    # label at each address
+    words, labels, names, address = {}, {}, {}, 0
+    for instr in instrs:
+        if instr.label:
+            labels[instr.label] = address
+            names.setdefault(address, instr.label)
+        if instr.opcode is not None:
+            words[address] = instr
+            address += 1
+
+    def target(instr: Instr, address: int) -> Optional[int]:
+        """Address a jump goes to, if we can tell"""
+        if instr.opcode == "LOAD":
+            # Address of the word holding the destination
+            if instr.ref is not None:
+                word = words.get(labels.get(instr.ref))
+            elif instr.src2 == "r15":
+                word = words.get(address + instr.offset)
+            else:
+                word = words.get(instr.offset)
+            return word.value if word is not None and word.opcode == "DATA" else None
+        if instr.ref is not None:
+            return labels.get(instr.ref)
+        if instr.src1 != "r0":
+            return None
+        return address + instr.offset if instr.src2 == "r15" else instr.offset
+
+    # Leaders:  labeled instructions, jump destinations, and
+    # instructions after a jump, HALT, or DATA
+    leaders, after_jump = set(names), True
+    for address in sorted(words):
+        instr = words[address]
+        if not instr.is_instruction():
+            after_jump = True
+            continue
+        if after_jump:
+            leaders.add(address)
+        after_jump = writes_pc(instr) or instr.opcode == "HALT"
+        if writes_pc(instr):
+            leaders.add(target(instr, address))
+    starts, current = {}, None
+    for address in sorted(words):
+        instr = words[address]
+        if not instr.is_instruction():
+            current = None
+            continue
+        if current is None or address in leaders:
+            current = graph.new_block(names.get(address, f"block_{address}"))
+            starts[address] = current
+        current.code.append(instr)
+
+    if starts:
+        graph.add_edge(graph.entry, starts[min(starts)])
+    else:
+        graph.add_edge(graph.entry, graph.exit)
+    for address, block in sorted(starts.items()):
+        last_address = address + len(block.code) - 1
+        last = block.code[-1]
+        falls_through = True
+        if last.opcode == "HALT":
+            graph.add_edge(block, graph.exit)
+            falls_through = not last.unpredicated()
+        elif writes_pc(last):
+            dest = target(last, last_address)
+            if dest is None:
+                # Anywhere at all
+                log.debug(f"Unknown destination of {last}")
+                for other in starts.values():
+                    graph.add_edge(block, other)
+            graph.add_edge(block, starts.get(dest, graph.exit))
+            falls_through = not last.unpredicated()
+        if falls_through:
+            graph.add_edge(block, starts.get(last_address + 1, graph.exit))
+    return graph.finish()
+
+
+class _ASTBuilder(object):
+
+    def __init__(self):
+        self.graph = CFG()
+        self.count = 0
+
+    def new_block(self, kind: str) -> Block:
+        self.count += 1
+        return self.graph.new_block(f"{kind}_{self.count}")
+
+    def walk(self, node: expr.Expr, current: Block) -> Block:
+        """Add node to the graph, starting in block current;
+        returns the block where control continues.
+        """
+        if isinstance(node, expr.Seq):
+            current = self.walk(node.left, current)
+            return self.walk(node.right, current)
+        if isinstance(node, expr.Pass):
+            return current
+        if isinstance(node, expr.If):
+            current.branch = node.cond
+            then_block, else_block = self.new_block("then"), self.new_block("else")
+            self.graph.add_edge(current, then_block)
+            self.graph.add_edge(current, else_block)
+            then_end = self.walk(node.thenpart, then_block)
+            else_end = self.walk(node.elsepart, else_block)
+            join = self.new_block("fi")
+            self.graph.add_edge(then_end, join)
+            self.graph.add_edge(else_end, join)
+            return join
+        if isinstance(node, expr.While):
+            head = self.new_block("while")
+            self.graph.add_edge(current, head)
+            head.branch = node.cond
+            body = self.new_block("do")
+            self.graph.add_edge(head, body)
+            body_end = self.walk(node.expr, body)
+            self.graph.add_edge(body_end, head)
+            after = self.new_block("od")
+            self.graph.add_edge(head, after)
+            return after
+        current.code.append(node)
+        return current
+
+
+def from_ast(program: expr.Expr) -> CFG:
+    """The CFG of a Mallard program"""
+    builder = _ASTBuilder()
+    start = builder.new_block("block")
+    builder.graph.add_edge(builder.graph.entry, start)
+    end = builder.walk(program, start)
+    builder.graph.add_edge(end, builder.graph.exit)
+    return builder.graph.finish()
+
+
+# Dataflow
+
+class Universe(object):
+    """The names a dataflow problem is about, each with its bit"""
+
+    def __init__(self, names: Iterable[str]):
+        self.names = sorted(set(names))
+        self.bits = {name: 1 << i for i, name in enumerate(self.names)}
+        self.all = (1 << len(self.names)) - 1
+
+    def to_bits(self, names: Iterable[str]) -> int:
+        vector = 0
+        for name in names:
+            vector |= self.bits[name]
+        return vector
+
+    def to_set(self, vector: int) -> FrozenSet[str]:
+        return frozenset(name for name in self.names if vector & self.bits[name])
+
+
+class Dataflow(object):
+    """A gen/kill dataflow problem, solved by the worklist algorithm.
+    Forward problems flow from the entry along edges, backward
+    problems from the exit against them.  The meet is "union"
+    (may problems, e.g., liveness) or "intersection" (must problems,
+    e.g., definite assignment).  After solve(), ins[block] and
+    outs[block] hold the sets at the start and end of each block.
+    """
+
+    def __init__(self, graph: CFG, gen: Dict[Block, Set[str]], kill: Dict[Block, Set[str]],
+                 forward: bool = True, meet: str = "union", boundary: Iterable[str] = ()):
+        assert meet in ["union", "intersection"]
+        self.graph = graph
+        names = set(boundary)
+        for sets in [gen, kill]:
+            for block_set in sets.values():
+                names |= set(block_set)
+        self.universe = Universe(names)
+        self.gen = {b: self.universe.to_bits(gen.get(b, ())) for b in graph.blocks}
+        self.kill = {b: self.universe.to_bits(kill.get(b, ())) for b in graph.blocks}
+        self.forward = forward
+        self.meet = meet
+        self.boundary = self.universe.to_bits(boundary)
+        self.ins = {}
+        self.outs = {}
+        # Blocks taken off the worklist, for the curious
+        self.steps = 0
+
+    def solve(self) -> "Dataflow":
+        graph, universe = self.graph, self.universe
+        start = graph.entry if self.forward else graph.exit
+        top = 0 if self.meet == "union" else universe.all
+        # Facts flowing into a block (before) and out of it (after),
+        # in the direction of the problem
+        before = {b: top for b in graph.blocks}
+        after = {b: top for b in graph.blocks}
+        before[start] = self.boundary
+        order = graph.reverse_postorder() if self.forward else graph.postorder()
+        order += [b for b in graph.blocks if b not in order]
+        worklist = list(order)
+        queued = set(worklist)
+        while worklist:
+            block = worklist.pop(0)
+            queued.discard(block)
+            self.steps += 1
+            sources = block.preds if self.forward else block.succs
+            if block is not start:
+                facts = [after[s] for s in sources]
+                if not facts:
+                    value = top if self.meet == "intersection" else 0
+                elif self.meet == "union":
+                    value = 0
+                    for fact in facts:
+                        value |= fact
+                else:
+                    value = universe.all
+                    for fact in facts:
+                        value &= fact
+                before[block] = value
+            out = self.gen[block] | (before[block] & ~self.kill[block])
+            if out != after[block]:
+                after[block] = out
+                for dest in (block.succs if self.forward else block.preds):
+                    if dest not in queued:
+                        worklist.append(dest)
+                        queued.add(dest)
+        to_set = universe.to_set
+        if self.forward:
+            self.ins = {b: to_set(before[b]) for b in graph.blocks}
+            self.outs = {b: to_set(after[b]) for b in graph.blocks}
+        else:
+            self.ins = {b: to_set(after[b]) for b in graph.blocks}
+            self.outs = {b: to_set(before[b]) for b in graph.blocks}
+        return self
+
+
+def uses_defs(item: Union[Instr, expr.Expr]) -> (Set[str], Set[str], bool):
+    """Names read and written by one instruction or statement, and
+    whether the write is certain (not predicated)
+    """
+    if isinstance(item, Instr):
+        if not item.is_instruction():
+            return set(), set(), True
+        reads = {item.src1, item.src2}
+        if item.opcode == "STORE":
+            reads.add(item.target)
+            writes = set()
+        elif item.opcode == "HALT" or item.is_jump():
+            writes = set()
+        else:
+            writes = {item.target}
+        reads = {r for r in reads if r is not None} - FIXED_REGISTERS
+        writes = {r for r in writes if r is not None} - FIXED_REGISTERS
+        return reads, writes, item.unpredicated()
+    if isinstance(item, expr.Assign):
+        return expr.variables(item.right), {item.left.name}, True
+    return expr.variables(item), set(), True
+
+
+def block_uses_defs(block: Block) -> (Set[str], Set[str]):
+    """Names read before they are written in block, and names
+    certainly written in it
+    """
+    used, defined = set(), set()
+    for item in block.code:
+        reads, writes, certain = uses_defs(item)
+        used |= reads - defined
+        if certain:
+            defined |= writes
+    if block.branch is not None:
+        used |= expr.variables(block.branch) - defined
+    return used, defined
+
+
+def liveness(graph: CFG) -> Dataflow:
+    """Variables (or registers) live at the start and end of each block"""
+    gen, kill = {}, {}
+    for block in graph.blocks:
+        gen[block], kill[block] = block_uses_defs(block)
+    return Dataflow(graph, gen, kill, forward=False).solve()
+
+
+def definitely_assigned(graph: CFG) -> Dataflow:
+    """Variables (or registers) certainly assigned on every path to each block"""
+    gen = {}
+    for block in graph.blocks:
+        gen[block] = block_uses_defs(block)[1]
+    return Dataflow(graph, gen, {}, forward=True, meet="intersection").solve()
+
+
+# Dominators and loops
+
+def immediate_dominators(graph: CFG) -> Dict[Block, Block]:
+    """The immediate dominator of each block reachable from
+    the entry (the entry's is itself)
+    """
+    order = graph.reverse_postorder()
+    index = {block: i for i, block in enumerate(order)}
+    idom = {graph.entry: graph.entry}
+
+    def intersect(a: Block, b: Block) -> Block:
+        while a is not b:
+            while index[a] > index[b]:
+                a = idom[a]
+            while index[b] > index[a]:
+                b = idom[b]
+        return a
+
+    changed = True
+    while changed:
+        changed = False
+        for block in order[1:]:
+            preds = [p for p in block.preds if p in idom]
+            new = preds[0]
+            for pred in preds[1:]:
+                new = intersect(pred, new)
+            if idom.get(block) is not new:
+                idom[block] = new
+                changed = True
+    return idom
+
+
+def dominates(idom: Dict[Block, Block], a: Block, b: Block) -> bool:
+    """Does every path from the entry to b pass through a?"""
+    while True:
+        if b is a:
+            return True
+        if b not in idom or idom[b] is b:
+            return False
+        b = idom[b]
+
+
+def dominator_tree(idom: Dict[Block, Block]) -> Dict[Block, List[Block]]:
+    """Children of each block in the dominator tree"""
+    tree = {block: [] for block in idom}
+    for block, parent in idom.items():
+        if parent is not block:
+            tree[parent].append(block)
+    return tree
+
+
+class Loop(object):
+    """A natural loop:  its header and the blocks of its body
+    (including the header), with the loops around and in it
+    """
+
+    def __init__(self, header: Block):
+        self.header = header
+        self.blocks = {header}
+        self.parent = None
+        self.children = []
+
+    @property
+    def depth(self) -> int:
+        return 1 if self.parent is None else self.parent.depth + 1
+
+    def __repr__(self) -> str:
+        return f"Loop({self.header.name}, {len(self.blocks)} blocks, depth {self.depth})"
+
+
+def find_loops(graph: CFG, idom: Dict[Block, Block]) -> List[Loop]:
+    """Natural loops, outermost first.  Back edges to the same
+    header make one loop.
+    """
+    loops = {}
+    for block in idom:
+        for succ in block.succs:
+            if succ in idom and dominates(idom, succ, block):
+                loop = loops.setdefault(succ, Loop(succ))
+                stack = [block]
+                while stack:
+                    member = stack.pop()
+                    if member not in loop.blocks:
+                        loop.blocks.add(member)
+                        stack.extend(member.preds)
+    ordered = sorted(loops.values(), key=lambda loop: len(loop.blocks))
+    for i, loop in enumerate(ordered):
+        for outer in ordered[i + 1:]:
+            if loop.blocks < outer.blocks:
+                loop.parent = outer
+                outer.children.append(loop)
+                break
+    return sorted(ordered, key=lambda loop: loop.depth)
+
+
+def loop_depth(loops: List[Loop], block: Block) -> int:
+    """Number of loops block is in"""
+    return max([loop.depth for loop in loops if block in loop.blocks], default=0)
+
+
+class Analyses(object):
+    """The CFG of one program (an AST, or a list of Instr records)
+    and analyses of it, each computed when first asked for and
+    kept until invalidate() is called.
+    """
+
+    def __init__(self, program: Union[expr.Expr, List[Instr]]):
+        self.program = program
+        self.results = {}
+        # Analyses computed, for the curious
+        self.computed = 0
+
+    def _get(self, name: str, compute: Callable):
+        if name not in self.results:
+            self.computed += 1
+            self.results[name] = compute()
+        return self.results[name]
+
+    def invalidate(self):
+        self.results = {}
+
+    def cfg(self) -> CFG:
+        if isinstance(self.program, expr.Expr):
+            return self._get("cfg", lambda: from_ast(self.program))
+        return self._get("cfg", lambda: from_instrs(self.program))
+
+    def dominators(self) -> Dict[Block, Block]:
+        return self._get("dominators", lambda: immediate_dominators(self.cfg()))
+
+    def dominator_tree(self) -> Dict[Block, List[Block]]:
+        return self._get("dominator_tree", lambda: dominator_tree(self.dominators()))
+
+    def loops(self) -> List[Loop]:
+        return self._get("loops", lambda: find_loops(self.cfg(), self.dominators()))
+
+    def liveness(self) -> Dataflow:
+        return self._get("liveness", lambda: liveness(self.cfg()))
+
+    def definitely_assigned(self) -> Dataflow:
+        return self._get("definitely_assigned", lambda: definitely_assigned(self.cfg()))
+
+
+def analyses(program: expr.Expr) -> Analyses:
+    """Cached analyses of a Mallard program, kept on the program
+    itself (a shallow copy of the program brings along the
+    analyses of the original, which are not used)
+    """
+    cached = program.__dict__.get("_analyses")
+    if cached is None or cached.program is not program:
+        cached = program._analyses = Analyses(program)
+    return cached
+
+
+def invalidate(program: expr.Expr):
+    """Forget the analyses of program, which a pass has changed"""
+    program.__dict__.pop("_analyses", None)
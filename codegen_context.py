@@ -11,9 +11,18 @@ place several small design decisions:  How
 registers are allocated, how constants and variables
 are declared, when and how the code is actually
 emitted to the output file.
+
+Code is kept as a list of Instr records rather than text, so
+that optimization passes and the assembler can work on the
+fields of an instruction.  Text is produced only when asked
+for (Context.get_lines).
 """
 
-from typing import List
+import copy
+import re
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, List, Optional
 
 import logging
 logging.basicConfig()
@@ -21,6 +30,167 @@ log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
 
+class RegisterExhausted(Exception):
+    """Raised when code generation needs a register
+    and none is left, even after spilling.
+    """
+    pass
+
+
+# Predicates that let an instruction execute whatever the
+# condition code is
+UNPREDICATED = {None, "ALWAYS", "MZPV"}
+
+# The farthest a PC-relative reference can reach (the offset
+# field is a signed 10-bit number).  Addresses up to here can
+# also be reached absolutely, as r0,r0[address], from anywhere
+# --- except for the memory-mapped input and output devices.
+MAX_REACH = 511
+IO_ADDRESSES = [510, 511]
+
+# Label of the first instruction when the data words are
+# placed before the code
+CODE_START = "code_start"
+
+# A reasonable limit on the size of the straight-line predicated
+# code that replaces a small If (see Context.if_conversion_cost)
+IF_CONVERSION_COST = 8
+
+
+class Instr(object):
+    """One line of assembly code:  an instruction, a DATA word,
+    or just a label and/or comment.  An instruction is either
+    fully specified
+
+        opcode/predicate  target,src1,src2[offset]
+
+    or refers to a label in place of src1, src2, and offset
+    (target,ref, as in LOAD r1,var_x), or is a JUMP to ref.
+    The comment, if any, includes its leading # or ;.
+    A line we can't make sense of keeps only its text.
+    """
+
+    # For the conditional jump of an If or While:  (site, role,
+    # steps), so that counts of its execution in object code can
+    # be traced back to the If or While (see Context.mark_branch)
+    site = None
+
+    def __init__(self, opcode: str = None, target: str = None,
+                 src1: str = None, src2: str = None, offset: int = 0,
+                 ref: str = None, predicate: str = None,
+                 label: str = None, comment: str = None,
+                 value: int = None, text: str = None):
+        self.opcode = opcode
+        self.predicate = predicate
+        self.target = target
+        self.src1 = src1
+        self.src2 = src2
+        self.offset = offset
+        self.ref = ref
+        self.label = label
+        self.comment = comment
+        # The word of a DATA line
+        self.value = value
+        # Original text of a line we could not parse
+        self.text = text
+
+    def is_instruction(self) -> bool:
+        return self.opcode is not None and self.opcode != "DATA"
+
+    def is_jump(self) -> bool:
+        return self.opcode == "JUMP"
+
+    def unpredicated(self) -> bool:
+        return self.predicate in UNPREDICATED
+
+    def registers(self) -> List[str]:
+        """Registers named in the instruction"""
+        return [r for r in [self.target, self.src1, self.src2] if r is not None]
+
+    def render(self) -> str:
+        """Assembly text for this line"""
+        if self.text is not None:
+            return self.text
+        label = f"{self.label}:" if self.label else ""
+        comment = f"  {self.comment}" if self.comment else ""
+        if self.opcode is None:
+            return f"{label}  {comment}".strip() if label else comment.strip()
+        if self.opcode == "DATA":
+            return f"{label}  DATA {self.value}{comment}"
+        pred = "" if self.predicate is None else f"/{self.predicate}"
+        if self.ref is None:
+            operands = f"{self.target},{self.src1},{self.src2}"
+            if self.offset:
+                operands += f"[{self.offset}]"
+        elif self.target is None:
+            operands = self.ref
+        else:
+            operands = f"{self.target},{self.ref}"
+        return f"{label}   {self.opcode}{pred}  {operands}{comment}"
+
+    def __str__(self) -> str:
+        return self.render()
+
+    def __repr__(self) -> str:
+        return f"Instr({self.render()!r})"
+
+
+LINE_PAT = re.compile(r"""
+   \s*
+   # Optional label
+   ((?P<label> [a-zA-Z]\w*):)?
+   \s*
+   # Optional instruction
+   (
+     (?P<opcode>    [a-zA-Z]+)
+     (/ (?P<predicate> [A-Z]+) )?
+     (\s+ (?P<operands> [^\#;]*?))?
+   )?
+   \s*
+   # Optional comment follows # or ;
+   (?P<comment> [\#;].*)?
+   \s*$
+   """, re.VERBOSE)
+
+OPERANDS_FULL = re.compile(r"(r\d+),(r\d+),(r\d+)(\[(-?\d+)\])?")
+OPERANDS_MEMOP = re.compile(r"(r\d+),([a-zA-Z]\w*)")
+LABEL = re.compile(r"[a-zA-Z]\w*")
+DATA_VALUE = re.compile(r"-?[0-9]+|0x[a-fA-F0-9]+")
+
+
+def parse_instr(text: str) -> Instr:
+    """The record for one line of assembly text, for code that
+    still produces text (and for hand-written assembly code).
+    """
+    text = text.rstrip()
+    match = LINE_PAT.fullmatch(text)
+    if not match:
+        return Instr(text=text)
+    label, comment = match.group("label"), match.group("comment")
+    opcode = match.group("opcode")
+    if opcode is None:
+        return Instr(label=label, comment=comment)
+    opcode = opcode.upper()
+    predicate = match.group("predicate")
+    operands = match.group("operands") or ""
+    full = OPERANDS_FULL.fullmatch(operands)
+    memop = OPERANDS_MEMOP.fullmatch(operands)
+    if opcode == "DATA" and DATA_VALUE.fullmatch(operands):
+        return Instr("DATA", value=int(operands, 0), label=label, comment=comment)
+    if full:
+        target, src1, src2 = full.group(1, 2, 3)
+        return Instr(opcode, target, src1, src2, int(full.group(5) or 0),
+                     predicate=predicate, label=label, comment=comment)
+    if memop:
+        target, ref = memop.groups()
+        return Instr(opcode, target, ref=ref, predicate=predicate,
+                     label=label, comment=comment)
+    if opcode == "JUMP" and LABEL.fullmatch(operands):
+        return Instr(opcode, ref=operands, predicate=predicate,
+                     label=label, comment=comment)
+    return Instr(text=text)
+
+
 class Context(object):
     """The state of code generation"""
 
@@ -37,35 +207,226 @@ class Context(object):
         # symbols used for them in the assembly code.
         self.vars = {}
 
+        # Values variables start with, other than 0 (see datainit.py)
+        self.initial_values = {}
+
         # Instructions in the source code, as a list of
-        # strings.
-        self.assm_lines = []
+        # Instr records, and a count of the changes made to
+        # them (so cached analyses of the code know it's changed;
+        # see cfg.py)
+        self._instrs = []
+        self.version = 0
+        self._analyses = None
 
         # The available registers
         self.registers = [f"r{i}" for i in range(1, 15)]
 
+        # Variables that live in registers rather than memory
+        # (see regalloc.py), with their registers
+        self.var_registers = {}
+
+        # Memory words used to hold values when we run out of
+        # registers ("spill slots"), and those not in use now
+        self.temps = []
+        self.free_temps = []
+
+        # Register pressure report: the most registers in use
+        # at once, and how many values had to be spilled
+        self.in_use = 0
+        self.max_pressure = 0
+        self.spills = 0
+
         # creates a unique label for identifying sign of integers
         self.label_count = 0
 
+        # An If whose predicated, branch-free form takes at most
+        # this many instructions is generated that way (None: never).
+        # The conditions of those converted, for the report.
+        self.if_conversion_cost = None
+        self.if_conversions = []
+
+        # Lay out branches for the expected path:  loops are tested
+        # at the bottom, and the unlikely arm of an If is moved out
+        # of line (to cold_instrs, placed after the HALT)
+        self.layout_branches = False
+        self.cold_instrs = []
+
+        # Choose instructions by tiling expression trees (see
+        # isel.py), with the tiles found for each node
+        self.select_instructions = False
+        self.tiles = {}
+
+        # What constant propagation folded and removed before
+        # code generation (see sccp.py)
+        self.sccp_stats = Counter()
+
+        # Loops replaced by closed forms (see scev.py)
+        self.scev_stats = Counter()
+
+        # The ranges of the program's values, and the work they
+        # removed (see ranges.py)
+        self.ranges = None
+        self.range_stats = Counter()
+
+        # Unroll counting loops by this factor (None:  don't), and
+        # what was unrolled (see unroll.py)
+        self.unroll_factor = None
+        self.unroll_stats = Counter()
+
+        # The Ifs and Whiles of the program as written, numbered
+        # as sites for profiles, and how the profile read for
+        # profile-guided optimization matched them (see pgo.py)
+        self.sites = []
+        self.pgo_stats = Counter()
+
+        # Variables initialized by their DATA words rather than
+        # by code (see datainit.py)
+        self.data_stats = Counter()
+
+    def scratch(self) -> "Context":
+        """A copy of this context for trial code generation:
+        code generated into it does not affect this context.
+        """
+        trial = copy.copy(self)
+        trial.instrs = []
+        trial._analyses = None
+        trial.consts = dict(self.consts)
+        trial.vars = dict(self.vars)
+        trial.registers = list(self.registers)
+        trial.temps = list(self.temps)
+        trial.free_temps = list(self.free_temps)
+        trial.if_conversions = list(self.if_conversions)
+        trial.cold_instrs = []
+        return trial
+
+    @property
+    def instrs(self) -> List[Instr]:
+        return self._instrs
+
+    @instrs.setter
+    def instrs(self, instrs: List[Instr]):
+        self._instrs = instrs
+        self.changed()
+
+    def changed(self):
+        """Note a change to the code.  A pass that changes
+        instructions in place must call this.
+        """
+        self.version += 1
+
+    def analyses(self) -> "cfg.Analyses":
+        """The CFG and analyses of the code as it is now"""
+        import cfg
+        if self._analyses is None or self._analyses[0] != self.version:
+            self._analyses = (self.version, cfg.Analyses(self.instrs))
+        return self._analyses[1]
+
+    def emit(self, opcode: str, target: str = None,
+             src1: str = None, src2: str = None, offset: int = 0,
+             ref: str = None, predicate: str = None, comment: str = None):
+        """Add an instruction, e.g.,
+            emit("ADD", "r1", "r2", "r3")     ADD  r1,r2,r3
+            emit("LOAD", "r1", ref="var_x")   LOAD  r1,var_x
+            emit("JUMP", ref="od_2", predicate="ZM")
+        """
+        self.instrs.append(Instr(opcode, target, src1, src2, offset,
+                                 ref=ref, predicate=predicate, comment=comment))
+        self.changed()
+
+    def add_label(self, label: str, comment: str = None):
+        """Place label at the next instruction"""
+        self.instrs.append(Instr(label=label, comment=comment))
+        self.changed()
+
     def add_line(self, line: str):
-        """Add a line of assembly code"""
-        self.assm_lines.append(line)
-       # log.info("Added line, now {}".format(self.assm_lines))
+        """Add a line of assembly code given as text"""
+        self.instrs.append(parse_instr(line))
+        self.changed()
 
-    def get_lines(self) -> List[str]:
-        """Get all the generated source code, including
+    def mark_branch(self, node, role: str):
+        """Tag the conditional jump just emitted for node, an If
+        or While of the program as written (with a site; see
+        pgo.py).  role says what taking it means:  "false" or
+        "true" (the If condition); "test" (leaving a loop tested
+        at the top), "guard" (skipping a loop tested at the
+        bottom), or "bottom" (repeating it).
+        """
+        if node.site is not None:
+            self.instrs[-1].site = (node.site, role, getattr(node, "steps", 1))
+
+    @contextmanager
+    def out_of_line(self):
+        """Code generated in this block goes to cold_instrs"""
+        saved = self.instrs
+        self.instrs = []
+        try:
+            yield
+        finally:
+            self.cold_instrs.extend(self.instrs)
+            self.instrs = saved
+
+    def place_cold_code(self):
+        """Append the out-of-line code, once nothing
+        can fall through into it (e.g., after HALT).
+        """
+        self.instrs.extend(self.cold_instrs)
+        self.cold_instrs = []
+        self.changed()
+
+    @property
+    def assm_lines(self) -> List[str]:
+        """The instructions so far, as text"""
+        return [instr.render() for instr in self.instrs]
+
+    @assm_lines.setter
+    def assm_lines(self, lines: List[str]):
+        self.instrs = [parse_instr(line) for line in lines]
+
+    def get_instrs(self, data_first: Optional[bool] = None) -> List[Instr]:
+        """All the generated code as records, including
         declarations of variables and constants.
+
+        The declarations normally follow the code.  In a program
+        that reaches the input/output addresses, the assembler moves
+        what follows them further on (see assembler_phase1.skip_io),
+        where code near the beginning can't reach it.  So the
+        declarations are placed at the beginning instead
+        (data_first), behind a JUMP over them:  at addresses below
+        MAX_REACH, the assembler can address them absolutely from
+        anywhere in the program.  data_first=None chooses by
+        program size.
         """
-        code = self.assm_lines.copy()
+        data = []
+        # Constants no instruction refers to (any more) are dropped
+        used = {instr.ref for instr in self.instrs}
         for constval in sorted(self.consts):
-            code.append(f"{self.consts[constval]}:  DATA {constval}")
+            if self.consts[constval] not in used:
+                continue
+            data.append(Instr("DATA", value=constval, label=self.consts[constval]))
+        for name in self.vars:
+            data.append(Instr("DATA", value=self.initial_values.get(name, 0), label=self.vars[name]))
+        for label in self.temps:
+            data.append(Instr("DATA", value=0, label=label))
+        code = self.instrs.copy()
+        words = len([instr for instr in code if instr.opcode is not None])
+        if data_first is None:
+            data_first = words + len(data) > min(IO_ADDRESSES)
+        if not data_first:
+            return code + data
+        if len(data) + 1 >= min(IO_ADDRESSES):
+            log.warning(f"{len(data)} data words will not all be within reach")
+        # Leading comments stay at the top
+        top = 0
+        while top < len(code) and code[top].opcode is None and code[top].label is None:
+            top += 1
+        return (code[:top] + [Instr("JUMP", ref=CODE_START, comment="# over the data")]
+                + data + [Instr(label=CODE_START)] + code[top:])
 
-        for name in (self.vars):
-          #  log.info(f"var name is: {name}")
-          #  log.info(f"data for var is: {self.vars[name]}")
-            code.append(f"{self.vars[name]}:  DATA 0")
-         #   log.info(f"code line is:   {code}")
-        return code
+    def get_lines(self, data_first: Optional[bool] = None) -> List[str]:
+        """Get all the generated source code, including
+        declarations of variables and constants.
+        """
+        return [instr.render() for instr in self.get_instrs(data_first)]
 
     def get_const_symbol(self, value: int) -> str:
         """Returns the name of the label associated
@@ -99,14 +460,56 @@ class Context(object):
         occupied. Keep exclusive access until it is returned with
         free_register(reg).
         """
+        if not self.registers:
+            raise RegisterExhausted("No free registers; expression needs spilling")
+        self.in_use += 1
+        self.max_pressure = max(self.max_pressure, self.in_use)
         return self.registers.pop()
 
     def free_register(self, reg_name: str):
         """Return the named register to the pool of
         available registers.
         """
+        self.in_use -= 1
         self.registers.append(reg_name)
 
+    def assign_variable_registers(self, assignment: Dict[str, str]):
+        """Keep the given variables in the given registers for
+        the whole program.  Those registers are no longer
+        available for expression temporaries.
+        """
+        self.var_registers.update(assignment)
+        for reg in set(assignment.values()):
+            self.registers.remove(reg)
+
+    def free_register_count(self) -> int:
+        """How many more registers can be allocated right now"""
+        return len(self.registers)
+
+    def allocate_temp(self) -> str:
+        """Get the label of a memory word to spill a register to.
+        It is declared at the end of the program, and reused
+        after it is returned with free_temp(label).
+        """
+        self.spills += 1
+        if self.free_temps:
+            return self.free_temps.pop()
+        label = f"tmp_{len(self.temps) + 1}"
+        self.temps.append(label)
+        return label
+
+    def free_temp(self, label: str):
+        """Return a spill slot for reuse"""
+        self.free_temps.append(label)
+
+    def register_report(self) -> str:
+        """Summary of register use for the program so far"""
+        report = (f"max register pressure {self.max_pressure}, "
+                  f"{self.spills} spills to {len(self.temps)} temporaries")
+        if self.var_registers:
+            report += f", {len(self.var_registers)} variables in registers"
+        return report
+
 
 
 
@@ -0,0 +1,162 @@
+"""
+A compiler for the mallard language,
+a very small programming language with
+integers as the only data type.  It translates
+a mallard program into DM2019W assembly code,
+which can be assembled and run on a duck machine.
+"""
+
+from llparse import parse
+from expr import Expr
+import codegen_context
+import regalloc
+import costmodel
+import datainit
+import peephole
+
+import argparse
+import datetime
+import sys
+
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+def cli() -> object:
+    """Get arguments from command line"""
+    parser = argparse.ArgumentParser(description="Mallard Language Compiler")
+    parser.add_argument("sourcefile", type=argparse.FileType('r'),
+                        help="Source program text")
+    parser.add_argument("outfile", type=argparse.FileType('w'),
+                        nargs="?", default=sys.stdout,
+                        help="Output file for assembly code")
+    parser.add_argument("--report", action="store_true",
+                        help="Report register pressure and spills")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="Fold constants and remove code that can never run, "
+                        "replace accumulation loops by closed forms, unroll counting loops, "
+                        "use value ranges to drop abs and decided comparisons, "
+                        "keep variables in registers, use immediate operands and "
+                        "predicated instructions for small ifs, test loops at the bottom, and "
+                        "clean up the generated code with peephole rules")
+    parser.add_argument("--if-cost", type=int, default=None,
+                        help="Largest if (in instructions) to replace by "
+                        f"predicated code (default with -O: {codegen_context.IF_CONVERSION_COST})")
+    parser.add_argument("--unroll", type=int, default=None,
+                        help="Unroll counting loops by this factor "
+                        "(default with -O: 4; 1 fully unrolls only short loops)")
+    parser.add_argument("--profile", type=argparse.FileType('r'),
+                        help="With -O, lay out branches, allocate registers, and unroll "
+                        "loops for this profile of the program (see pgo.py)")
+    parser.add_argument("--rules", type=argparse.FileType('r'),
+                        help="With -O, also apply the peephole rules in this table "
+                        "(written by superopt.py)")
+    parser.add_argument("--ssa", action="store_true",
+                        help="Generate code by way of SSA form, with copy propagation "
+                        "and global value numbering")
+    args = parser.parse_args()
+    return args
+
+
+def header(context: codegen_context.Context, source_name: str):
+    """Comments at the top of the generated code"""
+    context.add_line("# Lovingly crafted by the robots of CIS 211, Spring 2019")
+    context.add_line(f"# {datetime.datetime.now()} from {source_name}")
+    context.add_line("#")
+
+
+def generate(exp: Expr, context: codegen_context.Context, optimize: bool = False,
+             use_ssa: bool = False):
+    """Generate code for the whole program exp, ending with HALT.
+    Returns the SSA form of the program if use_ssa.
+    """
+    if use_ssa:
+        import ssa
+        return ssa.compile_program(exp, context)
+    if optimize:
+        import ranges
+        import sccp
+        import scev
+        import unroll
+        exp = sccp.simplify(exp, context.sccp_stats)
+        if context.unroll_factor is None:
+            context.unroll_factor = unroll.UNROLL_FACTOR
+        replaced = scev.replace_loops(exp, context.scev_stats)
+        unrolled = unroll.unroll(replaced, context.unroll_factor, stats=context.unroll_stats)
+        if unrolled is not exp:
+            # Constants in closed forms and the copies of unrolled bodies
+            exp = sccp.simplify(unrolled, context.sccp_stats)
+        exp, context.ranges = ranges.narrow(exp, stats=context.range_stats)
+        if context.if_conversion_cost is None:
+            context.if_conversion_cost = codegen_context.IF_CONVERSION_COST
+        context.layout_branches = True
+        context.select_instructions = True
+        regalloc.allocate_variables(exp, context)
+    exp = datainit.initialize(exp, context, context.data_stats)
+    work_register = context.allocate_register()
+    exp.gen(context, work_register)
+    context.free_register(work_register)
+    context.emit("HALT", "r0", "r0", "r0")
+    context.place_cold_code()
+
+
+def main():
+    args = cli()
+    context = codegen_context.Context()
+    header(context, args.sourcefile.name)
+    try:
+        exp = parse(args.sourcefile)
+        if args.profile:
+            import pgo
+            context.sites = pgo.annotate(exp, pgo.Profile.read(args.profile), context.pgo_stats)
+        context.if_conversion_cost = args.if_cost
+        context.unroll_factor = args.unroll
+        ir = generate(exp, context, args.optimize, args.ssa)
+        optimizer = None
+        if args.optimize:
+            rules = peephole.RULES + peephole.load_rules(args.rules) if args.rules else None
+            context.instrs, optimizer = peephole.optimize(context.instrs, rules)
+        assm = context.get_lines()
+        log.debug("assm = {}".format(assm))
+        for line in assm:
+            print(line, file=args.outfile)
+        if args.report:
+            print(f"#{context.register_report()}")
+            print(f"#{regalloc.memory_op_count(context.instrs)} loads and stores")
+            for stat, count in context.pgo_stats.items():
+                print(f"#pgo {count} {stat}")
+            for stat, count in context.sccp_stats.items():
+                print(f"#sccp {count} {stat}")
+            for stat, count in context.scev_stats.items():
+                print(f"#scev {count} {stat}")
+            for stat, count in context.unroll_stats.items():
+                print(f"#unroll {count} {stat}")
+            for stat, count in context.data_stats.items():
+                print(f"#data {count} {stat}")
+            for stat, count in context.range_stats.items():
+                print(f"#range {count} {stat}")
+            if context.ranges:
+                for line in context.ranges.report():
+                    print(f"#range {line}")
+            if ir:
+                for stat, count in ir.stats.items():
+                    print(f"#ssa {count} {stat}")
+            for line in context.if_conversions:
+                print(f"#predicated {line}")
+            if optimizer:
+                for line in optimizer.report():
+                    print(f"#peephole {line}")
+            for line in costmodel.estimate(context).report():
+                print(f"#cost {line}")
+        print("#Compilation complete")
+    except Exception as e:
+        print("Failed!")
+        print(e)
+        raise e
+
+
+if __name__ == "__main__":
+    main()
@@ -208,7 +208,8 @@ def _term(stream: TokenStream) -> expr.Expr:
 
 def _primary(stream: TokenStream) -> expr.Expr:
     """Unary operations, Constants, Variables,
-    input, and parenthesized expressions"""
+    input, and parenthesized expressions
+    (including comparisons, e.g., (x < y))"""
     log.debug(f"Parsing primary with starting token {stream.peek()}")
     token = stream.take()
     if token.kind is TokenCat.INT:
@@ -227,7 +228,11 @@ def _primary(stream: TokenStream) -> expr.Expr:
         operand = _primary(stream)
         return expr.Neg(operand)
     elif token.kind is TokenCat.LPAREN:
+        # A parenthesized comparison is a value, 0 or 1
         nested = _expr(stream)
+        if stream.peek().kind in COMPARISONS:
+            clazz = COMPARISONS[stream.take().kind]
+            nested = clazz(nested, _expr(stream))
         require(stream, TokenCat.RPAREN, consume=True)
         return nested
     else:
@@ -0,0 +1,154 @@
+"""
+A static cycle-cost model of DM2019W code.
+
+To compare optimization choices without running the program,
+each instruction is given a cost in cycles by what it does:
+
+ * ADD and SUB take one cycle in the ALU; MUL and DIV take more
+   (CYCLES);
+ * LOAD and STORE take a second cycle for the memory access;
+ * a jump (anything that writes r15) throws away the instruction
+   fetched after it, so takes JUMP_CYCLES whatever its opcode.
+
+A predicated instruction is charged as if it ran.  These are
+relative costs, not timings of any one machine.
+
+The cost of a basic block (see cfg.py) is the sum of the costs of
+its instructions, run once.  Its weighted cost assumes, as register
+allocation does (regalloc.LOOP_WEIGHT), that each loop around it
+runs ten times:
+
+    python3 costmodel.py prog.asm               most expensive blocks
+    python3 costmodel.py prog.asm --top 20
+    python3 compile.py -O --report prog.mal     (lines starting #cost)
+
+Passes ask for the cost of code (cycles, straight_line), of all
+the blocks of a program (estimate), or of the code generated for
+a piece of a program (node_cycles, as unroll.py does to decide
+whether unrolling a loop saves enough).
+"""
+
+from typing import List, NamedTuple, Union
+
+import cfg
+import expr
+from codegen_context import Context, Instr, parse_instr
+from regalloc import LOOP_WEIGHT
+
+import argparse
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+# Cycles by opcode
+CYCLES = {"ADD": 1, "SUB": 1, "MUL": 3, "DIV": 8,
+          "LOAD": 2, "STORE": 2, "HALT": 1}
+JUMP_CYCLES = 2
+
+# Blocks listed in a report
+TOP_BLOCKS = 10
+
+
+def cycles(instr: Instr) -> int:
+    """Cycles to run one instruction (0 for labels and DATA)"""
+    if not instr.is_instruction():
+        return 0
+    if cfg.writes_pc(instr):
+        return JUMP_CYCLES
+    return CYCLES.get(instr.opcode, 1)
+
+
+def straight_line(instrs: List[Instr]) -> int:
+    """Cycles to run instrs once, each of them"""
+    return sum(cycles(instr) for instr in instrs)
+
+
+class BlockCost(NamedTuple):
+    """Cost of one basic block"""
+    name: str
+    instructions: int
+    cycles: int
+    depth: int
+
+    @property
+    def weighted(self) -> int:
+        return self.cycles * LOOP_WEIGHT ** self.depth
+
+
+class Estimate(object):
+    """Costs of the blocks of a program, in layout order"""
+
+    def __init__(self, analyses: cfg.Analyses):
+        loops = analyses.loops()
+        self.blocks = [BlockCost(block.name, len(block.code), straight_line(block.code),
+                                 cfg.loop_depth(loops, block))
+                       for block in analyses.cfg().blocks if block.code]
+
+    @property
+    def cycles(self) -> int:
+        """Cycles to run every block once"""
+        return sum(block.cycles for block in self.blocks)
+
+    @property
+    def weighted(self) -> int:
+        """Cycles with each loop running LOOP_WEIGHT times"""
+        return sum(block.weighted for block in self.blocks)
+
+    def ranked(self) -> List[BlockCost]:
+        """Blocks by weighted cost, most expensive first"""
+        return sorted(self.blocks, key=lambda block: block.weighted, reverse=True)
+
+    def report(self, top: int = TOP_BLOCKS) -> List[str]:
+        lines = [f"{self.cycles} cycles straight through, {self.weighted} with "
+                 f"each loop running {LOOP_WEIGHT} times",
+                 f"{'block':16} {'instrs':>6} {'cycles':>6} {'depth':>5} {'weighted':>8}"]
+        for block in self.ranked()[:top]:
+            lines.append(f"{block.name:16} {block.instructions:6} {block.cycles:6} "
+                         f"{block.depth:5} {block.weighted:8}")
+        return lines
+
+
+def estimate(code: Union[Context, List[Instr]]) -> Estimate:
+    """The cost of generated code:  a Context (whose analyses
+    are cached) or a list of records
+    """
+    if isinstance(code, Context):
+        return Estimate(code.analyses())
+    return Estimate(cfg.Analyses(code))
+
+
+def node_cycles(node: expr.Expr) -> int:
+    """Cycles to run the code generated for node once, straight
+    through, generated without optimization (variables in memory)
+    """
+    context = Context()
+    target = context.allocate_register()
+    node.gen(context, target)
+    return straight_line(context.instrs)
+
+
+def read_asm(file) -> List[Instr]:
+    """Records of an assembly code file (an open file)"""
+    return [parse_instr(line) for line in file]
+
+
+def cli() -> object:
+    """Get arguments from command line"""
+    parser = argparse.ArgumentParser(description="Estimate the cycles DM2019W assembly code takes")
+    parser.add_argument("asmfile", type=argparse.FileType('r'),
+                        help="Assembly code, e.g., from compile.py")
+    parser.add_argument("--top", type=int, default=TOP_BLOCKS,
+                        help="How many of the most expensive blocks to list")
+    return parser.parse_args()
+
+
+def main():
+    args = cli()
+    for line in estimate(read_asm(args.asmfile)).report(args.top):
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
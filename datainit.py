@@ -0,0 +1,76 @@
+"""
+Static initialization of variables.
+
+Every variable that lives in memory has a DATA word, which
+holds 0 when the program starts.  A program that begins
+
+    x = 7;
+    y = read;
+
+spends its first instructions putting 7 there:
+
+    LOAD  r14,const_7
+    STORE r14,var_x
+
+when the word could hold 7 from the start (var_x: DATA 7), and
+const_7 would not be needed at all.
+
+An assignment x = c of a constant can be made static when it
+runs once, before anything else touches x:  it is one of the
+statements of the program itself (not inside an If or While),
+and no statement before it mentions x.  Every path to a use of
+x then goes through it.  The assignment is dropped, and the
+variable is declared with its value (Context.initial_values).
+
+Variables kept in registers (see regalloc.py) have no DATA word
+to initialize, so their assignments stay.  Only integer
+constants count (with -O, SCCP has already folded constant
+expressions; see sccp.py), and only those that fit in a word.
+"""
+
+from collections import Counter
+from typing import Dict, List
+
+import arith
+import expr
+import unroll
+from codegen_context import Context
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+def static_values(program: expr.Expr, in_registers: Dict[str, str]) -> (Dict[str, int], List[expr.Expr]):
+    """Values of the variables program can initialize statically,
+    and the statements of program without their assignments
+    """
+    values, kept, seen = {}, [], set()
+    for stmt in unroll.statements(program):
+        if (isinstance(stmt, expr.Assign) and isinstance(stmt.right, expr.IntConst)
+                and stmt.left.name not in seen and stmt.left.name not in in_registers
+                and arith.WORD_MIN <= stmt.right.value <= arith.WORD_MAX):
+            values[stmt.left.name] = stmt.right.value
+        else:
+            kept.append(stmt)
+        seen |= expr.variables(stmt)
+    return values, kept
+
+
+def initialize(program: expr.Expr, context: Context, stats: Counter = None) -> expr.Expr:
+    """program without the assignments that initialize variables
+    statically; their values are left in context.initial_values,
+    and what was done is counted in stats
+    """
+    if stats is None:
+        stats = Counter()
+    values, kept = static_values(program, context.var_registers)
+    if not values:
+        return program
+    for name, value in values.items():
+        context.get_var_symbol(name)
+        context.initial_values[name] = value
+        log.debug(f"{name} starts as {value}")
+    stats["variables initialized statically"] += len(values)
+    return unroll.sequence(kept)
@@ -4,6 +4,8 @@ Revised March 2019 for compiler project;
 Revised May 2019 to add comparison operations
 """
 
+from typing import List, Optional
+
 import logging
 logging.basicConfig()
 log = logging.getLogger(__name__)
@@ -13,10 +15,26 @@ log.setLevel(logging.INFO)
 
 # One global environment (scope) for
 # the calculator
-from codegen_context import Context
+from codegen_context import Context, RegisterExhausted
+import arith
 
 ENV = dict()
 
+# Integer semantics of the interpreter (see arith.py).
+# BigInt is Python's unbounded ints; arith.Int32() gives
+# the 32-bit arithmetic of the Duck Machine.
+ARITH = arith.BigInt()
+
+# Tiered execution:  A While loop that has run this many
+# iterations in the tree-walking interpreter is compiled
+# to a Python function (see tiered.py), which runs the rest
+# of its iterations.  None turns tiering off.
+HOT_LOOP_THRESHOLD = 100
+
+# Where If and While count what they do as the interpreter
+# runs (a pgo.Profile), or None
+PROFILE = None
+
 def env_clear():
     """Clear all variables in calculator memory"""
     global ENV
@@ -33,6 +51,10 @@ class UndefinedVariable(Exception):
 class Expr(object):
     """Abstract base class of all expressions."""
 
+    # Set where range analysis shows that the value always fits
+    # in a word, so it need not be checked (see ranges.py)
+    in_range = False
+
     def eval(self) -> "IntConst":
         """Implementations of eval should return an integer constant."""
         raise NotImplementedError("Each concrete Expr class must define 'eval'")
@@ -50,6 +72,19 @@ class Expr(object):
     def __eq__(self, other: "Expr") -> bool:
         raise NotImplementedError("__eq__ method not defined for class")
 
+    def need(self) -> int:
+        """Sethi-Ullman number: how many registers gen needs
+        to evaluate this expression without spilling.  Leaves
+        (constants, variables, read) need just the target.
+        """
+        return 1
+
+    def register(self, context: Context) -> "Optional[str]":
+        """The register that already holds the value of this
+        expression, if any (e.g., a variable kept in a register).
+        """
+        return None
+
 
 
 class IntConst(Expr):
@@ -73,8 +108,10 @@ class IntConst(Expr):
         Result of expression evaluation will be
         left in target register.
         """
+        if context.select_instructions and tiled(self, context, target):
+            return
         label = context.get_const_symbol(self.value)
-        context.add_line(f"    LOAD {target},{label}")
+        context.emit("LOAD", target, ref=label)
         return
 
 
@@ -84,6 +121,138 @@ class IntConst(Expr):
 # IntConst to define this one.
 NO_VALUE = IntConst(7777)  # Just an unlikely value to get randomly
 
+# Profile data a rewritten If or While keeps (see Control)
+PROFILE_FIELDS = ["site", "counts", "steps"]
+
+
+def with_profile(old: Expr, new: Expr) -> Expr:
+    """new, which replaces old in a rewritten program, with the
+    profile data of old
+    """
+    for field in PROFILE_FIELDS:
+        if field in vars(old):
+            setattr(new, field, getattr(old, field))
+    return new
+
+
+def side_effect_free(e: Expr) -> bool:
+    """True if evaluating e reads no input and changes nothing,
+    so the compiler may evaluate it out of order.
+    """
+    if isinstance(e, Read) or isinstance(e, Assign):
+        return False
+    return all(side_effect_free(child) for child in
+               [getattr(e, "left", None), getattr(e, "right", None)]
+               if isinstance(child, Expr))
+
+
+def variables(e: Expr) -> set:
+    """Names of the variables mentioned in e"""
+    if isinstance(e, Var):
+        return {e.name}
+    names = set()
+    for part in ["left", "right", "expr", "cond", "thenpart", "elsepart"]:
+        child = getattr(e, part, None)
+        if isinstance(child, Expr):
+            names |= variables(child)
+    return names
+
+
+def single_instruction(e: Expr) -> bool:
+    """True if e reads all its variables before it writes its
+    target register:  a leaf, a binary operation on leaves, or
+    unary operations applied to one of those.
+    """
+    while isinstance(e, UnOp):
+        e = e.left
+    if isinstance(e, BinOp):
+        return e.left.need() == 1 and e.right.need() == 1 \
+            and not isinstance(e.left, UnOp) and not isinstance(e.right, UnOp)
+    return e.need() == 1 and not isinstance(e, UnOp)
+
+
+def assignments(block: Expr) -> "Optional[List[Assign]]":
+    """The assignments making up block, if it is nothing but
+    assignments of side-effect-free expressions; else None.
+    """
+    if isinstance(block, Pass):
+        return []
+    if isinstance(block, Seq):
+        left, right = assignments(block.left), assignments(block.right)
+        if left is None or right is None:
+            return None
+        return left + right
+    if isinstance(block, Assign) and side_effect_free(block.right):
+        return [block]
+    return None
+
+
+def tiled(e: Expr, context: Context, target: str) -> bool:
+    """Generate e by instruction selection (see isel.py), if a
+    tiling does better than e's own gen method.
+    """
+    import isel
+    return isel.select(e, context, target)
+
+
+def gen_operands(context: Context, left: Expr, right: Expr, target: str):
+    """Evaluate left and right into two registers, one of them
+    target, for a binary operation or comparison.  Returns
+    (left register, right register, extra), where extra is the
+    register the caller must free after using the operands.
+
+    An operand that is already in a register (a variable that
+    lives in a register) is used where it is, and needs no
+    code at all.
+
+    Otherwise, following Sethi and Ullman, we evaluate the operand that
+    needs more registers first, when reordering is safe.  If
+    both operands need every register we have, the first one
+    is spilled to a temporary word in memory and reloaded.
+    """
+    left_reg = left.register(context)
+    right_reg = right.register(context)
+    if left_reg and right_reg:
+        return left_reg, right_reg, None
+    if left_reg or right_reg:
+        held = left_reg or right_reg
+        other = right if left_reg else left
+        if held == target:
+            # Don't overwrite the operand we are holding
+            reg = context.allocate_register()
+            other.gen(context, reg)
+            extra = reg
+        else:
+            reg = target
+            other.gen(context, target)
+            extra = None
+        return (held, reg, extra) if left_reg else (reg, held, extra)
+    left_need = left.need()
+    right_need = right.need()
+    available = 1 + context.free_register_count()
+    reorder = right_need > left_need and side_effect_free(left) and side_effect_free(right)
+    second_need = left_need if reorder else right_need
+    if second_need < available:
+        first, second = (right, left) if reorder else (left, right)
+        first.gen(context, target)
+        reg = context.allocate_register()
+        second.gen(context, reg)
+        if reorder:
+            return reg, target, reg
+        return target, reg, reg
+    # Not enough registers to hold the first value while
+    # evaluating the second
+    if available < 2:
+        raise RegisterExhausted("No registers left for a binary operation")
+    left.gen(context, target)
+    temp = context.allocate_temp()
+    context.emit("STORE", target, ref=temp, comment="# spill")
+    right.gen(context, target)
+    reg = context.allocate_register()
+    context.emit("LOAD", reg, ref=temp, comment="# reload")
+    context.free_temp(temp)
+    return reg, target, reg
+
 
 class BinOp(Expr):
     """Abstract base class for binary operators +, *, /, -"""
@@ -96,7 +265,9 @@ class BinOp(Expr):
         """Each concrete subclass must define _apply(int, int)->int"""
         left_val = self.left.eval()
         right_val = self.right.eval()
-        return IntConst(self._apply(left_val.value, right_val.value))
+        if self.in_range:
+            return IntConst(self._apply(left_val.value, right_val.value))
+        return IntConst(ARITH.binop(self._apply, left_val.value, right_val.value))
 
     def __str__(self) -> str:
         """Implementations of __str__ should return the expression in algebraic notation"""
@@ -117,12 +288,20 @@ class BinOp(Expr):
         """Which operation code do we use in the generated assembly code?"""
         raise NotImplementedError("Each binary operator should define the _opcode method")
 
+    def need(self) -> int:
+        left_need = self.left.need()
+        right_need = self.right.need()
+        if left_need == right_need:
+            return left_need + 1
+        return max(left_need, right_need)
+
     def gen(self, context: Context, target: str):
-        self.left.gen(context, target)
-        reg = context.allocate_register()
-        self.right.gen(context, reg)
-        context.add_line(f"   {self._opcode()}  {target},{target},{reg}")
-        context.free_register(reg)
+        if context.select_instructions and tiled(self, context, target):
+            return
+        left, right, extra = gen_operands(context, self.left, self.right, target)
+        context.emit(self._opcode(), target, left, right)
+        if extra:
+            context.free_register(extra)
 
 
 class Plus(BinOp):
@@ -190,7 +369,12 @@ class UnOp(Expr):
     def eval(self) -> "IntConst":
         """Each concrete subclass must define _apply(int, int)->int"""
         left_val = self.left.eval()
-        return IntConst(self._apply(left_val.value))
+        if self.in_range:
+            return IntConst(self._apply(left_val.value))
+        return IntConst(ARITH.unop(self._apply, left_val.value))
+
+    def need(self) -> int:
+        return self.left.need()
 
     def __str__(self) -> str:
         """Implementations of __str__ should return the expression in algebraic notation"""
@@ -218,8 +402,10 @@ class Neg(UnOp):
         return 0 - left
 
     def gen(self, context: Context, target: str):
+        if context.select_instructions and tiled(self, context, target):
+            return
         self.left.gen(context, target)
-        context.add_line(f"    SUB {target},r0,{target}  # Flip the sign")
+        context.emit("SUB", target, "r0", target, comment="# Flip the sign")
 
 
 class Abs(UnOp):
@@ -233,12 +419,10 @@ class Abs(UnOp):
         return abs(left)
 
     def gen(self, context: Context, target: str):
+        """Branch-free:  flip the sign only if it's negative"""
         self.left.gen(context, target)
-        pos = context.new_label("already_positive")
-        context.add_line(f"    SUB  r0,{target},r0  # <Abs>")
-        context.add_line(f"    JUMP/PZ {pos}")
-        context.add_line(f"    SUB {target},r0,{target}  # Flip the sign")
-        context.add_line(f"{pos}:   # </Abs>")
+        context.emit("SUB", "r0", target, "r0", comment="# <Abs>")
+        context.emit("SUB", target, "r0", target, predicate="M", comment="# Flip the sign </Abs>")
 
 
 class Var(Expr):
@@ -266,13 +450,21 @@ class Var(Expr):
         """Return the label that the compiler will use for this variable"""
         return context.get_var_symbol(self.name)
 
+    def register(self, context: Context) -> Optional[str]:
+        return context.var_registers.get(self.name)
+
     def gen(self, context: Context, target: str):
         """Generate code into the context object.
         Result of expression evaluation will be
         left in target register.
         """
+        reg = self.register(context)
+        if reg:
+            if reg != target:
+                context.emit("ADD", target, "r0", reg, comment=f"# {self.name}")
+            return
         label = context.get_var_symbol(self.name)
-        context.add_line(f"    LOAD {target},{label}")
+        context.emit("LOAD", target, ref=label)
         return
 
 
@@ -295,11 +487,25 @@ class Assign(Expr):
         self.left.assign(r_val)
         return r_val
 
+    def need(self) -> int:
+        return self.right.need()
+
     def gen(self, context: Context, target: str):
-        """Store value of expression into variable"""
-        loc = self.left.lvalue(context)
-        self.right.gen(context, target)
-        context.add_line(f"   STORE  {target},{loc}")
+        """Store value of expression into variable.
+        A variable that lives in a register is computed directly
+        into that register, unless the expression still needs the
+        old value after it starts writing its result.
+        """
+        reg = self.left.register(context)
+        if reg is None:
+            loc = self.left.lvalue(context)
+            self.right.gen(context, target)
+            context.emit("STORE", target, ref=loc)
+        elif self.left.name not in variables(self.right) or single_instruction(self.right):
+            self.right.gen(context, reg)
+        else:
+            self.right.gen(context, target)
+            context.emit("ADD", reg, "r0", target, comment=f"# {self.left.name}")
 
 
 class Control(Expr):
@@ -311,7 +517,12 @@ class Control(Expr):
     in Python and 'void' in C or C++), so we return 0
     from eval.
     """
-    pass
+    # Profile data (see pgo.py):  the node's place among the
+    # ifs and whiles of the program as written, and its counts
+    # from a profile (If: times true, times false; While: times
+    # entered, trips)
+    site = None
+    counts = None
     # Note PyCharm will complain that Control doesn't implement all
     # abstract methods, but that's because Control is itself an
     # abstract base class ... the abstract methods should be implemented
@@ -338,12 +549,9 @@ class Seq(Control):
         return self.right.eval()
 
     def gen(self, context: Context, target: str):
-        """ #FIXME """
+        """Code for left, then code for right"""
         self.left.gen(context, target)
-        self.left.eval()
-
         self.right.gen(context, target)
-        self.right.eval()
 
 
 
@@ -371,8 +579,11 @@ class Print(Control):
 
     def gen(self, context: Context, target: str):
         """We print by storing to the memory-mapped address 511"""
-        self.expr.gen(context, target)
-        context.add_line(f"   STORE  {target},r0,r0[511]")
+        reg = self.expr.register(context)
+        if reg is None:
+            self.expr.gen(context, target)
+            reg = target
+        context.emit("STORE", reg, "r0", "r0", 511)
 
 
 class Read(Expr):
@@ -389,12 +600,11 @@ class Read(Expr):
 
     def eval(self) -> IntConst:
         val = input("Quack! Gimme an int! ")
-        return IntConst(int(val))
+        return IntConst(ARITH.fit(int(val)))
 
     def gen(self, context: Context, target: str):
         """Get value from input by loading instruction from memory address 510"""
-        self.expr.eval()
-        context.add_line(f"   LOAD  {target},r0,r0[510]")
+        context.emit("LOAD", target, "r0", "r0", 510)
 
 
 class Comparison(Control):
@@ -405,12 +615,15 @@ class Comparison(Control):
     In the compiler, "if" and "while" delegate that branching
     to the relational construct, i.e., x < y does not create
     a value in a register but rather causes a jump if y - x
-    is positive.  Condition code is the condition code for
+    is positive.  Where a comparison is used as a value, gen
+    puts 0 or 1 in a register with a predicated ADD.  Condition code is the condition code for
     the conditional JUMP after a subtraction, e.g., Z for
     equality, P for >, PZ for >=.
     For each comparison, we give two condition codes: One if
     we want to branch when the condition is true, and another
-    if we want to branch when the condition is false.
+    if we want to branch when the condition is false.  A
+    subtraction that overflows sets only V, and then the
+    comparison is false (see arith.py).
     (Currently the compiler only uses the cond_code_false
     conditions, because it is jumping to the 'else' branch
     or out of the loop.)
@@ -440,35 +653,105 @@ class Comparison(Control):
         """
         left_val = self.left.eval()
         right_val = self.right.eval()
-        return IntConst(self._apply(left_val.value, right_val.value))
+        if self.in_range:
+            return IntConst(self._apply(left_val.value, right_val.value))
+        return IntConst(self._apply(*ARITH.relation(left_val.value, right_val.value)))
+
+    def operand_need(self) -> int:
+        """Registers to evaluate both operands for the comparison"""
+        left_need = self.left.need()
+        right_need = self.right.need()
+        if left_need == right_need:
+            return left_need + 1
+        return max(left_need, right_need)
+
+    def need(self) -> int:
+        """As a value, the operands are evaluated apart from the
+        target, which is cleared before the comparison.
+        """
+        return self.operand_need() + 1
 
     def gen(self, context: Context, target: str):
-        """We don't support using relational operators to
-        produce a value (although it would be easy to add).
+        """The value of the relation, 0 or 1, without jumping:
+        clear target, compare, and set target to 1 under the
+        condition code for true.  The operands are evaluated into
+        other registers, since target is cleared before the
+        comparison (which must come right before the predicated ADD).
+        Without registers enough for them, we jump instead.
+        """
+        if self.left.register(context) and self.right.register(context):
+            work = None
+        elif context.free_register_count() >= self.operand_need():
+            work = context.allocate_register()
+        else:
+            self.gen_with_jumps(context, target)
+            return
+        left, right, extra, offset = self.operands(context, work)
+        context.emit("ADD", target, "r0", "r0", comment=f"# {self}")
+        context.emit("SUB", "r0", left, right, offset=offset)
+        context.emit("ADD", target, "r0", "r0", offset=1, predicate=self.cond_code_true,
+                     comment=f"#{self.opsym}")
+        if extra:
+            context.free_register(extra)
+        if work:
+            context.free_register(work)
+
+    def gen_with_jumps(self, context: Context, target: str):
+        """The value of the relation when no register is left
+        to hold the operands apart from target.
+        """
+        false = context.new_label("false")
+        done = context.new_label("done")
+        self.condjump(context, target, false, jump_cond=False)
+        context.emit("ADD", target, "r0", "r0", offset=1)
+        context.emit("JUMP", ref=done)
+        context.add_label(false)
+        context.emit("ADD", target, "r0", "r0")
+        context.add_label(done)
+
+    def likely(self) -> bool:
+        """Static guess whether the relation holds, after Ball
+        and Larus:  values are seldom equal, and seldom negative.
         """
-        raise NotImplementedError("Relational operators do not support 'gen'; try 'condjump'")
+        if self.opsym in ["==", "!="]:
+            return self.opsym == "!="
+        if isinstance(self.right, IntConst) and self.right.value == 0:
+            return self.opsym in [">", ">="]
+        if isinstance(self.left, IntConst) and self.left.value == 0:
+            return self.opsym in ["<", "<="]
+        return True
+
+    def operands(self, context: Context, target: str) -> (str, str, Optional[str], int):
+        """Evaluate the operands for SUB r0,left,right[offset];
+        returns (left, right, extra, offset), where extra is a
+        register to free afterward (see gen_operands).
+        """
+        if context.select_instructions:
+            import isel
+            return isel.compare_operands(self, context, target)
+        left, right, extra = gen_operands(context, self.left, self.right, target)
+        return left, right, extra, 0
 
     def condjump(self, context: Context, target: str, label: str, jump_cond: bool = True):
         """Generate jump to label conditional on relation. """
-        self.left.gen(context, target)
-        reg = context.allocate_register()
-        self.right.gen(context, reg)
+        left, right, extra, offset = self.operands(context, target)
         if jump_cond:
             cond = self.cond_code_true
         else:
             cond = self.cond_code_false
         # All relations are implemented by subtraction.  What varies is
         # the condition code controlling the jump.
-        context.add_line(f"   SUB  r0,{target},{reg}")
-        context.add_line(f"   JUMP/{cond}  {label}  #{self.opsym}")
-        context.free_register(reg)
+        context.emit("SUB", "r0", left, right, offset=offset)
+        context.emit("JUMP", ref=label, predicate=cond, comment=f"#{self.opsym}")
+        if extra:
+            context.free_register(extra)
 
 
 class EQ(Comparison):
     """left == right"""
 
     def __init__(self, left: Expr, right: Expr):
-        super().__init__(left, right, "==", "Z", "PM")
+        super().__init__(left, right, "==", "Z", "PMV")
 
     def _apply(self, left: int, right: int) -> int:
         return 1 if left == right else 0
@@ -476,7 +759,7 @@ class EQ(Comparison):
 class NE(Comparison):
     """left != right"""
     def __init__(self, left: Expr, right: Expr):
-        super().__init__(left, right, "!=", "PM", "Z")
+        super().__init__(left, right, "!=", "PM", "ZV")
 
     def _apply(self, left: int, right: int) -> int:
         return 1 if left != right else 0
@@ -484,7 +767,7 @@ class NE(Comparison):
 class GT(Comparison):
     """left > right"""
     def __init__(self, left: Expr, right: Expr):
-        super().__init__(left, right, ">", "P", "ZM")
+        super().__init__(left, right, ">", "P", "ZMV")
 
     def _apply(self, left: int, right: int) -> int:
         return 1 if left > right else 0
@@ -492,7 +775,7 @@ class GT(Comparison):
 class GE(Comparison):
     """left >= right"""
     def __init__(self, left: Expr, right: Expr):
-        super().__init__(left, right, ">=", "PZ", "M")
+        super().__init__(left, right, ">=", "PZ", "MV")
 
     def _apply(self, left: int, right: int) -> int:
         return 1 if left >= right else 0
@@ -500,7 +783,7 @@ class GE(Comparison):
 class LT(Comparison):
     """left < right"""
     def __init__(self, left: Expr, right: Expr):
-        super().__init__(left, right, "<", "M", "PZ")
+        super().__init__(left, right, "<", "M", "PZV")
 
     def _apply(self, left: int, right: int) -> int:
         return 1 if left < right else 0
@@ -508,7 +791,7 @@ class LT(Comparison):
 class LE(Comparison):
     """left <= right"""
     def __init__(self, left: Expr, right: Expr):
-        super().__init__(left, right, "<=", "MZ", "P")
+        super().__init__(left, right, "<=", "MZ", "PV")
 
     def _apply(self, left: int, right: int) -> int:
         return 1 if left <= right else 0
@@ -517,10 +800,19 @@ class LE(Comparison):
 class While(Control):
     """Classic while loop."""
 
+    # Trips of the loop as written per trip of this one
+    # (more than 1 once it is unrolled; see unroll.py)
+    steps = 1
+
     def __init__(self, cond: Comparison, expr: Expr):
         """While cond do expr"""
         self.cond = cond
         self.expr = expr
+        # Tiered execution state:  iterations run by eval, and
+        # the compiled fast path once the loop becomes hot
+        # (None until we try, False if the loop can't be compiled)
+        self.iterations = 0
+        self.fast_path = None
 
     def __str__(self):
         return f"while {self.cond} do\n{self.expr}\nod"
@@ -532,23 +824,58 @@ class While(Control):
         """
         Repeat 'expr' part while 'cond' part evaluates to a non-zero
         value.  Returns value of last statement executed.
+        Once the loop is hot, the remaining iterations are handed
+        to the compiled fast path at the next iteration boundary
+        (before the condition is tested again).
         """
         last = NO_VALUE
-        cond_val = self.cond.eval()
-        while cond_val.value != 0:
-            last = self.expr.eval()
+        if PROFILE is not None:
+            PROFILE.enter(self)
+        while True:
+            if self.fast_path:
+                if self.fast_path.arith is ARITH and self.fast_path.assumes <= ENV.keys():
+                    return self.fast_path(ENV, last)
+                # The fast path was compiled for other semantics, or
+                # a variable it relies on is gone; start over
+                self.fast_path = None
+                self.iterations = 0
             cond_val = self.cond.eval()
-        return last
+            if cond_val.value == 0:
+                return last
+            if PROFILE is not None:
+                PROFILE.trip(self)
+            last = self.expr.eval()
+            self.iterations += 1
+            if (self.fast_path is None and HOT_LOOP_THRESHOLD is not None
+                    and self.iterations >= HOT_LOOP_THRESHOLD):
+                import tiered
+                self.fast_path = tiered.compile_loop(self) or False
 
     def gen(self, context: Context, target: str):
         """Looping"""
         loop_head = context.new_label("while_do")
         loop_exit = context.new_label("od")
-        context.add_line(f"{loop_head}:")
+        if context.layout_branches:
+            self.gen_rotated(context, target, loop_head, loop_exit)
+            return
+        context.add_label(loop_head)
         self.cond.condjump(context, target, loop_exit, jump_cond=False)
+        context.mark_branch(self, "test")
         self.expr.gen(context, target)
-        context.add_line(f"   JUMP  {loop_head}")
-        context.add_line(f"{loop_exit}:")
+        context.emit("JUMP", ref=loop_head)
+        context.add_label(loop_exit)
+
+    def gen_rotated(self, context: Context, target: str, loop_head: str, loop_exit: str):
+        """The loop tested at the bottom, with a guard to skip it
+        entirely:  one jump per iteration instead of two.
+        """
+        self.cond.condjump(context, target, loop_exit, jump_cond=False)
+        context.mark_branch(self, "guard")
+        context.add_label(loop_head)
+        self.expr.gen(context, target)
+        self.cond.condjump(context, target, loop_head, jump_cond=True)
+        context.mark_branch(self, "bottom")
+        context.add_label(loop_exit)
 
 
 class Pass(Control):
@@ -593,6 +920,8 @@ class If(Control):
     def eval(self) -> IntConst:
         """If statement.  Returns nothing. """
         cond_value = self.cond.eval()
+        if PROFILE is not None:
+            PROFILE.branch(self, cond_value.value != 0)
         if cond_value.value != 0:
             result = self.thenpart.eval()
         else:
@@ -600,21 +929,141 @@ class If(Control):
         return result
 
     def gen(self, context: Context, target: str):
-
-        predicate = context.new_label("if")
-        self.cond.condjump(context, target, predicate, jump_cond=False)
+        """Test the condition, jumping to the else part if it
+        is false; the then part jumps over the else part.
+        Small ifs may be generated without jumps instead; see
+        if_convert.
+        """
+        if self.if_convert(context, target):
+            return
+        if context.layout_branches:
+            self.gen_laid_out(context, target)
+            return
         otherwise = context.new_label("else")
-        context.add_line(f"{predicate}")
-        #self.cond.gen(context, target)
-        execute = context.new_label("fi")
-        context.add_line(f"   JUMP  {execute}")
-
-
-
-
-
-
-
-
-
-
+        endif = context.new_label("fi")
+        self.cond.condjump(context, target, otherwise, jump_cond=False)
+        context.mark_branch(self, "false")
+        self.thenpart.gen(context, target)
+        context.emit("JUMP", ref=endif)
+        context.add_label(otherwise)
+        self.elsepart.gen(context, target)
+        context.add_label(endif)
+
+    def likely(self) -> bool:
+        """Is the then part the likely path?  As the profile
+        counted, if there is one; else as the condition predicts.
+        """
+        if self.counts and sum(self.counts):
+            return self.counts[0] >= self.counts[1]
+        return self.cond.likely()
+
+    def gen_laid_out(self, context: Context, target: str):
+        """The likely arm (If.likely) falls through from the test
+        without a jump; the other is generated out of line, and
+        jumps back.
+        """
+        likely = self.likely()
+        common, rare = (self.thenpart, self.elsepart) if likely else (self.elsepart, self.thenpart)
+        endif = context.new_label("fi")
+        # The test jumps away when the condition is false if the
+        # then part is likely, and when it is true if it isn't
+        sense = "false" if likely else "true"
+        if isinstance(rare, Pass):
+            self.cond.condjump(context, target, endif, jump_cond=not likely)
+            context.mark_branch(self, sense)
+            common.gen(context, target)
+            context.add_label(endif)
+            return
+        away = context.new_label("else" if likely else "then")
+        self.cond.condjump(context, target, away, jump_cond=not likely)
+        context.mark_branch(self, sense)
+        common.gen(context, target)
+        context.add_label(endif)
+        with context.out_of_line():
+            context.add_label(away)
+            rare.gen(context, target)
+            context.emit("JUMP", ref=endif)
+
+    def predicated_arms(self, context: Context) -> Optional[list]:
+        """(assignment, predicate) for each assignment of the then
+        and else parts, if they can be made predicated instructions:
+        every value is computed before the condition is tested, so
+        the arms must be side-effect-free assignments that don't use
+        values assigned earlier in the same arm.
+        """
+        if not isinstance(self.cond, Comparison):
+            return None
+        arms = []
+        for block, cond in [(self.thenpart, self.cond.cond_code_true),
+                            (self.elsepart, self.cond.cond_code_false)]:
+            assigns = assignments(block)
+            if assigns is None:
+                return None
+            assigned = set()
+            for assign in assigns:
+                if variables(assign.right) & assigned:
+                    return None
+                assigned.add(assign.left.name)
+                arms.append((assign, cond))
+        if not arms:
+            return None
+        # The condition is tested again before each predicated
+        # instruction; it must not see a register variable change
+        changed = {assign.left.name for assign, _ in arms if assign.left.register(context)}
+        if len(arms) > 1 and changed & variables(self.cond):
+            return None
+        return arms
+
+    def gen_predicated(self, context: Context, target: str, arms: list):
+        """Compute the values of all the assignments, then store
+        each under the predicate of its arm.  Every instruction that
+        executes sets the condition code, so the comparison is
+        repeated before each predicated instruction.
+        """
+        values, allocated = [], []
+        for assign, _ in arms:
+            # (Only one arm's stores execute, so a variable in a
+            # register still holds its old value when it is used)
+            reg = assign.right.register(context)
+            if reg is None:
+                reg = context.allocate_register()
+                assign.right.gen(context, reg)
+                allocated.append(reg)
+            values.append(reg)
+        left, right, extra, offset = self.cond.operands(context, target)
+        comment = f"#{self.cond.opsym}"
+        for (assign, cond), reg in zip(arms, values):
+            context.emit("SUB", "r0", left, right, offset=offset, comment=comment)
+            comment = "# again"
+            var_reg = assign.left.register(context)
+            if var_reg:
+                context.emit("ADD", var_reg, "r0", reg, predicate=cond,
+                             comment=f"# {assign.left.name}")
+            else:
+                context.emit("STORE", reg, ref=assign.left.lvalue(context), predicate=cond)
+        if extra:
+            context.free_register(extra)
+        for reg in reversed(allocated):
+            context.free_register(reg)
+
+    def if_convert(self, context: Context, target: str) -> bool:
+        """Generate the if as straight-line predicated code, if it
+        is eligible (predicated_arms) and the code takes no more than
+        context.if_conversion_cost instructions.  Returns True if it did.
+        """
+        if context.if_conversion_cost is None:
+            return False
+        arms = self.predicated_arms(context)
+        if arms is None:
+            return False
+        trial = context.scratch()
+        try:
+            self.gen_predicated(trial, target, arms)
+        except RegisterExhausted:
+            return False
+        if len(trial.instrs) > context.if_conversion_cost:
+            return False
+        self.gen_predicated(context, target, arms)
+        jumps = 1 if isinstance(self.elsepart, Pass) else 2
+        context.if_conversions.append(f"if {self.cond}: {jumps} jumps eliminated")
+        return True
@@ -9,9 +9,17 @@ mallard program executing on a duck machine.
 
 from llparse import parse
 import expr
+import arith
+import lockstep
+import pgo
+import ranges
+import sccp
+import scev
+import unroll
 
 import argparse
 import sys
+from collections import Counter
 
 import logging
 
@@ -28,15 +36,77 @@ def cli() -> object:
     parser.add_argument("outfile", type=argparse.FileType('w'),
                         nargs="?", default=sys.stdout,
                         help="Output file for assembly code")
+    parser.add_argument("--hot", type=int, default=expr.HOT_LOOP_THRESHOLD,
+                        help="Compile a while loop after this many iterations")
+    parser.add_argument("--no-tiering", action="store_true",
+                        help="Run every loop in the tree-walking interpreter")
+    parser.add_argument("--arith", choices=sorted(arith.SEMANTICS), default="bigint",
+                        help="Integer semantics: unbounded, or 32-bit like the Duck Machine")
+    parser.add_argument("--sccp", action="store_true",
+                        help="Fold constants and remove code that can never run before interpreting")
+    parser.add_argument("--ranges", action="store_true",
+                        help="Find the range of each variable, and use it to drop abs, "
+                        "decided comparisons, and overflow checks, before interpreting")
+    parser.add_argument("--closed-form", action="store_true",
+                        help="Replace accumulation loops by closed forms before interpreting")
+    parser.add_argument("--unroll", type=int, default=None,
+                        help="Unroll counting loops by this factor before interpreting")
+    parser.add_argument("--lanes", type=argparse.FileType('r'),
+                        help="Run once per line of this file (the inputs for 'read'), in lockstep")
+    parser.add_argument("--profile", type=argparse.FileType('w'),
+                        help="Write a profile of the run here, for compile.py --profile "
+                        "(turns off tiering)")
     args = parser.parse_args()
+    if args.profile and args.lanes:
+        parser.error("--profile records a single run, not --lanes")
     return args
 
 def main():
     args = cli()
+    expr.HOT_LOOP_THRESHOLD = None if args.no_tiering else args.hot
+    expr.ARITH = arith.SEMANTICS[args.arith]()
     try:
         exp = parse(args.sourcefile)
         log.debug(repr(exp))
-        exp.eval()
+        # Numbered before any rewriting, as compile.py numbers them
+        sites = pgo.annotate(exp)
+        removed = Counter()
+        if args.sccp:
+            exp = sccp.simplify(exp, removed)
+        replaced = Counter()
+        if args.closed_form:
+            exp = scev.replace_loops(exp, replaced)
+        unrolled = Counter()
+        if args.unroll:
+            exp = unroll.unroll(exp, args.unroll, stats=unrolled)
+        narrowed, found = Counter(), None
+        if args.ranges:
+            exp, found = ranges.narrow(exp, isinstance(expr.ARITH, arith.Int32), narrowed)
+        if args.lanes:
+            rows = [[int(word) for word in line.split()]
+                    for line in args.lanes if line.strip()]
+            result = lockstep.run_lockstep(exp, rows)
+            for lane, printed in enumerate(result.outputs):
+                print(f"Quack! lane {lane}: {' '.join(str(v) for v in printed)}")
+        elif args.profile:
+            with pgo.recording(sites) as profile:
+                exp.eval()
+            profile.write(args.profile)
+        else:
+            exp.eval()
+        for stat, count in removed.items():
+            print(f"#sccp {count} {stat}")
+        for stat, count in replaced.items():
+            print(f"#scev {count} {stat}")
+        for stat, count in unrolled.items():
+            print(f"#unroll {count} {stat}")
+        for stat, count in narrowed.items():
+            print(f"#range {count} {stat}")
+        if found:
+            for line in found.report():
+                print(f"#range {line}")
+        if expr.ARITH.overflows:
+            print(f"#{expr.ARITH.overflows} arithmetic overflows")
         print("#Interpretation complete")
     except Exception as e:
         print("Failed!")
@@ -0,0 +1,247 @@
+"""
+Instruction selection by tree pattern matching.
+
+The code generator proper expands each AST node on its own:
+every IntConst is a LOAD from a const_N word, and every BinOp
+an instruction on two registers.  But the second operand of a
+DM2019W instruction is a register plus a displacement,
+src2[disp], so a small constant, or a register plus a small
+constant, costs no instruction of its own:
+
+    x + 1          ADD  r1,rx,r0[1]
+    x * (y - 3)    MUL  r1,rx,ry[-3]
+    5 - x          SUB  r1,r0,rx[-5]
+    x < 7          SUB  r0,rx,r0[7]
+    42             ADD  r1,r0,r0[42]
+
+Following the BURS approach (Fraser, Henry, and Proebsting), we
+tile the tree with the patterns in RULES.  Each rule derives a
+nonterminal from a node whose children are derived as the
+nonterminals it names, at a cost.  A bottom-up labeling pass
+finds the cheapest rule for each nonterminal at each node, and
+code is emitted top-down from the cheapest "reg" (or "cmp")
+rule.  The nonterminals are
+
+    imm    a constant that fits in the displacement field
+    disp   a register plus a displacement (the base register
+           may be r0):  the second operand of an ALU instruction
+    reg    a value in a register
+    cmp    the condition code set for a comparison
+
+Costs count instructions, plus one for each memory access.
+Nodes no rule covers are generated by their own gen method (the
+"classic" rule).  Because constants in immediates never get a
+const_N word, those words drop out of the data pool.
+"""
+
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+import expr
+from expr import Expr, IntConst, Var, Plus, Minus, Times, Neg, BinOp, Comparison
+from codegen_context import Context, MAX_REACH
+
+# The displacement field is 10 bits, signed
+OFFSET_MIN = -(MAX_REACH + 1)
+OFFSET_MAX = MAX_REACH
+
+INFINITE = float("inf")
+MEMORY = 1   # Extra cost of an instruction that accesses memory
+
+
+def fits(value: int) -> bool:
+    return OFFSET_MIN <= value <= OFFSET_MAX
+
+
+class Rule(NamedTuple):
+    """nonterminal <- node(kids), at cost (plus the cost of the
+    kids).  'node' is a class of AST node, or None for a chain rule
+    deriving one nonterminal from another at the same node.
+    'emit' gets the context, the node, the target register, and the
+    operands of the kids:  the node itself for a reg kid, the
+    value of an imm kid, (base expression or None, offset) for
+    a disp kid.  Rules for disp and imm return such an operand
+    rather than emitting code.
+    """
+    name: str
+    nonterminal: str
+    node: Optional[type]
+    kids: Tuple[str, ...]
+    cost: int
+    emit: Callable
+    when: Callable[[Expr, Context], bool] = lambda e, context: True
+
+
+def registers(context: Context, left: Optional[Expr], base: Optional[Expr],
+              target: str) -> (str, str, Optional[str]):
+    """Registers holding left and base (r0 for None), and the extra
+    register to free afterward, as gen_operands.
+    """
+    if left is not None and base is not None:
+        return expr.gen_operands(context, left, base, target)
+    one = left if left is not None else base
+    reg = "r0"
+    if one is not None:
+        reg = one.register(context)
+        if reg is None:
+            one.gen(context, target)
+            reg = target
+    return (reg, "r0", None) if left is not None else ("r0", reg, None)
+
+
+def alu(opcode: str, context: Context, target: str,
+        left: Optional[Expr], disp: Tuple[Optional[Expr], int]):
+    """opcode target,left,base[offset]"""
+    base, offset = disp
+    left_reg, base_reg, extra = registers(context, left, base, target)
+    context.emit(opcode, target, left_reg, base_reg, offset=offset)
+    if extra:
+        context.free_register(extra)
+
+
+def emit_alu(context: Context, e: BinOp, target: str, kids: tuple):
+    alu(e._opcode(), context, target, kids[0], kids[1])
+
+
+def emit_swapped(context: Context, e: BinOp, target: str, kids: tuple):
+    alu(e._opcode(), context, target, kids[1], kids[0])
+
+
+def emit_rsub(context: Context, e: Minus, target: str, kids: tuple):
+    """k - x is 0 - (x + -k)"""
+    k, right = kids
+    alu("SUB", context, target, None, (right, -k))
+
+
+def emit_neg(context: Context, e: Neg, target: str, kids: tuple):
+    alu("SUB", context, target, None, kids[0])
+
+
+def classic(context: Context, e: Expr, target: str, kids: tuple):
+    """Not tiled:  the node generates its own code"""
+    return classic
+
+
+def emit_compare(context: Context, e: Comparison, target: str, kids: tuple):
+    left, (base, offset) = kids
+    return registers(context, left, base, target) + (offset,)
+
+
+def emit_compare_imm(context: Context, e: Comparison, target: str, kids: tuple):
+    """k - x is 0 - (x + -k), with the same condition code"""
+    k, right = kids
+    left_reg, base_reg, extra = registers(context, None, right, target)
+    return left_reg, base_reg, extra, -k
+
+
+def in_register(e: Var, context: Context) -> bool:
+    return e.register(context) is not None
+
+
+def constant(e: Expr) -> bool:
+    return isinstance(e, IntConst)
+
+
+RULES = [
+    Rule("imm", "imm", IntConst, (), 0, lambda c, e, t, k: e.value,
+         when=lambda e, context: fits(e.value)),
+    Rule("const", "reg", IntConst, (), 1 + MEMORY, classic),
+    Rule("var", "reg", Var, (), 1 + MEMORY, classic,
+         when=lambda e, context: not in_register(e, context)),
+    Rule("var_register", "reg", Var, (), 0, classic, when=in_register),
+    Rule("alu", "reg", BinOp, ("reg", "disp"), 1, emit_alu),
+    Rule("alu_swapped", "reg", (Plus, Times), ("disp", "reg"), 1, emit_swapped,
+         when=lambda e, context: expr.side_effect_free(e)),
+    Rule("rsub", "reg", Minus, ("imm", "reg"), 1, emit_rsub,
+         when=lambda e, context: constant(e.left) and fits(-e.left.value)),
+    Rule("neg", "reg", Neg, ("disp",), 1, emit_neg),
+    Rule("plus_imm", "disp", Plus, ("reg", "imm"), 0, lambda c, e, t, k: k),
+    Rule("imm_plus", "disp", Plus, ("imm", "reg"), 0, lambda c, e, t, k: (k[1], k[0])),
+    Rule("minus_imm", "disp", Minus, ("reg", "imm"), 0, lambda c, e, t, k: (k[0], -k[1]),
+         when=lambda e, context: constant(e.right) and fits(-e.right.value)),
+    Rule("compare", "cmp", Comparison, ("reg", "disp"), 1, emit_compare),
+    Rule("compare_imm", "cmp", Comparison, ("imm", "reg"), 1, emit_compare_imm,
+         when=lambda e, context: constant(e.left) and fits(-e.left.value)),
+    # Chain rules, applied in this order after the others
+    Rule("load_imm", "reg", None, ("imm",), 1, lambda c, e, t, k: alu("ADD", c, t, None, (None, k[0]))),
+    Rule("imm_disp", "disp", None, ("imm",), 0, lambda c, e, t, k: (None, k[0])),
+    Rule("reg_disp", "disp", None, ("reg",), 0, lambda c, e, t, k: (k[0], 0)),
+]
+
+
+class Label(NamedTuple):
+    cost: float
+    rule: Optional[Rule]
+
+
+def children(e: Expr) -> list:
+    return [child for child in [getattr(e, "left", None), getattr(e, "right", None)]
+            if isinstance(child, Expr)]
+
+
+def label(e: Expr, context: Context) -> Dict[str, Label]:
+    """Cheapest rule for each nonterminal at e (memoized in context.tiles)"""
+    key = id(e)
+    if key in context.tiles:
+        return context.tiles[key][1]
+    best = {}
+
+    def consider(rule: Rule, cost: float):
+        if cost < best.get(rule.nonterminal, Label(INFINITE, None)).cost:
+            best[rule.nonterminal] = Label(cost, rule)
+
+    def chain():
+        for rule in RULES:
+            if rule.node is None and all(nt in best for nt in rule.kids) and rule.when(e, context):
+                consider(rule, rule.cost + sum(best[nt].cost for nt in rule.kids))
+
+    kids = children(e)
+    for rule in RULES:
+        if (rule.node is not None and isinstance(e, rule.node)
+                and len(rule.kids) == len(kids) and rule.when(e, context)):
+            costs = [label(kid, context).get(nt, Label(INFINITE, None)).cost
+                     for kid, nt in zip(kids, rule.kids)]
+            consider(rule, rule.cost + sum(costs))
+    chain()
+    if "reg" not in best:
+        # Anything can be generated the old way, and then used
+        # wherever a register can be
+        cost = 1 + sum(label(kid, context)["reg"].cost for kid in kids)
+        consider(Rule("classic", "reg", None, (), 0, classic), cost)
+        chain()
+    # (Keeping e keeps its id from being reused)
+    context.tiles[key] = (e, best)
+    return best
+
+
+def operand(e: Expr, nonterminal: str, context: Context):
+    """The operand derived as nonterminal from e (without code)"""
+    if nonterminal == "reg":
+        return e
+    rule = label(e, context)[nonterminal].rule
+    return rule.emit(context, e, None, kid_operands(e, rule, context))
+
+
+def kid_operands(e: Expr, rule: Rule, context: Context) -> tuple:
+    if rule.node is None:
+        return tuple(operand(e, nt, context) for nt in rule.kids)
+    return tuple(operand(kid, nt, context) for kid, nt in zip(children(e), rule.kids))
+
+
+def select(e: Expr, context: Context, target: str) -> bool:
+    """Generate e into target by its cheapest tiling.  Returns False,
+    having generated nothing, if e is best generated by its own
+    gen method.
+    """
+    rule = label(e, context)["reg"].rule
+    if rule.emit is classic:
+        return False
+    rule.emit(context, e, target, kid_operands(e, rule, context))
+    return True
+
+
+def compare_operands(cond: Comparison, context: Context, target: str) -> (str, str, Optional[str], int):
+    """Registers for SUB r0,left,right[offset] comparing cond's
+    operands:  (left, right, extra register to free, offset)
+    """
+    rule = label(cond, context)["cmp"].rule
+    return rule.emit(context, cond, target, kid_operands(cond, rule, context))
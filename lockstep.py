@@ -0,0 +1,272 @@
+"""
+Lockstep evaluation of one Mallard program over many input sets.
+
+For a parameter sweep we want to run the same program on tens of
+thousands of inputs.  Rather than calling Expr.eval once per input
+set, we evaluate the program once with every variable holding a
+NumPy array, one element ("lane") per input set.  Arithmetic and
+comparisons work element-wise on whole arrays.
+
+Control flow is handled with masks:  each statement is executed
+with a boolean array telling which lanes are active.  'if' splits
+the active lanes between the two arms; 'while' keeps executing its
+body until no active lane still satisfies the condition.  Lanes
+that are not active are carried along but never changed, so each
+lane follows its own path through the program and ends with the
+same variables and output it would have had in the interpreter.
+
+Each lane reads from its own column of inputs (lanes consume
+inputs at different rates), and each lane collects its own list
+of printed values.
+
+Integer semantics follow expr.ARITH (see arith.py).  With the
+default unbounded ints, lanes are int64 and a lane that overflows
+raises LaneOverflow rather than silently giving a different answer
+(dtype=object trades speed for exact Python ints).  With
+arith.Int32, lanes are int32 and wrap around just like DM2019W
+registers; overflows and divisions by zero are counted in the
+Int32 object's V flag, or raise if it traps.
+
+NumPy is optional for the rest of the compiler; this module
+raises an error if it is used without NumPy installed.
+"""
+
+import expr
+import arith
+
+from typing import Dict, List, Sequence
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class LaneOverflow(Exception):
+    """Raised when a value in an active lane does not fit
+    in the lane word size, so the result would differ from
+    the interpreter's.
+    """
+    pass
+
+
+class LockstepResult(object):
+    """Final variables and printed output of every lane"""
+
+    def __init__(self, env: Dict[str, "np.ndarray"], defined: Dict[str, "np.ndarray"],
+                 outputs: List[List[int]]):
+        self.env = env
+        self.defined = defined
+        self.outputs = outputs
+
+    def __len__(self) -> int:
+        return len(self.outputs)
+
+    def lane_env(self, lane: int) -> Dict[str, int]:
+        """Variables assigned in one lane, as plain ints"""
+        return {name: int(values[lane]) for name, values in self.env.items()
+                if self.defined[name][lane]}
+
+
+class Lockstep(object):
+    """The state of a lockstep evaluation:  one array per
+    variable, one input cursor per lane, one output list
+    per lane.
+    """
+
+    def __init__(self, inputs: Sequence[Sequence[int]], dtype=None,
+                 semantics: arith.BigInt = None):
+        if np is None:
+            raise ImportError("Lockstep evaluation requires numpy")
+        self.arith = semantics or expr.ARITH
+        self.fixed = isinstance(self.arith, arith.Int32)
+        if self.fixed:
+            dtype = np.int32
+        self.dtype = np.dtype(dtype or np.int64)
+        self.lanes = len(inputs)
+        width = max([len(row) for row in inputs], default=0)
+        # Inputs are wrapped to the lane width when they are read
+        in_dtype = object if self.dtype == object else np.int64
+        self.inputs = np.zeros((self.lanes, max(width, 1)), dtype=in_dtype)
+        self.input_len = np.zeros(self.lanes, dtype=np.int64)
+        for lane, row in enumerate(inputs):
+            self.inputs[lane, :len(row)] = row
+            self.input_len[lane] = len(row)
+        self.cursor = np.zeros(self.lanes, dtype=np.int64)
+        self.env = {}
+        self.defined = {}
+        self.outputs = [[] for lane in range(self.lanes)]
+        if self.dtype.kind == "i":
+            info = np.iinfo(self.dtype)
+            self.min, self.max = int(info.min), int(info.max)
+        else:
+            # dtype=object holds Python ints, which never overflow
+            self.min = self.max = None
+
+    def run(self, program: expr.Expr) -> LockstepResult:
+        self._exec(program, np.ones(self.lanes, dtype=bool))
+        return LockstepResult(self.env, self.defined, self.outputs)
+
+    # Statements
+
+    def _exec(self, node: expr.Expr, mask: "np.ndarray"):
+        """Execute node in the lanes selected by mask"""
+        if not mask.any():
+            return
+        if isinstance(node, expr.Seq):
+            self._exec(node.left, mask)
+            self._exec(node.right, mask)
+        elif isinstance(node, expr.Assign):
+            self._assign(node.left.name, self._eval(node.right, mask), mask)
+        elif isinstance(node, expr.Print):
+            values = self._eval(node.expr, mask)
+            for lane in np.flatnonzero(mask):
+                self.outputs[lane].append(int(values[lane]))
+        elif isinstance(node, expr.If):
+            taken = mask & (self._eval(node.cond, mask) != 0)
+            self._exec(node.thenpart, taken)
+            self._exec(node.elsepart, mask & ~taken)
+        elif isinstance(node, expr.While):
+            active = mask & (self._eval(node.cond, mask) != 0)
+            while active.any():
+                self._exec(node.expr, active)
+                active = active & (self._eval(node.cond, active) != 0)
+        elif isinstance(node, expr.Pass):
+            pass
+        else:
+            # Expression used as a statement; evaluate for its effects
+            self._eval(node, mask)
+
+    def _assign(self, name: str, values: "np.ndarray", mask: "np.ndarray"):
+        if name not in self.env:
+            self.env[name] = np.zeros(self.lanes, dtype=self.dtype)
+            self.defined[name] = np.zeros(self.lanes, dtype=bool)
+        self.env[name] = np.where(mask, values, self.env[name]).astype(self.dtype, copy=False)
+        self.defined[name] = self.defined[name] | mask
+
+    # Expressions
+
+    def _eval(self, node: expr.Expr, mask: "np.ndarray") -> "np.ndarray":
+        """Value of node in every lane.  Only the lanes selected
+        by mask are meaningful; the others may hold anything.
+        """
+        if isinstance(node, expr.IntConst):
+            return np.full(self.lanes, node.value, dtype=self.dtype)
+        if isinstance(node, expr.Var):
+            if node.name not in self.env or not self.defined[node.name][mask].all():
+                raise expr.UndefinedVariable(f"{node.name} has not been assigned a value")
+            return self.env[node.name]
+        if isinstance(node, expr.Read):
+            return self._read(mask)
+        if isinstance(node, expr.Assign):
+            values = self._eval(node.right, mask)
+            self._assign(node.left.name, values, mask)
+            return values
+        if isinstance(node, expr.Comparison):
+            left = self._eval(node.left, mask)
+            right = self._eval(node.right, mask)
+            if not self.fixed:
+                return RELATIONS[node.opsym](left, right).astype(np.int64).astype(self.dtype)
+            # Compare the 32-bit difference, as the machine does;
+            # where it overflows, no relation holds
+            with np.errstate(over="ignore"):
+                diff = left - right
+            overflow = ((left < 0) != (right < 0)) & ((diff < 0) != (left < 0))
+            holds = RELATIONS[node.opsym](self._checked(diff, mask, overflow), 0) & ~overflow
+            return holds.astype(np.int64).astype(self.dtype)
+        if isinstance(node, expr.BinOp):
+            left = self._eval(node.left, mask)
+            right = self._eval(node.right, mask)
+            return self._binop(node, left, right, mask)
+        if isinstance(node, expr.UnOp):
+            left = self._eval(node.left, mask)
+            with np.errstate(over="ignore"):
+                result = node._apply(left)
+            # Only the most negative value has no negation
+            overflow = None if self.min is None else (left == self.min)
+            return self._checked(result, mask, overflow)
+        raise NotImplementedError(f"No lockstep evaluation for {node.__class__.__name__}")
+
+    def _read(self, mask: "np.ndarray") -> "np.ndarray":
+        """Next input of each active lane"""
+        exhausted = mask & (self.cursor >= self.input_len)
+        if exhausted.any():
+            raise EOFError(f"Lanes {list(np.flatnonzero(exhausted))} ran out of input")
+        rows = np.arange(self.lanes)
+        cols = np.minimum(self.cursor, self.inputs.shape[1] - 1)
+        values = self.inputs[rows, cols]
+        self.cursor = self.cursor + mask
+        if not self.fixed:
+            return values
+        overflow = (values < self.min) | (values > self.max)
+        wrapped = ((values - self.min) % (self.max - self.min + 1)) + self.min
+        return self._checked(wrapped.astype(self.dtype), mask, overflow)
+
+    def _binop(self, node: expr.BinOp, left: "np.ndarray", right: "np.ndarray",
+               mask: "np.ndarray") -> "np.ndarray":
+        """Element-wise BinOp._apply, with the checks that keep
+        fixed-width lanes equal to Python's unbounded ints, or
+        that set the V flag in 32-bit mode.
+        """
+        zero = None
+        if isinstance(node, expr.Div):
+            zero = mask & (right == 0)
+            if zero.any() and not self.fixed:
+                raise ZeroDivisionError(f"Division by zero in lanes {list(np.flatnonzero(zero))}")
+            # Keep other lanes from dividing by zero
+            right = np.where(right == 0, 1, right).astype(self.dtype)
+        with np.errstate(over="ignore"):
+            result = node._apply(left, right)
+        if zero is not None and self.fixed:
+            # The DM2019W produces 0 and sets V
+            result = np.where(zero, 0, result).astype(self.dtype)
+        if self.min is None:
+            return result
+        if isinstance(node, expr.Plus):
+            overflow = ((left < 0) == (right < 0)) & ((result < 0) != (left < 0))
+        elif isinstance(node, expr.Minus):
+            overflow = ((left < 0) != (right < 0)) & ((result < 0) != (left < 0))
+        elif isinstance(node, expr.Times):
+            safe = np.where(right == 0, 1, right)
+            overflow = (right != 0) & ((result // safe != left)
+                                       | ((left == -1) & (right == self.min))
+                                       | ((right == -1) & (left == self.min)))
+        else:
+            overflow = (left == self.min) & (right == -1)
+            if zero is not None:
+                overflow = overflow | zero
+        return self._checked(result, mask, overflow)
+
+    def _checked(self, result: "np.ndarray", mask: "np.ndarray", overflow) -> "np.ndarray":
+        """Result, after dealing with the active lanes that overflowed"""
+        if overflow is None or not (mask & overflow).any():
+            return result
+        lanes = list(np.flatnonzero(mask & overflow))
+        if not self.fixed:
+            raise LaneOverflow(f"Value too large for {self.dtype} in lanes {lanes}")
+        self.arith.v = True
+        self.arith.overflows += len(lanes)
+        if self.arith.trap:
+            raise arith.ArithmeticOverflow(f"Overflow in lanes {lanes}")
+        return result
+
+
+if np is not None:
+    RELATIONS = {"==": np.equal, "!=": np.not_equal,
+                 ">": np.greater, ">=": np.greater_equal,
+                 "<": np.less, "<=": np.less_equal}
+
+
+def run_lockstep(program: expr.Expr, inputs: Sequence[Sequence[int]],
+                 dtype=None, semantics: arith.BigInt = None) -> LockstepResult:
+    """Run program once per row of inputs, all rows together.
+    Semantics default to expr.ARITH.  For unbounded ints, values
+    are int64 unless dtype=object is given (Python ints: slower,
+    but never overflows).  For Int32, values are int32.
+    """
+    return Lockstep(inputs, dtype, semantics).run(program)
@@ -0,0 +1,164 @@
+"""
+Run DM2019W object code:  a small execution engine for the
+words build.py (or assembler_phase2) writes, one per line in
+an .obj file.
+
+Each step fetches the word at the address in r15 and decodes
+it (instr_format.decode).  If its condition mask shares a bit
+with the condition code, it executes:
+
+    left = src1,  right = src2 + offset
+    result = left op right        (LOAD, STORE, HALT:  left + right)
+
+and the condition code becomes M, Z, or P by the sign of the
+result, or V if the result does not fit in 32 bits (it wraps)
+or is a division by zero (result 0).  Every instruction that
+executes sets the condition code, even LOAD and STORE.  r15
+reads as the address of the instruction, and holds the next
+address unless the instruction writes r15 (a jump).  r0 is
+always 0.  LOAD from 510 reads the next input; STORE to 511
+prints.
+
+We count, for each address, how many times the word there was
+fetched and how many times it executed (its predicate held);
+for a predicated jump, executed is the number of jumps taken.
+These are the counts a profile of object code is built from
+(see pgo.py).
+"""
+
+import os
+import sys
+from collections import Counter
+from typing import List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, "assembler_2019-master"))
+
+from instr_format import CondFlag, OpCode, decode
+import arith
+from codegen_context import IO_ADDRESSES
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+READ_ADDRESS, PRINT_ADDRESS = IO_ADDRESSES
+MEMORY_WORDS = 1024
+
+# Give up on a program that runs longer than this
+MAX_STEPS = 10_000_000
+
+ALU = {
+    OpCode.ADD: lambda x, y: x + y,
+    OpCode.SUB: lambda x, y: x - y,
+    OpCode.MUL: lambda x, y: x * y,
+    OpCode.DIV: lambda x, y: x // y,
+    OpCode.LOAD: lambda x, y: x + y,
+    OpCode.STORE: lambda x, y: x + y,
+    OpCode.HALT: lambda x, y: 0,
+}
+
+
+class MachineError(Exception):
+    """The program did something the machine can't do:  ran
+    out of input, addressed memory that isn't there, or ran
+    too long.
+    """
+    pass
+
+
+def condition(result: int) -> CondFlag:
+    if result < 0:
+        return CondFlag.M
+    if result == 0:
+        return CondFlag.Z
+    return CondFlag.P
+
+
+def alu(op: OpCode, left: int, right: int) -> (int, CondFlag):
+    """The result of op and the condition code it sets"""
+    if op is OpCode.DIV and right == 0:
+        return 0, CondFlag.V
+    result = ALU[op](left, right)
+    if not arith.WORD_MIN <= result <= arith.WORD_MAX:
+        return arith.wrap(result), CondFlag.V
+    return result, condition(result)
+
+
+class Machine(object):
+    """A DM2019W with a program loaded at address 0"""
+
+    def __init__(self, words: List[int], inputs: List[int] = None):
+        self.memory = list(words) + [0] * max(0, MEMORY_WORDS - len(words))
+        self.registers = [0] * 16
+        self.condition = CondFlag.ALWAYS
+        self.inputs = list(inputs or [])
+        self.outputs = []
+        self.halted = False
+        self.steps = 0
+        self.fetched = Counter()
+        self.executed = Counter()
+
+    def load(self, address: int) -> int:
+        if address == READ_ADDRESS:
+            if not self.inputs:
+                raise MachineError("Read past the end of the input")
+            return arith.wrap(self.inputs.pop(0))
+        if not 0 <= address < len(self.memory):
+            raise MachineError(f"Load from address {address}")
+        return self.memory[address]
+
+    def store(self, address: int, value: int):
+        if address == PRINT_ADDRESS:
+            self.outputs.append(value)
+        elif not 0 <= address < len(self.memory):
+            raise MachineError(f"Store to address {address}")
+        else:
+            self.memory[address] = value
+
+    def step(self):
+        """Fetch, decode, and execute one instruction"""
+        address = self.registers[15]
+        instr = decode(self.load(address))
+        self.fetched[address] += 1
+        self.steps += 1
+        self.registers[15] = address + 1
+        if not instr.cond & self.condition:
+            return
+        self.executed[address] += 1
+        left = self.registers[instr.reg_src1] if instr.reg_src1 != 15 else address
+        right = self.registers[instr.reg_src2] if instr.reg_src2 != 15 else address
+        result, self.condition = alu(instr.op, left, right + instr.offset)
+        if instr.op is OpCode.HALT:
+            self.halted = True
+        elif instr.op is OpCode.STORE:
+            self.store(result, self.registers[instr.reg_target])
+        else:
+            if instr.op is OpCode.LOAD:
+                result = self.load(result)
+            if instr.reg_target != 0:
+                self.registers[instr.reg_target] = result
+
+    def run(self, max_steps: int = MAX_STEPS) -> List[int]:
+        """Run to HALT; returns what was printed"""
+        while not self.halted:
+            if self.steps >= max_steps:
+                raise MachineError(f"No HALT after {max_steps} steps")
+            self.step()
+        return self.outputs
+
+
+def run(words: List[int], inputs: List[int] = None, max_steps: int = MAX_STEPS) -> Machine:
+    """Run words to HALT with inputs; returns the machine
+    (outputs, registers, memory, and counts)
+    """
+    machine = Machine(words, inputs)
+    machine.run(max_steps)
+    return machine
+
+
+def read_obj(path: str) -> List[int]:
+    """The words of an object file, one per line"""
+    with open(path) as f:
+        return [int(line) for line in f if line.strip()]
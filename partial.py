@@ -0,0 +1,341 @@
+"""
+Partial evaluation:  specializing a program on known inputs.
+
+Given the values of the first k inputs (the first k 'read's to
+run), specialize(program, inputs) runs the program as far as
+those values determine it, and builds the residual program that
+does the rest:
+
+    n = read;                      x = read;
+    x = read;                      print x * 1;
+    i = 0;                ==>      print x * 2;
+    while i < n do                 print x * 3;
+        i = i + 1;
+        print x * i;          (with the first input, n, 3)
+    od
+
+Each variable is static (its value is known) or dynamic.  Reads
+of known inputs, and arithmetic on static values, are done now;
+an assignment of a static value is not kept in the residual
+program, only remembered.  An if or while whose condition is
+static is decided:  the arm taken is specialized in place, and a
+loop is unrolled one trip at a time, up to MAX_TRIPS trips.
+
+An if on a dynamic condition keeps both arms, each specialized
+separately; a variable that the arms leave static with different
+values becomes dynamic, assigned its value at the end of each arm.
+A dynamic loop (or one that runs past MAX_TRIPS) makes dynamic the
+variables its body assigns, assigning their static values just
+before it.  Input is read in order, so once a read may or may not
+have run (in a dynamic arm or loop) the rest of the known inputs
+can't be placed, and SpecializationError is raised if any are left.
+
+Arithmetic follows the given semantics (by default expr.ARITH, so
+use arith.Int32 for DM2019W code).  An operation that overflows
+or divides by zero is left in the residual program, to do what
+it would have done.
+
+With every input known, a program that ends becomes a straight
+run of prints.  source() writes the residual program as Mallard
+text, and compile.generate can compile it directly:
+
+    python3 partial.py prog.mal 3 10         residual program
+    python3 partial.py prog.mal 3 --asm p.asm   DM2019W code for it
+"""
+
+import argparse
+import copy
+import sys
+from collections import Counter
+from typing import Dict, Iterable, List
+
+import arith
+import expr
+import unroll
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+# Most trips of a loop unrolled before it is left to run
+MAX_TRIPS = 1000
+
+
+class SpecializationError(Exception):
+    """Known inputs remain where it is not known which read
+    will consume them
+    """
+    pass
+
+
+def reads(node: expr.Expr) -> bool:
+    """Whether node contains a read"""
+    if isinstance(node, expr.Read):
+        return True
+    return any(reads(getattr(node, part)) for part in ["left", "right", "expr", "cond", "thenpart", "elsepart"]
+               if isinstance(getattr(node, part, None), expr.Expr))
+
+
+class Specializer(object):
+    """Specializes one program on known inputs"""
+
+    def __init__(self, inputs: Iterable[int], semantics: arith.BigInt, stats: Counter):
+        self.inputs = list(inputs)
+        self.consumed = 0
+        self.arith = copy.copy(semantics)
+        self.stats = stats
+        # Whether the reads that have run, and so the next input,
+        # are no longer known; and how many arms and loops on
+        # dynamic conditions are being specialized
+        self.order_lost = False
+        self.dynamic = 0
+
+    def read(self) -> expr.Expr:
+        if self.consumed < len(self.inputs):
+            if self.order_lost or self.dynamic:
+                raise SpecializationError(f"Input {self.consumed + 1} may be read by more than one read")
+            value = self.arith.fit(self.inputs[self.consumed])
+            self.consumed += 1
+            return expr.IntConst(value)
+        return expr.Read()
+
+    def unread(self, consumed: int):
+        """Go back to reading input consumed + 1"""
+        self.consumed = consumed
+
+    # Expressions
+
+    def fold(self, node: expr.Expr, *kids: expr.Expr) -> expr.Expr:
+        """node on residual kids, computed if they are constants
+        and it neither overflows nor divides by zero
+        """
+        if all(isinstance(kid, expr.IntConst) for kid in kids):
+            values = [kid.value for kid in kids]
+            self.arith.v = False
+            try:
+                if isinstance(node, expr.Comparison):
+                    result = node._apply(*self.arith.relation(*values))
+                elif isinstance(node, expr.UnOp):
+                    result = self.arith.unop(node._apply, *values)
+                else:
+                    result = self.arith.binop(node._apply, *values)
+                if not self.arith.v:
+                    return expr.IntConst(result)
+            except (ZeroDivisionError, arith.ArithmeticOverflow):
+                pass
+        return type(node)(*kids)
+
+    def value(self, node: expr.Expr, env: Dict[str, int]) -> expr.Expr:
+        """Residual expression for node; an IntConst if static"""
+        if isinstance(node, expr.IntConst):
+            return node
+        if isinstance(node, expr.Var):
+            return expr.IntConst(env[node.name]) if node.name in env else node
+        if isinstance(node, expr.Read):
+            return self.read()
+        if isinstance(node, (expr.BinOp, expr.Comparison)):
+            left = self.value(node.left, env)
+            return self.fold(node, left, self.value(node.right, env))
+        if isinstance(node, expr.UnOp):
+            return self.fold(node, self.value(node.left, env))
+        raise SpecializationError(f"Can't specialize {node.__class__.__name__} as a value")
+
+    # Statements
+
+    def stmt(self, node: expr.Expr, env: Dict[str, int]) -> List[expr.Expr]:
+        """Residual statements for node, changing env to the
+        static values after it
+        """
+        if isinstance(node, expr.Seq):
+            return self.stmt(node.left, env) + self.stmt(node.right, env)
+        if isinstance(node, expr.Pass):
+            return []
+        if isinstance(node, expr.Assign):
+            value = self.value(node.right, env)
+            if isinstance(value, expr.IntConst):
+                env[node.left.name] = value.value
+                return []
+            env.pop(node.left.name, None)
+            return [expr.Assign(node.left, value)]
+        if isinstance(node, expr.Print):
+            return [expr.Print(self.value(node.expr, env))]
+        if isinstance(node, expr.If):
+            return self.if_stmt(node, env)
+        if isinstance(node, expr.While):
+            return self.while_stmt(node, env)
+        value = self.value(node, env)
+        return [] if isinstance(value, expr.IntConst) else [value]
+
+    def if_stmt(self, node: expr.If, env: Dict[str, int]) -> List[expr.Expr]:
+        cond = self.value(node.cond, env)
+        if isinstance(cond, expr.IntConst):
+            self.stats["branches decided"] += 1
+            return self.stmt(node.thenpart if cond.value else node.elsepart, env)
+        then_env, else_env = dict(env), dict(env)
+        self.dynamic += 1
+        arms = [self.stmt(node.thenpart, then_env), self.stmt(node.elsepart, else_env)]
+        self.dynamic -= 1
+        if reads(node.thenpart) or reads(node.elsepart):
+            self.order_lost = True
+        env.clear()
+        for name in then_env.keys() | else_env.keys():
+            if then_env.get(name) == else_env.get(name):
+                env[name] = then_env[name]
+                continue
+            for arm, arm_env in zip(arms, [then_env, else_env]):
+                if name in arm_env:
+                    arm.append(expr.Assign(expr.Var(name), expr.IntConst(arm_env[name])))
+        return [expr.If(cond, *[unroll.sequence(arm) for arm in arms])]
+
+    def while_stmt(self, node: expr.While, env: Dict[str, int]) -> List[expr.Expr]:
+        residual = []
+        for trips in range(MAX_TRIPS + 1):
+            consumed = self.consumed
+            cond = self.value(node.cond, env)
+            if not isinstance(cond, expr.IntConst):
+                self.unread(consumed)
+                break
+            if not cond.value:
+                if trips:
+                    self.stats["loops unrolled"] += 1
+                    self.stats["trips unrolled"] += trips
+                return residual
+            if trips == MAX_TRIPS:
+                self.unread(consumed)
+                self.stats["loops over the trip limit"] += 1
+                break
+            residual += self.stmt(node.expr, env)
+        # The rest of the loop runs in the residual program
+        changed = unroll.assigned(node.expr)
+        for name in sorted(changed & env.keys()):
+            residual.append(expr.Assign(expr.Var(name), expr.IntConst(env.pop(name))))
+        if reads(node):
+            if self.consumed < len(self.inputs):
+                raise SpecializationError(f"Input {self.consumed + 1} is read in a loop on unknown data")
+            self.order_lost = True
+        self.dynamic += 1
+        cond = self.value(node.cond, env)
+        if isinstance(cond, expr.IntConst):
+            # Loops that run until the trip limit; the code
+            # generator branches on comparisons
+            cond = expr.NE(cond, expr.IntConst(0))
+        body_env = dict(env)
+        body = self.stmt(node.expr, body_env)
+        self.dynamic -= 1
+        for name in sorted(body_env.keys() - env.keys()):
+            body.append(expr.Assign(expr.Var(name), expr.IntConst(body_env[name])))
+        residual.append(expr.While(cond, unroll.sequence(body)))
+        return residual
+
+
+def specialize(program: expr.Expr, inputs: Iterable[int], semantics: arith.BigInt = None,
+               stats: Counter = None) -> expr.Expr:
+    """The residual program of program, given the first inputs;
+    what was done is counted in stats
+    """
+    if stats is None:
+        stats = Counter()
+    specializer = Specializer(inputs, semantics or expr.ARITH, stats)
+    residual = unroll.sequence(specializer.stmt(program, {}))
+    if specializer.consumed:
+        stats["reads replaced"] += specializer.consumed
+    if specializer.consumed < len(specializer.inputs):
+        stats["inputs not read"] += len(specializer.inputs) - specializer.consumed
+    return residual
+
+
+# Writing Mallard text
+
+def source_value(node: expr.Expr) -> str:
+    if isinstance(node, expr.IntConst):
+        return str(node.value)
+    if isinstance(node, expr.Var):
+        return node.name
+    if isinstance(node, expr.Read):
+        return "read"
+    if isinstance(node, expr.UnOp):
+        return f"{node.opsym}{source_value(node.left)}"
+    if isinstance(node, (expr.BinOp, expr.Comparison)):
+        return f"({source_value(node.left)} {node.opsym} {source_value(node.right)})"
+    raise ValueError(f"No Mallard text for {node.__class__.__name__} as a value")
+
+
+def source_cond(node: expr.Expr) -> str:
+    if isinstance(node, expr.Comparison):
+        return f"{source_value(node.left)} {node.opsym} {source_value(node.right)}"
+    # Mallard conditions are comparisons
+    return f"{source_value(node)} != 0"
+
+
+def source_lines(node: expr.Expr, depth: int = 0) -> List[str]:
+    pad = "    " * depth
+    if isinstance(node, expr.Seq):
+        return source_lines(node.left, depth) + source_lines(node.right, depth)
+    if isinstance(node, expr.Pass):
+        return []
+    if isinstance(node, expr.Assign):
+        return [f"{pad}{node.left.name} = {source_value(node.right)};"]
+    if isinstance(node, expr.Print):
+        return [f"{pad}print {source_value(node.expr)};"]
+    if isinstance(node, expr.If):
+        lines = [f"{pad}if {source_cond(node.cond)} then"] + source_lines(node.thenpart, depth + 1)
+        if not isinstance(node.elsepart, expr.Pass):
+            lines += [f"{pad}else"] + source_lines(node.elsepart, depth + 1)
+        return lines + [f"{pad}fi"]
+    if isinstance(node, expr.While):
+        return [f"{pad}while {source_cond(node.cond)} do"] + source_lines(node.expr, depth + 1) + [f"{pad}od"]
+    raise ValueError(f"No Mallard statement for {node.__class__.__name__}")
+
+
+def source(program: expr.Expr) -> str:
+    """Mallard text for program, which parses back to it"""
+    return "".join(line + "\n" for line in source_lines(program))
+
+
+def cli() -> object:
+    """Get arguments from command line"""
+    parser = argparse.ArgumentParser(description="Specialize a Mallard program on its first inputs")
+    parser.add_argument("sourcefile", type=argparse.FileType('r'),
+                        help="Source program text")
+    parser.add_argument("inputs", type=int, nargs="*",
+                        help="Values of the first inputs read")
+    parser.add_argument("--arith", choices=sorted(arith.SEMANTICS), default="bigint",
+                        help="Integer semantics for the residual program (int32 with --asm)")
+    parser.add_argument("--asm", type=argparse.FileType('w'),
+                        help="Write DM2019W assembly code for the residual program here")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="Optimize the assembly code as compile.py -O does")
+    return parser.parse_args()
+
+
+def main():
+    args = cli()
+    from llparse import parse
+    program = parse(args.sourcefile)
+    semantics = arith.Int32() if args.asm else arith.SEMANTICS[args.arith]()
+    stats = Counter()
+    try:
+        residual = specialize(program, args.inputs, semantics, stats)
+    except SpecializationError as e:
+        print(f"Failed! {e}", file=sys.stderr)
+        sys.exit(1)
+    if args.asm:
+        import codegen_context
+        import compile
+        import peephole
+        context = codegen_context.Context()
+        compile.header(context, args.sourcefile.name)
+        compile.generate(residual, context, args.optimize)
+        if args.optimize:
+            context.instrs, _ = peephole.optimize(context.instrs)
+        for line in context.get_lines():
+            print(line, file=args.asm)
+    else:
+        print(source(residual), end="")
+    for stat, count in stats.items():
+        print(f"#partial {count} {stat}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
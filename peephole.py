@@ -0,0 +1,408 @@
+"""
+Peephole optimization of generated DM2019W assembly code.
+
+The code generator works one AST node at a time, so it leaves
+local waste behind:  a STORE to a variable followed by a LOAD
+of the same variable, a JUMP to the label on the very next line,
+a JUMP to another JUMP, and so on.  The peephole optimizer
+slides a small window over the instruction records (Context.instrs,
+before get_lines adds the declarations) and rewrites or deletes
+instructions that match one of the rules in RULES.  Each pass
+can expose new matches, so we repeat until nothing changes.
+
+Two properties of the machine keep the rules honest:
+
+ * Every instruction that executes sets the condition code, and
+   a predicated instruction (e.g., JUMP/ZM) reads it.  A rule may
+   delete an executed instruction only where the condition code
+   is dead:  the next instruction in program order is not
+   predicated, so it overwrites the condition code before anything
+   can test it.
+ * A label may be the target of a jump from anywhere.  A window
+   never extends across a label, and labels are never deleted
+   (an instruction that carries a label leaves the label behind).
+
+Memory operations are matched only on symbolic addresses
+(variables, constants, spill slots).  Addresses like r0,r0[510]
+are input and output devices, where every access counts.
+
+More rules can be loaded from a table written by superopt.py
+(load_rules; compile.py --rules).  Each is a pattern of ALU
+instructions over r1 and r2, which stand for any two different
+registers, and its cheaper replacement:
+
+    SUB r1,r0,r1; SUB r1,r0,r1  =>  (nothing)  if cc dead
+"""
+
+import copy
+from collections import Counter
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from codegen_context import Instr, parse_instr
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+# Instructions that compute a value in the ALU and nothing else
+ALU_OPS = {"ADD", "SUB", "MUL", "DIV"}
+
+
+class Rule(NamedTuple):
+    """A peephole rule matches a window of consecutive
+    instructions whose opcodes are in the sets of 'pattern'
+    (None matches any instruction).  Its action returns the
+    positions in the window to delete (possibly none, if it
+    rewrote the window in place), or None if it doesn't apply.
+    """
+    name: str
+    pattern: List[Optional[Set[str]]]
+    action: Callable[["Peephole", List[Instr]], Optional[Set[int]]]
+
+
+class Peephole(object):
+    """Optimizes a list of assembly lines"""
+
+    def __init__(self, instrs: List[Instr], rules: List[Rule] = None):
+        # Copies, since rules rewrite them in place
+        self.lines = [copy.copy(instr) for instr in instrs]
+        self.rules = RULES if rules is None else rules
+        # Instructions removed and rewrites made, per rule
+        self.removed = Counter()
+        self.applied = Counter()
+        # Position of the window now being matched
+        self.position = 0
+        self.window_end = 0
+
+    def pc_relative(self) -> bool:
+        """Code with hand-resolved PC-relative addresses
+        breaks if we move anything, so we leave it alone.
+        """
+        return any(line.is_instruction() and line.ref is None
+                   and "r15" in (line.src1, line.src2)
+                   for line in self.lines)
+
+    def cc_dead(self) -> bool:
+        """Is the condition code dead after the current window?"""
+        for line in self.lines[self.window_end + 1:]:
+            if line.is_instruction():
+                return line.unpredicated()
+        return True
+
+    def label_position(self, label: str) -> Optional[int]:
+        for i, line in enumerate(self.lines):
+            if line.label == label:
+                return i
+        return None
+
+    def falls_into(self, label: str) -> bool:
+        """Does execution fall through from the current
+        window to label, without executing anything else?
+        """
+        for line in self.lines[self.window_end + 1:]:
+            if line.label == label:
+                return True
+            if line.is_instruction() or line.opcode == "DATA":
+                return False
+        return False
+
+    def instruction_at(self, label: str) -> Optional[Instr]:
+        """The first instruction at or after label"""
+        start = self.label_position(label)
+        if start is None:
+            return None
+        for line in self.lines[start:]:
+            if line.opcode == "DATA":
+                return None
+            if line.is_instruction():
+                return line
+        return None
+
+    def _window(self, start: int, size: int) -> Optional[List[int]]:
+        """Positions of size instructions starting at start,
+        with no label after the first.
+        """
+        positions = [start]
+        i = start + 1
+        while len(positions) < size and i < len(self.lines):
+            line = self.lines[i]
+            if line.label:
+                return None
+            if line.opcode == "DATA":
+                return None
+            if line.is_instruction():
+                positions.append(i)
+            i += 1
+        return positions if len(positions) == size else None
+
+    def _try(self, rule: Rule, start: int) -> bool:
+        positions = self._window(start, len(rule.pattern))
+        if positions is None:
+            return False
+        window = [self.lines[i] for i in positions]
+        for line, ops in zip(window, rule.pattern):
+            if ops is not None and line.opcode not in ops:
+                return False
+        self.position, self.window_end = start, positions[-1]
+        doomed = rule.action(self, window)
+        if doomed is None:
+            return False
+        self.applied[rule.name] += 1
+        self.removed[rule.name] += len(doomed)
+        for k in sorted(doomed, reverse=True):
+            line = self.lines[positions[k]]
+            log.debug(f"{rule.name}: deleting {line}")
+            if line.label:
+                self.lines[positions[k]] = Instr(label=line.label)
+            else:
+                del self.lines[positions[k]]
+        return True
+
+    def optimize(self) -> List[Instr]:
+        """Apply rules until none applies"""
+        if self.pc_relative():
+            return self.lines
+        changed = True
+        while changed:
+            changed = False
+            start = 0
+            while start < len(self.lines):
+                if self.lines[start].is_instruction():
+                    for rule in self.rules:
+                        if self._try(rule, start):
+                            changed = True
+                            if start >= len(self.lines) or not self.lines[start].is_instruction():
+                                break
+                start += 1
+        return self.lines
+
+    def report(self) -> List[str]:
+        """Instructions removed by each rule that removed any"""
+        return [f"{name}: {self.applied[name]} applied, {self.removed[name]} removed"
+                for name in self.applied]
+
+
+def same_address(first: Instr, second: Instr) -> bool:
+    return first.ref is not None and first.ref == second.ref
+
+
+# Rule actions.  Each gets the optimizer (for queries about the
+# surrounding code) and the instructions in the window.
+
+def store_load(opt: Peephole, window: List[Instr]) -> Optional[Set[int]]:
+    """STORE r1,x; LOAD r1,x:  r1 already holds x"""
+    store, load = window
+    if (same_address(store, load) and store.target == load.target
+            and store.unpredicated() and load.unpredicated() and opt.cc_dead()):
+        return {1}
+    return None
+
+
+def load_load(opt: Peephole, window: List[Instr]) -> Optional[Set[int]]:
+    """LOAD r1,x; LOAD r1,x:  the second load does nothing"""
+    first, second = window
+    if (same_address(first, second) and first.target == second.target
+            and first.unpredicated() and second.unpredicated() and opt.cc_dead()):
+        return {1}
+    return None
+
+
+def dead_store(opt: Peephole, window: List[Instr]) -> Optional[Set[int]]:
+    """STORE r1,x; STORE r2,x:  nobody sees the first value"""
+    first, second = window
+    if same_address(first, second) and first.unpredicated() and second.unpredicated():
+        return {0}
+    return None
+
+
+def redundant_compare(opt: Peephole, window: List[Instr]) -> Optional[Set[int]]:
+    """SUB r3,r1,r2; SUB r0,r1,r2:  the condition code is already set"""
+    first, second = window
+    if (first.opcode == second.opcode and second.target == "r0"
+            and (first.src1, first.src2, first.offset) == (second.src1, second.src2, second.offset)
+            and first.ref is None and second.ref is None
+            and first.target not in (first.src1, first.src2, "r15")
+            and first.unpredicated()):
+        return {1}
+    return None
+
+
+def dead_compare(opt: Peephole, window: List[Instr]) -> Optional[Set[int]]:
+    """SUB r0,r1,r2 sets only the condition code; if no one
+    tests it, it does nothing.
+    """
+    op, = window
+    if op.target == "r0" and op.ref is None and opt.cc_dead():
+        return {0}
+    return None
+
+
+def self_move(opt: Peephole, window: List[Instr]) -> Optional[Set[int]]:
+    """ADD r1,r0,r1 copies r1 to itself"""
+    op, = window
+    if (op.ref is None and op.offset == 0 and op.target != "r15"
+            and {op.src1, op.src2} == {"r0", op.target} and opt.cc_dead()):
+        return {0}
+    return None
+
+
+def dead_write(opt: Peephole, window: List[Instr]) -> Optional[Set[int]]:
+    """ADD r1,r2,r3; ADD r1,r0,r2:  the second overwrites r1 (and
+    the condition code) without reading r1
+    """
+    first, second = window
+    if (first.target not in ("r0", "r15") and second.target == first.target
+            and first.target not in (second.src1, second.src2)
+            and first.unpredicated() and second.unpredicated()):
+        return {0}
+    return None
+
+
+def jump_to_next(opt: Peephole, window: List[Instr]) -> Optional[Set[int]]:
+    """JUMP L immediately followed by L:"""
+    jump, = window
+    if opt.falls_into(jump.ref) and opt.cc_dead():
+        return {0}
+    return None
+
+
+def jump_chain(opt: Peephole, window: List[Instr]) -> Optional[Set[int]]:
+    """JUMP L1 where L1: JUMP L2 becomes JUMP L2.  The condition
+    code comes out the same, since both jumps compute the address L2.
+    """
+    jump, = window
+    label = jump.ref
+    seen = {label}
+    then = opt.instruction_at(label)
+    while then is not None and then.is_jump() and then.unpredicated():
+        if then.ref in seen:
+            # A loop of jumps; leave it be
+            return None
+        label = then.ref
+        seen.add(label)
+        then = opt.instruction_at(label)
+    if label == jump.ref or opt.label_position(label) is None:
+        return None
+    jump.ref = label
+    return set()
+
+
+def unreachable(opt: Peephole, window: List[Instr]) -> Optional[Set[int]]:
+    """Nothing without a label can follow an unconditional
+    JUMP or HALT.
+    """
+    stop, dead = window
+    if stop.unpredicated() and (stop.is_jump() or stop.opcode == "HALT"):
+        return {1}
+    return None
+
+
+RULES = [
+    Rule("store_load", [{"STORE"}, {"LOAD"}], store_load),
+    Rule("load_load", [{"LOAD"}, {"LOAD"}], load_load),
+    Rule("dead_store", [{"STORE"}, {"STORE"}], dead_store),
+    Rule("redundant_compare", [ALU_OPS, ALU_OPS], redundant_compare),
+    Rule("dead_compare", [ALU_OPS], dead_compare),
+    Rule("self_move", [{"ADD"}], self_move),
+    Rule("dead_write", [ALU_OPS, ALU_OPS | {"LOAD"}], dead_write),
+    Rule("jump_to_next", [{"JUMP"}], jump_to_next),
+    Rule("jump_chain", [{"JUMP"}], jump_chain),
+    Rule("unreachable", [{"JUMP", "HALT"}, None], unreachable),
+]
+
+
+def optimize(instrs: List[Instr], rules: List[Rule] = None) -> (List[Instr], Peephole):
+    """Optimized copy of instrs, and the optimizer (for its report)"""
+    opt = Peephole(instrs, rules)
+    return opt.optimize(), opt
+
+
+# Rule tables (see superopt.py)
+
+# An ALU instruction of a rule:  opcode, target, src1, src2, offset
+Shape = Tuple[str, str, str, str, int]
+
+# The registers r1 and r2 of a rule stand for
+SYMBOLIC = ["r1", "r2"]
+
+
+class RuleError(Exception):
+    """A rule table can't be read"""
+    pass
+
+
+def shapes(text: str) -> List[Shape]:
+    """The instructions of one side of a rule"""
+    if text.strip() == "(nothing)":
+        return []
+    result = []
+    for part in text.split(";"):
+        instr = parse_instr(part)
+        if instr.opcode not in ALU_OPS or instr.src1 is None or not instr.unpredicated():
+            raise RuleError(f"{part.strip()!r} is not an ALU instruction on registers")
+        if not set(instr.registers()) <= {"r0"} | set(SYMBOLIC):
+            raise RuleError(f"{part.strip()!r} uses registers other than r0, r1, r2")
+        result.append((instr.opcode, instr.target, instr.src1, instr.src2, instr.offset))
+    return result
+
+
+def table_rule(table: Dict[Tuple[Shape, ...], Tuple[List[Shape], bool]]) -> Callable:
+    """The action of the rules in table, whose patterns all have
+    the same length:  the window is looked up with its registers
+    renamed to r1 and r2, in the order they appear
+    """
+    def action(opt: Peephole, window: List[Instr]) -> Optional[Set[int]]:
+        names = {"r0": "r0"}
+        pattern = []
+        for instr in window:
+            if instr.ref is not None or not instr.unpredicated():
+                return None
+            for reg in [instr.src1, instr.src2, instr.target]:
+                if reg not in names:
+                    if reg == "r15" or len(names) > len(SYMBOLIC):
+                        return None
+                    names[reg] = SYMBOLIC[len(names) - 1]
+            pattern.append((instr.opcode, names[instr.target], names[instr.src1],
+                            names[instr.src2], instr.offset))
+        entry = table.get(tuple(pattern))
+        if entry is None:
+            return None
+        replacement, cc_dead = entry
+        if cc_dead and not opt.cc_dead():
+            return None
+        real = {symbol: reg for reg, symbol in names.items()}
+        if any(reg not in real for shape in replacement for reg in shape[1:4]):
+            return None
+        for instr, (opcode, target, src1, src2, offset) in zip(window, replacement):
+            instr.opcode, instr.target, instr.src1, instr.src2 = opcode, real[target], real[src1], real[src2]
+            instr.offset = offset
+        return set(range(len(replacement), len(window)))
+    return action
+
+
+def load_rules(file) -> List[Rule]:
+    """Rules from a table written by superopt.py (an open file),
+    longest patterns first
+    """
+    tables = {}
+    for number, line in enumerate(file, start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            pattern, replacement = line.split("=>")
+        except ValueError:
+            raise RuleError(f"Line {number} of the rule table is not pattern => replacement")
+        cc_dead = replacement.endswith("if cc dead")
+        if cc_dead:
+            replacement = replacement[:-len("if cc dead")]
+        try:
+            pattern, replacement = shapes(pattern), shapes(replacement)
+        except RuleError as e:
+            raise RuleError(f"Line {number} of the rule table:  {e}")
+        if not pattern or len(replacement) > len(pattern):
+            raise RuleError(f"Line {number} of the rule table has a replacement longer than its pattern")
+        tables.setdefault(len(pattern), {})[tuple(pattern)] = (replacement, cc_dead)
+    return [Rule(f"table_{length}", [ALU_OPS] * length, table_rule(tables[length]))
+            for length in sorted(tables, reverse=True)]
@@ -0,0 +1,284 @@
+"""
+Profile-guided optimization.
+
+Without a profile, the compiler guesses which way branches go
+(Comparison.likely, after Ball and Larus) and that every loop
+runs ten times (regalloc.LOOP_WEIGHT).  A profile records what
+runs of the program actually did at each If and While of the
+program as written --- its site, numbered in the order the
+parser reads them:
+
+    # site kind counts condition
+    0 while 1 100 i < n
+    1 if 97 3 x < y
+
+An If counts the times its condition was true and the times it
+was false; a While, the times it was entered and the trips it
+ran.  A profile is recorded
+
+ * by the interpreter (recording, or interpreter.py --profile),
+   as each If and While evaluates its condition, or
+
+ * by running object code on the execution engine in machine.py
+   (record_object), which counts how often the word at each
+   address was fetched and executed.  The code generator tags
+   the conditional jump of each If and While with its site and
+   what taking the jump means (Context.mark_branch); the tag
+   stays with the jump record through label resolution, so the
+   counts at the jump's address are traced back to the site.
+
+compile.py --profile FILE reads a profile back (annotate).
+With -O it is used to
+
+ * lay out each If with its more frequent arm falling through
+   (If.likely),
+ * weigh variables for register allocation by how often their
+   references ran (regalloc.arm_weights, regalloc.loop_weights),
+ * leave rolled the loops that never ran, and unroll the others
+   by no more than their average trips (unroll.py).
+
+The counts stay with an If or While through the rewriting done
+with -O (expr.with_profile).  A site whose kind or condition
+doesn't match the program (a stale profile) is ignored.
+
+    python3 pgo.py prog.mal prog.prof 5 3            interpret, inputs 5 and 3
+    python3 pgo.py prog.mal prog.prof 5 3 --object   run the object code
+    python3 pgo.py prog.mal prog.prof 5 3 --obj prog.obj -O
+                                                     run prog.obj, built with -O
+    python3 compile.py -O --profile prog.prof prog.mal prog.asm
+"""
+
+import io
+import os
+import sys
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, "compiler_2019-master"))
+
+import expr
+from codegen_context import UNPREDICATED
+
+import argparse
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+HEADER = "# site kind counts condition"
+
+
+class ProfileError(Exception):
+    """A profile can't be read, or doesn't belong to the program"""
+    pass
+
+
+def kind(node: expr.Control) -> str:
+    return "if" if isinstance(node, expr.If) else "while"
+
+
+def sites(program: expr.Expr) -> List[expr.Control]:
+    """The Ifs and Whiles of program, in the order the parser
+    reads them
+    """
+    if isinstance(program, expr.Seq):
+        return sites(program.left) + sites(program.right)
+    if isinstance(program, expr.If):
+        return [program] + sites(program.thenpart) + sites(program.elsepart)
+    if isinstance(program, expr.While):
+        return [program] + sites(program.expr)
+    return []
+
+
+class Profile(object):
+    """Counts for each site:  site -> [kind, condition, first, second]"""
+
+    def __init__(self):
+        self.sites = {}
+
+    @classmethod
+    def for_sites(cls, nodes: List[expr.Control]) -> "Profile":
+        """An empty profile of the sites nodes (see annotate)"""
+        profile = cls()
+        for node in nodes:
+            profile.sites[node.site] = [kind(node), str(node.cond), 0, 0]
+        return profile
+
+    def add(self, site: int, first: int, second: int):
+        entry = self.sites[site]
+        entry[2] += first
+        entry[3] += second
+
+    # Called by If.eval and While.eval while recording
+
+    def branch(self, node: expr.If, taken: bool):
+        if node.site is not None:
+            self.add(node.site, 1 if taken else 0, 0 if taken else 1)
+
+    def enter(self, node: expr.While):
+        if node.site is not None and node.steps == 1:
+            self.add(node.site, 1, 0)
+
+    def trip(self, node: expr.While):
+        if node.site is not None:
+            self.add(node.site, 0, node.steps)
+
+    def lines(self) -> List[str]:
+        return [HEADER] + [f"{site} {kind} {first} {second} {cond}"
+                           for site, (kind, cond, first, second) in sorted(self.sites.items())]
+
+    def write(self, file):
+        for line in self.lines():
+            print(line, file=file)
+
+    @classmethod
+    def read(cls, file) -> "Profile":
+        profile = cls()
+        for number, line in enumerate(file, start=1):
+            if not line.strip() or line.startswith("#"):
+                continue
+            try:
+                site, kind, first, second, cond = line.split(maxsplit=4)
+                profile.sites[int(site)] = [kind, cond.strip(), int(first), int(second)]
+            except ValueError:
+                raise ProfileError(f"Line {number} of the profile is not site kind count count condition")
+        return profile
+
+
+def annotate(program: expr.Expr, profile: Profile = None, stats: Counter = None) -> List[expr.Control]:
+    """Number the sites of program and, given a profile, give
+    each the counts the profile has for it.  Returns the sites.
+    """
+    if stats is None:
+        stats = Counter()
+    found = sites(program)
+    for number, node in enumerate(found):
+        node.site = number
+        if profile is None:
+            continue
+        entry = profile.sites.get(number)
+        if entry is not None and entry[:2] == [kind(node), str(node.cond)]:
+            node.counts = tuple(entry[2:])
+            stats["sites with counts"] += 1
+        else:
+            stats["stale sites ignored"] += 1
+    return found
+
+
+@contextmanager
+def recording(nodes: List[expr.Control]):
+    """Count what the sites nodes (numbered by annotate) do as
+    programs with them run in the interpreter, in the Profile
+    this yields.  Loops are not handed to compiled fast paths
+    while recording (see tiered.py):  their iterations would go
+    uncounted.
+    """
+    profile = Profile.for_sites(nodes)
+    saved = expr.PROFILE, expr.HOT_LOOP_THRESHOLD
+    expr.PROFILE, expr.HOT_LOOP_THRESHOLD = profile, None
+    try:
+        yield profile
+    finally:
+        expr.PROFILE, expr.HOT_LOOP_THRESHOLD = saved
+
+
+def from_counts(records: list, fetched: Dict[int, int], executed: Dict[int, int],
+                nodes: List[expr.Control]) -> Profile:
+    """The profile of the sites nodes, given resolved records
+    (build.Build.resolved) and how often the word at each address
+    was fetched and executed
+    """
+    profile = Profile.for_sites(nodes)
+    address = 0
+    for record in records:
+        if record.opcode is None:
+            continue
+        tag = getattr(record, "site", None)
+        if tag is not None and record.predicate not in UNPREDICATED:
+            site, role, steps = tag
+            tests, taken = fetched.get(address, 0), executed.get(address, 0)
+            if role == "false":
+                profile.add(site, tests - taken, taken)
+            elif role == "true":
+                profile.add(site, taken, tests - taken)
+            elif role == "test":
+                profile.add(site, taken if steps == 1 else 0, (tests - taken) * steps)
+            elif role == "guard":
+                profile.add(site, tests if steps == 1 else 0, 0)
+            elif role == "bottom":
+                profile.add(site, 0, tests * steps)
+        address += 1
+    return profile
+
+
+def record_object(sourcefile, inputs: List[int], optimize: bool = False,
+                  words: Optional[List[int]] = None,
+                  profile: Profile = None) -> (Profile, "machine.Machine"):
+    """Build the program in sourcefile (an open file), optimizing
+    for profile if given, run its object code on inputs, and trace
+    the counts back to the program.  Given words (say, read from
+    an .obj file), they must be the words of the build.
+    """
+    import build
+    import machine
+    result = build.build(sourcefile, optimize, profile)
+    if words is not None and words != result.words:
+        raise ProfileError("The object code is not the build of this program "
+                           f"({'with' if optimize else 'without'} -O)")
+    run = machine.run(result.words, inputs)
+    return from_counts(result.resolved, run.fetched, run.executed, result.context.sites), run
+
+
+def cli() -> object:
+    """Get arguments from command line"""
+    parser = argparse.ArgumentParser(description="Record a profile of a Mallard program")
+    parser.add_argument("sourcefile", type=argparse.FileType('r'),
+                        help="Source program text")
+    parser.add_argument("profile", type=argparse.FileType('w'),
+                        help="Write the profile here")
+    parser.add_argument("inputs", type=int, nargs="*",
+                        help="Inputs for 'read'")
+    parser.add_argument("--object", action="store_true",
+                        help="Run the object code rather than the interpreter")
+    parser.add_argument("--obj", type=argparse.FileType('r'),
+                        help="Run this object code, built from the source program")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="The object code is built with -O")
+    parser.add_argument("--built-for", type=argparse.FileType('r'),
+                        help="The object code is built with -O for this profile")
+    return parser.parse_args()
+
+
+def main():
+    args = cli()
+    if args.object or args.obj:
+        words = [int(line) for line in args.obj if line.strip()] if args.obj else None
+        built_for = Profile.read(args.built_for) if args.built_for else None
+        try:
+            profile, run = record_object(args.sourcefile, args.inputs,
+                                         args.optimize or built_for is not None, words, built_for)
+        except ProfileError as e:
+            print(f"Failed! {e}", file=sys.stderr)
+            sys.exit(1)
+        for value in run.outputs:
+            print(f"Quack!: {value}")
+        print(f"#{run.steps} instructions", file=sys.stderr)
+    else:
+        from llparse import parse
+        program = parse(args.sourcefile)
+        expr.env_clear()
+        saved = sys.stdin
+        sys.stdin = io.StringIO("".join(f"{value}\n" for value in args.inputs))
+        try:
+            with recording(annotate(program)) as profile:
+                program.eval()
+        finally:
+            sys.stdin = saved
+    profile.write(args.profile)
+
+
+if __name__ == "__main__":
+    main()
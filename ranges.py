@@ -0,0 +1,477 @@
+"""
+Range analysis:  intervals of values, by abstract interpretation.
+
+Each variable and expression gets an interval [lo, hi] holding
+every value it can have, found by running the program on
+intervals instead of integers:  both arms of an if are run and
+their results joined, and the condition of an if or a while
+narrows the intervals of the variables it compares on each arm
+(in the body of 'while i < 10', i <= 9).  A loop is run until the
+intervals at its head stop growing; so that this ends, after
+WIDEN_AFTER trips an interval still growing is widened to the
+end of its range (widening), and then one more trip from the
+widened head takes back what the condition allows (narrowing):
+
+    i = 0;
+    while i < 10 do     head:  [0, 0], [0, 1], [0, 2], then
+        i = i + 1;             widened [0, inf], narrowed [0, 10]
+    od                  after: [10, 10]
+
+With fixed-width (32-bit) arithmetic, a result that may fall
+outside a word may wrap around to anything in one, and a
+comparison is decided only where the subtraction the machine
+compares by can't overflow (see arith.py).  A variable that may
+not have been assigned yet can be anything:  the compiled code
+reads 0 where the interpreter stops with an error.
+
+narrow(program) uses the ranges to remove work:
+
+ * Abs of a value that is never negative is just the value;
+ * a comparison whose answer is always the same becomes that
+   answer:  an if becomes the arm taken, a while never entered
+   is removed;
+ * an expression (without side effects) with only one possible
+   value becomes that constant, which the instruction selector
+   puts in an immediate operand when it fits (see isel.py);
+ * with fixed-width arithmetic, an operation whose result always
+   fits in a word is marked in_range, and the interpreter does
+   not check it for overflow.
+"""
+
+import math
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+import arith
+import expr
+import sccp
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+# Trips around a loop before growing intervals are widened
+WIDEN_AFTER = 3
+
+Bound = Union[int, float]
+
+
+class Interval(NamedTuple):
+    """lo <= value <= hi, where lo may be -inf and hi inf"""
+    lo: Bound
+    hi: Bound
+
+    def __str__(self) -> str:
+        return f"[{self.lo}, {self.hi}]"
+
+    def join(self, other: "Interval") -> "Interval":
+        return Interval(min(self.lo, other.lo), max(self.hi, other.hi))
+
+    def meet(self, other: "Interval") -> Optional["Interval"]:
+        """The intersection, or None if it is empty"""
+        lo, hi = max(self.lo, other.lo), min(self.hi, other.hi)
+        return Interval(lo, hi) if lo <= hi else None
+
+    def within(self, other: "Interval") -> bool:
+        return other.lo <= self.lo and self.hi <= other.hi
+
+    def constant(self) -> Optional[int]:
+        return self.lo if self.lo == self.hi else None
+
+
+UNBOUNDED = Interval(-math.inf, math.inf)
+WORD = Interval(arith.WORD_MIN, arith.WORD_MAX)
+BOOLEAN = Interval(0, 1)
+
+# Environments map variable names to intervals.  A name that is
+# missing may be unassigned (or anything); None is an environment
+# that is never reached.
+Env = Optional[Dict[str, Interval]]
+
+# The relation that holds when opsym does not
+NEGATED = {"==": "!=", "!=": "==", "<": ">=", ">=": "<", ">": "<=", "<=": ">"}
+
+
+def times(a: Bound, b: Bound) -> Bound:
+    """a * b, where 0 times an infinity is 0"""
+    return 0 if a == 0 or b == 0 else a * b
+
+
+def divided(a: Bound, b: Bound) -> Bound:
+    """a // b (b not 0), where infinities behave as limits"""
+    if math.isinf(a):
+        return a if b > 0 else -a
+    if math.isinf(b):
+        return 0 if a == 0 or (a > 0) == (b > 0) else -1
+    return a // b
+
+
+def join_envs(a: Env, b: Env) -> Env:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return {name: a[name].join(b[name]) for name in a.keys() & b.keys()}
+
+
+def decided(difference: Interval, opsym: str) -> Optional[bool]:
+    """Whether left opsym right, when left - right is in difference,
+    is always true or always false
+    """
+    always = {"<": difference.hi < 0, "<=": difference.hi <= 0,
+              ">": difference.lo > 0, ">=": difference.lo >= 0,
+              "==": difference.lo == difference.hi == 0,
+              "!=": difference.hi < 0 or difference.lo > 0}
+    if always[opsym]:
+        return True
+    if always[NEGATED[opsym]]:
+        return False
+    return None
+
+
+def constrain(left: Interval, opsym: str, right: Interval) -> Tuple[Optional[Interval], Optional[Interval]]:
+    """left and right, narrowed to the values for which
+    left opsym right holds
+    """
+    if opsym in [">", ">="]:
+        r, l = constrain(right, {">": "<", ">=": "<="}[opsym], left)
+        return l, r
+    if opsym == "<":
+        return (left.meet(Interval(-math.inf, right.hi - 1)),
+                right.meet(Interval(left.lo + 1, math.inf)))
+    if opsym == "<=":
+        return left.meet(Interval(-math.inf, right.hi)), right.meet(Interval(left.lo, math.inf))
+    if opsym == "==":
+        both = left.meet(right)
+        return both, both
+
+    # != only trims an end equal to a single value on the other side
+    def trim(a: Interval, b: Interval) -> Optional[Interval]:
+        value = b.constant()
+        if value is None:
+            return a
+        if a.lo == value:
+            return a.meet(Interval(value + 1, math.inf))
+        if a.hi == value:
+            return a.meet(Interval(-math.inf, value - 1))
+        return a
+    return trim(left, right), trim(right, left)
+
+
+class Condition(NamedTuple):
+    """What is known of a condition:  the comparison, the
+    intervals of its sides, and its answer if decided.  If the
+    comparison may overflow (exact is False), it is false then,
+    so only its holding tells anything of the sides.
+    """
+    node: expr.Expr
+    left: Optional[Interval]
+    right: Optional[Interval]
+    outcome: Optional[bool]
+    exact: bool = True
+
+
+class Ranges(object):
+    """The intervals of the variables and expressions of one
+    program, with fixed-width or unbounded arithmetic
+    """
+
+    def __init__(self, program: expr.Expr, fixed: bool = True):
+        self.fixed = fixed
+        self.universe = WORD if fixed else UNBOUNDED
+        # id(node) -> (node, interval) for each expression reached
+        self.values = {}
+        # id(node) -> node for each operation that may overflow
+        # (setting V) or divide by zero
+        self.unsafe = {}
+        # Interval of every value assigned to each variable
+        self.variables = {}
+        self.recording = True
+        self.stmt(program, {})
+
+    def interval(self, node: expr.Expr) -> Optional[Interval]:
+        """The interval of node, if it is ever evaluated"""
+        return self.values.get(id(node), (node, None))[1]
+
+    def safe(self, node: expr.Expr) -> bool:
+        """Whether no operation in node, where it is evaluated,
+        ever overflows or divides by zero
+        """
+        if id(node) in self.unsafe:
+            return False
+        return all(self.safe(child) for child in [getattr(node, "left", None), getattr(node, "right", None)]
+                   if isinstance(child, expr.Expr))
+
+    def record(self, table: dict, node: expr.Expr, value: Interval):
+        if self.recording:
+            old = table.get(id(node), (node, None))[1]
+            table[id(node)] = (node, value if old is None else old.join(value))
+
+    def overflows(self, node: expr.Expr):
+        if self.recording:
+            self.unsafe[id(node)] = node
+
+    def fit(self, node: expr.Expr, value: Interval) -> Interval:
+        """value as held in a register"""
+        if value.within(self.universe):
+            return value
+        self.overflows(node)
+        return self.universe
+
+    # Expressions
+
+    def value(self, node: expr.Expr, env: dict) -> Interval:
+        result = self.evaluate(node, env)
+        self.record(self.values, node, result)
+        return result
+
+    def evaluate(self, node: expr.Expr, env: dict) -> Interval:
+        if isinstance(node, expr.IntConst):
+            return Interval(node.value, node.value)
+        if isinstance(node, expr.Var):
+            return env.get(node.name, self.universe)
+        if isinstance(node, expr.Read):
+            return self.universe
+        if isinstance(node, expr.Comparison):
+            answer = self.condition(node, env).outcome
+            return BOOLEAN if answer is None else Interval(int(answer), int(answer))
+        if isinstance(node, expr.Neg):
+            operand = self.value(node.left, env)
+            return self.fit(node, Interval(-operand.hi, -operand.lo))
+        if isinstance(node, expr.Abs):
+            operand = self.value(node.left, env)
+            if operand.lo >= 0:
+                return self.fit(node, operand)
+            if operand.hi <= 0:
+                return self.fit(node, Interval(-operand.hi, -operand.lo))
+            return self.fit(node, Interval(0, max(-operand.lo, operand.hi)))
+        if isinstance(node, expr.BinOp):
+            left, right = self.value(node.left, env), self.value(node.right, env)
+            return self.binop(node, left, right)
+        if isinstance(node, expr.Assign):
+            return self.assign(node, env)
+        # Statements used as expressions
+        self.stmt(node, env)
+        return self.universe
+
+    def binop(self, node: expr.BinOp, left: Interval, right: Interval) -> Interval:
+        if isinstance(node, expr.Plus):
+            return self.fit(node, Interval(left.lo + right.lo, left.hi + right.hi))
+        if isinstance(node, expr.Minus):
+            return self.fit(node, Interval(left.lo - right.hi, left.hi - right.lo))
+        if isinstance(node, expr.Times):
+            corners = [times(a, b) for a in left for b in right]
+            return self.fit(node, Interval(min(corners), max(corners)))
+        # Division, by the negative and positive parts of right
+        corners = []
+        for part in [right.meet(Interval(-math.inf, -1)), right.meet(Interval(1, math.inf))]:
+            if part is not None:
+                corners += [divided(a, b) for a in left for b in part]
+        if right.lo <= 0 <= right.hi:
+            self.overflows(node)
+            if self.fixed:
+                # Dividing by zero gives 0 (where unbounded ints raise)
+                corners.append(0)
+        if not corners:
+            return self.universe
+        return self.fit(node, Interval(min(corners), max(corners)))
+
+    def condition(self, node: expr.Expr, env: dict) -> Condition:
+        """Evaluate the condition node"""
+        if not isinstance(node, expr.Comparison):
+            value = self.value(node, env)
+            outcome = None
+            if value == Interval(0, 0):
+                outcome = False
+            elif value.lo > 0 or value.hi < 0:
+                outcome = True
+            return Condition(node, None, None, outcome)
+        left, right = self.value(node.left, env), self.value(node.right, env)
+        difference = Interval(left.lo - right.hi, left.hi - right.lo)
+        if not difference.within(self.universe):
+            self.overflows(node)
+        if not difference.within(self.universe):
+            # The subtraction may overflow, and then no relation
+            # holds (see arith.py)
+            cond = Condition(node, left, right, None, exact=False)
+        else:
+            cond = Condition(node, left, right, decided(difference, node.opsym))
+        self.record(self.values, node, BOOLEAN if cond.outcome is None
+                    else Interval(int(cond.outcome), int(cond.outcome)))
+        return cond
+
+    def refine(self, cond: Condition, env: Env, holds: bool) -> Env:
+        """env on the arm where cond is (holds) true"""
+        if env is None or cond.outcome == (not holds):
+            return None
+        env = dict(env)
+        if cond.left is None or not (holds or cond.exact):
+            return env
+        opsym = cond.node.opsym if holds else NEGATED[cond.node.opsym]
+        left, right = constrain(cond.left, opsym, cond.right)
+        if left is None or right is None:
+            return None
+        for side, narrowed in [(cond.node.right, right), (cond.node.left, left)]:
+            if isinstance(side, expr.Var):
+                current = env.get(side.name, self.universe).meet(narrowed)
+                if current is None:
+                    return None
+                env[side.name] = current
+        return env
+
+    # Statements
+
+    def assign(self, node: expr.Assign, env: dict) -> Interval:
+        value = self.value(node.right, env)
+        env[node.left.name] = value
+        if self.recording:
+            old = self.variables.get(node.left.name)
+            self.variables[node.left.name] = value if old is None else old.join(value)
+        return value
+
+    def stmt(self, node: expr.Expr, env: Env) -> Env:
+        """Run node on env, which it may change; returns the
+        environment after it
+        """
+        if env is None or isinstance(node, expr.Pass):
+            return env
+        if isinstance(node, expr.Seq):
+            return self.stmt(node.right, self.stmt(node.left, env))
+        if isinstance(node, expr.Print):
+            self.value(node.expr, env)
+            return env
+        if isinstance(node, expr.If):
+            cond = self.condition(node.cond, env)
+            then_env = self.stmt(node.thenpart, self.refine(cond, env, True))
+            else_env = self.stmt(node.elsepart, self.refine(cond, env, False))
+            return join_envs(then_env, else_env)
+        if isinstance(node, expr.While):
+            return self.loop(node, env)
+        self.value(node, env)
+        return env
+
+    def trip(self, node: expr.While, head: dict) -> Tuple[Condition, Env]:
+        """The condition at head, and the environment after the body"""
+        cond = self.condition(node.cond, head)
+        return cond, self.stmt(node.expr, self.refine(cond, head, True))
+
+    def loop(self, node: expr.While, entry: dict) -> Env:
+        recording, self.recording = self.recording, False
+        head, trips = entry, 0
+        while True:
+            _, after = self.trip(node, head)
+            grown = join_envs(head, after)
+            if grown == head:
+                break
+            trips += 1
+            if trips > WIDEN_AFTER:
+                grown = {name: Interval(self.universe.lo if value.lo < head[name].lo else value.lo,
+                                        self.universe.hi if value.hi > head[name].hi else value.hi)
+                         for name, value in grown.items()}
+            head = grown
+        # Narrowing:  one more trip from the head found
+        _, after = self.trip(node, head)
+        narrowed = join_envs(entry, after)
+        if all(narrowed[name].within(head[name]) for name in narrowed):
+            head = narrowed
+        self.recording = recording
+        cond, _ = self.trip(node, head)
+        return self.refine(cond, head, False)
+
+    def report(self) -> List[str]:
+        """Interval of each variable, one per line"""
+        return [f"{name} in {value}" for name, value in sorted(self.variables.items())]
+
+
+class Narrower(object):
+    """Rewrites an AST with what its ranges show"""
+
+    def __init__(self, program: expr.Expr, fixed: bool, stats: Counter):
+        self.ranges = Ranges(program, fixed)
+        self.fixed = fixed
+        self.stats = stats
+
+    def outcome(self, cond: expr.Expr) -> Optional[bool]:
+        value = self.ranges.interval(cond)
+        if value is None or value.constant() is None:
+            return None
+        return value.constant() != 0
+
+    def value(self, e: expr.Expr) -> expr.Expr:
+        value = self.ranges.interval(e)
+        if value is None:
+            return e
+        if value.constant() is not None and not isinstance(e, expr.IntConst) \
+                and expr.side_effect_free(e) and self.ranges.safe(e):
+            self.stats["comparisons folded" if isinstance(e, expr.Comparison) else "constants found"] += 1
+            return expr.IntConst(value.constant())
+        if isinstance(e, expr.Abs) and self.ranges.interval(e.left).lo >= 0:
+            self.stats["abs removed"] += 1
+            return self.value(e.left)
+        if isinstance(e, (expr.BinOp, expr.Comparison)):
+            result = sccp.rebuild(e, self.value(e.left), self.value(e.right))
+        elif isinstance(e, expr.UnOp):
+            result = sccp.rebuild(e, self.value(e.left))
+        else:
+            return e
+        return self.checked(e, result)
+
+    def checked(self, e: expr.Expr, result: expr.Expr) -> expr.Expr:
+        """result (rebuilt from e), marked in range if e always is"""
+        if self.fixed and self.ranges.interval(e) is not None and id(e) not in self.ranges.unsafe:
+            result.in_range = True
+            self.stats["overflow checks removed"] += 1
+        return result
+
+    def cond(self, e: expr.Expr) -> expr.Expr:
+        """A condition, kept a comparison for the code generator"""
+        if isinstance(e, expr.Comparison):
+            return self.checked(e, sccp.rebuild(e, self.value(e.left), self.value(e.right)))
+        return self.value(e)
+
+    def stmt(self, node: expr.Expr) -> expr.Expr:
+        if isinstance(node, expr.Seq):
+            left, right = self.stmt(node.left), self.stmt(node.right)
+            if isinstance(left, expr.Pass):
+                return right
+            if isinstance(right, expr.Pass):
+                return left
+            return sccp.rebuild(node, left, right)
+        if isinstance(node, expr.Assign):
+            return sccp.rebuild(node, node.left, self.value(node.right))
+        if isinstance(node, expr.Print):
+            return sccp.rebuild(node, self.value(node.expr))
+        if isinstance(node, expr.If):
+            outcome = self.outcome(node.cond)
+            if outcome is not None and expr.side_effect_free(node.cond) and self.ranges.safe(node.cond):
+                self.stats["comparisons folded"] += 1
+                return self.stmt(node.thenpart if outcome else node.elsepart)
+            return sccp.rebuild(node, self.cond(node.cond), self.stmt(node.thenpart),
+                                self.stmt(node.elsepart))
+        if isinstance(node, expr.While):
+            if self.outcome(node.cond) is False and expr.side_effect_free(node.cond) \
+                    and self.ranges.safe(node.cond):
+                self.stats["comparisons folded"] += 1
+                return expr.Pass()
+            return sccp.rebuild(node, self.cond(node.cond), self.stmt(node.expr))
+        if isinstance(node, expr.Pass):
+            return node
+        return self.value(node)
+
+
+def analyze(program: expr.Expr, fixed: bool = True) -> Ranges:
+    """The ranges of program, with fixed-width (32-bit) or
+    unbounded arithmetic
+    """
+    return Ranges(program, fixed)
+
+
+def narrow(program: expr.Expr, fixed: bool = True, stats: Counter = None) -> (expr.Expr, Ranges):
+    """program with the work its ranges show is not needed
+    removed, and the ranges; what was done is counted in stats
+    """
+    if stats is None:
+        stats = Counter()
+    narrower = Narrower(program, fixed, stats)
+    return narrower.stmt(program), narrower.ranges
@@ -0,0 +1,233 @@
+"""
+Global register allocation for Mallard variables.
+
+Without it, every reference to a variable is a LOAD from
+its DATA word and every assignment is a STORE, even in
+the tightest loop.  Mallard has only global variables and
+no procedures, so a variable that gets a register can live
+in that register for the whole program and never touch
+memory at all.
+
+We use linear scan allocation (Poletto and Sarkar):
+
+ * Number every variable reference in program order.  The
+   live interval of a variable runs from its first to its
+   last reference.  A variable referenced inside a loop is
+   live around the back edge, so its interval is widened
+   to cover the whole loop.
+ * Weigh each variable by its references, counting a
+   reference at loop depth d as 10^d references.  With a
+   profile (see pgo.py), a reference counts as often as the
+   code around it ran for each run of the program:  an If arm
+   by the share of tests that chose it, a loop body by its
+   trips per entry.
+ * Walk the intervals in order of their start.  Variables
+   whose intervals don't overlap may share a register.  When
+   every register is taken, the lightest of the competing
+   variables stays in memory.
+
+Registers not given to variables remain for expression
+temporaries.  We keep enough of them that the program's
+expressions need not spill (up to MAX_TEMP_REGISTERS).
+
+A variable that might be read before it is assigned holds
+0 when it lives in memory (DATA 0).  Such a variable's
+register is cleared at the start of the program, and its
+interval starts there.
+"""
+
+import expr
+from codegen_context import Context, Instr
+
+from typing import Dict, List, Set
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+# Expression temporaries are never squeezed below MIN, and we
+# never hold more than MAX back from variables
+MIN_TEMP_REGISTERS = 2
+MAX_TEMP_REGISTERS = 6
+
+# A reference inside a loop counts this many times more
+# than one outside it (per level of nesting)
+LOOP_WEIGHT = 10
+
+
+class Interval(object):
+    """Live interval and weight of one variable"""
+
+    def __init__(self, name: str, start: int):
+        self.name = name
+        self.start = start
+        self.end = start
+        self.weight = 0
+        self.register = None
+
+    def __repr__(self) -> str:
+        return f"Interval({self.name}, {self.start}..{self.end}, weight={self.weight})"
+
+
+class LiveIntervals(object):
+    """Walks the AST in program order, numbering references"""
+
+    def __init__(self):
+        self.position = 0
+        self.intervals = {}
+        # Variables that may be read before they are assigned
+        self.uninitialized = set()
+        # Largest Sethi-Ullman number of any expression
+        self.max_need = 1
+        # Range of positions of each loop, with the variables in it
+        self.loops = []
+
+    def _ref(self, name: str, weight: float, loops: List[list]):
+        self.position += 1
+        if name not in self.intervals:
+            self.intervals[name] = Interval(name, self.position)
+        interval = self.intervals[name]
+        interval.end = self.position
+        interval.weight += weight
+        for loop in loops:
+            loop[2].add(name)
+
+    def _expr(self, e: expr.Expr, weight: float, loops: List[list], assigned: Set[str]):
+        if isinstance(e, expr.Var):
+            if e.name not in assigned:
+                self.uninitialized.add(e.name)
+            self._ref(e.name, weight, loops)
+        elif isinstance(e, expr.Assign):
+            self._stmt(e, weight, loops, assigned)
+        else:
+            for part in ["left", "right"]:
+                child = getattr(e, part, None)
+                if isinstance(child, expr.Expr):
+                    self._expr(child, weight, loops, assigned)
+
+    def _stmt(self, s: expr.Expr, weight: float, loops: List[list], assigned: Set[str]) -> Set[str]:
+        """Walk statement s, where a reference has the given
+        weight.  'assigned' holds the variables certainly
+        assigned before s; returns those certainly assigned
+        after it.
+        """
+        if isinstance(s, expr.Seq):
+            assigned = self._stmt(s.left, weight, loops, assigned)
+            return self._stmt(s.right, weight, loops, assigned)
+        if isinstance(s, expr.Assign):
+            self.max_need = max(self.max_need, s.right.need())
+            self._expr(s.right, weight, loops, assigned)
+            self._ref(s.left.name, weight, loops)
+            return assigned | {s.left.name}
+        if isinstance(s, expr.Print):
+            self.max_need = max(self.max_need, s.expr.need())
+            self._expr(s.expr, weight, loops, assigned)
+            return assigned
+        if isinstance(s, expr.If):
+            self.max_need = max(self.max_need, s.cond.need())
+            self._expr(s.cond, weight, loops, assigned)
+            then_weight, else_weight = arm_weights(s, weight)
+            then_assigned = self._stmt(s.thenpart, then_weight, loops, assigned)
+            else_assigned = self._stmt(s.elsepart, else_weight, loops, assigned)
+            return then_assigned & else_assigned
+        if isinstance(s, expr.While):
+            loop = [self.position + 1, None, set()]
+            self.loops.append(loop)
+            inner = loops + [loop]
+            self.max_need = max(self.max_need, s.cond.need())
+            cond_weight, body_weight = loop_weights(s, weight)
+            self._expr(s.cond, cond_weight, inner, assigned)
+            self._stmt(s.expr, body_weight, inner, assigned)
+            loop[1] = self.position
+            # The body might not run at all
+            return assigned
+        if isinstance(s, expr.Pass):
+            return assigned
+        self.max_need = max(self.max_need, s.need())
+        self._expr(s, weight, loops, assigned)
+        return assigned
+
+    def compute(self, program: expr.Expr) -> List[Interval]:
+        self._stmt(program, 1, [], set())
+        for start, end, names in self.loops:
+            for name in names:
+                interval = self.intervals[name]
+                interval.start = min(interval.start, start)
+                interval.end = max(interval.end, end)
+        for name in self.uninitialized:
+            self.intervals[name].start = 0
+        return sorted(self.intervals.values(), key=lambda i: (i.start, i.end))
+
+
+def arm_weights(node: expr.If, weight: float) -> (float, float):
+    """Weights of references in the then and else parts of
+    node, where a reference in the If itself has weight
+    """
+    if node.counts is None:
+        return weight, weight
+    taken = sum(node.counts)
+    if taken == 0:
+        return 0, 0
+    return weight * node.counts[0] / taken, weight * node.counts[1] / taken
+
+
+def loop_weights(node: expr.While, weight: float) -> (float, float):
+    """Weights of references in the condition and body of
+    node, where a reference before the loop has weight
+    """
+    if node.counts is None:
+        return weight * LOOP_WEIGHT, weight * LOOP_WEIGHT
+    entries, trips = node.counts
+    if entries == 0:
+        return 0, 0
+    return weight * (entries + trips) / entries, weight * trips / entries
+
+
+def linear_scan(intervals: List[Interval], registers: List[str]) -> Dict[str, str]:
+    """Assign registers to intervals; returns variable -> register
+    for the variables that got one.
+    """
+    free = list(registers)
+    active = []
+    for interval in intervals:
+        # Registers of intervals that ended are free again
+        for old in [a for a in active if a.end < interval.start]:
+            active.remove(old)
+            free.append(old.register)
+        if free:
+            interval.register = free.pop(0)
+            active.append(interval)
+            continue
+        lightest = min(active, key=lambda a: a.weight)
+        if lightest.weight < interval.weight:
+            interval.register = lightest.register
+            lightest.register = None
+            active.remove(lightest)
+            active.append(interval)
+    return {i.name: i.register for i in intervals if i.register}
+
+
+def allocate_variables(program: expr.Expr, context: Context) -> Dict[str, str]:
+    """Choose registers for the variables of program and record
+    them in context.  Must be called before code generation
+    starts (it emits code to clear registers of variables that
+    may be read before they are assigned).
+    """
+    live = LiveIntervals()
+    intervals = live.compute(program)
+    temps = max(MIN_TEMP_REGISTERS, min(live.max_need, MAX_TEMP_REGISTERS))
+    pool = sorted(context.registers, key=lambda r: int(r[1:]))
+    for_vars = pool[:max(0, len(pool) - temps)]
+    assignment = linear_scan(intervals, for_vars)
+    context.assign_variable_registers(assignment)
+    for name in sorted(live.uninitialized):
+        if name in assignment:
+            context.emit("ADD", assignment[name], "r0", "r0", comment=f"# {name} = 0")
+    log.debug(f"Variables in registers: {assignment}")
+    return assignment
+
+
+def memory_op_count(instrs: List[Instr]) -> int:
+    """Number of LOAD and STORE instructions in the code"""
+    return len([instr for instr in instrs if instr.opcode in ["LOAD", "STORE"]])
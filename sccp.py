@@ -0,0 +1,361 @@
+"""
+Sparse conditional constant propagation (Wegman and Zadeck).
+
+Constants are propagated over the SSA form of the whole program
+(see ssa.py), through assignments, phis, and the arms of ifs and
+whiles, while the edges of the control flow graph that can ever
+be taken are found at the same time.  A branch is followed only
+along the arms its condition allows, so a condition that is
+constant only once values are propagated (a flag set before a
+loop and never changed, say) is decided, and the code in the arm
+not taken never contributes values to the rest of the program:
+
+    debug = 0;                     debug = 0;
+    x = read;                      x = read;
+    while x > 0 do          ==>    while x > 0 do
+        if debug == 1 then             x = x - 1;
+            print x;               od
+        fi
+        x = x - 1;
+    od
+
+Each SSA name has a value in the lattice
+
+    TOP        no value seen yet (the code computing it may
+               never run)
+    constant   the same integer every time it is computed
+    BOTTOM     not a constant
+
+and values only move down it.  Arithmetic is folded with
+expr.ARITH, except where the machine would set the V flag (an
+overflow, or a division by zero):  those are left to run.  So is
+any result that doesn't fit in a word, since with BigInt
+semantics (the default) nothing overflows, but the code
+generated for the machine would wrap it to 32 bits.
+
+The results are used two ways:
+
+    propagate(ir)       rewrites the SSA form:  constant
+                        operations become constants, decided
+                        branches become jumps, and blocks that
+                        never run are removed
+    simplify(program)   rewrites the AST, for the interpreter and
+                        the code generator:  constant expressions
+                        become IntConsts, a decided If becomes the
+                        arm taken, a While never entered and
+                        statements never reached are removed
+
+In the AST a variable read before it is assigned is an error, not
+0, so simplify() doesn't treat those as constants.
+"""
+
+import copy
+from collections import Counter
+from typing import List, Optional, Union
+
+import arith
+import expr
+import ssa
+from ssa import Block, IR, Op
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class Unknown(object):
+    """A lattice value that is not a constant"""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __repr__(self) -> str:
+        return self.name
+
+
+TOP = Unknown("TOP")
+BOTTOM = Unknown("BOTTOM")
+
+Value = Union[int, Unknown]
+
+
+def meet(a: Value, b: Value) -> Value:
+    if a is TOP:
+        return b
+    if b is TOP:
+        return a
+    if a is BOTTOM or b is BOTTOM or a != b:
+        return BOTTOM
+    return a
+
+
+class Propagation(object):
+    """The values of the names in ir, and the blocks and edges
+    that can be executed.  With undefined_known False, the value
+    of variables never assigned is not taken to be 0.
+    """
+
+    def __init__(self, ir: IR, undefined_known: bool = True):
+        self.ir = ir
+        self.undefined_known = undefined_known
+        self.values = {}
+        self.executable = set()
+        # Edges (source, dest) that can be taken; the entry's
+        # is (None, entry)
+        self.edges = set()
+        # Folding must not count overflows against the program
+        self.arith = copy.copy(expr.ARITH)
+        self.arith.v = False
+
+    def value(self, name: str) -> Value:
+        return self.values.get(name, TOP)
+
+    def constant(self, name: Optional[str]) -> Optional[int]:
+        """The value of name, if it is a constant"""
+        value = self.values.get(name, TOP)
+        return None if isinstance(value, Unknown) else value
+
+    def taken(self, block: Block) -> List[Block]:
+        """Successors of block whose edges can be taken"""
+        return [succ for succ in block.succs if (block, succ) in self.edges]
+
+    def solve(self) -> "Propagation":
+        uses = {}
+        for block in self.ir.blocks:
+            for op in block.code:
+                for arg in set(op.args):
+                    uses.setdefault(arg, []).append((op, block))
+        flow = [(None, self.ir.entry)]
+        work = []
+        while flow or work:
+            if flow:
+                edge = flow.pop()
+                if edge in self.edges:
+                    continue
+                self.edges.add(edge)
+                block = edge[1]
+                if block in self.executable:
+                    # Only the phis see the new edge
+                    ops = block.phis()
+                else:
+                    self.executable.add(block)
+                    ops = block.code
+                for op in ops:
+                    self.visit(op, block, flow, work, uses)
+            else:
+                op, block = work.pop()
+                if block in self.executable:
+                    self.visit(op, block, flow, work, uses)
+        return self
+
+    def visit(self, op: Op, block: Block, flow: list, work: list, uses: dict):
+        if op.opcode == "branch":
+            holds = self.fold(op, [self.value(arg) for arg in op.args])
+            if holds is BOTTOM:
+                flow.extend((block, target) for target in op.targets)
+            elif holds is not TOP:
+                flow.append((block, op.targets[0 if holds else 1]))
+        elif op.opcode == "jump":
+            flow.append((block, op.targets[0]))
+        elif op.opcode == "halt":
+            flow.append((block, self.ir.exit))
+        elif op.dest:
+            old = self.value(op.dest)
+            new = meet(old, self.evaluate(op, block))
+            if new is not old and new != old:
+                self.values[op.dest] = new
+                work.extend(uses.get(op.dest, []))
+
+    def evaluate(self, op: Op, block: Block) -> Value:
+        if op.opcode == "phi":
+            value = TOP
+            for pred, arg in zip(block.preds, op.args):
+                if (pred, block) in self.edges:
+                    value = meet(value, self.value(arg))
+            return value
+        if op.opcode == "const":
+            if op.dest == self.ir.undefined and not self.undefined_known:
+                return BOTTOM
+            return op.value
+        if op.opcode == "read":
+            return BOTTOM
+        if op.opcode == "copy":
+            return self.value(op.args[0])
+        return self.fold(op, [self.value(arg) for arg in op.args])
+
+    def fold(self, op: Op, args: List[Value]) -> Value:
+        """The value of op on args"""
+        if BOTTOM in args:
+            return BOTTOM
+        if TOP in args:
+            return TOP
+        try:
+            if op.opcode in ["cmp", "branch"]:
+                if not arith.WORD_MIN <= args[0] - args[1] <= arith.WORD_MAX:
+                    # The machine's comparison overflows (see arith.py)
+                    return BOTTOM
+                value = ssa.RELATIONS[op.relop]._apply(*self.arith.relation(*args))
+            elif op.opcode in ["neg", "abs"]:
+                value = self.arith.unop(ssa.APPLY[op.opcode]._apply, *args)
+            elif op.opcode == "div" and args[1] == 0:
+                return BOTTOM
+            else:
+                value = self.arith.binop(ssa.APPLY[op.opcode]._apply, *args)
+        except arith.ArithmeticOverflow:
+            return BOTTOM
+        if self.arith.v:
+            self.arith.v = False
+            return BOTTOM
+        if not arith.WORD_MIN <= value <= arith.WORD_MAX:
+            return BOTTOM
+        return value
+
+
+def propagate(ir: IR) -> Propagation:
+    """Rewrite ir with the constants and the executable blocks
+    found by SCCP
+    """
+    result = Propagation(ir).solve()
+    stats = ir.stats
+    for block in ir.blocks:
+        if block not in result.executable:
+            continue
+        phis, constants, rest = [], [], []
+        for op in block.code:
+            value = result.constant(op.dest)
+            if op.opcode in ssa.PURE and op.opcode != "const" and value is not None:
+                (constants if op.opcode == "phi" else rest).append(Op("const", op.dest, value=value))
+                stats["constants propagated"] += 1
+            elif op.opcode == "branch" and len(result.taken(block)) == 1:
+                rest.append(Op("jump", targets=result.taken(block)))
+                for target in op.targets:
+                    if target not in result.taken(block):
+                        ir.remove_edge(block, target)
+                stats["branches folded"] += 1
+            else:
+                (phis if op.opcode == "phi" else rest).append(op)
+        block.code = phis + constants + rest
+    for block in list(ir.blocks):
+        if block in result.executable or block is ir.exit:
+            continue
+        for succ in list(block.succs):
+            ir.remove_edge(block, succ)
+        for pred in list(block.preds):
+            ir.remove_edge(pred, block)
+        ir.blocks.remove(block)
+        stats["blocks removed"] += 1
+    return result
+
+
+# Simplifying the AST
+
+def statement_count(node: expr.Expr) -> int:
+    """Statements in node, not counting sequencing and pass"""
+    if isinstance(node, expr.Seq):
+        return statement_count(node.left) + statement_count(node.right)
+    if isinstance(node, expr.If):
+        return 1 + statement_count(node.thenpart) + statement_count(node.elsepart)
+    if isinstance(node, expr.While):
+        return 1 + statement_count(node.expr)
+    if isinstance(node, expr.Pass):
+        return 0
+    return 1
+
+
+def rebuild(node: expr.Expr, *kids) -> expr.Expr:
+    """node, or a new node like it with different kids"""
+    old = {expr.Seq: ("left", "right"), expr.Assign: ("left", "right"),
+           expr.Print: ("expr",), expr.If: ("cond", "thenpart", "elsepart"),
+           expr.While: ("cond", "expr")}.get(type(node))
+    if old is None:
+        old = ("left", "right") if isinstance(node, (expr.BinOp, expr.Comparison)) else ("left",)
+    if all(getattr(node, field) is kid for field, kid in zip(old, kids)):
+        return node
+    return expr.with_profile(node, type(node)(*kids))
+
+
+class Simplifier(object):
+    """Rewrites an AST with the results of SCCP on its SSA form"""
+
+    def __init__(self, program: expr.Expr, stats: Counter):
+        self.ir = ssa.build(program)
+        self.result = Propagation(self.ir, undefined_known=False).solve()
+        self.stats = stats
+
+    def reached(self, node: expr.Expr) -> bool:
+        block = self.ir.statements.get(id(node), (node, None))[1]
+        return block is None or block in self.result.executable
+
+    def fold(self, e: expr.Expr) -> expr.Expr:
+        name = self.ir.values.get(id(e), (e, None))[1]
+        value = self.result.constant(name)
+        if value is not None and not isinstance(e, expr.IntConst):
+            self.stats["expressions folded"] += 1
+            return expr.IntConst(value)
+        if isinstance(e, (expr.BinOp, expr.Comparison)):
+            return rebuild(e, self.fold(e.left), self.fold(e.right))
+        if isinstance(e, expr.UnOp):
+            return rebuild(e, self.fold(e.left))
+        return e
+
+    def stmt(self, node: expr.Expr) -> expr.Expr:
+        if isinstance(node, expr.Pass):
+            return node
+        if not self.reached(node):
+            self.stats["statements removed"] += statement_count(node)
+            return expr.Pass()
+        if isinstance(node, expr.Seq):
+            left, right = self.stmt(node.left), self.stmt(node.right)
+            if isinstance(left, expr.Pass):
+                return right
+            if isinstance(right, expr.Pass):
+                return left
+            return rebuild(node, left, right)
+        if isinstance(node, expr.Assign):
+            return rebuild(node, node.left, self.fold(node.right))
+        if isinstance(node, expr.Print):
+            return rebuild(node, self.fold(node.expr))
+        if isinstance(node, expr.If):
+            return self.if_stmt(node)
+        if isinstance(node, expr.While):
+            return self.while_stmt(node)
+        return self.fold(node)
+
+    def arms(self, node: expr.Expr) -> Optional[List[Block]]:
+        """Targets of the branch of node that can be taken"""
+        block = self.ir.branches.get(id(node), (node, None))[1]
+        if block is None:
+            return None
+        return self.result.taken(block)
+
+    def if_stmt(self, node: expr.If) -> expr.Expr:
+        taken = self.arms(node)
+        if taken is not None and len(taken) == 1:
+            then_block, _ = self.ir.branches[id(node)][1].code[-1].targets
+            arm, other = node.thenpart, node.elsepart
+            if taken[0] is not then_block:
+                arm, other = other, arm
+            self.stats["branches folded"] += 1
+            self.stats["statements removed"] += statement_count(other)
+            return self.stmt(arm)
+        return rebuild(node, self.fold(node.cond), self.stmt(node.thenpart), self.stmt(node.elsepart))
+
+    def while_stmt(self, node: expr.While) -> expr.Expr:
+        taken = self.arms(node)
+        if taken is not None:
+            body_block, _ = self.ir.branches[id(node)][1].code[-1].targets
+            if body_block not in taken:
+                self.stats["loops removed"] += 1
+                self.stats["statements removed"] += statement_count(node.expr)
+                return expr.Pass()
+        return rebuild(node, self.fold(node.cond), self.stmt(node.expr))
+
+
+def simplify(program: expr.Expr, stats: Counter = None) -> expr.Expr:
+    """program with constant expressions folded and code that can
+    never run removed; what was done is counted in stats
+    """
+    if stats is None:
+        stats = Counter()
+    return Simplifier(program, stats).stmt(program)
@@ -0,0 +1,468 @@
+"""
+Scalar evolution:  replacing accumulation loops by closed forms.
+
+A loop like
+
+    i = 1;
+    while i <= n do
+        s = s + i;
+        i = i + 1;
+    od
+
+takes n trips to compute what one formula gives.  When a while
+loop counts (its condition compares an induction variable with a
+bound the body doesn't change; see unroll.induction) and its body
+is nothing but assignments of sums, differences, and products,
+the value each variable has after k trips is often a polynomial
+in k and the values entering the loop:
+
+    i = i + 1       i0 + k                 an affine induction variable
+    s = s + i       s0 + k*i0 + k(k-1)/2   a polynomial one, summing i
+    t = 2 * i       2*i0 + 2*k             (k >= 1) not depending on t
+
+These are found by symbolic execution of one trip:  a variable
+assigned x = x + g, with g a polynomial in the trip number k,
+sums g (with Faulhaber's formulas); one assigned x = e, where e
+doesn't mention x, takes the value of e in the last trip.
+Anything else (division, abs, comparisons, a variable depending
+on itself any other way, or read before a plain x = e assigns
+it) leaves the loop alone, as does a degree above MAX_DEGREE.
+
+The loop is replaced by code that computes the number of trips
+from the entry values and sets each variable to its polynomial
+at that number, under the loop's own condition (so a loop that
+never runs still changes nothing):
+
+    if i <= n then
+        trips_distance = n - i;
+        if trips_distance <= 46340 then
+            trips = trips_distance + 1;
+            trips_pairs = trips * (trips - 1) / 2;
+            i_final = trips + i;
+            s = trips * i + trips_pairs + s;
+            i = i_final;
+        else
+            (the original loop)
+        fi
+    fi
+
+Polynomials are evaluated in the binomial basis (trips choose j),
+where their coefficients are integers, so each division is exact.
+With 32-bit words, j * (trips choose j) must fit in a word for
+that, so past a limit on trips the original loop runs instead;
+sums and products otherwise wrap around just as the loop's
+would.  The number of trips must be exact too, but the distance
+from the induction variable to its bound (with the rounding up
+to a multiple of the step) may not fit in a word, however the
+condition holds.  So the original loop also runs when the
+distance is too far, unless the ranges of the variable and the
+bound (see ranges.py) show it never is; then, for a sum of
+degree 1, there is no test at all.
+"""
+
+import math
+from collections import Counter
+from fractions import Fraction
+from typing import Dict, List, Optional, Tuple
+
+import arith
+import expr
+import ranges
+import unroll
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+# Highest degree of polynomial replaced
+MAX_DEGREE = 3
+
+# Names of the trip number, the number of trips, and the value of
+# a variable at the start of the current trip, in polynomials
+# (none of them a Mallard variable name)
+TRIP = "#k"
+TRIPS = "#n"
+CURRENT = "@"
+
+# Names for (trips choose j) in the code
+CHOOSE = {2: "pairs", 3: "triples"}
+
+Monomial = Tuple[Tuple[str, int], ...]
+
+
+class Poly(object):
+    """A polynomial in named variables, with rational coefficients"""
+
+    def __init__(self, terms: Dict[Monomial, Fraction] = None):
+        self.terms = {mono: coef for mono, coef in (terms or {}).items() if coef != 0}
+
+    @staticmethod
+    def const(value) -> "Poly":
+        return Poly({(): Fraction(value)})
+
+    @staticmethod
+    def var(name: str) -> "Poly":
+        return Poly({((name, 1),): Fraction(1)})
+
+    def __add__(self, other: "Poly") -> "Poly":
+        terms = dict(self.terms)
+        for mono, coef in other.terms.items():
+            terms[mono] = terms.get(mono, 0) + coef
+        return Poly(terms)
+
+    def __neg__(self) -> "Poly":
+        return Poly({mono: -coef for mono, coef in self.terms.items()})
+
+    def __sub__(self, other: "Poly") -> "Poly":
+        return self + -other
+
+    def __mul__(self, other: "Poly") -> "Poly":
+        terms = {}
+        for m1, c1 in self.terms.items():
+            for m2, c2 in other.terms.items():
+                powers = dict(m1)
+                for name, power in m2:
+                    powers[name] = powers.get(name, 0) + power
+                mono = tuple(sorted(powers.items()))
+                terms[mono] = terms.get(mono, 0) + c1 * c2
+        return Poly(terms)
+
+    def __pow__(self, power: int) -> "Poly":
+        result = Poly.const(1)
+        for _ in range(power):
+            result = result * self
+        return result
+
+    def __eq__(self, other: "Poly") -> bool:
+        return isinstance(other, Poly) and self.terms == other.terms
+
+    def __str__(self) -> str:
+        if not self.terms:
+            return "0"
+        return " + ".join(f"{coef}" + "".join(f"*{name}^{power}" for name, power in mono)
+                          for mono, coef in sorted(self.terms.items()))
+
+    def degree(self, name: str) -> int:
+        return max([dict(mono).get(name, 0) for mono in self.terms] or [0])
+
+    def names(self) -> set:
+        return {name for mono in self.terms for name, _ in mono}
+
+    def coefficient(self, name: str, power: int) -> "Poly":
+        """The polynomial multiplying name^power"""
+        return Poly({tuple((n, p) for n, p in mono if n != name): coef
+                     for mono, coef in self.terms.items() if dict(mono).get(name, 0) == power})
+
+    def substitute(self, name: str, value: "Poly") -> "Poly":
+        result = Poly()
+        for power in range(self.degree(name) + 1):
+            result = result + self.coefficient(name, power) * value ** power
+        return result
+
+    def integral(self) -> bool:
+        return all(coef.denominator == 1 for coef in self.terms.values())
+
+
+def bernoulli(count: int) -> List[Fraction]:
+    """B_0 .. B_count-1, with B_1 = -1/2"""
+    numbers = []
+    for m in range(count):
+        numbers.append(Fraction(1) if m == 0 else
+                       -sum(math.comb(m + 1, j) * numbers[j] for j in range(m)) / (m + 1))
+    return numbers
+
+
+def power_sum(power: int) -> Poly:
+    """0^power + 1^power + ... + (k-1)^power, as a polynomial in k"""
+    b = bernoulli(power + 1)
+    k = Poly.var(TRIP)
+    total = Poly()
+    for i in range(power + 1):
+        total = total + Poly.const(Fraction(math.comb(power + 1, i)) * b[i] / (power + 1)) * k ** (power + 1 - i)
+    return total
+
+
+def sum_below(g: Poly) -> Poly:
+    """g(0) + g(1) + ... + g(k-1), for g a polynomial in the trip number k"""
+    total = Poly()
+    for power in range(g.degree(TRIP) + 1):
+        total = total + g.coefficient(TRIP, power) * power_sum(power)
+    return total
+
+
+class NotPolynomial(Exception):
+    """A value that is not a polynomial in the trip number"""
+    pass
+
+
+class Unsolved(Exception):
+    """A value depending on a variable not solved yet"""
+    pass
+
+
+def evolution(loop: expr.While) -> Optional[Dict[str, Poly]]:
+    """The value of each variable assigned in loop after n >= 1
+    trips, as a polynomial in n (TRIPS) and the values the
+    variables had entering the loop (by their names), if the loop
+    is simple enough
+    """
+    body = expr.assignments(loop.expr)
+    if not body:
+        return None
+    names = [stmt.left.name for stmt in body]
+    if len(set(names)) != len(names):
+        return None
+    position = {name: i for i, name in enumerate(names)}
+    # Value at the start of trip k (None for a variable that
+    # isn't a polynomial there), and after its assignment in trip k
+    start, after = {}, {}
+
+    def value(e: expr.Expr, at: int, target: str) -> Poly:
+        if isinstance(e, expr.IntConst):
+            return Poly.const(e.value)
+        if isinstance(e, expr.Var):
+            name = e.name
+            if name not in position:
+                return Poly.var(name)
+            if position[name] < at:
+                if name not in after:
+                    raise Unsolved(name)
+                return after[name]
+            if name == target:
+                return Poly.var(CURRENT + name)
+            if name not in start:
+                raise Unsolved(name)
+            if start[name] is None:
+                raise NotPolynomial(name)
+            return start[name]
+        if isinstance(e, expr.Plus):
+            return value(e.left, at, target) + value(e.right, at, target)
+        if isinstance(e, expr.Minus):
+            return value(e.left, at, target) - value(e.right, at, target)
+        if isinstance(e, expr.Times):
+            return value(e.left, at, target) * value(e.right, at, target)
+        if isinstance(e, expr.Neg):
+            return -value(e.left, at, target)
+        raise NotPolynomial(str(e))
+
+    unsolved = list(names)
+    while unsolved:
+        progress = False
+        for name in list(unsolved):
+            try:
+                e = value(body[position[name]].right, position[name], name)
+            except Unsolved:
+                continue
+            except NotPolynomial:
+                return None
+            current = CURRENT + name
+            if e.degree(current) == 0:
+                start[name] = None
+                after[name] = e
+            elif e.degree(current) == 1 and e.coefficient(current, 1) == Poly.const(1):
+                step = e - Poly.var(current)
+                start[name] = Poly.var(name) + sum_below(step)
+                after[name] = start[name] + step
+            else:
+                return None
+            unsolved.remove(name)
+            progress = True
+        if not progress:
+            return None
+    n = Poly.var(TRIPS)
+    finals = {}
+    for name in names:
+        if start[name] is not None:
+            finals[name] = start[name].substitute(TRIP, n)
+        else:
+            finals[name] = after[name].substitute(TRIP, n - Poly.const(1))
+        if finals[name].degree(TRIPS) > MAX_DEGREE:
+            return None
+    return finals
+
+
+def binomial_basis(p: Poly) -> Optional[List[Poly]]:
+    """Coefficients a_j with p = sum of a_j * (n choose j), if
+    they are integers (forward differences of p at 0)
+    """
+    values = [p.substitute(TRIPS, Poly.const(i)) for i in range(p.degree(TRIPS) + 1)]
+    coefficients = []
+    for j in range(len(values)):
+        a = Poly()
+        for i in range(j + 1):
+            a = a + Poly.const((-1) ** (j - i) * math.comb(j, i)) * values[i]
+        if not a.integral():
+            return None
+        coefficients.append(a)
+    return coefficients
+
+
+def trips_limit(degree: int) -> int:
+    """Most trips for which j * (trips choose j) fits in a word,
+    for each j up to degree
+    """
+    if degree < 2:
+        return arith.WORD_MAX
+    low, high = 1, arith.WORD_MAX
+    while low < high:
+        mid = (low + high + 1) // 2
+        if all(j * math.comb(mid, j) <= arith.WORD_MAX for j in range(2, degree + 1)):
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def to_ast(p: Poly, names: Dict[str, str]) -> expr.Expr:
+    """p, with integer coefficients, as an expression (names maps
+    the names in p that are not variables to variables)
+    """
+    result = None
+    for mono, coef in sorted(p.terms.items()):
+        term = None
+        for name, power in mono:
+            for _ in range(power):
+                factor = expr.Var(names.get(name, name))
+                term = factor if term is None else expr.Times(term, factor)
+        magnitude = int(abs(coef))
+        if term is None:
+            term = expr.IntConst(magnitude)
+        elif magnitude != 1:
+            term = expr.Times(expr.IntConst(magnitude), term)
+        if result is None:
+            result = term if coef > 0 else expr.Neg(term)
+        else:
+            result = expr.Plus(result, term) if coef > 0 else expr.Minus(result, term)
+    return result if result is not None else expr.IntConst(0)
+
+
+def distance(ind: unroll.Induction) -> expr.Expr:
+    """How far the induction variable is from its bound, in
+    the direction it steps
+    """
+    return expr.Minus(ind.bound, ind.var) if ind.step > 0 else expr.Minus(ind.var, ind.bound)
+
+
+def rounding(loop: expr.While, ind: unroll.Induction) -> int:
+    """What trip_count adds to the distance, before dividing by
+    the step
+    """
+    relop = loop.cond.opsym if ind.on_left else unroll.MIRROR[loop.cond.opsym](None, None).opsym
+    return abs(ind.step) - 1 + (1 if relop in ["<=", ">="] else 0)
+
+
+def trip_count(loop: expr.While, ind: unroll.Induction, distance: expr.Expr) -> expr.Expr:
+    """Trips the loop takes, given that it takes at least one and
+    the variable is distance from the bound
+    """
+    step = abs(ind.step)
+    # distance + (0 or 1), rounded up to a multiple of step
+    extra = rounding(loop, ind)
+    if extra:
+        distance = expr.Plus(distance, expr.IntConst(extra))
+    return distance if step == 1 else expr.Div(distance, expr.IntConst(step))
+
+
+class Replacer(object):
+    """Replaces the loops of one program that have closed forms"""
+
+    def __init__(self, program: expr.Expr, stats: Counter):
+        self.used = expr.variables(program)
+        self.stats = stats
+        self.ranges = ranges.analyze(program)
+
+    def fresh(self, base: str) -> str:
+        name = base
+        while name in self.used:
+            name += "_"
+        self.used.add(name)
+        return name
+
+    def farthest(self, ind: unroll.Induction) -> ranges.Bound:
+        """The greatest distance the loop's variable can be from
+        its bound where the loop tests it
+        """
+        x, bound = self.ranges.interval(ind.var), self.ranges.interval(ind.bound)
+        if x is None or bound is None:
+            return math.inf
+        return bound.hi - x.lo if ind.step > 0 else x.hi - bound.lo
+
+    def stmt(self, node: expr.Expr) -> expr.Expr:
+        if isinstance(node, expr.Seq):
+            left, right = self.stmt(node.left), self.stmt(node.right)
+            return node if left is node.left and right is node.right else expr.Seq(left, right)
+        if isinstance(node, expr.If):
+            thenpart, elsepart = self.stmt(node.thenpart), self.stmt(node.elsepart)
+            if thenpart is node.thenpart and elsepart is node.elsepart:
+                return node
+            return expr.with_profile(node, expr.If(node.cond, thenpart, elsepart))
+        if isinstance(node, expr.While):
+            return self.loop(node)
+        return node
+
+    def loop(self, node: expr.While) -> expr.Expr:
+        body = self.stmt(node.expr)
+        if body is not node.expr:
+            node = expr.with_profile(node, expr.While(node.cond, body))
+        ind = unroll.induction(node)
+        finals = evolution(node) if ind else None
+        if finals is None:
+            return node
+        bases = {name: binomial_basis(p) for name, p in finals.items()}
+        if None in bases.values():
+            return node
+        degree = max(len(coefficients) - 1 for coefficients in bases.values())
+        trips = self.fresh("trips")
+        choose = {TRIPS + "0": None, TRIPS + "1": trips}
+        # Farthest distance for which the number of trips fits in a
+        # word, and is within the limit for the degree
+        step, extra = abs(ind.step), rounding(node, ind)
+        limit = min(arith.WORD_MAX, (trips_limit(degree) + 1) * step - 1) - extra
+        far = None
+        if self.farthest(ind) <= limit:
+            setup = [expr.Assign(expr.Var(trips), trip_count(node, ind, distance(ind)))]
+            guarded = []
+        else:
+            far = self.fresh(f"{trips}_distance")
+            setup = [expr.Assign(expr.Var(far), distance(ind))]
+            guarded = [expr.Assign(expr.Var(trips), trip_count(node, ind, expr.Var(far)))]
+        for j in range(2, degree + 1):
+            choose[TRIPS + str(j)] = self.fresh(f"{trips}_{CHOOSE[j]}")
+            # (n choose j) = (n choose j-1) * (n - j + 1) / j, exactly
+            guarded.append(expr.Assign(expr.Var(choose[TRIPS + str(j)]), expr.Div(
+                expr.Times(expr.Var(choose[TRIPS + str(j - 1)]),
+                           expr.Minus(expr.Var(trips), expr.IntConst(j - 1))),
+                expr.IntConst(j))))
+        values = {}
+        for name, coefficients in bases.items():
+            p = Poly()
+            for j, a in enumerate(coefficients):
+                p = p + a * (Poly.var(TRIPS + str(j)) if j else Poly.const(1))
+            values[name] = to_ast(p, choose)
+        # Variables whose entry values other closed forms need are
+        # set last, through temporaries
+        needed = {name for name in finals
+                  if any(name in expr.variables(v) for other, v in values.items() if other != name)}
+        temps = {name: self.fresh(f"{name}_final") for name in sorted(needed)}
+        for name in sorted(needed):
+            guarded.append(expr.Assign(expr.Var(temps[name]), values[name]))
+        for name in finals:
+            if name not in needed:
+                guarded.append(expr.Assign(expr.Var(name), values[name]))
+        for name in sorted(needed):
+            guarded.append(expr.Assign(expr.Var(name), expr.Var(temps[name])))
+        closed = unroll.sequence(guarded)
+        if far is not None:
+            closed = expr.If(expr.LE(expr.Var(far), expr.IntConst(limit)), closed, node)
+        self.stats["loops replaced by closed forms"] += 1
+        return expr.If(node.cond, unroll.sequence(setup + [closed]))
+
+
+def replace_loops(program: expr.Expr, stats: Counter = None) -> expr.Expr:
+    """program with its accumulation loops replaced by closed
+    forms; what was done is counted in stats
+    """
+    if stats is None:
+        stats = Counter()
+    return Replacer(program, stats).stmt(program)
@@ -0,0 +1,794 @@
+"""
+A static single assignment (SSA) intermediate representation
+between the Mallard AST and DM2019W assembly code.
+
+Each operation is three-address code, dest = opcode args, and
+each name is assigned by exactly one operation.  Where values of
+a variable meet (the header of a while loop, the join after an
+if), a phi operation chooses among them by the block control
+came from:
+
+    while_2:
+        i.4 = phi(t1, t9)
+        s.5 = phi(t3, t8)
+        branch i.4 < t2 ? do_3 : od_6
+
+Mallard variables disappear:  they are only names for values
+while the IR is built (by the algorithm of Braun et al., "Simple
+and Efficient Construction of Static Single Assignment Form").
+A variable read before it is assigned is 0, as in memory.
+
+Blocks and the IR itself are cfg.Block and cfg.CFG, so the
+dominators, loops, and dataflow of cfg.py apply.  The passes are
+
+    sccp.propagate   constants are propagated, and code that
+                     can never run removed (see sccp.py)
+    copy_propagate   uses of a copy, or of a phi whose arguments
+                     are all the same value, use that value
+    value_number     global value numbering over the dominator
+                     tree:  a pure operation computed again where
+                     an equal one dominates it uses the first
+    dead_code        pure operations no one uses are removed
+    out_of_ssa       phis become copies at the ends of the
+                     predecessor blocks (parallel copies, put in
+                     sequence), after coalescing phi arguments
+                     with the phi where their lifetimes don't
+                     overlap, so that most copies vanish
+    lower            the IR becomes DM2019W code in a Context,
+                     each name in a register (or, if the graph
+                     coloring runs out, a memory word)
+
+run() interprets the IR, with the arithmetic of expr.ARITH.
+"""
+
+import expr
+import cfg
+from codegen_context import Context
+from isel import fits
+
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+# Operations, by the AST node that computes them
+BINARY = {expr.Plus: "add", expr.Minus: "sub", expr.Times: "mul", expr.Div: "div"}
+UNARY = {expr.Neg: "neg", expr.Abs: "abs"}
+
+# Node instances that know how to apply each operation
+APPLY = {"add": expr.Plus(None, None), "sub": expr.Minus(None, None),
+         "mul": expr.Times(None, None), "div": expr.Div(None, None),
+         "neg": expr.Neg(None), "abs": expr.Abs(None)}
+RELATIONS = {rel.opsym: rel for rel in [
+    expr.EQ(None, None), expr.NE(None, None), expr.GT(None, None),
+    expr.GE(None, None), expr.LT(None, None), expr.LE(None, None)]}
+
+# Operations with no effect but their value
+PURE = {"const", "add", "sub", "mul", "div", "neg", "abs", "cmp", "copy", "phi"}
+COMMUTATIVE = {"add", "mul", "==", "!="}
+TERMINATORS = {"jump", "branch", "halt"}
+OPCODES = {"ADD": "add", "SUB": "sub", "MUL": "mul", "DIV": "div"}
+
+
+class Op(object):
+    """dest = opcode args.  A const has its value; a cmp or branch
+    has the relation (relop) between its two args; a jump or branch
+    has its target blocks (true, then false).
+    """
+
+    def __init__(self, opcode: str, dest: str = None, args: List[str] = None,
+                 value: int = None, relop: str = None, targets: list = None):
+        self.opcode = opcode
+        self.dest = dest
+        self.args = args or []
+        self.value = value
+        self.relop = relop
+        self.targets = targets or []
+
+    def __str__(self) -> str:
+        assign = f"{self.dest} = " if self.dest else ""
+        if self.opcode == "const":
+            return f"{assign}{self.value}"
+        if self.opcode == "copy":
+            return f"{assign}{self.args[0]}"
+        if self.opcode == "cmp":
+            return f"{assign}{self.args[0]} {self.relop} {self.args[1]}"
+        if self.opcode == "branch":
+            true, false = self.targets
+            return f"branch {self.args[0]} {self.relop} {self.args[1]} ? {true.name} : {false.name}"
+        if self.opcode == "jump":
+            return f"jump {self.targets[0].name}"
+        if self.opcode == "phi":
+            return f"{assign}phi({', '.join(self.args)})"
+        args = " ".join(self.args)
+        return f"{assign}{self.opcode} {args}".strip()
+
+    def __repr__(self) -> str:
+        return f"Op({self})"
+
+
+class Block(cfg.Block):
+    """A basic block of Ops:  phis first, a terminator last"""
+
+    def phis(self) -> List[Op]:
+        return [op for op in self.code if op.opcode == "phi"]
+
+    def body(self) -> List[Op]:
+        """Operations other than phis and the terminator"""
+        return [op for op in self.code if op.opcode != "phi" and op.opcode not in TERMINATORS]
+
+    def terminator(self) -> Optional[Op]:
+        if self.code and self.code[-1].opcode in TERMINATORS:
+            return self.code[-1]
+        return None
+
+
+class IR(cfg.CFG):
+    """A program in SSA form"""
+
+    def __init__(self):
+        super().__init__()
+        self.entry = Block("entry")
+        self.exit = Block("exit")
+        self.blocks = [self.entry]
+        self.count = 0
+        # What the passes did
+        self.stats = Counter()
+        # The name of the value of each AST expression, the block
+        # where each statement starts, and the block ending in the
+        # branch of each If and While, keyed by id (see
+        # Builder.note), for passes that rewrite the AST
+        self.values = {}
+        self.statements = {}
+        self.branches = {}
+        # The value of variables never assigned, if any
+        self.undefined = None
+
+    def new_block(self, kind: str) -> Block:
+        self.count += 1
+        block = Block(f"{kind}_{self.count}")
+        self.blocks.append(block)
+        return block
+
+    def new_name(self, base: str = "t") -> str:
+        self.count += 1
+        return f"{base}{'.' if base != 't' else ''}{self.count}"
+
+    def remove_edge(self, source: Block, dest: Block):
+        """Remove the edge source -> dest, and the phi arguments
+        that come along it
+        """
+        which = dest.preds.index(source)
+        for phi in dest.phis():
+            del phi.args[which]
+        del dest.preds[which]
+        source.succs.remove(dest)
+
+    def ops(self) -> Iterable[Op]:
+        for block in self.blocks:
+            yield from block.code
+
+    def substitute(self, replace: Dict[str, str]):
+        """Use replace[name] wherever name is used"""
+        for op in self.ops():
+            op.args = [find(replace, arg) for arg in op.args]
+
+    def __str__(self) -> str:
+        lines = []
+        for block in self.blocks:
+            if block is self.exit:
+                continue
+            lines.append(f"{block.name}:")
+            lines.extend(f"    {op}" for op in block.code)
+        return "\n".join(lines)
+
+
+def find(replace: Dict[str, str], name: str) -> str:
+    while name in replace:
+        name = replace[name]
+    return name
+
+
+# Building SSA from the AST
+
+class Builder(object):
+    """Translates an AST to SSA, placing phis as it goes:  reading
+    a variable looks for its value in the block, then in the
+    predecessors.  A block whose predecessors are not all known
+    yet (a loop header, until the loop body is built) is not
+    sealed, and gets a phi for each variable read in it, to be
+    completed when it is sealed.
+    """
+
+    def __init__(self):
+        self.ir = IR()
+        # Value of each variable at the end of each block
+        self.defs = {}
+        self.sealed = {self.ir.entry}
+        self.incomplete = {}
+        self.zero = None
+
+    def emit(self, block: Block, opcode: str, args: List[str] = (), **fields) -> str:
+        dest = self.ir.new_name()
+        block.code.append(Op(opcode, dest, list(args), **fields))
+        return dest
+
+    def write(self, var: str, block: Block, name: str):
+        self.defs.setdefault(var, {})[block] = name
+
+    def read(self, var: str, block: Block) -> str:
+        if block in self.defs.get(var, {}):
+            return self.defs[var][block]
+        if block not in self.sealed:
+            phi = self.new_phi(var, block)
+            self.incomplete.setdefault(block, {})[var] = phi
+            name = phi.dest
+        elif not block.preds:
+            name = self.undefined()
+        elif len(block.preds) == 1:
+            name = self.read(var, block.preds[0])
+        else:
+            phi = self.new_phi(var, block)
+            self.write(var, block, phi.dest)
+            self.add_phi_args(var, phi, block)
+            name = phi.dest
+        self.write(var, block, name)
+        return name
+
+    def new_phi(self, var: str, block: Block) -> Op:
+        phi = Op("phi", self.ir.new_name(var))
+        block.code.insert(len(block.phis()), phi)
+        self.ir.stats["phis placed"] += 1
+        return phi
+
+    def add_phi_args(self, var: str, phi: Op, block: Block):
+        for pred in block.preds:
+            phi.args.append(self.read(var, pred))
+
+    def seal(self, block: Block):
+        for var, phi in self.incomplete.pop(block, {}).items():
+            self.add_phi_args(var, phi, block)
+        self.sealed.add(block)
+
+    def undefined(self) -> str:
+        """The value of a variable never assigned:  0"""
+        if self.zero is None:
+            self.zero = self.ir.new_name()
+            self.ir.entry.code.insert(0, Op("const", self.zero, value=0))
+            self.ir.undefined = self.zero
+        return self.zero
+
+    def place(self, block: Block):
+        """Lay out block after those made so far"""
+        self.ir.blocks.remove(block)
+        self.ir.blocks.append(block)
+
+    def jump(self, block: Block, dest: Block):
+        block.code.append(Op("jump", targets=[dest]))
+        self.ir.add_edge(block, dest)
+
+    def branch(self, node: expr.Expr, block: Block, true: Block, false: Block):
+        """Branch on the condition of If or While node"""
+        cond = node.cond
+        self.note(self.ir.branches, node, block)
+        if isinstance(cond, expr.Comparison):
+            args, relop = [self.value(cond.left, block), self.value(cond.right, block)], cond.opsym
+        else:
+            args = [self.value(cond, block), self.emit(block, "const", value=0)]
+            relop = "!="
+        block.code.append(Op("branch", args=args, relop=relop, targets=[true, false]))
+        self.ir.add_edge(block, true)
+        self.ir.add_edge(block, false)
+
+    def note(self, table: dict, node: expr.Expr, result):
+        """table[id(node)] = (node, result); a node that occurs
+        twice in the tree with different results gets None
+        """
+        key = id(node)
+        if key in table and table[key][1] != result:
+            result = None
+        table[key] = (node, result)
+
+    def value(self, e: expr.Expr, block: Block) -> str:
+        """Name of the value of expression e, computed in block"""
+        name = self.compute(e, block)
+        self.note(self.ir.values, e, name)
+        return name
+
+    def compute(self, e: expr.Expr, block: Block) -> str:
+        if isinstance(e, expr.IntConst):
+            return self.emit(block, "const", value=e.value)
+        if isinstance(e, expr.Var):
+            return self.read(e.name, block)
+        if isinstance(e, expr.Read):
+            return self.emit(block, "read")
+        if isinstance(e, expr.Comparison):
+            args = [self.value(e.left, block), self.value(e.right, block)]
+            return self.emit(block, "cmp", args, relop=e.opsym)
+        if type(e) in BINARY:
+            args = [self.value(e.left, block), self.value(e.right, block)]
+            return self.emit(block, BINARY[type(e)], args)
+        if type(e) in UNARY:
+            return self.emit(block, UNARY[type(e)], [self.value(e.left, block)])
+        raise ValueError(f"No SSA form for expression {e}")
+
+    def stmt(self, node: expr.Expr, block: Block) -> Block:
+        """Translate statement node, starting in block; returns
+        the block where control continues
+        """
+        self.note(self.ir.statements, node, block)
+        if isinstance(node, expr.Seq):
+            return self.stmt(node.right, self.stmt(node.left, block))
+        if isinstance(node, expr.Pass):
+            return block
+        if isinstance(node, expr.Assign):
+            self.write(node.left.name, block, self.value(node.right, block))
+            return block
+        if isinstance(node, expr.Print):
+            block.code.append(Op("print", args=[self.value(node.expr, block)]))
+            return block
+        if isinstance(node, expr.If):
+            then_block, else_block = self.ir.new_block("then"), self.ir.new_block("else")
+            self.branch(node, block, then_block, else_block)
+            self.seal(then_block)
+            self.seal(else_block)
+            then_end = self.stmt(node.thenpart, then_block)
+            self.place(else_block)
+            else_end = self.stmt(node.elsepart, else_block)
+            join = self.ir.new_block("fi")
+            self.jump(then_end, join)
+            self.jump(else_end, join)
+            self.seal(join)
+            return join
+        if isinstance(node, expr.While):
+            header = self.ir.new_block("while")
+            self.jump(block, header)
+            body, after = self.ir.new_block("do"), self.ir.new_block("od")
+            self.branch(node, header, body, after)
+            self.seal(body)
+            self.seal(after)
+            self.jump(self.stmt(node.expr, body), header)
+            self.seal(header)
+            self.place(after)
+            return after
+        # An expression evaluated for its effect (e.g., read)
+        self.value(node, block)
+        return block
+
+
+def build(program: expr.Expr) -> IR:
+    """The SSA form of a Mallard program"""
+    builder = Builder()
+    end = builder.stmt(program, builder.ir.entry)
+    end.code.append(Op("halt"))
+    builder.ir.add_edge(end, builder.ir.exit)
+    return builder.ir.finish()
+
+
+# Interpreting
+
+def run(ir: IR, inputs: Iterable[int], limit: int = 1000000) -> List[int]:
+    """Run the IR, reading inputs; returns what it prints"""
+    inputs = iter(inputs)
+    env, printed = {}, []
+    block, came_from = ir.entry, None
+    for _ in range(limit):
+        phis = block.phis()
+        if phis:
+            which = block.preds.index(came_from)
+            values = [env[phi.args[which]] for phi in phis]
+            for phi, value in zip(phis, values):
+                env[phi.dest] = value
+        for op in block.code:
+            if op.opcode == "phi":
+                continue
+            args = [env[arg] for arg in op.args]
+            if op.opcode == "const":
+                env[op.dest] = op.value
+            elif op.opcode == "copy":
+                env[op.dest] = args[0]
+            elif op.opcode == "read":
+                env[op.dest] = expr.ARITH.fit(next(inputs))
+            elif op.opcode == "print":
+                printed.append(args[0])
+            elif op.opcode in ["neg", "abs"]:
+                env[op.dest] = expr.ARITH.unop(APPLY[op.opcode]._apply, *args)
+            elif op.opcode in APPLY:
+                env[op.dest] = expr.ARITH.binop(APPLY[op.opcode]._apply, *args)
+            elif op.opcode == "cmp":
+                env[op.dest] = RELATIONS[op.relop]._apply(*expr.ARITH.relation(*args))
+            elif op.opcode == "branch":
+                holds = RELATIONS[op.relop]._apply(*expr.ARITH.relation(*args))
+                came_from, block = block, op.targets[0 if holds else 1]
+                break
+            elif op.opcode == "jump":
+                came_from, block = block, op.targets[0]
+                break
+            elif op.opcode == "halt":
+                return printed
+    raise RuntimeError(f"No HALT after {limit} blocks")
+
+
+# Optimization passes
+
+def copy_propagate(ir: IR) -> int:
+    """Remove copies, and phis that choose among one value;
+    returns how many
+    """
+    replace, removed = {}, 0
+    changed = True
+    while changed:
+        changed = False
+        for block in ir.blocks:
+            for op in list(block.code):
+                op.args = [find(replace, arg) for arg in op.args]
+                if op.opcode == "copy":
+                    source = op.args[0]
+                elif op.opcode == "phi" and len(set(op.args) - {op.dest}) == 1:
+                    source = (set(op.args) - {op.dest}).pop()
+                else:
+                    continue
+                replace[op.dest] = source
+                block.code.remove(op)
+                removed += 1
+                changed = True
+    ir.substitute(replace)
+    ir.stats["copies propagated"] += removed
+    return removed
+
+
+def value_key(op: Op, block: Block) -> Optional[tuple]:
+    """Operations with the same key compute the same value"""
+    if op.opcode not in PURE or op.opcode == "copy":
+        return None
+    args = tuple(op.args)
+    if op.opcode in COMMUTATIVE or op.relop in COMMUTATIVE:
+        args = tuple(sorted(args))
+    if op.opcode == "phi":
+        # Equal only in the same block
+        return ("phi", block.name, args)
+    return (op.opcode, op.relop, op.value, args)
+
+
+def value_number(ir: IR) -> int:
+    """Global value numbering over the dominator tree:  an
+    operation equal to one in a dominating position is replaced
+    by it.  Returns how many were replaced.
+    """
+    tree = cfg.dominator_tree(cfg.immediate_dominators(ir))
+    replace, removed = {}, 0
+    stack = [(ir.entry, {})]
+    while stack:
+        block, table = stack.pop()
+        table = dict(table)
+        for op in list(block.code):
+            op.args = [find(replace, arg) for arg in op.args]
+            key = value_key(op, block)
+            if key is None:
+                continue
+            if key in table:
+                replace[op.dest] = table[key]
+                block.code.remove(op)
+                removed += 1
+            else:
+                table[key] = op.dest
+        stack.extend((child, table) for child in tree.get(block, []))
+    ir.substitute(replace)
+    ir.stats["values numbered"] += removed
+    return removed
+
+
+def dead_code(ir: IR) -> int:
+    """Remove pure operations whose values are never used"""
+    removed = 0
+    changed = True
+    while changed:
+        used = {arg for op in ir.ops() for arg in op.args}
+        changed = False
+        for block in ir.blocks:
+            for op in list(block.code):
+                if op.opcode in PURE and op.dest not in used:
+                    block.code.remove(op)
+                    removed += 1
+                    changed = True
+    ir.stats["dead operations"] += removed
+    return removed
+
+
+def optimize(ir: IR) -> IR:
+    import sccp
+    sccp.propagate(ir)
+    copy_propagate(ir)
+    value_number(ir)
+    copy_propagate(ir)
+    dead_code(ir)
+    return ir
+
+
+# Liveness and interference
+
+def live_at_ends(ir: IR) -> Dict[Block, Set[str]]:
+    """Names live at the end of each block, including the
+    arguments of phis in its successors that come from it
+    """
+    gen, kill, phi_uses = {}, {}, {}
+    for block in ir.blocks:
+        phi_uses[block] = set()
+        for succ in block.succs:
+            which = succ.preds.index(block)
+            phi_uses[block] |= {phi.args[which] for phi in succ.phis()}
+        used, defined = set(), set()
+        for op in block.code:
+            if op.opcode != "phi":
+                used |= set(op.args) - defined
+            if op.dest:
+                defined.add(op.dest)
+        gen[block] = used | (phi_uses[block] - defined)
+        kill[block] = defined
+    live = cfg.Dataflow(ir, gen, kill, forward=False).solve()
+    return {block: set(live.outs[block]) | phi_uses[block] for block in ir.blocks}
+
+
+def interference(ir: IR) -> Dict[str, Set[str]]:
+    """Names whose values are live at the same time.  The
+    destination of a copy does not interfere with its source.
+    """
+    graph = {}
+
+    def add(a: str, b: str):
+        if a != b:
+            graph.setdefault(a, set()).add(b)
+            graph.setdefault(b, set()).add(a)
+
+    for block, live in live_at_ends(ir).items():
+        live = set(live)
+        for op in reversed(block.code):
+            if op.opcode == "phi":
+                continue
+            if op.dest:
+                graph.setdefault(op.dest, set())
+                for other in live:
+                    if not (op.opcode == "copy" and other == op.args[0]):
+                        add(op.dest, other)
+                live.discard(op.dest)
+            live |= set(op.args)
+        # Phis all take their values at the top of the block
+        dests = [phi.dest for phi in block.phis()]
+        for dest in dests:
+            graph.setdefault(dest, set())
+            for other in live | set(dests):
+                add(dest, other)
+    return graph
+
+
+# Out of SSA
+
+def split_critical_edges(ir: IR) -> int:
+    """An edge from a block with several successors to a block
+    with phis and several predecessors gets a block of its own,
+    where the copies for the phis can go
+    """
+    split = 0
+    for block in list(ir.blocks):
+        if not block.phis() or len(block.preds) < 2:
+            continue
+        for i, pred in enumerate(list(block.preds)):
+            if len(pred.succs) < 2:
+                continue
+            middle = ir.new_block("edge")
+            middle.code.append(Op("jump", targets=[block]))
+            term = pred.terminator()
+            term.targets = [middle if t is block else t for t in term.targets]
+            pred.succs[pred.succs.index(block)] = middle
+            middle.preds.append(pred)
+            middle.succs.append(block)
+            block.preds[i] = middle
+            split += 1
+    return split
+
+
+def sequentialize(copies: List[Tuple[str, str]], new_name: Callable[[], str]) -> List[Tuple[str, str]]:
+    """Copies (dest, source) made all at once, as a sequence of
+    copies made one at a time; a cycle of copies (a swap) goes
+    through a new temporary.
+    """
+    pending = [(dest, source) for dest, source in copies if dest != source]
+    result = []
+    while pending:
+        sources = {source for _, source in pending}
+        ready = [copy for copy in pending if copy[0] not in sources]
+        if ready:
+            result.append(ready[0])
+            pending.remove(ready[0])
+        else:
+            dest, source = pending[0]
+            temp = new_name()
+            result.append((temp, source))
+            pending = [(d, temp if s == source else s) for d, s in pending]
+    return result
+
+
+def out_of_ssa(ir: IR) -> IR:
+    """Replace phis by copies, coalescing names that can share"""
+    ir.stats["critical edges split"] += split_critical_edges(ir)
+    graph = interference(ir)
+    # Union-find of coalesced names, with the members of each class
+    rep, members = {}, {}
+
+    def interferes(a: str, b: str) -> bool:
+        return any(graph.get(m, set()) & members.get(b, {b}) for m in members.get(a, {a}))
+
+    for block in ir.blocks:
+        for phi in block.phis():
+            for arg in phi.args:
+                a, b = find(rep, phi.dest), find(rep, arg)
+                if a != b and not interferes(a, b):
+                    rep[b] = a
+                    members[a] = members.get(a, {a}) | members.pop(b, {b})
+                    ir.stats["copies coalesced"] += 1
+    for op in ir.ops():
+        if op.dest:
+            op.dest = find(rep, op.dest)
+        op.args = [find(rep, arg) for arg in op.args]
+    for block in ir.blocks:
+        phis = block.phis()
+        if not phis:
+            continue
+        for which, pred in enumerate(block.preds):
+            copies = sequentialize([(phi.dest, phi.args[which]) for phi in phis], ir.new_name)
+            at = len(pred.code) - (1 if pred.terminator() else 0)
+            pred.code[at:at] = [Op("copy", dest, [source]) for dest, source in copies]
+            ir.stats["copies inserted"] += len(copies)
+        block.code = [op for op in block.code if op.opcode != "phi"]
+    return ir
+
+
+# Lowering to DM2019W code
+
+def allocate(ir: IR, registers: List[str]) -> Dict[str, Optional[str]]:
+    """A register for each name, by coloring the interference
+    graph (None for names left in memory).  Names related by a
+    copy get the same register when they can.
+    """
+    graph = interference(ir)
+    uses = Counter(arg for op in ir.ops() for arg in op.args)
+    partners = {}
+    for op in ir.ops():
+        if op.opcode == "copy":
+            partners.setdefault(op.dest, []).append(op.args[0])
+            partners.setdefault(op.args[0], []).append(op.dest)
+    colors = {}
+    for name in sorted(graph, key=lambda n: (-uses[n], n)):
+        taken = {colors.get(other) for other in graph[name]}
+        free = [r for r in registers if r not in taken]
+        preferred = [colors.get(p) for p in partners.get(name, []) if colors.get(p) in free]
+        colors[name] = (preferred or free or [None])[0]
+    return colors
+
+
+class Lowering(object):
+    """Emits the code for an IR, one operation at a time"""
+
+    def __init__(self, ir: IR, context: Context):
+        self.ir = ir
+        self.context = context
+        registers = sorted(context.registers, key=lambda r: int(r[1:]))
+        # Two registers are held back for values in memory
+        self.scratch = registers[-2:]
+        self.colors = allocate(ir, registers[:-2])
+        self.memory = {}
+
+    def use(self, name: str, which: int = 0) -> str:
+        reg = self.colors.get(name)
+        if reg:
+            return reg
+        reg = self.scratch[which]
+        self.context.emit("LOAD", reg, ref=self.word(name))
+        return reg
+
+    def word(self, name: str) -> str:
+        if name not in self.memory:
+            self.memory[name] = self.context.get_var_symbol(name.replace(".", "_"))
+        return self.memory[name]
+
+    def define(self, name: str) -> str:
+        return self.colors.get(name) or self.scratch[0]
+
+    def store(self, name: str, reg: str):
+        if not self.colors.get(name):
+            self.context.emit("STORE", reg, ref=self.word(name))
+
+    def lower_op(self, op: Op, following: Optional[Block]):
+        context = self.context
+        if op.opcode == "jump":
+            if op.targets[0] is not following:
+                context.emit("JUMP", ref=op.targets[0].name)
+            return
+        if op.opcode == "branch":
+            left, right = self.use(op.args[0]), self.use(op.args[1], 1)
+            relation = RELATIONS[op.relop]
+            true, false = op.targets
+            context.emit("SUB", "r0", left, right)
+            if true is following:
+                context.emit("JUMP", ref=false.name, predicate=relation.cond_code_false,
+                             comment=f"#{op.relop}")
+            else:
+                context.emit("JUMP", ref=true.name, predicate=relation.cond_code_true,
+                             comment=f"#{op.relop}")
+                if false is not following:
+                    context.emit("JUMP", ref=false.name)
+            return
+        if op.opcode == "halt":
+            context.emit("HALT", "r0", "r0", "r0")
+            return
+        if op.opcode == "print":
+            context.emit("STORE", self.use(op.args[0]), "r0", "r0", 511)
+            return
+        args = [self.use(arg, i) for i, arg in enumerate(op.args)]
+        dest = self.define(op.dest)
+        if op.opcode == "const":
+            if fits(op.value):
+                context.emit("ADD", dest, "r0", "r0", offset=op.value)
+            else:
+                context.emit("LOAD", dest, ref=context.get_const_symbol(op.value))
+        elif op.opcode == "read":
+            context.emit("LOAD", dest, "r0", "r0", 510)
+        elif op.opcode == "copy":
+            if dest != args[0]:
+                context.emit("ADD", dest, "r0", args[0], comment=f"# {op.dest} = {op.args[0]}")
+        elif op.opcode == "neg":
+            context.emit("SUB", dest, "r0", args[0])
+        elif op.opcode == "abs":
+            # The move sets the condition code
+            context.emit("ADD", dest, "r0", args[0])
+            context.emit("SUB", dest, "r0", dest, predicate="M")
+        elif op.opcode == "cmp":
+            # The result register is cleared before the compare,
+            # so it can't hold an operand
+            left, right = args
+            free = [r for r in [dest] + self.scratch if r not in args]
+            if not free:
+                # Both operands in scratch registers:  compare
+                # their difference instead
+                context.emit("SUB", right, left, right)
+                left, right = right, "r0"
+                free = [self.scratch[0]]
+            result = free[0]
+            context.emit("ADD", result, "r0", "r0", comment=f"# {op}")
+            context.emit("SUB", "r0", left, right)
+            context.emit("ADD", result, "r0", "r0", offset=1,
+                         predicate=RELATIONS[op.relop].cond_code_true)
+            if result != dest:
+                context.emit("ADD", dest, "r0", result)
+        else:
+            opcode = {value: key for key, value in OPCODES.items()}[op.opcode]
+            context.emit(opcode, dest, args[0], args[1])
+        self.store(op.dest, dest)
+
+    def lower(self):
+        layout = [block for block in self.ir.blocks if block is not self.ir.exit]
+        targets = {target for op in self.ir.ops() for target in op.targets}
+        for i, block in enumerate(layout):
+            following = layout[i + 1] if i + 1 < len(layout) else None
+            if block in targets:
+                self.context.add_label(block.name)
+            for op in block.code:
+                self.lower_op(op, following)
+
+
+def lower(ir: IR, context: Context):
+    """Emit code for the IR (out of SSA form) into context"""
+    if any(block.phis() for block in ir.blocks if isinstance(block, Block)):
+        raise ValueError("Translate the IR out of SSA form before lowering it")
+    Lowering(ir, context).lower()
+
+
+def compile_program(program: expr.Expr, context: Context) -> IR:
+    """Generate code for program by way of SSA form"""
+    ir = optimize(build(program))
+    out_of_ssa(ir)
+    lower(ir, context)
+    return ir
@@ -0,0 +1,318 @@
+"""
+A superoptimizer for short DM2019W instruction sequences,
+which writes peephole rules (see peephole.load_rules).
+
+The instruction set is tiny, so we can afford to look at every
+sequence of up to three register-to-register ALU instructions
+(ADD, SUB, MUL, DIV, unpredicated) over two registers and r0,
+with small offsets.  For each, we want the cheapest sequence
+that leaves the same values in the registers; it is a rule if
+it is cheaper than the sequence itself.  Cost is the number of
+instructions, then the number of MULs and DIVs.
+
+As Massalin did, we run each sequence on a fixed handful of
+register states and take the results as its fingerprint.
+Sequences are enumerated by length, as extensions of the
+cheapest sequences found so far (a sequence with a cheaper
+equivalent prefix can't be the cheapest, so is never extended).
+A sequence whose fingerprint matches a cheaper sequence's is
+a candidate rule.  If only the register values match and not the
+condition code, the rule applies only where the condition code
+is dead.
+
+Matching fingerprints don't prove anything, so each candidate
+is verified:  both sequences are run on every combination of
+edge-case values (0, 1, -1, the largest and smallest words, ...)
+and on many random states, on a local executor that decodes
+each instruction word with instr_format.decode and computes as
+the machine does (machine.alu, with 32-bit wraparound and the
+V flag).  Only candidates that agree on all of them are written.
+
+Rules are written one per line, with r1 and r2 standing for any
+two different registers (neither r0 nor r15):
+
+    ADD r2,r0,r1; ADD r2,r2,r2  =>  ADD r2,r1,r1
+    SUB r1,r0,r1; SUB r1,r0,r1  =>  (nothing)  if cc dead
+
+Patterns that peephole's own rules already shorten (an
+instruction whose result is overwritten before it is read, or
+one that sets only a dead condition code) are left out, as are
+patterns with a shorter rule inside them.
+
+Offsets are searched only over a small set (by default 0 and 1),
+so a rule is for those offsets only.  Length 3 over the default
+alphabet takes some minutes and finds about 27000 rules.
+
+    python3 superopt.py superopt.rules              search, write rules
+    python3 superopt.py superopt.rules --length 2 --offsets -1 0 1 2
+    python3 compile.py -O --rules superopt.rules prog.mal prog.asm
+"""
+
+import os
+import random
+import sys
+from collections import Counter
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, "assembler_2019-master"))
+
+from instr_format import CondFlag, Instruction, OpCode, decode
+import arith
+import machine
+from codegen_context import Instr
+
+import argparse
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+OPCODES = [OpCode.ADD, OpCode.SUB, OpCode.MUL, OpCode.DIV]
+OFFSETS = [0, 1]
+MAX_LENGTH = 3
+
+# The registers of rules (standing for any two others)
+REGISTERS = [1, 2]
+
+EDGE_VALUES = [0, 1, -1, 2, -2, 3, 7, -8, arith.WORD_MAX, arith.WORD_MIN,
+               arith.WORD_MAX - 1, arith.WORD_MIN + 1, 1 << 16, -(1 << 16)]
+FINGERPRINT_STATES = 16
+RANDOM_STATES = 500
+
+# A sequence is a tuple of instruction words; a state, the
+# values of REGISTERS and the condition code (None:  not set
+# by the sequence)
+Sequence = Tuple[int, ...]
+State = Tuple[Tuple[int, ...], Optional[CondFlag]]
+
+_decoded = {}
+
+
+def instruction(word: int) -> Instruction:
+    if word not in _decoded:
+        _decoded[word] = decode(word)
+    return _decoded[word]
+
+
+def execute(words: Iterable[int], values: Tuple[int, ...], cc: Optional[CondFlag] = None) -> State:
+    """Run register-to-register ALU instructions from a state
+    where REGISTERS hold values
+    """
+    registers = [0] * (max(REGISTERS) + 1)
+    for reg, value in zip(REGISTERS, values):
+        registers[reg] = value
+    for word in words:
+        instr = instruction(word)
+        result, cc = machine.alu(instr.op, registers[instr.reg_src1],
+                                 registers[instr.reg_src2] + instr.offset)
+        if instr.reg_target != 0:
+            registers[instr.reg_target] = result
+    return tuple(registers[reg] for reg in REGISTERS), cc
+
+
+def alphabet(opcodes: List[OpCode] = None, offsets: List[int] = None) -> List[int]:
+    """Words of every instruction the search may use"""
+    regs = [0] + REGISTERS
+    return [Instruction(op, CondFlag.ALWAYS, target, src1, src2, offset).encode()
+            for op in opcodes or OPCODES for target in regs for src1 in regs for src2 in regs
+            for offset in (OFFSETS if offsets is None else offsets)]
+
+
+def cost(words: Sequence) -> (int, int):
+    return len(words), sum(1 for word in words if instruction(word).op in (OpCode.MUL, OpCode.DIV))
+
+
+def text(words: Sequence) -> str:
+    if not words:
+        return "(nothing)"
+    return "; ".join(str(Instr(instruction(w).op.name, f"r{instruction(w).reg_target}",
+                               f"r{instruction(w).reg_src1}", f"r{instruction(w).reg_src2}",
+                               instruction(w).offset)).strip()
+                     for w in words)
+
+
+def renamed(words: Sequence) -> Sequence:
+    """words with its registers renamed to appear in the order of
+    REGISTERS.  (Rules are written for such canonical sequences
+    only; others are renamings of them.)
+    """
+    names = {0: 0}
+    result = []
+    for word in words:
+        instr = instruction(word)
+        for reg in [instr.reg_src1, instr.reg_src2, instr.reg_target]:
+            if reg not in names:
+                names[reg] = REGISTERS[len(names) - 1]
+        result.append(Instruction(instr.op, instr.cond, names[instr.reg_target], names[instr.reg_src1],
+                                  names[instr.reg_src2], instr.offset).encode())
+    return tuple(result)
+
+
+def canonical(words: Sequence) -> bool:
+    return renamed(words) == words
+
+
+def reads(instr: Instruction) -> set:
+    return {instr.reg_src1, instr.reg_src2}
+
+
+def wasteful(words: Sequence, cc_dead: bool) -> bool:
+    """Does words have an instruction that peephole's own rules
+    delete (dead_compare, dead_write):  one that sets only the
+    condition code, or whose result the next overwrites unread?
+    """
+    if cc_dead and instruction(words[-1]).reg_target == 0:
+        return True
+    for first, second in zip(words, words[1:]):
+        first, second = instruction(first), instruction(second)
+        if first.reg_target == 0 or (first.reg_target == second.reg_target
+                                     and first.reg_target not in reads(second)):
+            return True
+    return False
+
+
+def test_states(count: int, seed: int = 211) -> List[Tuple[int, ...]]:
+    """Edge-case states, then random ones, count in all"""
+    rng = random.Random(seed)
+    states = [(a, b) for a in EDGE_VALUES for b in EDGE_VALUES]
+    rng.shuffle(states)
+    while len(states) < count:
+        states.append(tuple(rng.choice([rng.randint(-100, 100),
+                                        rng.randint(arith.WORD_MIN, arith.WORD_MAX)])
+                            for _ in REGISTERS))
+    return states[:count]
+
+
+class Rule(NamedTuple):
+    pattern: Sequence
+    replacement: Sequence
+    cc_dead: bool
+
+    def __str__(self) -> str:
+        return f"{text(self.pattern)}  =>  {text(self.replacement)}{'  if cc dead' if self.cc_dead else ''}"
+
+
+def verify(rule: Rule, states: List[Tuple[int, ...]]) -> bool:
+    """Do pattern and replacement agree on every state?"""
+    for values in states:
+        want, got = execute(rule.pattern, values), execute(rule.replacement, values)
+        if want[0] != got[0] or (not rule.cc_dead and want[1] != got[1]):
+            return False
+    return True
+
+
+class Search(object):
+    """Enumerates sequences by length, keeping the cheapest of
+    each fingerprint, and collects the rules they show
+    """
+
+    def __init__(self, words: List[int], stats: Counter = None):
+        self.words = words
+        self.stats = Counter() if stats is None else stats
+        self.probes = test_states(FINGERPRINT_STATES, seed=2019)
+        self.checks = test_states(len(EDGE_VALUES) ** 2 + RANDOM_STATES)
+        # Cheapest sequence by fingerprint, with and without the
+        # condition code
+        self.cheapest = {}
+        self.cheapest_values = {}
+        self.rules = []
+        self.patterns = set()
+
+    def fingerprint(self, states: List[State]) -> (tuple, tuple):
+        return tuple(states), tuple(values for values, _ in states)
+
+    def subsumed(self, words: Sequence) -> bool:
+        """Does a rule already apply within words?"""
+        return any(renamed(words[i:j]) in self.patterns
+                   for i in range(len(words)) for j in range(i + 1, len(words) + 1)
+                   if (i, j) != (0, len(words)))
+
+    def consider(self, words: Sequence, full: tuple, values: tuple) -> bool:
+        """Record words; True if it is the cheapest of its kind"""
+        best = self.cheapest.get(full)
+        best_values = self.cheapest_values.get(values)
+        if best is not None and cost(best) < cost(words):
+            self.candidate(Rule(words, best, False))
+        elif best_values is not None and cost(best_values) < cost(words):
+            self.candidate(Rule(words, best_values, True))
+        if best_values is None or cost(words) < cost(best_values):
+            self.cheapest_values[values] = words
+        if best is None or cost(words) < cost(best):
+            self.cheapest[full] = words
+            return True
+        return False
+
+    def candidate(self, rule: Rule):
+        if not canonical(rule.pattern) or self.subsumed(rule.pattern):
+            return
+        if wasteful(rule.pattern, rule.cc_dead):
+            self.stats["patterns left to built-in rules"] += 1
+            return
+        self.stats["candidates"] += 1
+        if not verify(rule, self.checks):
+            self.stats["candidates refuted"] += 1
+            return
+        self.stats["rules"] += 1
+        self.rules.append(rule)
+        self.patterns.add(rule.pattern)
+
+    def run(self, max_length: int = MAX_LENGTH) -> List[Rule]:
+        empty = [(values, None) for values in self.probes]
+        self.consider((), *self.fingerprint(empty))
+        frontier = [((), empty)]
+        for length in range(1, max_length + 1):
+            extended = []
+            for prefix, states in frontier:
+                # Rules are written for canonical patterns only, but
+                # any sequence may be the replacement in one
+                if length == max_length and not canonical(prefix):
+                    continue
+                for word in self.words:
+                    words = prefix + (word,)
+                    self.stats["sequences"] += 1
+                    after = [execute((word,), values, cc) for values, cc in states]
+                    if self.consider(words, *self.fingerprint(after)) and length < max_length:
+                        extended.append((words, after))
+            log.debug(f"Length {length}: {len(extended)} sequences to extend")
+            frontier = extended
+        return self.rules
+
+
+def search(max_length: int = MAX_LENGTH, opcodes: List[OpCode] = None,
+           offsets: List[int] = None, stats: Counter = None) -> List[Rule]:
+    """Verified rules for sequences up to max_length long"""
+    return Search(alphabet(opcodes, offsets), stats).run(max_length)
+
+
+def write_rules(rules: List[Rule], file):
+    print("# DM2019W peephole rules found by superopt.py:  r1 and r2 stand", file=file)
+    print("# for any two different registers other than r0 and r15", file=file)
+    for rule in rules:
+        print(rule, file=file)
+
+
+def cli() -> object:
+    """Get arguments from command line"""
+    parser = argparse.ArgumentParser(description="Find peephole rules for DM2019W code by exhaustive search")
+    parser.add_argument("rules", type=argparse.FileType('w'),
+                        help="Write the rules here")
+    parser.add_argument("--length", type=int, default=MAX_LENGTH,
+                        help="Longest sequence to consider")
+    parser.add_argument("--offsets", type=int, nargs="+", default=OFFSETS,
+                        help="Offsets the instructions may have")
+    return parser.parse_args()
+
+
+def main():
+    args = cli()
+    stats = Counter()
+    rules = search(args.length, offsets=args.offsets, stats=stats)
+    write_rules(rules, args.rules)
+    for stat, count in stats.items():
+        print(f"#superopt {count} {stat}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
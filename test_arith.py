@@ -0,0 +1,164 @@
+"""Test the integer semantics layer:  32-bit wraparound,
+the V flag, division by zero, and agreement between the
+interpreter, the tiered fast path, and lockstep evaluation.
+"""
+
+import unittest
+from unittest import mock
+
+import arith
+import expr
+from expr import *
+
+try:
+    import numpy as np
+    import lockstep
+except ImportError:
+    np = None
+
+BIG = 2 ** 31 - 1
+
+
+def with_arith(semantics: arith.BigInt, program: Expr, threshold=None) -> dict:
+    """Run program from a clean environment under the given
+    semantics, returning final variable values.
+    """
+    saved = expr.ARITH, expr.HOT_LOOP_THRESHOLD
+    expr.ARITH, expr.HOT_LOOP_THRESHOLD = semantics, threshold
+    try:
+        env_clear()
+        program.eval()
+        return {name: val.value for name, val in expr.ENV.items()}
+    finally:
+        expr.ARITH, expr.HOT_LOOP_THRESHOLD = saved
+
+
+def powers(n: int) -> Expr:
+    """p = 1; i = 0; while i < n do p = p * 3; i = i + 1; od"""
+    return Seq(Seq(Assign(Var("p"), IntConst(1)), Assign(Var("i"), IntConst(0))),
+               While(LT(Var("i"), IntConst(n)),
+                     Seq(Assign(Var("p"), Times(Var("p"), IntConst(3))),
+                         Assign(Var("i"), Plus(Var("i"), IntConst(1))))))
+
+
+class Test_Int32(unittest.TestCase):
+
+    def test_wrap(self):
+        self.assertEqual(arith.wrap(BIG + 1), -BIG - 1)
+        self.assertEqual(arith.wrap(-BIG - 2), BIG)
+        self.assertEqual(arith.wrap(2 ** 32 + 5), 5)
+        self.assertEqual(arith.wrap(-7), -7)
+
+    def test_overflow_sets_v(self):
+        semantics = arith.Int32()
+        env = with_arith(semantics, Assign(Var("x"), Plus(IntConst(BIG), IntConst(1))))
+        self.assertEqual(env["x"], -BIG - 1)
+        self.assertTrue(semantics.v)
+        self.assertEqual(semantics.overflows, 1)
+
+    def test_no_overflow_clears_v(self):
+        semantics = arith.Int32()
+        with_arith(semantics, Assign(Var("x"), Plus(IntConst(BIG), IntConst(1))))
+        with_arith(semantics, Assign(Var("x"), Plus(IntConst(1), IntConst(1))))
+        self.assertFalse(semantics.v)
+        self.assertEqual(semantics.overflows, 1)
+
+    def test_divide_by_zero(self):
+        semantics = arith.Int32()
+        env = with_arith(semantics, Assign(Var("x"), Div(IntConst(7), IntConst(0))))
+        self.assertEqual(env["x"], 0)
+        self.assertTrue(semantics.v)
+        with self.assertRaises(ZeroDivisionError):
+            with_arith(arith.BigInt(), Assign(Var("x"), Div(IntConst(7), IntConst(0))))
+
+    def test_negate_most_negative(self):
+        semantics = arith.Int32()
+        env = with_arith(semantics, Assign(Var("x"), Neg(IntConst(-BIG - 1))))
+        self.assertEqual(env["x"], -BIG - 1)
+        self.assertEqual(semantics.overflows, 1)
+
+    def test_comparison_by_subtraction(self):
+        """BIG > -2 is false on the machine, because BIG - (-2) wraps"""
+        program = Assign(Var("c"), GT(IntConst(BIG), IntConst(-2)))
+        self.assertEqual(with_arith(arith.Int32(), program)["c"], 0)
+        self.assertEqual(with_arith(arith.BigInt(), program)["c"], 1)
+
+    def test_overflowing_comparison(self):
+        """Only V is set, so no relation holds"""
+        semantics = arith.Int32()
+        for relation in [EQ, NE, LT, LE, GT, GE]:
+            program = Assign(Var("c"), relation(IntConst(511), IntConst(-BIG)))
+            self.assertEqual(with_arith(semantics, program)["c"], 0, msg=relation.__name__)
+            self.assertTrue(semantics.v)
+        self.assertEqual(semantics.overflows, 6)
+
+    def test_trap(self):
+        with self.assertRaises(arith.ArithmeticOverflow):
+            with_arith(arith.Int32(trap=True), Assign(Var("x"), Times(IntConst(BIG), IntConst(2))))
+
+    def test_read_wraps(self):
+        semantics = arith.Int32()
+        with mock.patch("builtins.input", return_value=str(2 ** 32 + 3)):
+            env = with_arith(semantics, Assign(Var("x"), Read()))
+        self.assertEqual(env["x"], 3)
+        self.assertTrue(semantics.v)
+
+    def test_bigint_unchanged(self):
+        env = with_arith(arith.BigInt(), powers(40))
+        self.assertEqual(env["p"], 3 ** 40)
+
+
+class Test_Int32_Engines(unittest.TestCase):
+    """The fast engines give the same answers as eval"""
+
+    def test_tiered(self):
+        slow, fast = arith.Int32(), arith.Int32()
+        expected = with_arith(slow, powers(40))
+        self.assertEqual(with_arith(fast, powers(40), threshold=3), expected)
+        self.assertEqual(expected["p"], arith.wrap(3 ** 40))
+        self.assertEqual(fast.overflows, slow.overflows)
+
+    def test_tiered_respecializes(self):
+        """A loop compiled for one semantics is not reused for another"""
+        program = powers(40)
+        with_arith(arith.BigInt(), program, threshold=3)
+        self.assertEqual(with_arith(arith.Int32(), program, threshold=3)["p"],
+                         arith.wrap(3 ** 40))
+
+    def test_overflowing_comparisons(self):
+        """Comparisons that overflow are false in every engine"""
+        program = Seq(Seq(Assign(Var("i"), IntConst(0)), Assign(Var("c"), IntConst(0))),
+                      While(LT(Var("i"), IntConst(10)),
+                            Seq(Assign(Var("c"), Plus(Var("c"), Plus(NE(IntConst(BIG), Neg(Var("i"))),
+                                                                     LT(IntConst(-BIG), Var("i"))))),
+                                Assign(Var("i"), Plus(Var("i"), IntConst(1))))))
+        expected = with_arith(arith.Int32(), program)
+        self.assertEqual(expected["c"], 3)
+        self.assertEqual(with_arith(arith.Int32(), program, threshold=2), expected)
+        if np is not None:
+            result = lockstep.run_lockstep(program, [[0]], semantics=arith.Int32())
+            self.assertEqual(result.lane_env(0), expected)
+
+    @unittest.skipIf(np is None, "lockstep evaluation requires numpy")
+    def test_lockstep(self):
+        program = Seq(Assign(Var("n"), Read()),
+                      Seq(Seq(Assign(Var("p"), IntConst(1)), Assign(Var("i"), IntConst(0))),
+                          While(LT(Var("i"), Var("n")),
+                                Seq(Assign(Var("p"), Times(Var("p"), IntConst(3))),
+                                    Seq(Assign(Var("q"), Div(Var("p"), Minus(Var("i"), IntConst(5)))),
+                                        Assign(Var("i"), Plus(Var("i"), IntConst(1))))))))
+        rows = [[n] for n in [0, 3, 19, 20, 21, 40]]
+        semantics = arith.Int32()
+        result = lockstep.run_lockstep(program, rows, semantics=semantics)
+        overflows = 0
+        for lane, row in enumerate(rows):
+            scalar = arith.Int32()
+            with mock.patch("builtins.input", return_value=str(row[0])):
+                env = with_arith(scalar, program)
+            overflows += scalar.overflows
+            self.assertEqual(result.lane_env(lane), env)
+        self.assertEqual(semantics.overflows, overflows)
+
+
+if __name__ == "__main__":
+    unittest.main()
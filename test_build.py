@@ -0,0 +1,172 @@
+"""Test the in-process build against the text pipeline
+(compile, assembler_phase1, assembler_phase2).
+"""
+
+import io
+import os
+import tempfile
+import unittest
+
+import build
+import assembler_phase1
+import assembler_phase2
+import machine
+
+MALLARD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler_2019-master", "mallard")
+
+FACT = """
+x = read;
+fact = 1;
+while x > 1 do
+    fact = fact * x;
+    x = x - 1;
+od
+print fact;
+"""
+
+
+def text_pipeline(result: build.Build) -> list:
+    """Object code the old way, through text at each step"""
+    return assembler_phase2.assemble(assembler_phase1.transform(result.asm_lines()))
+
+
+class Test_Build(unittest.TestCase):
+
+    def test_same_as_text(self):
+        for optimize in [False, True]:
+            result = build.build(io.StringIO(FACT), optimize)
+            self.assertEqual(result.words, text_pipeline(result))
+
+    def test_sample_programs(self):
+        for name in ["absdiff.mal", "max.mal", "seq.mal"]:
+            with open(os.path.join(MALLARD, name)) as f:
+                result = build.build(f)
+            self.assertEqual(result.words, text_pipeline(result), name)
+
+    def test_stages_timed(self):
+        result = build.build(io.StringIO(FACT), optimize=True)
+        self.assertEqual(list(result.stages.seconds),
+                         ["parse", "codegen", "peephole", "resolve", "encode"])
+        self.assertTrue(result.stages.report()[-1].startswith("total"))
+
+    def test_dasm_resolved(self):
+        result = build.build(io.StringIO(FACT))
+        for line in result.dasm_lines():
+            self.assertNotIn("JUMP", line.split("#")[0])
+
+    def test_write(self):
+        result = build.build(io.StringIO(FACT))
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "fact.obj")
+            build.write_lines(path, result.words)
+            with open(path) as f:
+                self.assertEqual([int(line) for line in f], result.words)
+
+    def test_relation_values(self):
+        """A parenthesized comparison is a 0/1 value, computed without jumps"""
+        source = "a = read; b = read; c = read; d = read;\nx = (a < b) + (c == d);\nprint x;\n"
+        for optimize in [False, True]:
+            result = build.build(io.StringIO(source), optimize)
+            self.assertNotIn("JUMP", [instr.opcode for instr in result.context.instrs])
+            self.assertEqual(result.words, text_pipeline(result))
+
+
+def effective_addresses(result: build.Build) -> list:
+    """(label referenced, address reached) for every
+    resolved reference in the program
+    """
+    refs = []
+    address = 0
+    for record in result.resolved:
+        if record.opcode is None:
+            continue
+        if record.comment and record.comment.startswith("#") and record.src1 == "r0":
+            ref = record.comment[1:].split()[0]
+            base = address if record.src2 == "r15" else 0
+            refs.append((ref, base + record.offset))
+        address += 1
+    return refs
+
+
+class Test_Large_Programs(unittest.TestCase):
+    """Programs too long for every reference to be PC-relative"""
+
+    def test_data_within_reach(self):
+        source = "x = read;\n" + "x = x + 1;\n" * 200 + "print x;\n"
+        result = build.build(io.StringIO(source))
+        self.assertGreater(len(result.words), 800)
+        labels = assembler_phase1.resolve_records(result.resolved)
+        refs = effective_addresses(result)
+        # x = read; 200 of LOAD x, LOAD 1, STORE x; print x; the jumps
+        # over the data and over 510 and 511
+        self.assertEqual(len(refs), 1 + 3 * 200 + 1 + 2)
+        for ref, reached in refs:
+            self.assertEqual(reached, labels[ref])
+            self.assertTrue(reached < 510 or ref == assembler_phase1.PAST_IO)
+        # Data comes right after the jump at address 0
+        self.assertEqual(labels["code_start"], 3)
+        self.assertEqual(result.words, text_pipeline(result))
+        self.assertEqual(machine.run(result.words, [5]).outputs, [205])
+
+    def test_input_output_skipped(self):
+        """Code runs around the input and output addresses"""
+        source = "x = 1;\n" + "x = x + 1;\n" * 200 + "print x;\n"
+        for optimize in [False, True]:
+            result = build.build(io.StringIO(source), optimize)
+            self.assertEqual(machine.run(result.words, []).outputs, [201])
+        source = "x = read;\n" + "y = x * 3;\nprint y - x;\n" * 150
+        result = build.build(io.StringIO(source))
+        self.assertGreater(len(result.words), 1000)
+        self.assertEqual(machine.run(result.words, [7]).outputs, [14] * 150)
+
+    def test_long_loop(self):
+        """The loop exit jumps over more than 512 words"""
+        source = "x = read;\nwhile x > 0 do\n x = x - 1;\n" + "y = y + x;\n" * 150 + "od\nprint y;\n"
+        result = build.build(io.StringIO(source))
+        labels = assembler_phase1.resolve_records(result.resolved)
+        far_jumps = [r for r in result.resolved if r.opcode == "LOAD" and r.target == "r15"]
+        self.assertEqual(len(far_jumps), 1)
+        self.assertEqual(far_jumps[0].predicate, "ZMV")
+        words = [r for r in result.resolved if r.label == "far_jump_1"]
+        self.assertEqual(words[0].value, labels["od_2"])
+        for ref, reached in effective_addresses(result):
+            self.assertEqual(reached, labels[ref])
+        self.assertEqual(result.words, text_pipeline(result))
+        self.assertEqual(machine.run(result.words, [4]).outputs, [(3 + 2 + 1) * 150])
+
+    def test_sizes_around_io(self):
+        """Programs that just reach the input/output addresses"""
+        sizes = set()
+        for n in range(248, 253):
+            source = "x = read;\n" + "print read;\n" * n + "print x; print 123456;\n"
+            result = build.build(io.StringIO(source))
+            sizes.add(len(result.words))
+            inputs = list(range(n + 1))
+            self.assertEqual(machine.run(result.words, inputs).outputs, inputs[1:] + [0, 123456])
+        for n in range(503, 506):
+            source = "x = read;\n" + "x = x + 1;\n" * n + "print x; print 123456;\n"
+            result = build.build(io.StringIO(source), True)
+            sizes.add(len(result.words))
+            self.assertEqual(machine.run(result.words, [7]).outputs, [7 + n, 123456])
+        # The largest that fit below 510, and the smallest that don't
+        self.assertLessEqual({509, 510, 515}, sizes)
+
+    def test_relaxed_around_io(self):
+        """A long jump whose address word would be at 510"""
+        lines = (["   ADD r1,r0,r0[3]"] + ["   ADD r2,r2,r0[1]"] * 506 +
+                 ["loop:  SUB r1,r1,r0[1]", "   JUMP/Z done", "   STORE r1,r0,r0[511]"] +
+                 ["   ADD r3,r3,r0[1]"] * 600 +
+                 ["   JUMP loop", "done:  STORE r2,r0,r0[511]", "   HALT r0,r0,r0"])
+        relaxed = assembler_phase1.relax_lines(lines)
+        labels = assembler_phase1.resolve(relaxed)
+        self.assertNotIn(labels["far_jump_1"], assembler_phase1.IO_ADDRESSES)
+        words = assembler_phase2.assemble(assembler_phase1.transform(lines))
+        self.assertEqual(machine.run(words, []).outputs, [2, 1, 506])
+
+    def test_small_programs_unchanged(self):
+        result = build.build(io.StringIO(FACT))
+        self.assertNotIn("code_start", assembler_phase1.resolve_records(result.resolved))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+"""Test control flow graphs, dataflow, dominators, and loops"""
+
+import gc
+import io
+import os
+import sys
+import unittest
+import weakref
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler_2019-master"))
+from llparse import parse
+
+import build
+import cfg
+import compile
+from codegen_context import Context
+
+NESTED = """
+n = read;
+i = 0;
+while i < n do
+    j = 0;
+    while j < i do
+        if j == 3 then print j; else s = s + j; fi
+        j = j + 1;
+    od
+    i = i + 1;
+od
+print s;
+"""
+
+
+def program(source: str):
+    return parse(io.StringIO(source))
+
+
+def names(blocks) -> list:
+    return sorted(block.name for block in blocks)
+
+
+class Test_AST_CFG(unittest.TestCase):
+
+    def test_shape(self):
+        graph = cfg.from_ast(program(NESTED))
+        self.assertEqual(str(graph).split("\n"), [
+            "entry -> block_1",
+            "block_1 -> while_2",
+            "while_2 -> do_3, od_10",
+            "do_3 -> while_4",
+            "while_4 -> do_5, od_9",
+            "do_5 -> then_6, else_7",
+            "then_6 -> fi_8",
+            "else_7 -> fi_8",
+            "fi_8 -> while_4",
+            "od_9 -> while_2",
+            "od_10 -> exit",
+            "exit -> "])
+        self.assertEqual(str(graph.block("while_4").branch), "j < i")
+
+    def test_loops(self):
+        analyses = cfg.analyses(program(NESTED))
+        outer, inner = analyses.loops()
+        self.assertEqual((outer.header.name, outer.depth), ("while_2", 1))
+        self.assertEqual((inner.header.name, inner.depth), ("while_4", 2))
+        self.assertIs(inner.parent, outer)
+        self.assertEqual(names(inner.blocks), ["do_5", "else_7", "fi_8", "then_6", "while_4"])
+        graph = analyses.cfg()
+        self.assertEqual(cfg.loop_depth(analyses.loops(), graph.block("then_6")), 2)
+        self.assertEqual(cfg.loop_depth(analyses.loops(), graph.block("od_10")), 0)
+
+    def test_dominators(self):
+        analyses = cfg.analyses(program(NESTED))
+        graph, idom = analyses.cfg(), analyses.dominators()
+        self.assertIs(idom[graph.block("fi_8")], graph.block("do_5"))
+        self.assertTrue(cfg.dominates(idom, graph.block("while_2"), graph.block("then_6")))
+        self.assertFalse(cfg.dominates(idom, graph.block("then_6"), graph.block("fi_8")))
+        self.assertEqual(names(analyses.dominator_tree()[graph.block("do_5")]),
+                         ["else_7", "fi_8", "then_6"])
+
+    def test_liveness(self):
+        analyses = cfg.analyses(program(NESTED))
+        graph, live = analyses.cfg(), analyses.liveness()
+        self.assertEqual(live.ins[graph.block("while_4")], {"i", "j", "n", "s"})
+        self.assertEqual(live.ins[graph.block("od_10")], {"s"})
+        # s may be read before it is assigned
+        self.assertEqual(live.ins[graph.block("block_1")], {"s"})
+
+    def test_definitely_assigned(self):
+        analyses = cfg.analyses(program(NESTED))
+        graph, assigned = analyses.cfg(), analyses.definitely_assigned()
+        self.assertEqual(assigned.ins[graph.block("fi_8")], {"i", "j", "n"})
+        self.assertEqual(assigned.outs[graph.block("else_7")], {"i", "j", "n", "s"})
+
+
+class Test_Code_CFG(unittest.TestCase):
+
+    def test_generated(self):
+        context = Context()
+        context.unroll_factor = 1
+        compile.generate(program(NESTED), context, optimize=True)
+        analyses = context.analyses()
+        loops = analyses.loops()
+        self.assertEqual([loop.depth for loop in loops], [1, 2])
+        # The rotated loop's bottom test jumps back or falls through
+        bottom = [b for b in loops[1].blocks if loops[1].header in b.succs][0]
+        self.assertEqual(len(bottom.succs), 2)
+        self.assertIn("r1", analyses.liveness().ins[loops[0].header])
+
+    def test_resolved(self):
+        """Resolved jumps (ADD r15, and LOAD r15 from a far jump word) are followed"""
+        source = "x = read;\nwhile x > 0 do\n x = x - 1;\n" + "y = y + x;\n" * 150 + "od\nprint y;\n"
+        result = build.build(io.StringIO(source))
+        symbolic = cfg.from_instrs(result.context.get_instrs())
+        resolved = cfg.from_instrs(result.resolved)
+        self.assertTrue(any(i.opcode == "LOAD" and i.target == "r15" for i in result.resolved))
+        for graph in [symbolic, resolved]:
+            loops = cfg.find_loops(graph, cfg.immediate_dominators(graph))
+            self.assertEqual(len(loops), 1)
+            self.assertIn(graph.exit, [b for b in graph.blocks if b.succs == []])
+        far = [b for b in resolved.blocks if b.code and b.code[-1].target == "r15"
+               and b.code[-1].opcode == "LOAD"][0]
+        dest = [b for b in far.succs if b.code[0].opcode == "LOAD" and b.code[0].ref is None][0]
+        self.assertEqual(dest.code[1].offset, 511)
+
+    def test_empty(self):
+        graph = cfg.from_instrs([])
+        self.assertEqual(graph.entry.succs, [graph.exit])
+
+
+class Test_Caching(unittest.TestCase):
+
+    def test_context(self):
+        context = Context()
+        context.emit("ADD", "r1", "r0", "r0", offset=1)
+        first = context.analyses()
+        first.loops()
+        first.loops()
+        self.assertEqual(first.computed, 3)
+        self.assertIs(context.analyses(), first)
+        context.emit("HALT", "r0", "r0", "r0")
+        self.assertIsNot(context.analyses(), first)
+        self.assertEqual(len(context.analyses().cfg().blocks), 3)
+
+    def test_invalidate(self):
+        tree = program(NESTED)
+        analyses = cfg.analyses(tree)
+        graph = analyses.cfg()
+        self.assertIs(cfg.analyses(tree).cfg(), graph)
+        cfg.invalidate(tree)
+        self.assertIsNot(cfg.analyses(tree).cfg(), graph)
+
+    def test_not_kept_alive(self):
+        tree = program(NESTED)
+        cfg.analyses(tree).loops()
+        ref = weakref.ref(tree)
+        del tree
+        gc.collect()
+        self.assertIsNone(ref())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,7 +10,7 @@ build up the full code generator.
 
 import unittest
 from expr import *
-from codegen_context import Context
+from codegen_context import Context, parse_instr
 from typing import List, Union
 
 
@@ -220,9 +220,7 @@ class Test_Unops_Gen(AsmTestCase):
         expected = """
         LOAD r14,const_n_3
         SUB  r0,r14,r0  # <Abs>
-        JUMP/PZ already_positive_1
-        SUB r14,r0,r14  # Flip the sign
-        already_positive_1:   # </Abs>
+        SUB/M r14,r0,r14  # Flip the sign </Abs>
         const_n_3:  DATA -3
         """
         generated = context.get_lines()
@@ -258,7 +256,7 @@ class Test_Condjump(AsmTestCase):
         LOAD  r14,const_3
         LOAD  r13,const_5
         SUB   r0,r14,r13
-        JUMP/PM  here_if_false #==
+        JUMP/PMV here_if_false #==
         const_3: DATA 3
         const_5: DATA 5
         """
@@ -292,7 +290,7 @@ class Test_Condjump(AsmTestCase):
         LOAD  r14,const_3
         LOAD  r13,const_5
         SUB   r0,r14,r13
-        JUMP/Z  here_if_false #!=
+        JUMP/ZV here_if_false #!=
         const_3: DATA 3
         const_5: DATA 5
         """
@@ -326,7 +324,7 @@ class Test_Condjump(AsmTestCase):
         LOAD  r14,const_3
         LOAD  r13,const_5
         SUB   r0,r14,r13
-        JUMP/ZM  here_if_false #>
+        JUMP/ZMV here_if_false #>
         const_3: DATA 3
         const_5: DATA 5
         """
@@ -360,7 +358,7 @@ class Test_Condjump(AsmTestCase):
         LOAD  r14,const_3
         LOAD  r13,const_5
         SUB   r0,r14,r13
-        JUMP/M  here_if_false #>=
+        JUMP/MV here_if_false #>=
         const_3: DATA 3
         const_5: DATA 5
         """
@@ -394,7 +392,7 @@ class Test_Condjump(AsmTestCase):
         LOAD  r14,const_3
         LOAD  r13,const_5
         SUB   r0,r14,r13
-        JUMP/PZ  here_if_false #<
+        JUMP/PZV here_if_false #<
         const_3: DATA 3
         const_5: DATA 5
         """
@@ -428,7 +426,7 @@ class Test_Condjump(AsmTestCase):
         LOAD  r14,const_3
         LOAD  r13,const_5
         SUB   r0,r14,r13
-        JUMP/P  here_if_false #<=
+        JUMP/PV here_if_false #<=
         const_3: DATA 3
         const_5: DATA 5
         """
@@ -448,7 +446,7 @@ class Test_While_Gen(AsmTestCase):
         LOAD  r14,var_x
         LOAD  r13,var_x
         SUB  r0,r14,r13
-        JUMP/PM  od_2    #==
+        JUMP/PMV od_2    #==
         LOAD  r14,var_x
         LOAD  r13,const_1
         SUB   r14,r14,r13
@@ -475,7 +473,7 @@ class Test_If_Gen(AsmTestCase):
         LOAD  r14,var_x
         LOAD  r13,const_1
         SUB  r0,r14,r13
-        JUMP/PM  else_1 #==
+        JUMP/PMV else_1 #==
         LOAD  r14,var_x
         LOAD  r13,const_1
         SUB   r14,r14,r13
@@ -494,5 +492,329 @@ class Test_If_Gen(AsmTestCase):
         self.codeEqual(generated, expected)
 
 
+class Test_Register_Allocation(AsmTestCase):
+    """Sethi-Ullman ordering and spilling"""
+
+    def test_need(self):
+        self.assertEqual(Var("x").need(), 1)
+        self.assertEqual(Plus(Var("x"), IntConst(1)).need(), 2)
+        self.assertEqual(Plus(Var("a"), Times(Var("b"), Var("c"))).need(), 2)
+        self.assertEqual(Plus(Times(Var("a"), Var("b")), Times(Var("c"), Var("d"))).need(), 3)
+        self.assertEqual(Neg(Plus(Var("x"), IntConst(1))).need(), 2)
+
+    def test_heavier_operand_first(self):
+        context = Context()
+        target = context.allocate_register()
+        e = Plus(Var("a"), Times(Var("b"), Var("c")))
+        e.gen(context, target)
+        expected = """
+        LOAD r14,var_b
+        LOAD r13,var_c
+        MUL  r14,r14,r13
+        LOAD r13,var_a
+        ADD  r14,r13,r14
+        var_b: DATA 0
+        var_c: DATA 0
+        var_a: DATA 0
+        """
+        self.codeEqual(context.get_lines(), expected)
+        self.assertEqual(context.max_pressure, 2)
+
+    def test_read_keeps_order(self):
+        """Input must still be read before the right operand"""
+        context = Context()
+        target = context.allocate_register()
+        e = Minus(Read(), Times(Var("b"), Var("c")))
+        e.gen(context, target)
+        generated = crush(context.get_lines())
+        self.assertEqual(generated[0], "LOAD r14,r0,r0[510]")
+        self.assertEqual(context.max_pressure, 3)
+
+    def deep(self, depth: int, names: List[str]) -> Expr:
+        """A complete binary tree of additions"""
+        if depth == 0:
+            return Var(names.pop())
+        return Plus(self.deep(depth - 1, names), self.deep(depth - 1, names))
+
+    def test_spill(self):
+        """A tree needing 15 registers can't be evaluated in 14
+        without spilling.
+        """
+        e = self.deep(14, [f"v{i}" for i in range(2 ** 14)])
+        self.assertEqual(e.need(), 15)
+        context = Context()
+        target = context.allocate_register()
+        e.gen(context, target)
+        context.free_register(target)
+        generated = crush(context.get_lines())
+        self.assertEqual(context.spills, 1)
+        self.assertEqual(context.max_pressure, 14)
+        self.assertIn("STORE r14,tmp_1 # spill", generated)
+        self.assertIn("LOAD r13,tmp_1 # reload", generated)
+        self.assertIn("tmp_1: DATA 0", generated)
+        self.assertEqual(crush(context.assm_lines)[-1], "ADD r14,r13,r14")
+        self.assertEqual(context.free_register_count(), 14)
+
+    def test_report(self):
+        context = Context()
+        target = context.allocate_register()
+        Plus(Times(Var("a"), Var("b")), Times(Var("c"), Var("d"))).gen(context, target)
+        self.assertEqual(context.register_report(),
+                         "max register pressure 3, 0 spills to 0 temporaries")
+
+
+class Test_Instr_Records(AsmTestCase):
+    """Code is kept as records and rendered as text on request"""
+
+    def test_fields(self):
+        context = Context()
+        target = context.allocate_register()
+        LT(Var("x"), IntConst(3)).condjump(context, target, "there", jump_cond=True)
+        load_x, load_3, sub, jump = context.instrs
+        self.assertEqual((load_x.opcode, load_x.target, load_x.ref), ("LOAD", "r14", "var_x"))
+        self.assertEqual((sub.target, sub.src1, sub.src2), ("r0", "r14", "r13"))
+        self.assertEqual((jump.opcode, jump.predicate, jump.ref), ("JUMP", "M", "there"))
+        self.assertEqual(squish(jump.render()), "JUMP/M there #<")
+
+    def test_parse_round_trip(self):
+        text = """
+        # A comment
+        again:  LOAD r1,var_x  # load it
+                STORE r1,r0,r0[511]
+                JUMP/PZ again
+        done:
+        const_n_3: DATA -3
+        """
+        records = [parse_instr(line) for line in crush(text)]
+        self.assertEqual([r.opcode for r in records],
+                         [None, "LOAD", "STORE", "JUMP", None, "DATA"])
+        self.assertEqual(records[2].offset, 511)
+        self.assertEqual(records[5].value, -3)
+        self.codeEqual([r.render() for r in records], text)
+
+    def test_add_line(self):
+        """Text added with add_line is parsed into a record"""
+        context = Context()
+        context.add_line("   SUB  r1,r2,r3[-4]  # text")
+        self.assertEqual(context.instrs[0].offset, -4)
+        self.assertEqual(crush(context.get_lines()), ["SUB r1,r2,r3[-4] # text"])
+
+
+class Test_If_Conversion(AsmTestCase):
+    """Small ifs become predicated instructions"""
+
+    def max_if(self) -> If:
+        """if x > y then m = x else m = y fi"""
+        return If(GT(Var("x"), Var("y")),
+                  Assign(Var("m"), Var("x")),
+                  Assign(Var("m"), Var("y")))
+
+    def test_max(self):
+        context = Context()
+        context.if_conversion_cost = 12
+        target = context.allocate_register()
+        self.max_if().gen(context, target)
+        expected = """
+        LOAD r13,var_x
+        LOAD r12,var_y
+        LOAD r14,var_x
+        LOAD r11,var_y
+        SUB  r0,r14,r11  #>
+        STORE/P  r13,var_m
+        SUB  r0,r14,r11  # again
+        STORE/ZMV r12,var_m
+        var_x: DATA 0
+        var_y: DATA 0
+        var_m: DATA 0
+        """
+        self.codeEqual(context.get_lines(), expected)
+        self.assertEqual(context.if_conversions, ["if x > y: 2 jumps eliminated"])
+        self.assertEqual(context.free_register_count(), 13)
+
+    def test_register_variables(self):
+        context = Context()
+        context.if_conversion_cost = 8
+        context.assign_variable_registers({"x": "r1", "y": "r2", "m": "r3"})
+        target = context.allocate_register()
+        self.max_if().gen(context, target)
+        expected = """
+        SUB  r0,r1,r2  #>
+        ADD/P  r3,r0,r1  # m
+        SUB  r0,r1,r2  # again
+        ADD/ZMV r3,r0,r2  # m
+        """
+        self.codeEqual(context.get_lines(), expected)
+
+    def test_over_cost(self):
+        """Too long for the threshold, or no threshold:  jumps as before"""
+        for cost in [None, 4]:
+            context = Context()
+            context.if_conversion_cost = cost
+            target = context.allocate_register()
+            self.max_if().gen(context, target)
+            self.assertIn("JUMP", [instr.opcode for instr in context.instrs])
+            self.assertEqual(context.if_conversions, [])
+
+    def test_ineligible(self):
+        dependent = Seq(Assign(Var("a"), IntConst(1)),
+                        Assign(Var("b"), Plus(Var("a"), IntConst(1))))
+        for part in [Print(Var("x")),
+                     Assign(Var("a"), Read()),
+                     While(LT(Var("x"), IntConst(3)), Pass()),
+                     dependent]:
+            context = Context()
+            context.if_conversion_cost = 100
+            target = context.allocate_register()
+            If(GT(Var("x"), Var("y")), part, Pass()).gen(context, target)
+            self.assertEqual(context.if_conversions, [], str(part))
+
+    def test_condition_changed(self):
+        """Recomparing would see the new value of a register variable"""
+        context = Context()
+        context.if_conversion_cost = 100
+        context.assign_variable_registers({"x": "r1"})
+        target = context.allocate_register()
+        If(LT(Var("x"), IntConst(0)),
+           Assign(Var("x"), IntConst(0)),
+           Assign(Var("y"), IntConst(1))).gen(context, target)
+        self.assertEqual(context.if_conversions, [])
+
+
+def used_registers(context: Context) -> set:
+    """Registers the instructions generated so far name"""
+    return {reg for instr in context.instrs if instr.is_instruction()
+            for reg in [instr.target, instr.src1, instr.src2] if reg}
+
+
+class Test_Comparison_Values(AsmTestCase):
+    """Comparisons used as values are 0 or 1, without jumps"""
+
+    def test_lt(self):
+        context = Context()
+        target = context.allocate_register()
+        LT(Var("a"), Var("b")).gen(context, target)
+        expected = """
+        LOAD r13,var_a
+        LOAD r12,var_b
+        ADD  r14,r0,r0  # a < b
+        SUB  r0,r13,r12
+        ADD/M r14,r0,r0[1]  #<
+        var_a: DATA 0
+        var_b: DATA 0
+        """
+        self.codeEqual(context.get_lines(), expected)
+        self.assertEqual(context.free_register_count(), 13)
+
+    def test_sum_of_relations(self):
+        context = Context()
+        context.assign_variable_registers({"a": "r1", "b": "r2", "c": "r3", "d": "r4"})
+        target = context.allocate_register()
+        Assign(Var("x"), Plus(LT(Var("a"), Var("b")), EQ(Var("c"), Var("d")))).gen(context, target)
+        expected = """
+        ADD  r14,r0,r0  # a < b
+        SUB  r0,r1,r2
+        ADD/M r14,r0,r0[1]  #<
+        ADD  r13,r0,r0  # c == d
+        SUB  r0,r3,r4
+        ADD/Z r13,r0,r0[1]  #==
+        ADD  r14,r14,r13
+        STORE r14,var_x
+        var_x: DATA 0
+        """
+        self.codeEqual(context.get_lines(), expected)
+
+    def test_no_register_to_spare(self):
+        context = Context()
+        context.assign_variable_registers({"a": "r1"})
+        target = context.allocate_register()
+        held = [context.allocate_register() for _ in range(context.free_register_count())]
+        GE(Var("a"), IntConst(0)).gen(context, target)
+        opcodes = [instr.opcode for instr in context.instrs if instr.is_instruction()]
+        self.assertIn("JUMP", opcodes)
+        self.assertEqual(crush(context.get_lines())[-1], "const_0: DATA 0")
+        self.assertFalse(used_registers(context) & set(held))
+
+    def test_operands_need_registers(self):
+        """One free register is not enough when an operand needs two"""
+        context = Context()
+        context.assign_variable_registers({"c": "r1"})
+        target = context.allocate_register()
+        held = [context.allocate_register() for _ in range(context.free_register_count() - 1)]
+        relation = LT(IntConst(27), Plus(IntConst(23), Plus(Var("c"), Var("c"))))
+        self.assertEqual(relation.need(), 3)
+        relation.gen(context, target)
+        opcodes = [instr.opcode for instr in context.instrs if instr.is_instruction()]
+        self.assertIn("JUMP", opcodes)
+        self.assertEqual(context.free_register_count(), 1)
+        self.assertFalse(used_registers(context) & set(held))
+
+
+class Test_Branch_Layout(AsmTestCase):
+    """Rotated loops and out-of-line if arms"""
+
+    def context(self) -> Context:
+        context = Context()
+        context.layout_branches = True
+        context.assign_variable_registers({"x": "r1", "y": "r2"})
+        return context
+
+    def test_rotated_while(self):
+        context = self.context()
+        target = context.allocate_register()
+        While(GT(Var("x"), Var("y")), Assign(Var("x"), Minus(Var("x"), IntConst(1)))).gen(context, target)
+        expected = """
+        SUB  r0,r1,r2
+        JUMP/ZMV od_2  #>
+        while_do_1:
+        LOAD r13,const_1
+        SUB  r1,r1,r13
+        SUB  r0,r1,r2
+        JUMP/P  while_do_1  #>
+        od_2:
+        const_1: DATA 1
+        """
+        self.codeEqual(context.get_lines(), expected)
+
+    def test_unlikely_then(self):
+        """x == y seldom holds, so the else part falls through"""
+        context = self.context()
+        target = context.allocate_register()
+        If(EQ(Var("x"), Var("y")), Print(Var("x")), Print(Var("y"))).gen(context, target)
+        context.emit("HALT", "r0", "r0", "r0")
+        context.place_cold_code()
+        expected = """
+        SUB  r0,r1,r2
+        JUMP/Z  then_2  #==
+        STORE r2,r0,r0[511]
+        fi_1:
+        HALT r0,r0,r0
+        then_2:
+        STORE r1,r0,r0[511]
+        JUMP fi_1
+        """
+        self.codeEqual(context.get_lines(), expected)
+
+    def test_no_else(self):
+        context = self.context()
+        target = context.allocate_register()
+        If(GT(Var("x"), Var("y")), Print(Var("x")), Pass()).gen(context, target)
+        expected = """
+        SUB  r0,r1,r2
+        JUMP/ZMV fi_1  #>
+        STORE r1,r0,r0[511]
+        fi_1:
+        """
+        self.codeEqual(context.get_lines(), expected)
+
+    def test_likely(self):
+        x = Var("x")
+        self.assertFalse(EQ(x, IntConst(3)).likely())
+        self.assertTrue(NE(x, IntConst(3)).likely())
+        self.assertFalse(LT(x, IntConst(0)).likely())
+        self.assertTrue(GE(x, IntConst(0)).likely())
+        self.assertFalse(GT(IntConst(0), x).likely())
+        self.assertTrue(LT(x, Var("y")).likely())
+
+
 if __name__ == "__main__":
     unittest.main()
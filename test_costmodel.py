@@ -0,0 +1,72 @@
+"""Test the static cycle-cost model"""
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler_2019-master"))
+from llparse import parse
+
+import compile
+import costmodel
+from codegen_context import Context, parse_instr
+
+LOOP = """
+n = read;
+while n > 0 do
+    print n * n;
+    n = n - 1;
+od
+"""
+
+
+def generated(source: str, optimize: bool = False) -> Context:
+    context = Context()
+    # Unrolled, the loop would be counted as running 10 times for
+    # each copy of its body
+    context.unroll_factor = 1
+    compile.generate(parse(io.StringIO(source)), context, optimize)
+    return context
+
+
+class Test_Cycles(unittest.TestCase):
+
+    def test_instructions(self):
+        costs = [costmodel.cycles(parse_instr(text)) for text in
+                 ["ADD r1,r2,r3", "MUL r1,r2,r3", "LOAD r1,var_x", "STORE/Z r1,var_x",
+                  "JUMP/P there", "ADD r15,r0,r15[3]", "there: DATA 4", "# comment"]]
+        self.assertEqual(costs, [1, 3, 2, 2, 2, 2, 0, 0])
+
+    def test_node(self):
+        # LOAD x, LOAD const_2 for the product, MUL, STORE y
+        self.assertEqual(costmodel.node_cycles(parse(io.StringIO("y = x * 99;"))), 2 + 2 + 3 + 2)
+
+
+class Test_Estimate(unittest.TestCase):
+
+    def test_loop_ranked_first(self):
+        estimate = costmodel.estimate(generated(LOOP))
+        hottest = estimate.ranked()[0]
+        self.assertEqual(hottest.depth, 1)
+        self.assertEqual(hottest.weighted, 10 * hottest.cycles)
+        self.assertEqual(estimate.cycles, sum(costmodel.cycles(instr) for instr in generated(LOOP).instrs))
+        self.assertGreater(estimate.weighted, estimate.cycles)
+
+    def test_optimized_cheaper(self):
+        self.assertLess(costmodel.estimate(generated(LOOP, optimize=True)).weighted,
+                        costmodel.estimate(generated(LOOP)).weighted)
+
+    def test_asm(self):
+        """An .asm file costs what its Context does"""
+        context = generated(LOOP)
+        text = io.StringIO("\n".join(context.get_lines()))
+        from_file = costmodel.estimate(costmodel.read_asm(text))
+        self.assertEqual(from_file.blocks, costmodel.estimate(context).blocks)
+        report = from_file.report(top=1)
+        self.assertEqual(len(report), 3)
+        self.assertTrue(report[2].startswith(from_file.ranked()[0].name))
+
+
+if __name__ == "__main__":
+    unittest.main()
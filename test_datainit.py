@@ -0,0 +1,67 @@
+"""Test initializing variables by their DATA words"""
+
+import io
+import os
+import sys
+import unittest
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler_2019-master"))
+from llparse import parse
+
+import arith
+import build
+import compile
+import datainit
+import expr
+import machine
+from codegen_context import Context
+from test_codegen import crush
+from test_lockstep import interpret
+
+
+def generated(source: str) -> Context:
+    context = Context()
+    compile.generate(parse(io.StringIO(source)), context)
+    return context
+
+
+class Test_Static(unittest.TestCase):
+
+    def test_littlest(self):
+        context = generated("x = 7;")
+        self.assertEqual(crush(context.get_lines()), ["HALT r0,r0,r0", "var_x: DATA 7"])
+        self.assertEqual(context.data_stats, Counter({"variables initialized statically": 1}))
+
+    def test_values(self):
+        program = parse(io.StringIO("""
+            a = -5;
+            print b;
+            b = 3;
+            x = read;
+            if x > 0 then c = 1; fi
+            d = 2;
+            d = 4;
+            """))
+        values, kept = datainit.static_values(program, {})
+        self.assertEqual(values, {"a": -5, "d": 2})
+        self.assertEqual(len(kept), 5)
+        values, kept = datainit.static_values(program, {"a": "r1"})
+        self.assertEqual(values, {"d": 2})
+
+    def test_runs_the_same(self):
+        source = "a = -5; n = read; b = 3; while n > 0 do a = a + b; n = n - 1; od print a; d = 9; print d;"
+        saved = expr.ARITH
+        expr.ARITH = arith.Int32()
+        try:
+            for optimize in [False, True]:
+                words = build.build(io.StringIO(source), optimize).words
+                for n in [0, 4]:
+                    self.assertEqual(machine.run(words, [n]).outputs,
+                                     interpret(parse(io.StringIO(source)), [n])[1])
+        finally:
+            expr.ARITH = saved
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+"""Test instruction selection by tiling expression trees"""
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler_2019-master"))
+from llparse import parse
+
+import arith
+import build
+import compile
+import expr
+import isel
+import machine
+from codegen_context import Context
+from expr import *
+from test_codegen import crush
+from test_lockstep import interpret
+
+
+def selecting(registers: dict = None) -> Context:
+    context = Context()
+    context.select_instructions = True
+    context.assign_variable_registers(registers or {})
+    return context
+
+
+def generated(e: Expr, registers: dict = None) -> list:
+    context = selecting(registers)
+    target = context.allocate_register()
+    e.gen(context, target)
+    return crush(context.get_lines())
+
+
+class Test_Tiles(unittest.TestCase):
+
+    def test_small_constant(self):
+        self.assertEqual(generated(IntConst(42)), ["ADD r14,r0,r0[42]"])
+        self.assertEqual(generated(IntConst(-512)), ["ADD r14,r0,r0[-512]"])
+
+    def test_large_constant(self):
+        self.assertEqual(generated(IntConst(512)), ["LOAD r14,const_512", "const_512: DATA 512"])
+
+    def test_add_immediate(self):
+        self.assertEqual(generated(Plus(Var("x"), IntConst(1))),
+                         ["LOAD r14,var_x", "ADD r14,r14,r0[1]", "var_x: DATA 0"])
+        self.assertEqual(generated(Plus(IntConst(1), Var("x")), {"x": "r1"}),
+                         ["ADD r14,r1,r0[1]"])
+
+    def test_displacement(self):
+        e = Times(Var("x"), Minus(Var("y"), IntConst(3)))
+        self.assertEqual(generated(e, {"x": "r1", "y": "r2"}), ["MUL r14,r1,r2[-3]"])
+
+    def test_reverse_subtract(self):
+        self.assertEqual(generated(Minus(IntConst(5), Var("x")), {"x": "r1"}),
+                         ["SUB r14,r0,r1[-5]"])
+
+    def test_negate(self):
+        self.assertEqual(generated(Neg(Plus(Var("x"), IntConst(2))), {"x": "r1"}),
+                         ["SUB r14,r0,r1[2]"])
+
+    def test_input_order(self):
+        """Operands that read input are not swapped"""
+        code = generated(Plus(Read(), Read()))
+        self.assertEqual(code, ["LOAD r14,r0,r0[510]", "LOAD r13,r0,r0[510]", "ADD r14,r14,r13"])
+
+    def test_costs(self):
+        context = selecting({"x": "r1"})
+        self.assertEqual(isel.label(Plus(Var("x"), IntConst(1)), context)["reg"].cost, 1)
+        self.assertEqual(isel.label(Plus(Var("y"), IntConst(1)), context)["reg"].cost, 3)
+        self.assertEqual(isel.label(IntConst(1000), context)["reg"].cost, 2)
+
+
+class Test_Compare(unittest.TestCase):
+
+    def condjump(self, cond: Comparison) -> list:
+        context = selecting({"x": "r1"})
+        target = context.allocate_register()
+        cond.condjump(context, target, "there")
+        return crush(context.get_lines())
+
+    def test_compare_immediate(self):
+        self.assertEqual(self.condjump(LT(Var("x"), IntConst(7))),
+                         ["SUB r0,r1,r0[7]", "JUMP/M there #<"])
+
+    def test_immediate_first(self):
+        """7 - x has the condition code of 7 < x"""
+        self.assertEqual(self.condjump(LT(IntConst(7), Var("x"))),
+                         ["SUB r0,r0,r1[-7]", "JUMP/M there #<"])
+
+    def test_any_right_operand(self):
+        """Operands that only tile the classic way still compare"""
+        for right in [Abs(Var("x")), Read(), LT(Var("x"), Var("y"))]:
+            self.assertIn("JUMP/P there #>", self.condjump(GT(Var("x"), right)), msg=str(right))
+
+    def test_programs(self):
+        saved = expr.ARITH
+        expr.ARITH = arith.Int32()
+        try:
+            for source in ["x = read; if x > @x then print 1; fi",
+                           "x = read; while x < read do print x; od",
+                           "x = read; y = read; if 0 < (x < y) then print y; fi"]:
+                words = build.build(io.StringIO(source), True).words
+                for inputs in [[-3, 5, 9, -7], [4, 2, 1, 0]]:
+                    self.assertEqual(machine.run(words, inputs).outputs,
+                                     interpret(parse(io.StringIO(source)), inputs)[1], msg=source)
+        finally:
+            expr.ARITH = saved
+
+
+class Test_Const_Pool(unittest.TestCase):
+
+    def test_unused_dropped(self):
+        context = Context()
+        context.get_const_symbol(5)
+        context.emit("LOAD", "r1", ref=context.get_const_symbol(6))
+        self.assertEqual(crush(context.get_lines()), ["LOAD r1,const_6", "const_6: DATA 6"])
+
+    def test_program(self):
+        source = "x = read; while x > 0 do print x * 3 + 1; x = x - 1; od"
+        context = Context()
+        compile.generate(parse(io.StringIO(source)), context, optimize=True)
+        code = crush(context.get_lines())
+        self.assertFalse([line for line in code if "const_" in line])
+        self.assertIn("MUL r14,r1,r0[3]", code)
+
+
+if __name__ == "__main__":
+    unittest.main()
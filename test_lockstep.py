@@ -0,0 +1,137 @@
+"""Test lockstep evaluation:  running a program over many
+input sets at once should give each input set exactly the
+variables and output it gets from Expr.eval.
+"""
+
+import io
+import os
+import sys
+import random
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler_2019-master"))
+from llparse import parse
+
+import expr
+import lockstep
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MALLARD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler_2019-master", "mallard")
+
+FACT = """
+x = read;
+fact = 1;
+while x > 1 do
+    fact = fact * x;
+    x = x - 1;
+od
+print fact;
+"""
+
+COUNT = """
+watch = read;
+count = 0;
+observe = read;
+while  observe != 0 do
+    if watch == observe then
+       count = count + 1;
+    fi
+    observe = read;
+od
+print count;
+"""
+
+DIVIDE = """
+x = read;
+y = read;
+q = 0;
+while x >= y do
+    x = x - y;
+    q = q + 1;
+od
+print q;
+print x;
+print x / y + (q * ~2);
+"""
+
+
+def interpret(program: expr.Expr, inputs: list) -> (dict, list):
+    """Run the ordinary interpreter on one input set"""
+    expr.env_clear()
+    with mock.patch("builtins.input", side_effect=[str(v) for v in inputs]), \
+            mock.patch("builtins.print") as printed:
+        program.eval()
+    outputs = [int(call.args[0].split()[-1]) for call in printed.call_args_list]
+    env = {name: value.value for name, value in expr.ENV.items()}
+    return env, outputs
+
+
+@unittest.skipIf(np is None, "lockstep evaluation requires numpy")
+class Test_Lockstep(unittest.TestCase):
+
+    def check_same(self, program: expr.Expr, rows: list, dtype=None):
+        result = lockstep.run_lockstep(program, rows, dtype=dtype)
+        self.assertEqual(len(result), len(rows))
+        for lane, row in enumerate(rows):
+            env, outputs = interpret(program, row)
+            self.assertEqual(result.outputs[lane], outputs, f"lane {lane}: {row}")
+            self.assertEqual(result.lane_env(lane), env, f"lane {lane}: {row}")
+
+    def test_straight_line(self):
+        with open(os.path.join(MALLARD, "absdiff.mal")) as f:
+            program = parse(f)
+        self.check_same(program, [[3, 8], [8, 3], [-5, 5], [0, 0]])
+
+    def test_if(self):
+        with open(os.path.join(MALLARD, "max.mal")) as f:
+            program = parse(f)
+        self.check_same(program, [[3, 8], [8, 3], [4, 4], [-1, -9]])
+
+    def test_loops_of_different_lengths(self):
+        program = parse(io.StringIO(FACT))
+        self.check_same(program, [[n] for n in range(12)])
+
+    def test_reads_at_different_rates(self):
+        program = parse(io.StringIO(COUNT))
+        rows = [[3, 1, 3, 3, 0], [5, 0], [2, 2, 2, 2, 2, 2, 0], [7, 1, 2, 7, 4, 0]]
+        self.check_same(program, rows)
+
+    def test_random_sweep(self):
+        program = parse(io.StringIO(DIVIDE))
+        rng = random.Random(211)
+        rows = [[rng.randint(0, 500), rng.randint(1, 20)] for i in range(200)]
+        self.check_same(program, rows)
+
+    def test_python_ints(self):
+        """dtype=object keeps unbounded ints, like the interpreter"""
+        program = parse(io.StringIO(FACT))
+        self.check_same(program, [[25], [3]], dtype=object)
+
+    def test_overflow_detected(self):
+        program = parse(io.StringIO(FACT))
+        with self.assertRaises(lockstep.LaneOverflow):
+            lockstep.run_lockstep(program, [[25], [3]])
+
+    def test_undefined_in_one_lane(self):
+        program = parse(io.StringIO("""
+            x = read;
+            if x > 0 then y = 1; fi
+            print y;
+            """))
+        self.assertEqual(lockstep.run_lockstep(program, [[1], [2]]).outputs, [[1], [1]])
+        with self.assertRaises(expr.UndefinedVariable):
+            lockstep.run_lockstep(program, [[1], [0]])
+
+    def test_divide_by_zero(self):
+        program = parse(io.StringIO("x = read; print 10 / x;"))
+        with self.assertRaises(ZeroDivisionError):
+            lockstep.run_lockstep(program, [[1], [0]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+"""Test the DM2019W execution engine against sample object code
+and the interpreter
+"""
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler_2019-master"))
+from llparse import parse
+
+import arith
+import build
+import expr
+import machine
+from instr_format import CondFlag
+from test_lockstep import FACT, interpret
+
+PROGRAMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assembler_2019-master", "programs")
+
+
+class Test_Machine(unittest.TestCase):
+
+    def test_sample(self):
+        run = machine.run(machine.read_obj(os.path.join(PROGRAMS, "count10.obj")))
+        self.assertEqual(run.outputs, list(range(11)))
+        # The loop's test jumps out once, after 11 trips
+        self.assertEqual(run.fetched[6], 12)
+        self.assertEqual(run.executed[6], 1)
+
+    def test_alu(self):
+        self.assertEqual(machine.alu(machine.OpCode.DIV, -7, 2), (-4, CondFlag.M))
+        self.assertEqual(machine.alu(machine.OpCode.DIV, 7, 0), (0, CondFlag.V))
+        self.assertEqual(machine.alu(machine.OpCode.ADD, arith.WORD_MAX, 1), (arith.WORD_MIN, CondFlag.V))
+
+    def test_compiled(self):
+        saved = expr.ARITH
+        expr.ARITH = arith.Int32()
+        try:
+            for optimize in [False, True]:
+                words = build.build(io.StringIO(FACT), optimize).words
+                for x in [0, 5, 13, 20]:
+                    self.assertEqual(machine.run(words, [x]).outputs,
+                                     interpret(parse(io.StringIO(FACT)), [x])[1])
+        finally:
+            expr.ARITH = saved
+
+    def test_overflowing_comparisons(self):
+        """A comparison whose subtraction overflows is false, in
+        jumps and as a value, as in the interpreter
+        """
+        source = """
+            x = read;
+            if 511 == x then print 1; else print 2; fi
+            print (508 > x); print (x < 5); print (x != 7);
+            while x < 5 do print x; x = 5; od
+            print (508 > -2147483648);
+            y = 2147483000;
+            if y != -1000 then print 3; fi
+            """
+        saved = expr.ARITH
+        expr.ARITH = arith.Int32()
+        try:
+            for optimize in [False, True]:
+                words = build.build(io.StringIO(source), optimize).words
+                for x in [arith.WORD_MIN, -2147483000, 7, arith.WORD_MAX]:
+                    self.assertEqual(machine.run(words, [x]).outputs,
+                                     interpret(parse(io.StringIO(source)), [x])[1])
+            # Each of the first comparisons overflows
+            self.assertEqual(interpret(parse(io.StringIO(source)), [arith.WORD_MIN])[1][:4], [2, 0, 0, 0])
+        finally:
+            expr.ARITH = saved
+
+    def test_errors(self):
+        words = build.build(io.StringIO("x = read; y = read;")).words
+        with self.assertRaises(machine.MachineError):
+            machine.run(words, [1])
+        words = build.build(io.StringIO("while 1 < 2 do x = 1; od")).words
+        with self.assertRaises(machine.MachineError):
+            machine.run(words, max_steps=1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
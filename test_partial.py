@@ -0,0 +1,111 @@
+"""Test partial evaluation on known inputs"""
+
+import io
+import os
+import sys
+import unittest
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler_2019-master"))
+from llparse import parse
+
+import arith
+import compile
+import expr
+import partial
+from codegen_context import Context
+from test_lockstep import interpret
+
+TIMES = """
+n = read;
+x = read;
+i = 0;
+while i < n do
+    i = i + 1;
+    print x * i;
+od
+"""
+
+
+def program(source: str):
+    return parse(io.StringIO(source))
+
+
+def specialized(source: str, inputs: list, **options) -> (expr.Expr, Counter):
+    stats = Counter()
+    return partial.specialize(program(source), inputs, stats=stats, **options), stats
+
+
+class Test_Source(unittest.TestCase):
+
+    def test_round_trip(self):
+        source = "x = read; y = ~(x - -3) * @x; if (x < y) == 1 then print y / 2; else z = 1; fi " \
+                 "while x > 0 do x = x - 1; od"
+        text = partial.source(program(source))
+        self.assertEqual(str(program(text)), str(program(source)))
+
+
+class Test_Specialize(unittest.TestCase):
+
+    def test_unrolled(self):
+        tree, stats = specialized(TIMES, [3])
+        self.assertEqual(partial.source(tree), "x = read;\nprint (x * 1);\nprint (x * 2);\nprint (x * 3);\n")
+        self.assertEqual(stats, Counter({"reads replaced": 1, "loops unrolled": 1, "trips unrolled": 3}))
+
+    def test_all_known(self):
+        tree, stats = specialized(TIMES, [4, 5])
+        self.assertTrue(all(isinstance(s, expr.Print) and isinstance(s.expr, expr.IntConst)
+                            for s in partial.unroll.statements(tree)))
+        self.assertEqual(interpret(tree, [])[1], [5, 10, 15, 20])
+
+    def test_nothing_known(self):
+        tree, stats = specialized(TIMES, [])
+        self.assertEqual(str(tree), str(program(TIMES)))
+        self.assertFalse(stats)
+
+    def test_dynamic_if(self):
+        """x differs between the arms, so each arm assigns it"""
+        source = "c = read; x = 1; y = 7; if c > 0 then x = 2; fi print x; print y;"
+        tree, stats = specialized(source, [])
+        self.assertIn("print 7;", partial.source(tree))
+        for c in [-1, 1]:
+            self.assertEqual(interpret(tree, [c])[1], interpret(program(source), [c])[1])
+
+    def test_dynamic_loop(self):
+        source = "k = read; n = read; s = 0; i = 0; while i < n do s = s + i * k; i = i + 1; od print s;"
+        tree, stats = specialized(source, [3])
+        self.assertTrue(partial.source(tree).startswith("n = read;\ni = 0;\ns = 0;\nwhile"))
+        self.assertIn("s = (s + (i * 3));", partial.source(tree))
+        self.assertEqual(interpret(tree, [10])[1], interpret(program(source), [3, 10])[1])
+
+    def test_trip_limit(self):
+        tree, stats = specialized("i = 0; while 1 < 2 do i = i + 1; od", [])
+        self.assertEqual(stats["loops over the trip limit"], 1)
+        self.assertEqual(partial.source(tree), f"i = {partial.MAX_TRIPS};\nwhile 1 != 0 do\n    i = (i + 1);\nod\n")
+
+    def test_order_lost(self):
+        """After a branch on unknown data, the next read is not known"""
+        source = "x = read; y = x / 0; if y > 0 then z = read; fi w = read; print w;"
+        with self.assertRaises(partial.SpecializationError):
+            specialized(source, [1, 2, 3])
+        tree, stats = specialized(source, [1])
+        self.assertIn("y = (1 / 0);", partial.source(tree))
+
+    def test_overflow_left(self):
+        tree, stats = specialized("x = read; print x + 1;", [arith.WORD_MAX], semantics=arith.Int32())
+        self.assertEqual(partial.source(tree), "print (2147483647 + 1);\n")
+
+
+class Test_Codegen(unittest.TestCase):
+
+    def test_straight_prints(self):
+        tree, stats = specialized(TIMES, [4, 5], semantics=arith.Int32())
+        context = Context()
+        compile.generate(tree, context)
+        opcodes = {instr.opcode for instr in context.instrs}
+        self.assertEqual(opcodes, {"LOAD", "STORE", "HALT"})
+        self.assertNotIn(510, [instr.offset for instr in context.instrs])
+
+
+if __name__ == "__main__":
+    unittest.main()
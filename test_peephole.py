@@ -0,0 +1,205 @@
+"""Test peephole rules on small pieces of assembly code"""
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler_2019-master"))
+from llparse import parse
+
+import peephole
+from codegen_context import Context, parse_instr
+from test_codegen import crush
+
+
+def optimized(text: str) -> (list, peephole.Peephole):
+    instrs = [parse_instr(line) for line in text.strip().split("\n")]
+    instrs, opt = peephole.optimize(instrs)
+    return crush([instr.render() for instr in instrs]), opt
+
+
+class Test_Rules(unittest.TestCase):
+
+    def test_store_load(self):
+        code, opt = optimized("""
+            STORE r14,var_x
+            LOAD  r14,var_x
+            STORE r14,var_y
+            """)
+        self.assertEqual(code, ["STORE r14,var_x", "STORE r14,var_y"])
+        self.assertEqual(opt.removed["store_load"], 1)
+
+    def test_store_load_other_register(self):
+        code, opt = optimized("""
+            STORE r14,var_x
+            LOAD  r13,var_x
+            """)
+        self.assertEqual(len(code), 2)
+
+    def test_label_blocks_window(self):
+        """Another path may reach 'again' with a different r14"""
+        code, opt = optimized("""
+            STORE r14,var_x
+        again:
+            LOAD  r14,var_x
+            JUMP again
+            """)
+        self.assertIn("LOAD r14,var_x", code)
+
+    def test_condition_code_live(self):
+        """The LOAD sets the condition code tested by JUMP/Z"""
+        code, opt = optimized("""
+            STORE r14,var_x
+            LOAD  r14,var_x
+            JUMP/Z somewhere
+            HALT r0,r0,r0
+        somewhere:
+            ADD r1,r1,r1
+            """)
+        self.assertIn("LOAD r14,var_x", code)
+
+    def test_io_untouched(self):
+        code, opt = optimized("""
+            STORE r14,r0,r0[511]
+            STORE r14,r0,r0[511]
+            LOAD  r13,r0,r0[510]
+            LOAD  r13,r0,r0[510]
+            """)
+        self.assertEqual(len(code), 4)
+
+    def test_load_load(self):
+        code, opt = optimized("""
+            LOAD  r14,var_x
+            LOAD  r14,var_x
+            LOAD  r13,var_x
+            """)
+        self.assertEqual(code, ["LOAD r14,var_x", "LOAD r13,var_x"])
+        self.assertEqual(opt.removed["load_load"], 1)
+
+    def test_dead_store(self):
+        code, opt = optimized("""
+            STORE r14,var_x
+            STORE r13,var_x
+            """)
+        self.assertEqual(code, ["STORE r13,var_x"])
+
+    def test_dead_write(self):
+        code, opt = optimized("""
+            ADD r14,r13,r0[1]
+            LOAD r14,var_x
+            MUL r13,r13,r13
+            SUB r13,r13,r0[1]
+            """)
+        self.assertEqual(code, ["LOAD r14,var_x", "MUL r13,r13,r13", "SUB r13,r13,r0[1]"])
+        self.assertEqual(opt.removed["dead_write"], 1)
+
+    def test_jump_to_next(self):
+        code, opt = optimized("""
+            JUMP/P  next_1  # comment
+            # only a comment
+        next_1:
+            HALT r0,r0,r0
+            """)
+        self.assertEqual(code, ["# only a comment", "next_1:", "HALT r0,r0,r0"])
+        self.assertEqual(opt.removed["jump_to_next"], 1)
+
+    def test_jump_chain(self):
+        code, opt = optimized("""
+            SUB r0,r1,r2
+            JUMP/Z  first_1
+            ADD r1,r1,r1
+            HALT r0,r0,r0
+        first_1:
+            JUMP second_2
+            ADD r2,r2,r2
+        second_2:
+            ADD r3,r3,r3
+            """)
+        self.assertIn("JUMP/Z second_2", code)
+        self.assertNotIn("ADD r2,r2,r2", code)
+        self.assertEqual(opt.applied["jump_chain"], 1)
+
+    def test_jump_loop(self):
+        code, opt = optimized("""
+            JUMP a_1
+            HALT r0,r0,r0
+        a_1: JUMP b_2
+        b_2: JUMP a_1
+            """)
+        self.assertEqual(code, ["a_1:", "b_2: JUMP a_1"])
+
+    def test_predicated_labels_kept(self):
+        code, opt = optimized("""
+            SUB r0,r1,r2
+        here: JUMP/Z there
+            JUMP there
+        other: ADD r1,r1,r1
+        there:
+            HALT r0,r0,r0
+            """)
+        self.assertEqual(code, ["SUB r0,r1,r2", "here: JUMP/Z there", "JUMP there",
+                                "other: ADD r1,r1,r1", "there:", "HALT r0,r0,r0"])
+        code, opt = optimized("""
+            SUB r0,r1,r2
+        here: JUMP/Z there
+        there:
+            HALT r0,r0,r0
+            """)
+        self.assertEqual(code, ["here:", "there:", "HALT r0,r0,r0"])
+
+    def test_redundant_compare(self):
+        code, opt = optimized("""
+            SUB r3,r1,r2
+            SUB r0,r1,r2
+            JUMP/M there
+            HALT r0,r0,r0
+        there:
+            ADD r1,r1,r1
+            """)
+        self.assertEqual(code[:2], ["SUB r3,r1,r2", "JUMP/M there"])
+
+    def test_unreachable(self):
+        code, opt = optimized("""
+            HALT r0,r0,r0
+            ADD r1,r1,r1
+            DATA 4
+            """)
+        self.assertEqual(code, ["HALT r0,r0,r0", "DATA 4"])
+
+    def test_pc_relative_left_alone(self):
+        text = """
+            ADD r15,r0,r15[2]
+            JUMP next_1
+        next_1:
+            HALT r0,r0,r0
+            """
+        code, opt = optimized(text)
+        self.assertEqual(len(code), 4)
+
+
+class Test_Generated(unittest.TestCase):
+
+    def test_fixpoint(self):
+        context = Context()
+        program = parse(io.StringIO("""
+            x = read;
+            y = x;
+            while y > 0 do
+                y = y - 1;
+            od
+            print y;
+            """))
+        target = context.allocate_register()
+        program.gen(context, target)
+        before = crush(context.assm_lines)
+        after, opt = optimized("\n".join(context.assm_lines))
+        self.assertEqual(len(before) - len(after), sum(opt.removed.values()))
+        self.assertEqual(opt.removed["store_load"], 1)
+        again, opt = optimized("\n".join(after))
+        self.assertEqual(again, after)
+        self.assertEqual(sum(opt.applied.values()), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+"""Test recording profiles and optimizing for them"""
+
+import io
+import os
+import sys
+import unittest
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler_2019-master"))
+from llparse import parse
+
+import arith
+import build
+import compile
+import expr
+import pgo
+import regalloc
+from codegen_context import Context
+from test_lockstep import interpret
+
+BIG = """
+n = read;
+big = 0;
+while n > 0 do
+    x = read;
+    if x > 100 then
+        big = big + 1;
+    else
+        print x;
+    fi
+    n = n - 1;
+od
+print big;
+"""
+
+
+def program(source: str):
+    return parse(io.StringIO(source))
+
+
+def interpreted(source: str, inputs: list) -> pgo.Profile:
+    tree = program(source)
+    with pgo.recording(pgo.annotate(tree)) as profile:
+        interpret(tree, inputs)
+    return profile
+
+
+def annotated(source: str, profile: pgo.Profile) -> (expr.Expr, Counter):
+    tree, stats = program(source), Counter()
+    pgo.annotate(tree, profile, stats)
+    return tree, stats
+
+
+class Test_Record(unittest.TestCase):
+
+    def test_interpreter(self):
+        profile = interpreted(BIG, [3, 500, 7, 8])
+        self.assertEqual(profile.lines()[1:], ["0 while 1 3 n > 0", "1 if 1 2 x > 100"])
+        self.assertIsNone(expr.PROFILE)
+
+    def test_round_trip(self):
+        profile = interpreted(BIG, [2, 1, 2])
+        text = io.StringIO()
+        profile.write(text)
+        text.seek(0)
+        self.assertEqual(pgo.Profile.read(text).sites, profile.sites)
+        with self.assertRaises(pgo.ProfileError):
+            pgo.Profile.read(io.StringIO("0 while x i < n\n"))
+
+    def test_not_run(self):
+        profile = interpreted("x = read; if x > 0 then while x > 0 do x = x - 1; od fi", [0])
+        self.assertEqual(profile.lines()[1:], ["0 if 0 1 x > 0", "1 while 0 0 x > 0"])
+
+    def test_object(self):
+        """Counts from object code are those of the interpreter,
+        however the code is laid out and unrolled
+        """
+        saved = expr.ARITH
+        expr.ARITH = arith.Int32()
+        try:
+            for inputs in [[0], [2, 1, 2], [9, 1, 2, 3, 400, 5, 6, 7, 800, 9]]:
+                expected = interpreted(BIG, inputs).sites
+                for optimize, built_for in [(False, None), (True, None), (True, interpreted(BIG, [2, 1, 2]))]:
+                    profile, run = pgo.record_object(io.StringIO(BIG), inputs, optimize, profile=built_for)
+                    self.assertEqual(profile.sites, expected, (inputs, optimize))
+        finally:
+            expr.ARITH = saved
+
+    def test_wrong_object(self):
+        words = build.build(io.StringIO(BIG)).words
+        with self.assertRaises(pgo.ProfileError):
+            pgo.record_object(io.StringIO(BIG), [0], optimize=True, words=words)
+
+
+class Test_Annotate(unittest.TestCase):
+
+    def test_stale(self):
+        profile = interpreted(BIG, [2, 1, 2])
+        tree, stats = annotated(BIG.replace("x > 100", "x > 99"), profile)
+        self.assertEqual(stats, Counter({"sites with counts": 1, "stale sites ignored": 1}))
+
+    def test_kept_by_rewriting(self):
+        import sccp
+        profile = interpreted(BIG, [2, 1, 2])
+        tree, _ = annotated("k = 100; " + BIG.replace("x > 100", "x > k"), profile)
+        rewritten = sccp.simplify(tree)
+        self.assertIn("x > 100", str(rewritten))
+        self.assertEqual([node.counts for node in pgo.sites(rewritten)], [(1, 2), None])
+
+
+class Test_Optimize(unittest.TestCase):
+
+    def compiled(self, profile: pgo.Profile) -> Context:
+        tree, _ = annotated(BIG, profile)
+        context = Context()
+        compile.generate(tree, context, optimize=True)
+        return context
+
+    def test_layout(self):
+        """With mostly small inputs, the else part falls through"""
+        labels = [instr.label for instr in self.compiled(interpreted(BIG, [4, 1, 2, 3, 4])).instrs]
+        self.assertIn("then_4", labels)
+        self.assertNotIn("else_4", labels)
+        labels = [instr.label for instr in self.compiled(None).instrs]
+        self.assertIn("else_4", labels)
+
+    def test_unroll(self):
+        self.assertEqual(self.compiled(interpreted(BIG, [2, 1, 2])).unroll_stats,
+                         Counter({"loops unrolled by 2": 1}))
+        self.assertEqual(self.compiled(interpreted(BIG, [1, 5])).unroll_stats,
+                         Counter({"loops left rolled by profile": 1}))
+        self.assertEqual(self.compiled(interpreted(BIG, [0])).unroll_stats,
+                         Counter({"loops left rolled by profile": 1}))
+
+    def test_weights(self):
+        source = "x = read; if x > 0 then y = x; else z = x; fi while x > 0 do x = x - 1; od"
+        tree, _ = annotated(source, interpreted(source, [5]))
+        weights = {i.name: i.weight for i in regalloc.LiveIntervals().compute(tree)}
+        # x:  read, test, then part, 6 tests and 5 trips of the loop
+        self.assertEqual(weights, {"x": 1 + 1 + 1 + 6 + 2 * 5, "y": 1, "z": 0})
+
+
+if __name__ == "__main__":
+    unittest.main()
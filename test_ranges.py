@@ -0,0 +1,147 @@
+"""Test range analysis"""
+
+import io
+import math
+import os
+import sys
+import unittest
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler_2019-master"))
+from llparse import parse
+
+import arith
+import compile
+import expr
+import ranges
+from codegen_context import Context
+from ranges import Interval
+from test_lockstep import interpret
+
+COUNT = "i = 0; while i < 10 do print @i; i = i + 1; od print i;"
+
+
+def program(source: str):
+    return parse(io.StringIO(source))
+
+
+def operations(node: expr.Expr) -> list:
+    """The BinOps in node"""
+    found = [node] if isinstance(node, expr.BinOp) else []
+    for part in ["left", "right", "expr", "cond", "thenpart", "elsepart"]:
+        child = getattr(node, part, None)
+        if isinstance(child, expr.Expr):
+            found += operations(child)
+    return found
+
+
+def narrowed(source: str, fixed: bool = True) -> (expr.Expr, Counter):
+    stats = Counter()
+    tree, _ = ranges.narrow(program(source), fixed, stats)
+    return tree, stats
+
+
+class Test_Intervals(unittest.TestCase):
+
+    def test_decided(self):
+        self.assertTrue(ranges.decided(Interval(-5, -1), "<"))
+        self.assertFalse(ranges.decided(Interval(0, 3), "<"))
+        self.assertIsNone(ranges.decided(Interval(-1, 1), "<="))
+        self.assertFalse(ranges.decided(Interval(1, 4), "=="))
+
+    def test_constrain(self):
+        self.assertEqual(ranges.constrain(Interval(0, 100), "<", Interval(5, 10)),
+                         (Interval(0, 9), Interval(5, 10)))
+        self.assertEqual(ranges.constrain(Interval(0, 100), ">=", Interval(5, 10)),
+                         (Interval(5, 100), Interval(5, 10)))
+        self.assertEqual(ranges.constrain(Interval(0, 9), "!=", Interval(0, 0)),
+                         (Interval(1, 9), Interval(0, 0)))
+        self.assertEqual(ranges.constrain(Interval(0, 3), ">", Interval(5, 9))[0], None)
+
+
+class Test_Analysis(unittest.TestCase):
+
+    def test_widening(self):
+        result = ranges.analyze(program(COUNT))
+        self.assertEqual(result.variables["i"], Interval(0, 10))
+        self.assertEqual(result.report(), ["i in [0, 10]"])
+
+    def test_unbounded(self):
+        result = ranges.analyze(program("x = read; y = @x + 1;"), fixed=False)
+        self.assertEqual(result.variables["y"], Interval(1, math.inf))
+        # @x overflows for the most negative word
+        result = ranges.analyze(program("x = read; y = @x + 1;"), fixed=True)
+        self.assertEqual(result.variables["y"], ranges.WORD)
+
+    def test_branches(self):
+        result = ranges.analyze(program("x = read; if x > 3 then y = x; else y = 0 - x; fi"), fixed=False)
+        self.assertEqual(result.variables["y"], Interval(-3, math.inf))
+
+    def test_nested(self):
+        source = "i = 0; while i < 5 do j = i; while j < 8 do j = j + 2; od i = i + 1; od"
+        result = ranges.analyze(program(source))
+        self.assertEqual(result.variables["j"], Interval(0, 9))
+
+
+class Test_Narrow(unittest.TestCase):
+
+    def test_abs(self):
+        tree, stats = narrowed(COUNT)
+        self.assertNotIn("@", str(tree))
+        self.assertEqual(stats["abs removed"], 1)
+        self.assertEqual(interpret(tree, [])[1], interpret(program(COUNT), [])[1])
+
+    def test_comparison(self):
+        source = "i = 0; while i < 10 do if i >= 0 then print i; else print 0 - i; fi i = i + 1; od"
+        tree, stats = narrowed(source)
+        self.assertNotIn("if", str(tree))
+        self.assertEqual(stats["comparisons folded"], 1)
+
+    def test_equal(self):
+        """x is known in the arm where x == 3 holds"""
+        tree, stats = narrowed("x = read; if x == 3 then print x + 1; fi")
+        self.assertIn("print 4;", str(tree))
+        self.assertEqual(interpret(tree, [3])[1], [4])
+
+    def test_overflow_possible(self):
+        """x - 5 may overflow, so the comparison is not decided"""
+        source = "x = read; if x < 5 then if x - 5 < 0 then print 1; fi fi"
+        tree, stats = narrowed(source)
+        self.assertEqual(stats["comparisons folded"], 0)
+        tree, stats = narrowed(source, fixed=False)
+        self.assertEqual(stats["comparisons folded"], 1)
+
+    def test_division_by_zero_kept(self):
+        source = "d = read; if d >= 0 then if d < 3 then print 0 / d; fi fi"
+        tree, stats = narrowed(source, fixed=False)
+        with self.assertRaises(ZeroDivisionError):
+            interpret(tree, [0])
+
+    def test_overflow_checks(self):
+        saved = expr.ARITH
+        expr.ARITH = arith.Int32(trap=True)
+        try:
+            tree, stats = narrowed("x = read; y = x + 1; i = 0; while i < 10 do i = i + 1; od")
+            # i + 1, and the test i < 10
+            self.assertEqual(stats["overflow checks removed"], 2)
+            checked = {str(node): node.in_range for node in operations(tree)}
+            self.assertEqual(checked, {"(x + 1)": False, "(i + 1)": True})
+            with self.assertRaises(arith.ArithmeticOverflow):
+                interpret(tree, [arith.WORD_MAX])
+        finally:
+            expr.ARITH = saved
+
+
+class Test_Codegen(unittest.TestCase):
+
+    def test_report(self):
+        context = Context()
+        compile.generate(program("x = read; if x == 3 then print x * 100; fi"), context, optimize=True)
+        self.assertEqual(context.range_stats["constants found"], 1)
+        self.assertIn("x in [-2147483648, 2147483647]", context.ranges.report())
+        # 300 fits in an immediate operand
+        self.assertNotIn("MUL", [instr.opcode for instr in context.instrs])
+
+
+if __name__ == "__main__":
+    unittest.main()
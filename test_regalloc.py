@@ -0,0 +1,108 @@
+"""Test global register allocation of Mallard variables"""
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler_2019-master"))
+from llparse import parse
+
+import regalloc
+from codegen_context import Context
+from test_codegen import crush
+
+FACT = """
+x = read;
+fact = 1;
+while x > 1 do
+    fact = fact * x;
+    x = x - 1;
+od
+print fact;
+"""
+
+
+def compile_program(source: str, optimize: bool) -> Context:
+    context = Context()
+    program = parse(io.StringIO(source))
+    if optimize:
+        regalloc.allocate_variables(program, context)
+    target = context.allocate_register()
+    program.gen(context, target)
+    context.free_register(target)
+    return context
+
+
+class Test_Live_Intervals(unittest.TestCase):
+
+    def intervals(self, source: str) -> dict:
+        live = regalloc.LiveIntervals()
+        return {i.name: i for i in live.compute(parse(io.StringIO(source)))}
+
+    def test_straight_line(self):
+        intervals = self.intervals("a = 1; b = a; c = 2; print c;")
+        self.assertEqual((intervals["a"].start, intervals["a"].end), (1, 2))
+        self.assertLess(intervals["b"].end, intervals["c"].start)
+
+    def test_loop_widens(self):
+        """A variable used in a loop is live around the back edge"""
+        intervals = self.intervals("i = 0; t = 0; while i < 10 do t = i; i = i + 1; od print 0;")
+        self.assertEqual(intervals["t"].end, intervals["i"].end)
+        self.assertGreater(intervals["i"].weight, 10 * 2)
+
+    def test_maybe_uninitialized(self):
+        intervals = self.intervals("x = read; if x > 0 then y = 1; fi print y;")
+        self.assertEqual(intervals["y"].start, 0)
+        self.assertGreater(intervals["x"].start, 0)
+
+
+class Test_Linear_Scan(unittest.TestCase):
+
+    def test_disjoint_share(self):
+        live = regalloc.LiveIntervals()
+        intervals = live.compute(parse(io.StringIO("a = 1; print a; b = 2; print b;")))
+        assignment = regalloc.linear_scan(intervals, ["r1"])
+        self.assertEqual(assignment, {"a": "r1", "b": "r1"})
+
+    def test_heaviest_wins(self):
+        """With one register, the loop variable gets it"""
+        live = regalloc.LiveIntervals()
+        source = "a = 1; i = 0; while i < 10 do i = i + 1; od print a;"
+        intervals = live.compute(parse(io.StringIO(source)))
+        self.assertEqual(regalloc.linear_scan(intervals, ["r1"]), {"i": "r1"})
+
+
+class Test_Allocated_Code(unittest.TestCase):
+
+    def test_fewer_memory_operations(self):
+        plain = compile_program(FACT, optimize=False)
+        optimized = compile_program(FACT, optimize=True)
+        self.assertEqual(regalloc.memory_op_count(plain.instrs), 14)
+        self.assertEqual(regalloc.memory_op_count(optimized.instrs), 5)
+        self.assertEqual(optimized.var_registers, {"x": "r1", "fact": "r2"})
+        generated = crush(optimized.get_lines())
+        self.assertIn("MUL r2,r2,r1", generated)
+        self.assertIn("STORE r2,r0,r0[511]", generated)
+        self.assertNotIn("var_x: DATA 0", generated)
+
+    def test_temporaries_kept(self):
+        context = compile_program(FACT, optimize=True)
+        self.assertNotIn("r14", context.var_registers.values())
+        self.assertGreaterEqual(context.free_register_count(), regalloc.MIN_TEMP_REGISTERS)
+
+    def test_zero_initialized(self):
+        context = compile_program("x = read; if x > 0 then y = 1; fi print y;", optimize=True)
+        reg = context.var_registers["y"]
+        self.assertEqual(crush(context.assm_lines)[0], f"ADD {reg},r0,r0 # y = 0")
+
+    def test_old_value_preserved(self):
+        """x = 1 - (x * x) must not overwrite x before squaring it"""
+        context = compile_program("x = read; x = 1 - (x * x); print x;", optimize=True)
+        reg = context.var_registers["x"]
+        generated = crush(context.assm_lines)
+        self.assertEqual(generated[-2], f"ADD {reg},r0,r14 # x")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+"""Test sparse conditional constant propagation"""
+
+import io
+import os
+import sys
+import unittest
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler_2019-master"))
+from llparse import parse
+
+import arith
+import compile
+import expr
+import sccp
+import ssa
+from codegen_context import Context
+from test_lockstep import interpret
+
+FLAG = """
+debug = 0;
+x = read;
+while x > 0 do
+    if debug == 1 then print x; print debug; fi
+    step = debug * 5 + 2;
+    x = x - step;
+od
+while debug > 0 do print 7; od
+print x;
+"""
+
+
+def program(source: str):
+    return parse(io.StringIO(source))
+
+
+def simplified(source: str) -> (expr.Expr, Counter):
+    stats = Counter()
+    return sccp.simplify(program(source), stats), stats
+
+
+class Test_Lattice(unittest.TestCase):
+
+    def test_meet(self):
+        self.assertEqual(sccp.meet(sccp.TOP, 3), 3)
+        self.assertEqual(sccp.meet(3, 3), 3)
+        self.assertIs(sccp.meet(3, 4), sccp.BOTTOM)
+        self.assertIs(sccp.meet(sccp.BOTTOM, sccp.TOP), sccp.BOTTOM)
+
+
+class Test_Propagation(unittest.TestCase):
+
+    def test_flag(self):
+        """debug is 0 around the loop, so the print is never reached"""
+        ir = ssa.build(program(FLAG))
+        result = sccp.Propagation(ir).solve()
+        self.assertEqual(len([b for b in ir.blocks if b not in result.executable]), 2)
+        step = [op for op in ir.ops() if op.opcode == "sub"][0].args[1]
+        self.assertEqual(result.constant(step), 2)
+
+    def test_loop_carried(self):
+        """A variable changed in the loop is not constant"""
+        ir = ssa.build(program("i = 0; while i < 10 do i = i + 1; od print i;"))
+        result = sccp.Propagation(ir).solve()
+        printed = [op for op in ir.ops() if op.opcode == "print"][0].args[0]
+        self.assertIs(result.value(printed), sccp.BOTTOM)
+        self.assertEqual(len(result.executable), len(ir.blocks))
+
+    def test_rewrite(self):
+        ir = ssa.build(program(FLAG))
+        sccp.propagate(ir)
+        self.assertEqual(ir.stats["blocks removed"], 2)
+        self.assertEqual(ir.stats["branches folded"], 2)
+        self.assertEqual(len([op for op in ir.ops() if op.opcode == "print"]), 1)
+        for row in [[0], [5], [-3]]:
+            self.assertEqual(ssa.run(ir, row), interpret(program(FLAG), row)[1])
+
+    def test_no_overflow_folded(self):
+        saved = expr.ARITH
+        expr.ARITH = arith.Int32()
+        try:
+            ir = ssa.build(program("x = 2147483647 + 1; y = 7 / 0; print x; print y;"))
+            result = sccp.Propagation(ir).solve()
+            self.assertFalse([op for op in ir.ops() if op.opcode in ["add", "div"]
+                              and result.constant(op.dest) is not None])
+            self.assertEqual(expr.ARITH.overflows, 0)
+        finally:
+            expr.ARITH = saved
+
+
+class Test_Simplify(unittest.TestCase):
+
+    def test_flag(self):
+        tree, stats = simplified(FLAG)
+        self.assertEqual(str(tree).count("print"), 1)
+        self.assertIn("x - 2", str(tree))
+        self.assertEqual(stats, Counter({"statements removed": 3, "branches folded": 1,
+                                         "loops removed": 1, "expressions folded": 2}))
+        for row in [[0], [5], [-3]]:
+            self.assertEqual(interpret(tree, row)[1], interpret(program(FLAG), row)[1])
+
+    def test_if_arm(self):
+        tree, stats = simplified("k = 3; if k < 2 then print 1; else print 2; fi")
+        self.assertNotIn("if", str(tree))
+        self.assertEqual(interpret(tree, [])[1], [2])
+
+    def test_after_endless_loop(self):
+        tree, stats = simplified("x = read; while 1 < 2 do print x; od print 5; print 6;")
+        self.assertEqual(stats["statements removed"], 2)
+        self.assertNotIn("5", str(tree))
+
+    def test_undefined_not_zero(self):
+        """Reading an unassigned variable is still an error in the interpreter"""
+        tree, stats = simplified("if x == 0 then print 1; fi")
+        self.assertFalse(stats)
+        with self.assertRaises(expr.UndefinedVariable):
+            interpret(tree, [])
+
+    def test_unchanged(self):
+        source = "x = read; while x > 0 do print x; x = x - 1; od"
+        original = program(source)
+        self.assertIs(sccp.simplify(original), original)
+
+
+class Test_Codegen(unittest.TestCase):
+
+    def test_removed_from_code(self):
+        context = Context()
+        compile.generate(program(FLAG), context, optimize=True)
+        stores = [i for i in context.instrs if i.opcode == "STORE" and i.offset == 511]
+        self.assertEqual(len(stores), 1)
+        self.assertEqual(context.sccp_stats["loops removed"], 1)
+
+    def test_word_sized(self):
+        """Products too big for a word are left to the machine,
+        which wraps them, rather than folded into a DATA word
+        """
+        import build
+        import machine
+        source = "e = 25; e = e * 250000; e = e * 250000; print e;"
+        tree, _ = simplified(source)
+        self.assertEqual(interpret(tree, [])[1], [1562500000000])
+        words = build.build(io.StringIO(source), optimize=True).words
+        self.assertEqual(machine.run(words).outputs, [arith.wrap(1562500000000)])
+        self.assertTrue(all(arith.WORD_MIN <= word <= arith.WORD_MAX for word in words))
+
+    def test_ssa_path(self):
+        context = Context()
+        ir = compile.generate(program(FLAG), context, use_ssa=True)
+        self.assertEqual(ir.stats["blocks removed"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,176 @@
+"""Test replacing accumulation loops by closed forms"""
+
+import io
+import os
+import sys
+import unittest
+from collections import Counter
+from fractions import Fraction
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler_2019-master"))
+from llparse import parse
+
+import arith
+import build
+import expr
+import machine
+import scev
+from scev import Poly
+from test_lockstep import interpret
+from test_unroll import loops
+
+SUM = """
+n = read;
+i = 1;
+s = 0;
+while i <= n do
+    s = s + i;
+    i = i + 1;
+od
+print s;
+print i;
+"""
+
+SQUARES = "n = read; i = 0; s = 0; while i < n do s = s + i * i; i = i + 1; od print s;"
+
+COUNTDOWN = "n = read; c = 0; while n > 0 do n = n - 3; c = c + 1; t = c * 2; od print n; print c; print t;"
+
+# n + 2 fits in a word, so the trips can always be counted
+HALVED = COUNTDOWN.replace("n = read;", "n = read / 2;")
+
+# Counting by millions, from near one end of a word toward the other
+FAR = "n = read; c = 0; while n > 0 do n = n - 1000000; c = c + 1; od print n; print c;"
+
+
+def program(source: str):
+    return parse(io.StringIO(source))
+
+
+def replaced(source: str) -> (expr.Expr, Counter):
+    stats = Counter()
+    return scev.replace_loops(program(source), stats), stats
+
+
+class Test_Poly(unittest.TestCase):
+
+    def test_arithmetic(self):
+        x, y = Poly.var("x"), Poly.var("y")
+        p = (x + y) * (x - y)
+        self.assertEqual(p, x * x - y * y)
+        self.assertEqual(p.degree("x"), 2)
+        self.assertEqual(p.substitute("y", Poly.const(3)), x ** 2 - Poly.const(9))
+
+    def test_power_sums(self):
+        for power in range(4):
+            p = scev.power_sum(power)
+            for k in range(6):
+                self.assertEqual(p.substitute(scev.TRIP, Poly.const(k)),
+                                 Poly.const(sum(j ** power for j in range(k))))
+
+    def test_binomial_basis(self):
+        n = Poly.var(scev.TRIPS)
+        # n(n-1)/2 is n choose 2
+        self.assertEqual(scev.binomial_basis(Poly.const(Fraction(1, 2)) * n * (n - Poly.const(1))),
+                         [Poly(), Poly(), Poly.const(1)])
+        self.assertIsNone(scev.binomial_basis(Poly.const(Fraction(1, 2)) * n))
+
+    def test_limit(self):
+        self.assertEqual(scev.trips_limit(2), 46341)
+        self.assertLessEqual(3 * (1626 * 1625 * 1624 // 6), arith.WORD_MAX)
+
+
+class Test_Evolution(unittest.TestCase):
+
+    def test_sum(self):
+        finals = scev.evolution(loops(program(SUM))[0])
+        n, i, s = Poly.var(scev.TRIPS), Poly.var("i"), Poly.var("s")
+        self.assertEqual(finals["i"], i + n)
+        half = Poly.const(Fraction(1, 2))
+        self.assertEqual(finals["s"], s + n * i + half * n * (n - Poly.const(1)))
+
+    def test_not_polynomial(self):
+        for source in ["x = read; while x > 1 do x = x / 2; od",                # division
+                       "x = read; while x > 1 do x = x - 1; y = @x; od",        # abs
+                       "x = read; while x > 1 do x = x - 1; print x; od",       # print
+                       "x = read; while x > 1 do x = x - 1; y = read; od",      # read
+                       "x = read; while x > 1 do x = x - 1; y = y * 2; od",     # geometric
+                       "x = read; while x > 1 do y = z; x = x - 1; z = x; od",  # read before set
+                       "x = read; while x > 1 do x = x - 1; s = s + x * x * x; od"]:  # degree 4
+            self.assertIsNone(scev.evolution(loops(program(source))[0]), source)
+
+
+class Test_Replace(unittest.TestCase):
+
+    def check(self, source: str, rows: list):
+        tree, stats = replaced(source)
+        self.assertEqual(stats, Counter({"loops replaced by closed forms": 1}))
+        for row in rows:
+            self.assertEqual(interpret(tree, row)[1], interpret(program(source), row)[1], row)
+        return tree
+
+    def test_sum(self):
+        tree = self.check(SUM, [[-2], [0], [1], [10], [100]])
+        self.assertEqual(interpret(tree, [100000])[1], [5000050000, 100001])
+
+    def test_countdown(self):
+        tree = self.check(COUNTDOWN, [[1], [3], [7], [9], [10]])
+        self.assertEqual(len(loops(tree)), 1)
+        tree = self.check(HALVED, [[2], [6], [14], [19], [20]])
+        self.assertEqual(len(loops(tree)), 0)
+
+    def test_far(self):
+        """The loop runs where the distance to the bound may not fit"""
+        saved = expr.ARITH
+        expr.ARITH = arith.Int32()
+        try:
+            tree = self.check(FAR, [[-5], [1], [2000000], [2147483647], [2147000000]])
+            self.assertEqual(interpret(tree, [2147483647])[1], [-516353, 2148])
+        finally:
+            expr.ARITH = saved
+
+    def test_squares(self):
+        """A degree 2 sum falls back on the loop past the limit"""
+        tree = self.check(SQUARES, [[0], [1], [5], [20]])
+        self.assertEqual(len(loops(tree)), 1)
+
+    def test_wraparound(self):
+        saved = expr.ARITH
+        expr.ARITH = arith.Int32()
+        try:
+            self.check(SQUARES, [[3000], [50000]])
+        finally:
+            expr.ARITH = saved
+
+    def test_nested(self):
+        """Only the inner loop is replaced:  the outer one's body has a loop in it"""
+        source = "k = read; t = 0; while k > 0 do j = k; while j > 0 do t = t + j; j = j - 1; od k = k - 1; od print t;"
+        self.check(source, [[0], [1], [6]])
+
+    def test_unchanged(self):
+        source = "x = read; while x > 1 do x = x / 2; od print x;"
+        original = program(source)
+        self.assertIs(scev.replace_loops(original), original)
+
+
+class Test_Build(unittest.TestCase):
+
+    def test_no_loop(self):
+        result = build.build(io.StringIO(HALVED), optimize=True)
+        self.assertEqual(result.context.scev_stats, Counter({"loops replaced by closed forms": 1}))
+        self.assertNotIn("while", "\n".join(result.context.get_lines()))
+
+    def test_far(self):
+        words = build.build(io.StringIO(FAR), optimize=True).words
+        self.assertEqual(machine.run(words, [2147483647]).outputs, [-516353, 2148])
+        self.assertEqual(machine.run(words, [5000000]).outputs, [0, 5])
+
+    def test_guarded(self):
+        """Past the limit on trips, the loop runs"""
+        result = build.build(io.StringIO(SUM), optimize=True)
+        self.assertIn("while", "\n".join(result.context.get_lines()))
+        self.assertIn(("MUL", "DIV"), list(zip([i.opcode for i in result.context.instrs],
+                                               [i.opcode for i in result.context.instrs[1:]])))
+
+
+if __name__ == "__main__":
+    unittest.main()
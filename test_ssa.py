@@ -0,0 +1,173 @@
+"""Test the SSA form:  construction, passes, and lowering"""
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler_2019-master"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "assembler_2019-master"))
+from llparse import parse
+
+import assembler_phase1
+import assembler_phase2
+import compile
+import ssa
+from codegen_context import Context
+from test_lockstep import interpret
+
+LOOP = """
+n = read;
+i = 0;
+s = 0;
+while i < n do
+    if i == 3 then s = s + i * 2; else s = s + i * 2 + 1; fi
+    i = i + 1;
+od
+print s;
+"""
+
+SWAP = """
+x = read; y = read; n = read;
+while n > 0 do
+    t = x; x = y; y = t;
+    n = n - 1;
+od
+print x; print y;
+"""
+
+PROGRAMS = [
+    (LOOP, [[0], [4], [7]]),
+    (SWAP, [[1, 2, 0], [1, 2, 3], [5, 9, 4]]),
+    ("a = read; b = read; print (a < b) + (a == b) * 2; print @(a - b); print ~a / 2;",
+     [[3, 5], [5, 5], [-7, 2]]),
+    ("x = read; while x > 1 do if x / 2 * 2 == x then x = x / 2; else x = 3 * x + 1; fi "
+     "print x; od", [[6], [27]]),
+]
+
+
+def program(source: str):
+    return parse(io.StringIO(source))
+
+
+def lines(ir: ssa.IR, name: str) -> list:
+    """The operations of block name, as text"""
+    return [str(op) for op in ir.block(name).code]
+
+
+class Test_Build(unittest.TestCase):
+
+    def test_phis_at_loop_header(self):
+        ir = ssa.build(program(LOOP))
+        header = lines(ir, "while_4")
+        self.assertEqual([op for op in header if "phi" in op],
+                         ["i.7 = phi(t2, t24)", "n.8 = phi(t1, n.25)", "s.12 = phi(t3, s.26)"])
+        self.assertEqual(header[-1], "branch i.7 < n.8 ? do_5 : od_6")
+
+    def test_phis_at_join(self):
+        ir = ssa.build(program(LOOP))
+        self.assertIn("s.26 = phi(t15, t20)", lines(ir, "fi_21"))
+
+    def test_undefined_is_zero(self):
+        ir = ssa.build(program("print x;"))
+        self.assertEqual(lines(ir, "entry"), ["t1 = 0", "print t1", "halt"])
+
+    def test_run(self):
+        for source, rows in PROGRAMS:
+            ir = ssa.build(program(source))
+            for row in rows:
+                self.assertEqual(ssa.run(ir, row), interpret(program(source), row)[1], source)
+
+
+class Test_Passes(unittest.TestCase):
+
+    def test_copy_propagation(self):
+        """n is the same on every path, so needs no phi"""
+        ir = ssa.build(program(LOOP))
+        ssa.copy_propagate(ir)
+        self.assertFalse([op for op in ir.ops() if op.opcode == "phi" and op.dest.startswith("n.")])
+        self.assertIn("branch i.7 < t1 ? do_5 : od_6", lines(ir, "while_4"))
+
+    def test_value_numbering(self):
+        ir = ssa.build(program("a = read; b = (a + 1) * (1 + a); print b;"))
+        self.assertEqual(ssa.value_number(ir), 2)
+        ssa.dead_code(ir)
+        self.assertEqual(lines(ir, "entry"), ["t1 = read", "t2 = 1", "t3 = add t1 t2",
+                                              "t6 = mul t3 t3", "print t6", "halt"])
+
+    def test_dominating_only(self):
+        """Values computed in the two arms of an if are not shared"""
+        source = "a = read; if a > 0 then print a * 3; else print a * 3; fi"
+        ir = ssa.optimize(ssa.build(program(source)))
+        self.assertEqual(len([op for op in ir.ops() if op.opcode == "mul"]), 2)
+
+    def test_optimized_run(self):
+        for source, rows in PROGRAMS:
+            ir = ssa.optimize(ssa.build(program(source)))
+            for row in rows:
+                self.assertEqual(ssa.run(ir, row), interpret(program(source), row)[1], source)
+
+
+class Test_Out_Of_SSA(unittest.TestCase):
+
+    def test_no_phis(self):
+        for source, rows in PROGRAMS:
+            ir = ssa.out_of_ssa(ssa.optimize(ssa.build(program(source))))
+            self.assertFalse([op for op in ir.ops() if op.opcode == "phi"])
+            for row in rows:
+                self.assertEqual(ssa.run(ir, row), interpret(program(source), row)[1], source)
+
+    def test_coalesced(self):
+        """i = i + 1 needs no copy on the back edge"""
+        ir = ssa.out_of_ssa(ssa.optimize(ssa.build(program(LOOP))))
+        self.assertIn("i.7 = add i.7 t23", lines(ir, "fi_21"))
+        self.assertGreater(ir.stats["copies coalesced"], 0)
+
+    def test_swap(self):
+        """The swap's phis copy each other:  a cycle needs a temporary"""
+        ir = ssa.out_of_ssa(ssa.optimize(ssa.build(program(SWAP))))
+        copies = [op for op in ir.ops() if op.opcode == "copy"]
+        self.assertGreaterEqual(len(copies), 3)
+        self.assertEqual(ssa.run(ir, [1, 2, 3]), [2, 1])
+
+    def test_sequentialize(self):
+        names = iter(["tmp"])
+        self.assertEqual(ssa.sequentialize([("a", "b"), ("b", "a"), ("c", "a")], lambda: next(names)),
+                         [("c", "a"), ("tmp", "b"), ("b", "a"), ("a", "tmp")])
+
+
+class Test_Lowering(unittest.TestCase):
+
+    def lowered(self, source: str) -> Context:
+        context = Context()
+        compile.generate(program(source), context, use_ssa=True)
+        return context
+
+    def test_assembles(self):
+        for source, _ in PROGRAMS:
+            code = self.lowered(source).get_lines()
+            self.assertTrue(assembler_phase2.assemble(assembler_phase1.transform(code)))
+
+    def test_registers(self):
+        code = [line.split("#")[0].split() for line in self.lowered(LOOP).get_lines()]
+        self.assertFalse([line for line in code if line and line[0] in ["LOAD", "STORE"]
+                          and "[51" not in line[1]])
+        self.assertIn(["HALT", "r0,r0,r0"], code)
+
+    def test_spilled(self):
+        """Values for which there are too few registers live in memory"""
+        names = [f"v_{'x' * i}" for i in range(16)]
+        source = "".join(f"{name} = read;\n" for name in names)
+        source += "".join(f"print {name};\n" for name in names)
+        context = self.lowered(source)
+        code = context.get_lines()
+        self.assertTrue([line for line in code if line.strip().startswith("STORE") and "var_t" in line])
+        self.assertTrue(assembler_phase2.assemble(assembler_phase1.transform(code)))
+
+    def test_lower_needs_copies(self):
+        with self.assertRaises(ValueError):
+            ssa.lower(ssa.build(program(LOOP)), Context())
+
+
+if __name__ == "__main__":
+    unittest.main()
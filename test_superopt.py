@@ -0,0 +1,107 @@
+"""Test the superoptimizer and loading the rules it writes"""
+
+import io
+import unittest
+
+import peephole
+import superopt
+from codegen_context import parse_instr
+from instr_format import CondFlag, Instruction, OpCode
+from test_codegen import crush
+
+
+def words(*instrs: tuple) -> tuple:
+    """Words of (op, target, src1, src2, offset) instructions"""
+    return tuple(Instruction(op, CondFlag.ALWAYS, *fields).encode() for op, *fields in instrs)
+
+
+def optimized(text: str, rules: list) -> list:
+    instrs = [parse_instr(line) for line in text.strip().split("\n")]
+    instrs, opt = peephole.optimize(instrs, rules)
+    return crush([instr.render() for instr in instrs])
+
+
+class Test_Search(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rules = superopt.search(2, opcodes=[OpCode.ADD, OpCode.SUB], offsets=[0, 1])
+        cls.rules = {" ".join(str(rule).split()) for rule in rules}
+
+    def test_execute(self):
+        self.assertEqual(superopt.execute(words((OpCode.DIV, 1, 1, 0, 0)), (7, 3)), ((0, 3), CondFlag.V))
+        self.assertEqual(superopt.execute(words((OpCode.SUB, 0, 1, 2, 0)), (7, 3)), ((7, 3), CondFlag.P))
+
+    def test_found(self):
+        self.assertIn("SUB r1,r0,r1; SUB r1,r0,r1 => (nothing) if cc dead", self.rules)
+        self.assertIn("ADD r2,r0,r1; ADD r2,r2,r2 => ADD r2,r1,r1", self.rules)
+
+    def test_no_waste(self):
+        """Patterns for peephole's own rules, and renamings, are left out"""
+        self.assertNotIn("ADD r1,r0,r0; ADD r1,r0,r2 => ADD r1,r0,r2", self.rules)
+        self.assertFalse(any(rule.startswith("SUB r2,r0,r2") for rule in self.rules))
+
+    def test_verify(self):
+        wrong = superopt.Rule(words((OpCode.ADD, 1, 1, 0, 1)), (), True)
+        self.assertFalse(superopt.verify(wrong, superopt.test_states(50)))
+        # Multiplying by r0 leaves 0, but with condition code Z or V
+        right = superopt.Rule(words((OpCode.MUL, 1, 1, 0, 0)), words((OpCode.ADD, 1, 0, 0, 0)), True)
+        self.assertTrue(superopt.verify(right, superopt.test_states(500)))
+
+
+class Test_Load(unittest.TestCase):
+
+    TABLE = """
+        # A comment
+        SUB  r1,r0,r1; SUB  r1,r0,r1  =>  (nothing)  if cc dead
+        ADD  r2,r0,r1; ADD  r2,r2,r2  =>  ADD  r2,r1,r1
+        """
+
+    def rules(self) -> list:
+        return peephole.RULES + peephole.load_rules(io.StringIO(self.TABLE))
+
+    def test_round_trip(self):
+        rule = superopt.Rule(words((OpCode.ADD, 2, 0, 1, 0), (OpCode.ADD, 2, 2, 2, 0)),
+                             words((OpCode.ADD, 2, 1, 1, 0)), False)
+        text = io.StringIO()
+        superopt.write_rules([rule], text)
+        text.seek(0)
+        loaded = peephole.load_rules(text)
+        self.assertEqual([r.name for r in loaded], ["table_2"])
+        self.assertEqual(optimized("ADD r9,r0,r4\nADD r9,r9,r9", loaded), ["ADD r9,r4,r4"])
+
+    def test_registers_bound(self):
+        code = optimized("""
+            ADD r7,r0,r3   # double
+            ADD r7,r7,r7
+            SUB r5,r0,r5
+            SUB r5,r0,r5
+            STORE r7,var_x
+            """, self.rules())
+        self.assertEqual(code, ["ADD r7,r3,r3 # double", "STORE r7,var_x"])
+        code = optimized("""
+            ADD r7,r0,r3
+            ADD r7,r7,r3
+            """, self.rules())
+        self.assertEqual(len(code), 2)
+
+    def test_condition_code_live(self):
+        code = optimized("""
+            SUB r5,r0,r5
+            SUB r5,r0,r5
+            JUMP/Z there
+            HALT r0,r0,r0
+        there:
+            HALT r0,r0,r0
+            """, self.rules())
+        self.assertEqual(code[:2], ["SUB r5,r0,r5", "SUB r5,r0,r5"])
+
+    def test_errors(self):
+        for table in ["ADD r1,r0,r1", "LOAD r1,var_x => (nothing)", "ADD r3,r0,r1 => (nothing)",
+                      "ADD r1,r0,r1 => ADD r1,r0,r1; ADD r1,r0,r1"]:
+            with self.assertRaises(peephole.RuleError, msg=table):
+                peephole.load_rules(io.StringIO(table))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+"""Test tiered execution:  hot While loops should be
+compiled and should give the same results as the
+tree-walking interpreter.
+"""
+
+import unittest
+from unittest import mock
+
+import expr
+from expr import *
+
+
+def factorial(n: int) -> Expr:
+    """x = n; fact = 1; while x > 1 do fact = fact * x; x = x - 1; od"""
+    return Seq(Seq(Assign(Var("x"), IntConst(n)),
+                   Assign(Var("fact"), IntConst(1))),
+               While(GT(Var("x"), IntConst(1)),
+                     Seq(Assign(Var("fact"), Times(Var("fact"), Var("x"))),
+                         Assign(Var("x"), Minus(Var("x"), IntConst(1))))))
+
+
+def run(program: Expr, threshold) -> dict:
+    """Evaluate program from a clean environment, returning
+    the final variable values.
+    """
+    saved = expr.HOT_LOOP_THRESHOLD
+    expr.HOT_LOOP_THRESHOLD = threshold
+    try:
+        env_clear()
+        program.eval()
+        return {name: val.value for name, val in expr.ENV.items()}
+    finally:
+        expr.HOT_LOOP_THRESHOLD = saved
+
+
+class Test_Tiering(unittest.TestCase):
+
+    def test_hot_loop_promoted(self):
+        program = factorial(30)
+        loop = program.right
+        self.assertEqual(run(program, 5), run(factorial(30), None))
+        self.assertIsNotNone(loop.fast_path)
+        self.assertEqual(loop.iterations, 5)
+
+    def test_short_loop_stays_interpreted(self):
+        program = factorial(4)
+        loop = program.right
+        run(program, 5)
+        self.assertIsNone(loop.fast_path)
+        self.assertEqual(loop.iterations, 3)
+
+    def test_loop_value(self):
+        """The value of a loop is the value of the last
+        statement executed, on either tier.
+        """
+        loop = While(LT(Var("i"), IntConst(10)),
+                     Assign(Var("i"), Plus(Var("i"), IntConst(1))))
+        for threshold in [None, 1, 3]:
+            env_clear()
+            Assign(Var("i"), IntConst(0)).eval()
+            saved = expr.HOT_LOOP_THRESHOLD
+            expr.HOT_LOOP_THRESHOLD = threshold
+            try:
+                self.assertEqual(loop.eval(), IntConst(10))
+            finally:
+                expr.HOT_LOOP_THRESHOLD = saved
+
+    def test_nested_if_and_loops(self):
+        """Count multiples of 3 below 50 with an inner loop"""
+        program = Seq(Seq(Assign(Var("n"), IntConst(0)),
+                          Assign(Var("count"), IntConst(0))),
+                      While(LT(Var("n"), IntConst(50)),
+                            Seq(Seq(Assign(Var("m"), Var("n")),
+                                    While(GE(Var("m"), IntConst(3)),
+                                          Assign(Var("m"), Minus(Var("m"), IntConst(3))))),
+                                Seq(If(EQ(Var("m"), IntConst(0)),
+                                       Assign(Var("count"), Plus(Var("count"), IntConst(1)))),
+                                    Assign(Var("n"), Plus(Var("n"), IntConst(1)))))))
+        self.assertEqual(run(program, 2), run(program, None))
+        self.assertEqual(run(program, 2)["count"], 17)
+
+    def test_read_and_print(self):
+        """Input and output happen in the same order on the fast path"""
+        program = Seq(Assign(Var("total"), IntConst(0)),
+                      Seq(Assign(Var("v"), Read()),
+                          While(NE(Var("v"), IntConst(0)),
+                                Seq(Assign(Var("total"), Plus(Var("total"), Var("v"))),
+                                    Seq(Print(Var("total")),
+                                        Assign(Var("v"), Read()))))))
+        for threshold in [None, 2]:
+            with mock.patch("builtins.input", side_effect=["3", "4", "5", "6", "0"]), \
+                    mock.patch("builtins.print") as printed:
+                env = run(program, threshold)
+            self.assertEqual(env["total"], 18)
+            self.assertEqual([call.args[0] for call in printed.call_args_list],
+                             ["Quack!: 3", "Quack!: 7", "Quack!: 12", "Quack!: 18"])
+
+    def test_undefined_variable(self):
+        """A variable first read in the fast path must still be checked"""
+        program = Seq(Assign(Var("i"), IntConst(0)),
+                      While(LT(Var("i"), IntConst(10)),
+                            Seq(Assign(Var("i"), Plus(Var("i"), IntConst(1))),
+                                If(EQ(Var("i"), IntConst(8)),
+                                   Assign(Var("j"), Var("never_set"))))))
+        with self.assertRaises(UndefinedVariable):
+            run(program, 3)
+        self.assertEqual(expr.ENV["i"].value, 8)
+
+    def test_deoptimize_after_env_clear(self):
+        """A fast path that assumed 'x' was defined must not be
+        used in a run where 'x' is undefined.
+        """
+        loop = While(LT(Var("i"), IntConst(10)),
+                     Seq(Assign(Var("i"), Plus(Var("i"), IntConst(1))),
+                         Assign(Var("y"), Var("x"))))
+        program = Seq(Assign(Var("i"), IntConst(0)),
+                      Seq(Assign(Var("x"), IntConst(5)), loop))
+        self.assertEqual(run(program, 2)["y"], 5)
+        self.assertIsNotNone(loop.fast_path)
+        with self.assertRaises(UndefinedVariable):
+            run(Seq(Assign(Var("i"), IntConst(0)), loop), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
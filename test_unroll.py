@@ -0,0 +1,177 @@
+"""Test unrolling counting loops"""
+
+import io
+import os
+import sys
+import unittest
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler_2019-master"))
+from llparse import parse
+
+import arith
+import build
+import expr
+import machine
+import unroll
+from test_lockstep import interpret
+
+COUNT10 = "i = 0; while i < 10 do print i; i = i + 1; od"
+
+SUM = """
+n = read;
+if n < 0 then
+    n = 0;
+fi
+i = 0;
+s = 0;
+while i < n do
+    s = s + i;
+    i = i + 1;
+od
+print s;
+"""
+
+
+def program(source: str):
+    return parse(io.StringIO(source))
+
+
+def unrolled(source: str, **options) -> (expr.Expr, Counter):
+    stats = Counter()
+    return unroll.unroll(program(source), stats=stats, **options), stats
+
+
+def loops(node: expr.Expr) -> list:
+    """The while loops in node, outermost first"""
+    found = []
+    if isinstance(node, expr.While):
+        found.append(node)
+    for part in ["left", "right", "expr", "thenpart", "elsepart"]:
+        child = getattr(node, part, None)
+        if isinstance(child, expr.Expr):
+            found += loops(child)
+    return found
+
+
+class Test_Induction(unittest.TestCase):
+
+    def induction(self, source: str):
+        return unroll.induction(loops(program(source))[0])
+
+    def test_counting_up(self):
+        ind = self.induction(SUM)
+        self.assertEqual((ind.var.name, ind.step, str(ind.bound), ind.on_left), ("i", 1, "n", True))
+
+    def test_counting_down(self):
+        ind = self.induction("n = read; while 0 < n do n = n - 2; od")
+        self.assertEqual((ind.var.name, ind.step, ind.on_left), ("n", -2, False))
+
+    def test_not_counted(self):
+        for source in ["n = read; while n > 0 do n = n + 1; od",                  # wrong way
+                       "n = read; while i < n do i = i + 1; n = n - 1; od",       # bound changes
+                       "n = read; while i < n do i = i + 1; i = i + 1; od",       # two steps
+                       "n = read; while i < n do if i > 2 then i = i + 1; fi od",  # step in an if
+                       "n = read; while i != n do i = i + 1; od",                 # may pass n
+                       "n = read; while i < read do i = i + 1; od"]:              # bound reads
+            self.assertIsNone(self.induction(source), source)
+
+
+class Test_Unroll(unittest.TestCase):
+
+    def test_full(self):
+        tree, stats = unrolled(COUNT10)
+        self.assertEqual(loops(tree), [])
+        self.assertEqual(stats, Counter({"loops fully unrolled": 1}))
+        self.assertEqual(interpret(tree, [])[1], list(range(10)))
+
+    def test_too_many_trips(self):
+        tree, stats = unrolled(COUNT10, max_trips=9)
+        self.assertEqual(stats, Counter({"loops unrolled by 4": 1}))
+
+    def test_partial(self):
+        tree, stats = unrolled(SUM, factor=3)
+        main, rest = loops(tree)
+        self.assertEqual(str(main.cond), "i < (n + -2)")
+        self.assertEqual(len(unroll.statements(main.expr)), 6)
+        for n in range(8):
+            self.assertEqual(interpret(tree, [n])[1], interpret(program(SUM), [n])[1])
+
+    def test_counting_down(self):
+        source = "n = read; while n > 0 do print n; n = n - 3; od"
+        tree, stats = unrolled(source)
+        self.assertEqual(str(loops(tree)[0].cond), "n > 9")
+        for n in [-1, 0, 1, 5, 12, 13, 20]:
+            self.assertEqual(interpret(tree, [n])[1], interpret(program(source), [n])[1])
+
+    def test_nested(self):
+        source = "i = 0; while i < 3 do j = read; while j > 0 do print j; j = j - 1; od i = i + 1; od"
+        tree, stats = unrolled(source)
+        self.assertEqual(stats, Counter({"loops fully unrolled": 1, "loops unrolled by 4": 1}))
+        rows = [6, 0, 9]
+        self.assertEqual(interpret(tree, rows)[1], interpret(program(source), rows)[1])
+
+    def test_budget(self):
+        size = unroll.program_size(program(SUM))
+        # Two copies of the body (8 words each), and the test
+        grown = size + 2 * 8 + 5
+        tree, stats = unrolled(SUM, budget=grown - 1)
+        self.assertEqual(stats, Counter({"loops over budget": 1}))
+        tree, stats = unrolled(SUM, budget=grown)
+        self.assertEqual(stats, Counter({"loops unrolled by 2": 1}))
+
+    def test_costly_body(self):
+        """A test and jump that cost little next to the body"""
+        source = "n = read; i = 0; while i < n do\n" + "s = s + i / 7;\n" * 30 + "i = i + 1; od"
+        tree, stats = unrolled(source)
+        self.assertEqual(stats, Counter({"loops left rolled by cost": 1}))
+
+    def test_undefined_start(self):
+        """A loop variable never assigned has no known start"""
+        tree, stats = unrolled("while i < 3 do i = i + 1; od")
+        self.assertEqual(stats, Counter({"loops unrolled by 4": 1}))
+
+    def test_near_word_limit(self):
+        """The bound checking trips ahead must not wrap around"""
+        expr.ARITH = arith.Int32()
+        try:
+            source = "i = read; while i < 2147483647 do print i; i = i + 1; od"
+            tree, stats = unrolled(source)
+            self.assertEqual(str(loops(tree)[0].cond), "i < 2147483644")
+            for i in [2147483640, 2147483644, 2147483645]:
+                self.assertEqual(interpret(tree, [i])[1], interpret(program(source), [i])[1])
+            # With a bound near the bottom of a word, only two at a time fit
+            source = "i = read; while i < -2147483647 do print i; i = i + 1; od"
+            tree, stats = unrolled(source)
+            self.assertEqual(stats, Counter({"loops unrolled by 2": 1}))
+            self.assertEqual(interpret(tree, [-2147483648])[1], [-2147483648])
+            # i + 3 wraps around to less than n, n - 3 to more than i
+            source = "i = read; n = read; while i < n do print i; i = i + 1; od"
+            tree, stats = unrolled(source)
+            self.assertEqual(stats, Counter({"loops left rolled by range": 1}))
+        finally:
+            expr.ARITH = arith.BigInt()
+
+
+class Test_Build(unittest.TestCase):
+
+    def test_in_reach(self):
+        """A long loop body is not unrolled past the reach of the offset field"""
+        source = "n = read; if n < 0 then n = 0; fi i = 0; while i < n do\n" + "s = s + i * 3;\n" * 20 + "i = i + 1; od print s;"
+        result = build.build(io.StringIO(source), optimize=True)
+        self.assertEqual(result.context.unroll_stats, Counter({"loops unrolled by 2": 1}))
+        self.assertLessEqual(len(result.words), 511)
+
+    def test_near_word_limit(self):
+        source = "i = read; while i < 2147483647 do print i; i = i + 1; od"
+        words = build.build(io.StringIO(source), optimize=True).words
+        for i in [2147483640, 2147483645, 2147483647]:
+            self.assertEqual(machine.run(words, [i]).outputs, list(range(i, 2147483647)))
+
+    def test_count10(self):
+        result = build.build(io.StringIO(COUNT10), optimize=True)
+        self.assertNotIn("JUMP", [instr.opcode for instr in result.context.instrs])
+
+
+if __name__ == "__main__":
+    unittest.main()
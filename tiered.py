@@ -0,0 +1,255 @@
+"""
+Tiered execution for the Mallard interpreter.
+
+The tree-walking interpreter (Expr.eval) is cheap to start but
+slow in loops:  every iteration walks the same nodes again.
+While.eval counts its iterations, and once a loop is "hot" it
+asks this module to compile the loop into a Python function.
+The rest of the iterations run in that function, with Mallard
+variables held in Python local variables instead of ENV.
+
+The compiled function is generated as Python source text and
+passed to exec.  For example,
+
+    while x > 1 do
+        fact = fact * x;
+        x = x - 1;
+    od
+
+becomes roughly
+
+    def hot_loop(env, last):
+        v_fact = env["fact"].value
+        v_x = env["x"].value
+        try:
+            while v_x > 1:
+                v_fact = v_fact * v_x
+                v_x = v_x - 1
+                last = v_x
+        finally:
+            env["fact"] = IntConst(v_fact)
+            env["x"] = IntConst(v_x)
+        return last
+
+The function is specialized for the integer semantics in effect
+(expr.ARITH).  With 32-bit arithmetic, each result is range-checked
+inline and only out-of-range values go through ARITH.fit, which
+wraps them and records the overflow.
+
+Variables that were already in ENV when the loop was compiled
+are read without checks.  The compiled function records them in
+its 'assumes' attribute; if a later run of the loop finds one
+of them missing (e.g., after env_clear), While.eval drops the
+fast path and goes back to eval.
+"""
+
+import expr
+import arith
+import operator
+
+from typing import Callable, List, Optional, Set
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class NotCompilable(Exception):
+    """Raised when a loop contains a construct that
+    the fast path does not handle.  The loop just
+    keeps running in the tree-walking interpreter.
+    """
+    pass
+
+
+# Marks a variable that has not been assigned yet
+_UNDEF = None
+
+# Comparison operators that mean the same thing in Python
+PY_RELATIONS = {"==": "==", "!=": "!=", ">": ">", ">=": ">=",
+                "<": "<", "<=": "<="}
+
+
+def _undefined(name: str):
+    raise expr.UndefinedVariable(f"{name} has not been assigned a value")
+
+
+def _local(name: str) -> str:
+    """Python name for a Mallard variable.  The prefix keeps
+    Mallard names from colliding with Python keywords and with
+    the names the generated code uses for itself.
+    """
+    return f"v_{name}"
+
+
+class LoopCompiler(object):
+    """Translates one While node (and everything nested in it)
+    into the source text of a Python function.
+    """
+
+    def __init__(self, loop: expr.While, defined: Set[str], semantics: arith.BigInt):
+        self.loop = loop
+        self.arith = semantics
+        self.fixed = isinstance(semantics, arith.Int32)
+        # Variables known to be in ENV at entry to the fast path
+        self.defined = defined
+        # Every variable the loop mentions, and those it assigns
+        self.used = set()
+        self.assigned = set()
+
+    def compile(self) -> Callable[[dict, expr.IntConst], expr.IntConst]:
+        # We enter at an iteration boundary, so the loop test comes
+        # first; 'last' keeps the value passed in until the body runs.
+        body = [f"        while {self._cond(self.loop.cond)}:"]
+        self._stmt(self.loop.expr, 3, body, tail=True)
+        src = ["def hot_loop(env, last_in):",
+               "    last = None"]
+        for name in sorted(self.used):
+            if name in self.defined:
+                src.append(f"    {_local(name)} = env[{name!r}].value")
+            else:
+                src.append(f"    {_local(name)} = env[{name!r}].value if {name!r} in env else _UNDEF")
+        src.append("    try:")
+        src.extend(body)
+        src.append("    finally:")
+        if not self.assigned:
+            src.append("        pass")
+        for name in sorted(self.assigned):
+            if name in self.defined:
+                src.append(f"        env[{name!r}] = IntConst({_local(name)})")
+            else:
+                src.append(f"        if {_local(name)} is not _UNDEF:")
+                src.append(f"            env[{name!r}] = IntConst({_local(name)})")
+        src.append("    return last_in if last is None else IntConst(last)")
+        text = "\n".join(src)
+        log.debug(f"Compiled hot loop:\n{text}")
+        namespace = {"IntConst": expr.IntConst, "_UNDEF": _UNDEF,
+                     "_undefined": _undefined, "_arith": self.arith,
+                     "_div": operator.floordiv}
+        exec(compile(text, "<hot loop>", "exec"), namespace)
+        fast_path = namespace["hot_loop"]
+        fast_path.assumes = frozenset(self.used & self.defined)
+        fast_path.arith = self.arith
+        fast_path.source = text
+        return fast_path
+
+    # Statements
+
+    def _stmt(self, node: expr.Expr, depth: int, out: List[str], tail: bool):
+        """Emit Python statements for node at indentation depth.
+        If tail is true, the value of node is the value of the
+        enclosing loop body, so it is saved in 'last'.
+        """
+        pad = "    " * depth
+        if isinstance(node, expr.Seq):
+            self._stmt(node.left, depth, out, tail=False)
+            self._stmt(node.right, depth, out, tail=tail)
+        elif isinstance(node, expr.Assign):
+            name = node.left.name
+            value = self._expr(node.right)
+            self.used.add(name)
+            self.assigned.add(name)
+            out.append(f"{pad}{_local(name)} = {value}")
+            if tail:
+                out.append(f"{pad}last = {_local(name)}")
+        elif isinstance(node, expr.Print):
+            value = self._expr(node.expr)
+            out.append(f"{pad}_p = {value}")
+            out.append(f'{pad}print(f"Quack!: {{_p}}")')
+            if tail:
+                out.append(f"{pad}last = _p")
+        elif isinstance(node, expr.If):
+            out.append(f"{pad}if {self._cond(node.cond)}:")
+            self._stmt(node.thenpart, depth + 1, out, tail=tail)
+            out.append(f"{pad}else:")
+            self._stmt(node.elsepart, depth + 1, out, tail=tail)
+        elif isinstance(node, expr.While):
+            # The value of a loop that never runs its body is NO_VALUE
+            if tail:
+                out.append(f"{pad}last = {expr.NO_VALUE.value}")
+            out.append(f"{pad}while {self._cond(node.cond)}:")
+            self._stmt(node.expr, depth + 1, out, tail=tail)
+        elif isinstance(node, expr.Pass):
+            if tail:
+                out.append(f"{pad}last = {expr.NO_VALUE.value}")
+            else:
+                out.append(f"{pad}pass")
+        elif isinstance(node, expr.Control) and not isinstance(node, expr.Comparison):
+            raise NotCompilable(f"No fast path for {node.__class__.__name__}")
+        else:
+            # An expression used as a statement
+            value = self._expr(node)
+            if tail:
+                out.append(f"{pad}last = {value}")
+            else:
+                out.append(f"{pad}{value}")
+
+    # Expressions
+
+    def _cond(self, node: expr.Expr) -> str:
+        """Python condition that is true when node.eval() is non-zero"""
+        if isinstance(node, expr.Comparison) and node.opsym in PY_RELATIONS:
+            if self.fixed and not node.in_range:
+                # Compare the 32-bit difference, as the machine does;
+                # one that overflows compares false (arith.Int32.relation)
+                diff = (f"(_t if {arith.WORD_MIN} <= (_t := {self._expr(node.left)} - "
+                        f"{self._expr(node.right)}) <= {arith.WORD_MAX} else _arith.relation(_t, 0)[0])")
+                return f"{diff} {PY_RELATIONS[node.opsym]} 0"
+            return f"{self._expr(node.left)} {PY_RELATIONS[node.opsym]} {self._expr(node.right)}"
+        return f"{self._expr(node)} != 0"
+
+    def _expr(self, node: expr.Expr) -> str:
+        """Python expression with the same integer value as node.eval()"""
+        if isinstance(node, expr.IntConst):
+            return f"({node.value})"
+        if isinstance(node, expr.Var):
+            self.used.add(node.name)
+            if node.name in self.defined:
+                return _local(node.name)
+            return f"({_local(node.name)} if {_local(node.name)} is not _UNDEF else _undefined({node.name!r}))"
+        if isinstance(node, expr.Read):
+            return 'int(input("Quack! Gimme an int! "))' if not self.fixed else \
+                '_arith.fit(int(input("Quack! Gimme an int! ")))'
+        if isinstance(node, expr.Comparison):
+            return f"(1 if {self._cond(node)} else 0)"
+        if isinstance(node, expr.Div) and self.fixed and not node.in_range:
+            # Division by zero sets V rather than raising
+            return f"_arith.binop(_div, {self._expr(node.left)}, {self._expr(node.right)})"
+        if isinstance(node, expr.Plus):
+            return self._fit(f"{self._expr(node.left)} + {self._expr(node.right)}", node)
+        if isinstance(node, expr.Minus):
+            return self._fit(f"{self._expr(node.left)} - {self._expr(node.right)}", node)
+        if isinstance(node, expr.Times):
+            return self._fit(f"{self._expr(node.left)} * {self._expr(node.right)}", node)
+        if isinstance(node, expr.Div):
+            return f"({self._expr(node.left)} // {self._expr(node.right)})"
+        if isinstance(node, expr.Neg):
+            return self._fit(f"0 - {self._expr(node.left)}", node)
+        if isinstance(node, expr.Abs):
+            return self._fit(f"abs({self._expr(node.left)})", node)
+        raise NotCompilable(f"No fast path for {node.__class__.__name__}")
+
+    def _fit(self, value: str, node: expr.Expr = None) -> str:
+        """Python expression for value as held in a register.
+        In 32-bit mode the common in-range case is checked inline,
+        unless range analysis showed that node is always in range.
+        """
+        if not self.fixed or (node is not None and node.in_range):
+            return f"({value})"
+        return f"(_t if {arith.WORD_MIN} <= (_t := {value}) <= {arith.WORD_MAX} else _arith.fit(_t))"
+
+
+def compile_loop(loop: expr.While) -> Optional[Callable]:
+    """Compile a hot While loop.  Returns a function
+    f(env, last) -> IntConst that runs the loop to completion
+    starting at an iteration boundary (i.e., it tests the
+    condition first), or None if the loop can't be compiled.
+    """
+    try:
+        fast_path = LoopCompiler(loop, set(expr.ENV.keys()), expr.ARITH).compile()
+        log.debug(f"Promoted hot loop {loop.cond}")
+        return fast_path
+    except NotCompilable as e:
+        log.debug(f"Loop stays in interpreter: {e}")
+        return None
@@ -0,0 +1,343 @@
+"""
+Unrolling while loops that count.
+
+A loop like
+
+    i = 0;
+    while i < n do
+        s = s + i;
+        i = i + 1;
+    od
+
+runs its compare and jump once for every iteration.  When the
+condition compares an induction variable (assigned exactly once
+in the body, by a top-level x = x + c or x = x - c) with a bound
+the body doesn't change, the iterations can be counted:
+
+ * With a small constant trip count (the value of x entering the
+   loop and the bound are constants, found by SCCP; see sccp.py),
+   the loop is fully unrolled:  it becomes that many copies of
+   its body, and the compares and jumps disappear.
+
+ * Otherwise it is partly unrolled by a factor k:  a loop whose
+   condition checks that k more iterations will all run (the
+   condition with b - (k-1)c in place of b) runs k copies of the
+   body at a time, and the original loop after it runs the rest:
+
+        while i < n - 3 do  s = s + i; i = i + 1;  (4 times)  od
+        while i < n do  s = s + i; i = i + 1;  od
+
+   x + (k-1)c could wrap around past the end of a word, and
+   b - (k-1)c too, and then the first loop would run trips the
+   original doesn't.  So a loop is partly unrolled only when the
+   ranges of b (see ranges.py) show b - (k-1)c always fits in a
+   word, by a smaller factor if a large one doesn't fit.
+
+Only loops whose steps move x toward the bound are unrolled
+(x < b with c > 0, x > b with c < 0); a loop that may never end
+is left alone.
+
+Unrolling makes the program bigger, and every data reference
+and jump in DM2019W code must reach its target through the
+10-bit offset field.  So the program is kept within a budget of
+estimated code and data words (by default MAX_REACH):  a loop
+that would go over it is unrolled by a smaller factor, or not
+at all.
+
+Unrolling saves only the compare and jump of the trips it
+folds together.  A loop whose test and jump take less than
+MIN_OVERHEAD_SHARE of the cycles of a trip (by the cost model of
+costmodel.py) is left rolled:  it would grow by a whole body for
+each small saving.
+
+With a profile (see pgo.py), loops that never ran are left
+alone, and a loop is partly unrolled by no more than the trips
+it ran on average each time it was entered, so the budget isn't
+spent on copies that never run.
+"""
+
+import copy
+import functools
+from collections import Counter
+from typing import List, NamedTuple, Optional
+
+import arith
+import costmodel
+import expr
+import ranges
+import sccp
+import ssa
+from codegen_context import MAX_REACH
+
+import logging
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+UNROLL_FACTOR = 4
+FULL_UNROLL_TRIPS = 16
+MIN_OVERHEAD_SHARE = 0.02
+
+# The relation with the operands swapped
+MIRROR = {"<": expr.GT, "<=": expr.GE, ">": expr.LT, ">=": expr.LE}
+
+
+def statements(node: expr.Expr) -> List[expr.Expr]:
+    """The statements of a block, in order"""
+    if isinstance(node, expr.Seq):
+        return statements(node.left) + statements(node.right)
+    if isinstance(node, expr.Pass):
+        return []
+    return [node]
+
+
+def sequence(stmts: List[expr.Expr]) -> expr.Expr:
+    """A block of stmts, nested as the parser nests them"""
+    if not stmts:
+        return expr.Pass()
+    return functools.reduce(expr.Seq, stmts)
+
+
+def assigned(node: expr.Expr) -> set:
+    """Names of the variables assigned anywhere in node"""
+    if isinstance(node, expr.Assign):
+        return {node.left.name}
+    names = set()
+    for part in ["left", "right", "expr", "thenpart", "elsepart"]:
+        child = getattr(node, part, None)
+        if isinstance(child, expr.Expr):
+            names |= assigned(child)
+    return names
+
+
+def estimated_size(node: expr.Expr) -> int:
+    """About how many instructions the code for node takes"""
+    if isinstance(node, expr.Pass):
+        return 0
+    if isinstance(node, expr.Seq):
+        return estimated_size(node.left) + estimated_size(node.right)
+    if isinstance(node, expr.While):
+        return estimated_size(node.cond) + estimated_size(node.expr) + 2
+    if isinstance(node, expr.If):
+        return estimated_size(node.cond) + estimated_size(node.thenpart) \
+            + estimated_size(node.elsepart) + 2
+    size = 1
+    for part in ["left", "right", "expr"]:
+        child = getattr(node, part, None)
+        if isinstance(child, expr.Expr) and not (isinstance(node, expr.Assign) and part == "left"):
+            size += estimated_size(child)
+    return size
+
+
+def program_size(program: expr.Expr) -> int:
+    """Estimated words of code and data for program"""
+    return estimated_size(program) + len(expr.variables(program))
+
+
+class Induction(NamedTuple):
+    """x (a Var) stepping by step toward bound, where cond is
+    x relop bound, or bound relop x when x is on the right
+    """
+    var: expr.Var
+    step: int
+    bound: expr.Expr
+    on_left: bool
+
+
+def step_of(update: expr.Expr, name: str) -> Optional[int]:
+    """c for x = x + c, c + x, or (-c) x - c"""
+    right = update.right
+
+    def is_x(e: expr.Expr) -> bool:
+        return isinstance(e, expr.Var) and e.name == name
+
+    if isinstance(right, expr.Plus):
+        if is_x(right.left) and isinstance(right.right, expr.IntConst):
+            return right.right.value
+        if is_x(right.right) and isinstance(right.left, expr.IntConst):
+            return right.left.value
+    if isinstance(right, expr.Minus) and is_x(right.left) and isinstance(right.right, expr.IntConst):
+        return -right.right.value
+    return None
+
+
+def induction(loop: expr.While) -> Optional[Induction]:
+    """The induction variable of loop, if its trips can be counted"""
+    cond = loop.cond
+    if not isinstance(cond, expr.Comparison) or cond.opsym not in MIRROR:
+        return None
+    body = statements(loop.expr)
+    changed = assigned(loop.expr)
+    for var, bound, on_left in [(cond.left, cond.right, True), (cond.right, cond.left, False)]:
+        if not isinstance(var, expr.Var) or not expr.side_effect_free(bound):
+            continue
+        if expr.variables(bound) & changed:
+            continue
+        updates = [s for s in body if isinstance(s, expr.Assign) and s.left.name == var.name]
+        if len(updates) != 1 or any(var.name in assigned(s) for s in body if s is not updates[0]):
+            continue
+        step = step_of(updates[0], var.name)
+        if not step:
+            continue
+        relop = cond.opsym if on_left else MIRROR[cond.opsym](None, None).opsym
+        if (step > 0) != (relop in ["<", "<="]):
+            continue
+        return Induction(var, step, bound, on_left)
+    return None
+
+
+class Unroller(object):
+    """Unrolls the loops of one program"""
+
+    def __init__(self, program: expr.Expr, factor: int, max_trips: int, budget: int, stats: Counter):
+        self.factor = factor
+        self.max_trips = max_trips
+        self.budget = budget
+        self.stats = stats
+        self.size = program_size(program)
+        self.ir = ssa.build(program)
+        self.values = sccp.Propagation(self.ir, undefined_known=False).solve()
+        self.ranges = ranges.analyze(program)
+
+    def trips(self, loop: expr.While, ind: Induction) -> Optional[int]:
+        """How many times loop runs, if it is the same small
+        number every time it is entered
+        """
+        header = self.ir.branches.get(id(loop), (loop, None))[1]
+        if header is None or header not in self.values.executable:
+            return None
+        phis = [phi for phi in header.phis() if phi.dest.rsplit(".", 1)[0] == ind.var.name]
+        branch = header.terminator()
+        if not phis:
+            return None
+        start = self.values.constant(phis[0].args[0])
+        bound = self.values.constant(branch.args[1 if ind.on_left else 0])
+        if start is None or bound is None:
+            return None
+        relation = ssa.RELATIONS[loop.cond.opsym]
+        semantics = copy.copy(expr.ARITH)
+        x, count = start, 0
+        semantics.v = False
+        while True:
+            operands = (x, bound) if ind.on_left else (bound, x)
+            if not relation._apply(*semantics.relation(*operands)):
+                return count
+            count += 1
+            if count > self.max_trips:
+                return None
+            try:
+                x = semantics.binop(lambda a, b: a + b, x, ind.step)
+            except arith.ArithmeticOverflow:
+                return None
+            if semantics.v or not arith.WORD_MIN <= x <= arith.WORD_MAX:
+                return None
+
+    def ahead(self, ind: Induction, factor: int) -> Optional[expr.Expr]:
+        """The bound checking that factor more trips will all run,
+        if it always fits in a word
+        """
+        distance = (factor - 1) * ind.step
+        interval = self.ranges.interval(ind.bound)
+        if interval is None or not (arith.WORD_MIN <= interval.lo - distance
+                                    and interval.hi - distance <= arith.WORD_MAX):
+            return None
+        if interval.constant() is not None:
+            return expr.IntConst(interval.constant() - distance)
+        return expr.Plus(copy.deepcopy(ind.bound), expr.IntConst(-distance))
+
+    def pays(self, loop: expr.While) -> bool:
+        """Do the test and jump of loop take enough of the cycles
+        of a trip for unrolling to pay?
+        """
+        overhead = costmodel.node_cycles(expr.While(loop.cond, expr.Pass()))
+        return overhead >= MIN_OVERHEAD_SHARE * (overhead + costmodel.node_cycles(loop.expr))
+
+    def fits(self, growth: int) -> bool:
+        return self.size + growth <= self.budget
+
+    def stmt(self, node: expr.Expr) -> expr.Expr:
+        if isinstance(node, expr.Seq):
+            left, right = self.stmt(node.left), self.stmt(node.right)
+            return node if left is node.left and right is node.right else expr.Seq(left, right)
+        if isinstance(node, expr.If):
+            thenpart, elsepart = self.stmt(node.thenpart), self.stmt(node.elsepart)
+            if thenpart is node.thenpart and elsepart is node.elsepart:
+                return node
+            return expr.with_profile(node, expr.If(node.cond, thenpart, elsepart))
+        if isinstance(node, expr.While):
+            return self.loop(node)
+        return node
+
+    def loop(self, node: expr.While) -> expr.Expr:
+        # Counted on the original loop, before its body changes
+        ind = induction(node)
+        trips = self.trips(node, ind) if ind else None
+        body = self.stmt(node.expr)
+        if body is not node.expr:
+            node = expr.with_profile(node, expr.While(node.cond, body))
+        if ind is None:
+            return node
+        # Trips per entry, from the profile
+        average = None
+        if node.counts is not None:
+            entries, run = node.counts
+            if entries == 0:
+                self.stats["loops left rolled by profile"] += 1
+                return node
+            average = run // entries
+        body_size = estimated_size(body)
+        if trips is not None:
+            growth = trips * body_size - estimated_size(node)
+            if self.fits(growth):
+                self.size += growth
+                self.stats["loops fully unrolled"] += 1
+                return sequence([copy.deepcopy(s) for _ in range(trips) for s in statements(body)])
+        if self.factor < 2:
+            return node
+        factor = self.factor
+        while average is not None and factor > max(average, 1):
+            factor //= 2
+        if factor < 2:
+            self.stats["loops left rolled by profile"] += 1
+            return node
+        if not self.pays(node):
+            self.stats["loops left rolled by cost"] += 1
+            return node
+        while factor >= 2 and self.ahead(ind, factor) is None:
+            factor //= 2
+        if factor < 2:
+            self.stats["loops left rolled by range"] += 1
+            return node
+        while factor >= 2 and not self.fits(factor * body_size + estimated_size(node.cond) + 2):
+            factor //= 2
+        if factor < 2:
+            self.stats["loops over budget"] += 1
+            return node
+        self.size += factor * body_size + estimated_size(node.cond) + 2
+        self.stats[f"loops unrolled by {factor}"] += 1
+        ahead = self.ahead(ind, factor)
+        cond = node.cond
+        if ind.on_left:
+            cond = type(cond)(copy.deepcopy(cond.left), ahead)
+        else:
+            cond = type(cond)(ahead, copy.deepcopy(cond.right))
+        unrolled = sequence([copy.deepcopy(s) for _ in range(factor) for s in statements(body)])
+        ahead_loop = expr.with_profile(node, expr.While(cond, unrolled))
+        ahead_loop.steps = node.steps * factor
+        if average is not None:
+            # Estimates:  each entry runs the average trips
+            node = expr.with_profile(node, expr.While(node.cond, body))
+            ahead_loop.counts = (entries, entries * (average // factor))
+            node.counts = (entries, entries * (average % factor))
+        return expr.Seq(ahead_loop, node)
+
+
+def unroll(program: expr.Expr, factor: int = UNROLL_FACTOR, max_trips: int = FULL_UNROLL_TRIPS,
+           budget: int = MAX_REACH, stats: Counter = None) -> expr.Expr:
+    """program with its counting loops unrolled (fully, when they
+    run at most max_trips times, else by factor), staying within
+    budget words of code and data; what was done is counted in stats
+    """
+    if stats is None:
+        stats = Counter()
+    return Unroller(program, factor, max_trips, budget, stats).stmt(program)